@@ -1,25 +1,36 @@
 import asyncio
 import base64
+import bisect
+import hashlib
 import io
 import json
 import logging
-import mimetypes
+import math
 import os
+import random
 import re
 import subprocess
+import threading
+import time
 import uuid
-from datetime import datetime
-from typing import List, Tuple, Union, Optional, Dict
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable, List, Tuple, Union, Optional, Dict
 
 import cv2
 import numpy as np
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
+import pandas as pd
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Header
 from typing import List as TypingList
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from google import genai  # type: ignore[reportMissingImports]
+from google.genai import errors as genai_errors  # type: ignore[reportMissingImports]
 from google.genai import types  # type: ignore[reportMissingImports]
-from docx import Document  # type: ignore[reportMissingImports]
 
 # ----------------- Config -----------------
 
@@ -99,7 +110,21 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # ----------------- FastAPI App -----------------
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start the background job and supply-chain workers with the app and drain them on shutdown."""
+    job_manager.start()
+    erp_batcher.start()
+    await requeue_erp_updates()
+    supply_chain_pipeline.start()
+    yield
+    await supply_chain_pipeline.shutdown()
+    # After the pipeline has drained, so stage-5 updates are in the last batches
+    await erp_batcher.shutdown()
+    await job_manager.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Enable CORS for frontend
 # Get allowed origins from environment or use defaults
@@ -126,6 +151,10 @@ app.add_middleware(
 )
 
 # ----------------- Comparison Prompt Strategies -----------------
+# Default for /compare: ask the comparison prompt for finding bboxes too (no separate bbox request)
+GEMINI_COMPARE_SINGLE_PASS = os.getenv("GEMINI_COMPARE_SINGLE_PASS", "0").lower() in ("1", "true", "yes")
+# Default for /compare-vendor: one multi-file call (1 = extract each vendor concurrently and reduce locally)
+GEMINI_VENDOR_MAP_REDUCE = os.getenv("GEMINI_VENDOR_MAP_REDUCE", "0").lower() in ("1", "true", "yes")
 
 
 class ComparisonPromptStrategy:
@@ -338,1030 +367,3939 @@ class HornComparisonStrategy(ComparisonPromptStrategy):
         return self._PROMPT
 
 
-# ----------------- Gemini Client -----------------
-class GeminiClient:
-    """Wrapper around Gemini 2.5 Pro via Vertex AI SDK."""
+# ----------------- Image Preprocessing -----------------
+# Drawings are shrunk to a token budget before upload; boxes are mapped back to the original
+GEMINI_IMAGE_PREPROCESS = os.getenv("GEMINI_IMAGE_PREPROCESS", "1").lower() not in ("0", "false", "no")
+# Gemini bills large images per 768x768 tile (258 tokens each); the budget caps the tile count
+GEMINI_IMAGE_TOKEN_BUDGET = int(os.getenv("GEMINI_IMAGE_TOKEN_BUDGET", "4128"))
+GEMINI_IMAGE_GRAYSCALE = os.getenv("GEMINI_IMAGE_GRAYSCALE", "1").lower() not in ("0", "false", "no")
 
-    def __init__(self, project: str, region: str, model_name: str):
-        self.client = genai.Client(
-            vertexai=True,
-            project=project,
-            location=region,
-        )
-        self.model_name = model_name
+_IMAGE_TILE_PX = 768
+_IMAGE_TILE_TOKENS = 258
+# Pixels darker than this count as drawing content when cropping borders
+_IMAGE_BORDER_THRESHOLD = 240
 
-    def _create_file_part(self, file_bytes: bytes, mime_type: Optional[str]) -> types.Part:
-        file_type = "PDF" if mime_type == "application/pdf" else "image"
-        logger.info(f"Sending {file_type} to Gemini model {self.model_name}")
 
-        file_b64 = base64.b64encode(file_bytes).decode("utf-8")
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Approximate Gemini input tokens for an image of the given size."""
+    if width <= _IMAGE_TILE_PX // 2 and height <= _IMAGE_TILE_PX // 2:
+        return _IMAGE_TILE_TOKENS
+    return math.ceil(width / _IMAGE_TILE_PX) * math.ceil(height / _IMAGE_TILE_PX) * _IMAGE_TILE_TOKENS
 
-        return types.Part(
-            inline_data=types.Blob(
-                mime_type=mime_type or "application/octet-stream",
-                data=file_b64
-            )
-        )
 
-    def chat(self, file_bytes: bytes, mime_type: str, prompt: str) -> str:
-        """Send single file + prompt to Gemini and return text response."""
-        return self.chat_with_files(prompt, [(file_bytes, mime_type)])
+class ImageTransform:
+    """Maps pixel coordinates of a preprocessed image back onto the original upload."""
 
-    def chat_with_files(self, prompt: str, files: List[Tuple[Union[bytes, str], Optional[str]]]) -> str:
-        """Send multiple files + prompt to Gemini and return text response."""
-        contents: List[Union[str, types.Part]] = [prompt]
-        for data, mime in files:
-            if isinstance(data, bytes):
-                contents.append(self._create_file_part(data, mime))
-            else:
-                contents.append(str(data))
+    def __init__(
+        self,
+        original_size: Tuple[int, int],
+        crop_origin: Tuple[int, int],
+        scale: float,
+        size: Tuple[int, int],
+    ):
+        self.original_width, self.original_height = original_size
+        self.crop_x, self.crop_y = crop_origin
+        self.scale = scale
+        self.width, self.height = size
+
+    def to_original(self, x: float, y: float) -> Tuple[float, float]:
+        return self.crop_x + x / self.scale, self.crop_y + y / self.scale
+
+    def box_to_original(self, box: Tuple[float, float, float, float]) -> List[float]:
+        """Map an (x1, y1, x2, y2) pixel box to [0..1] coordinates of the original image."""
+        x1, y1 = self.to_original(box[0], box[1])
+        x2, y2 = self.to_original(box[2], box[3])
+        return [
+            min(1.0, max(0.0, x1 / self.original_width)),
+            min(1.0, max(0.0, y1 / self.original_height)),
+            min(1.0, max(0.0, x2 / self.original_width)),
+            min(1.0, max(0.0, y2 / self.original_height)),
+        ]
 
-        response = self.client.models.generate_content(
-            model=self.model_name,
-            contents=contents,
-            config={
-                "max_output_tokens": 16384,
-                "temperature": 0,  # Set to 0 for maximum determinism
-            },
+    def __repr__(self) -> str:
+        return (
+            f"ImageTransform({self.original_width}x{self.original_height} -> {self.width}x{self.height}, "
+            f"crop=({self.crop_x}, {self.crop_y}), scale={self.scale:.3f})"
         )
 
-        if hasattr(response, 'candidates') and response.candidates:
-            candidate = response.candidates[0]
-            if hasattr(candidate, 'finish_reason'):
-                if candidate.finish_reason == 'MAX_TOKENS':
-                    logger.warning("⚠ Response may have been truncated due to token limit")
-                logger.info(f"Finish reason: {candidate.finish_reason}")
 
-        return response.text
-
-
-# ----------------- Welding Inspector -----------------
-class WeldingInspector:
-    def __init__(self, client: GeminiClient):
-        self.client = client
-        self.word_mime_types = {
-            "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            "application/msword",
-        }
-        strategies: List[ComparisonPromptStrategy] = [
-            SparkPlugComparisonStrategy(),
-            BrakeDiscComparisonStrategy(),
-            HornComparisonStrategy(),
-        ]
-        self._comparison_strategies: Dict[str, ComparisonPromptStrategy] = {
-            strategy.part_key: strategy for strategy in strategies
-        }
-        self._comparison_alias_map: Dict[str, str] = {}
-        for strategy in strategies:
-            self._comparison_alias_map[strategy.part_key] = strategy.part_key
-            for alias in strategy.aliases:
-                self._comparison_alias_map[alias] = strategy.part_key
+def _content_bounds(gray: np.ndarray) -> Tuple[int, int, int, int]:
+    """Return (x, y, w, h) of the non-white content plus a small margin (whole image if blank)."""
+    height, width = gray.shape[:2]
+    _, mask = cv2.threshold(gray, _IMAGE_BORDER_THRESHOLD, 255, cv2.THRESH_BINARY_INV)
+    points = cv2.findNonZero(mask)
+    if points is None:
+        return 0, 0, width, height
+    x, y, w, h = cv2.boundingRect(points)
+    margin = max(8, int(0.01 * max(width, height)))
+    x0, y0 = max(0, x - margin), max(0, y - margin)
+    x1, y1 = min(width, x + w + margin), min(height, y + h + margin)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def _fit_token_budget(width: int, height: int, budget: int) -> float:
+    """Largest scale <= 1 at which the image fits the token budget."""
+    if estimate_image_tokens(width, height) <= budget:
+        return 1.0
+    tiles = max(1, budget // _IMAGE_TILE_TOKENS)
+    scale = min(1.0, math.sqrt(tiles * _IMAGE_TILE_PX * _IMAGE_TILE_PX / float(width * height)))
+    while scale > 0.05 and estimate_image_tokens(int(width * scale), int(height * scale)) > budget:
+        scale *= 0.95
+    return scale
+
+
+def preprocess_drawing_image(
+    data: bytes,
+    mime_type: str,
+    token_budget: int = GEMINI_IMAGE_TOKEN_BUDGET,
+    grayscale: bool = GEMINI_IMAGE_GRAYSCALE,
+) -> Tuple[bytes, str, Optional[ImageTransform]]:
+    """Grayscale, crop white borders, downscale to ``token_budget`` and re-encode an image.
+
+    Returns ``(bytes, mime_type, transform)``. Non-images, undecodable files and images
+    that would not get smaller are returned unchanged with ``transform=None``.
+    CPU-bound; call it via ``asyncio.to_thread`` from async code.
+    """
+    if not GEMINI_IMAGE_PREPROCESS or not (mime_type or "").startswith("image/"):
+        return data, mime_type, None
+
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+    if image is None:
+        logger.warning("[PREPROCESS] Unable to decode %s image; sending it unchanged", mime_type)
+        return data, mime_type, None
+
+    if image.ndim == 3 and image.shape[2] == 4:
+        # Composite transparency onto white so empty areas do not turn black
+        alpha = image[:, :, 3:4].astype(np.float32) / 255.0
+        image = (image[:, :, :3].astype(np.float32) * alpha + 255.0 * (1.0 - alpha)).astype(np.uint8)
+    if image.dtype != np.uint8:
+        image = cv2.convertScaleAbs(image, alpha=255.0 / max(1.0, float(image.max())))
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    original_height, original_width = gray.shape[:2]
+    x, y, w, h = _content_bounds(gray)
+    working = gray if grayscale else image
+    working = working[y:y + h, x:x + w]
+
+    scale = _fit_token_budget(w, h, token_budget)
+    if scale < 1.0:
+        size = (max(1, int(w * scale)), max(1, int(h * scale)))
+        working = cv2.resize(working, size, interpolation=cv2.INTER_AREA)
+    out_height, out_width = working.shape[:2]
+
+    # Keep photographic scans as JPEG; line art compresses best (and losslessly) as PNG
+    if mime_type in ("image/jpeg", "image/jpg"):
+        success, buffer = cv2.imencode(".jpg", working, [cv2.IMWRITE_JPEG_QUALITY, 90])
+        out_mime = "image/jpeg"
+    else:
+        success, buffer = cv2.imencode(".png", working)
+        out_mime = "image/png"
+    if not success:
+        logger.warning("[PREPROCESS] Failed to re-encode image; sending it unchanged")
+        return data, mime_type, None
+
+    original_tokens = estimate_image_tokens(original_width, original_height)
+    out_tokens = estimate_image_tokens(out_width, out_height)
+    if out_tokens >= original_tokens and len(buffer) >= len(data):
+        return data, mime_type, None
+
+    logger.info(
+        "[PREPROCESS] %dx%d %s (%d bytes, ~%d tokens) -> %dx%d %s (%d bytes, ~%d tokens)",
+        original_width, original_height, mime_type, len(data), original_tokens,
+        out_width, out_height, out_mime, len(buffer), out_tokens,
+    )
+    transform = ImageTransform(
+        (original_width, original_height),
+        (x, y),
+        # Per-axis scales differ by at most one pixel of rounding; use the width ratio
+        out_width / float(w),
+        (out_width, out_height),
+    )
+    return buffer.tobytes(), out_mime, transform
 
-    @staticmethod
-    def _extract_docx_text(file_bytes: bytes) -> str:
-        """Extract meaningful text (including tables) from a DOCX file."""
-        document = Document(io.BytesIO(file_bytes))
-        lines: List[str] = []
-
-        for paragraph in document.paragraphs:
-            text = paragraph.text.strip()
-            if text:
-                lines.append(text)
-
-        for table in document.tables:
-            for row in table.rows:
-                row_cells = [cell.text.strip() for cell in row.cells if cell.text.strip()]
-                if row_cells:
-                    lines.append(" | ".join(row_cells))
-
-        combined = "\n".join(lines).strip()
-        return combined if combined else "RFQ document (DOCX) contained no extractable text."
 
-    def _prepare_rfq_input(self, rfq_bytes: bytes, rfq_mime: str) -> Tuple[Union[bytes, str], Optional[str]]:
-        """Prepare RFQ input for Gemini, converting DOCX files to plain text."""
-        if rfq_mime == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-            try:
-                text_content = self._extract_docx_text(rfq_bytes)
-                logger.info("[COMPARE] Converted DOCX RFQ to plain text for Gemini input")
-                return text_content, None
-            except Exception as exc:
-                logger.error("[COMPARE] Failed to read DOCX RFQ", exc_info=True)
-                raise HTTPException(
-                    status_code=400,
-                    detail="Unable to read DOCX file. Please ensure the document is not corrupted."
-                ) from exc
-        if rfq_mime == "application/msword":
-            raise HTTPException(
-                status_code=400,
-                detail="Legacy .doc files are not supported. Please upload the RFQ as PDF or convert it to DOCX."
-            )
-        return rfq_bytes, rfq_mime
+# ----------------- PDF Page Splitting -----------------
+# Multi-page drawing sets are analyzed page by page, concurrently, and the weld lists merged
+GEMINI_PDF_FANOUT = os.getenv("GEMINI_PDF_FANOUT", "1").lower() not in ("0", "false", "no")
+GEMINI_PDF_PAGES_PER_REQUEST = int(os.getenv("GEMINI_PDF_PAGES_PER_REQUEST", "1"))
 
-    @staticmethod
-    def _strip_markdown_fence(text: str) -> str:
-        """Remove surrounding markdown fences (``` or ```json)."""
-        text = text.strip()
-        if text.startswith("```json"):
-            text = text[7:]
-        elif text.startswith("```"):
-            text = text[3:]
-        if text.endswith("```"):
-            text = text[:-3]
-        return text.strip()
 
-    @staticmethod
-    def _quote_unquoted_keys(text: str) -> str:
-        """Ensure object keys are wrapped in double quotes for valid JSON parsing."""
-        pattern = re.compile(r'(?m)^(?P<indent>\s*)(?P<key>[A-Za-z][A-Za-z0-9_\-\s]*?)\s*:(?=\s)')
+def split_pdf_pages(data: bytes, pages_per_chunk: int = 1) -> List[Tuple[bytes, List[int]]]:
+    """Split a PDF into standalone PDFs of ``pages_per_chunk`` pages each.
 
-        def replacer(match: re.Match) -> str:
-            indent = match.group("indent")
-            key = match.group("key").strip()
-            # Skip keys that are already quoted
-            if key.startswith('"') and key.endswith('"'):
-                return match.group(0)
-            return f'{indent}"{key}":'
+    Returns ``[(chunk_bytes, [page numbers, 1-based]), ...]``, or an empty list when the
+    PDF has a single page, cannot be parsed, or pypdf is not installed.
+    CPU-bound; call it via ``asyncio.to_thread`` from async code.
+    """
+    try:
+        from pypdf import PdfReader, PdfWriter  # type: ignore[reportMissingImports]
+    except ImportError:
+        logger.info("[PDF] pypdf not installed; sending PDFs as a single file")
+        return []
 
-        return pattern.sub(replacer, text)
+    try:
+        reader = PdfReader(io.BytesIO(data))
+        if reader.is_encrypted:
+            reader.decrypt("")
+        page_count = len(reader.pages)
+        if page_count < 2:
+            return []
 
-    @staticmethod
-    def _clean_list_item(value: str) -> str:
-        cleaned = value.strip().strip(",")
-        if cleaned.startswith('"') and cleaned.endswith('"'):
-            cleaned = cleaned[1:-1]
-        return cleaned.strip()
+        pages_per_chunk = max(1, pages_per_chunk)
+        chunks: List[Tuple[bytes, List[int]]] = []
+        for start in range(0, page_count, pages_per_chunk):
+            writer = PdfWriter()
+            page_numbers = list(range(start + 1, min(page_count, start + pages_per_chunk) + 1))
+            for number in page_numbers:
+                writer.add_page(reader.pages[number - 1])
+            buffer = io.BytesIO()
+            writer.write(buffer)
+            chunks.append((buffer.getvalue(), page_numbers))
+    except Exception as exc:
+        logger.warning("[PDF] Unable to split PDF (%s); sending it as a single file", exc)
+        return []
 
-    def _extract_list_section(self, text: str, key: str) -> List[str]:
-        """Extract an array section even if formatting is slightly invalid."""
-        items: List[str] = []
-        # Primary: look for JSON-style array
-        array_pattern = re.compile(
-            rf'\b{key}\b\s*[:=]\s*\[(?P<body>.*?)\]',
-            re.IGNORECASE | re.DOTALL,
-        )
-        match = array_pattern.search(text)
-        if match:
-            body = match.group("body")
-            # Prefer quoted strings
-            quoted_items = re.findall(r'"([^"]+)"', body)
-            if quoted_items:
-                items.extend(item.strip() for item in quoted_items if item.strip())
-            else:
-                # Fall back to comma-separated entries
-                for part in body.split(","):
-                    cleaned = self._clean_list_item(part)
-                    if cleaned:
-                        items.append(cleaned)
-            if items:
-                return items
+    logger.info("[PDF] Split %d-page PDF into %d request(s)", page_count, len(chunks))
+    return chunks
 
-        # Secondary: capture bullet list following the key
-        lines = text.replace("\r", "").split("\n")
-        collecting = False
-        for line in lines:
-            stripped = line.strip()
-            if not collecting:
-                if re.match(rf'^\s*{key}\s*[:=]?\s*$', stripped, re.IGNORECASE):
-                    collecting = True
-                continue
 
-            if not stripped:
-                break
+# ----------------- File Handles -----------------
+# Files are encoded (or uploaded) once and reused by later calls within the TTL window
+GEMINI_FILE_HANDLE_TTL_SECONDS = int(os.getenv("GEMINI_FILE_HANDLE_TTL_SECONDS", "900"))
+# Cap on the base64 kept for inline handles, per worker process
+GEMINI_FILE_HANDLE_MAX_MB = int(os.getenv("GEMINI_FILE_HANDLE_MAX_MB", "64"))
+# Optional GCS bucket: files are uploaded once and referenced by gs:// URI instead of inlined
+GEMINI_FILE_BUCKET = os.getenv("GEMINI_FILE_BUCKET", "").strip()
+GEMINI_FILE_PREFIX = os.getenv("GEMINI_FILE_PREFIX", "gemini-uploads").strip("/")
 
-            if re.match(r'^[A-Za-z0-9_]+\s*[:=]', stripped):
-                # Next top-level field detected
-                break
 
-            if stripped.startswith(("-", "*")):
-                stripped = stripped[1:].strip()
+class FileHandle:
+    """Reusable reference to a file that has already been encoded or uploaded for Gemini."""
 
-            cleaned = self._clean_list_item(stripped)
-            if cleaned:
-                items.append(cleaned)
+    def __init__(self, sha256: str, mime_type: str, size: int, part: types.Part, memory_bytes: int, uri: Optional[str] = None):
+        self.sha256 = sha256
+        self.mime_type = mime_type
+        self.size = size
+        self.part = part
+        self.memory_bytes = memory_bytes
+        self.uri = uri
+        self.created_at = time.time()
 
-        return items
+    def __repr__(self) -> str:
+        return f"FileHandle({self.sha256[:12]}, {self.mime_type}, {self.size} bytes)"
 
-    def _parse_comparison_fallback(self, text: str):
-        """Fallback parser when JSON decoding fails."""
-        logger.info("[COMPARISON PARSER] Attempting fallback parsing heuristics")
-        normalized = text.replace("\r", "")
 
-        result = {
-            "match": False,
-            "confidence": "",
-            "summary": "",
-            "rfq_requirements": [],
-            "cad_findings": [],
-            "mismatches": [],
-            "recommendations": "",
-        }
+class InlineFileStore:
+    """Local stand-in: base64-encodes the file into an inline Part (no network upload)."""
 
-        match_match = re.search(r'\bmatch\b\s*[:=]\s*(true|false)', normalized, re.IGNORECASE)
-        if match_match:
-            result["match"] = match_match.group(1).lower() == "true"
+    name = "inline"
 
-        confidence_match = re.search(r'\bconfidence\b\s*[:=]\s*"?(High|Medium|Low)"?', normalized, re.IGNORECASE)
-        if confidence_match:
-            result["confidence"] = confidence_match.group(1).capitalize()
+    def put(self, data: bytes, mime_type: str, sha256: str) -> Tuple[types.Part, int, Optional[str]]:
+        encoded = base64.b64encode(data).decode("utf-8")
+        part = types.Part(inline_data=types.Blob(mime_type=mime_type, data=encoded))
+        return part, len(encoded), None
 
-        summary_match = re.search(r'\bsummary\b\s*[:=]\s*"([^"]+)"', normalized)
-        if summary_match:
-            result["summary"] = summary_match.group(1).strip()
-        else:
-            summary_match = re.search(r'\bsummary\b\s*[:=]\s*(.+)', normalized)
-            if summary_match:
-                result["summary"] = summary_match.group(1).strip().rstrip(",")
 
-        for section in ("rfq_requirements", "cad_findings", "mismatches"):
-            extracted = self._extract_list_section(normalized, section)
-            if extracted:
-                result[section] = extracted
+class GcsFileStore:
+    """Uploads each file once to Cloud Storage and references it by gs:// URI.
 
-        rec_list = self._extract_list_section(normalized, "recommendations")
-        if rec_list:
-            result["recommendations"] = "; ".join(rec_list)
-        else:
-            rec_match = re.search(r'\brecommendations?\b\s*[:=]\s*"([^"]+)"', normalized, re.IGNORECASE)
-            if rec_match:
-                result["recommendations"] = rec_match.group(1).strip()
-            else:
-                rec_match = re.search(r'\brecommendations?\b\s*[:=]\s*(.+)', normalized, re.IGNORECASE)
-                if rec_match:
-                    result["recommendations"] = rec_match.group(1).strip()
+    Objects are shared by every worker, so none is deleted when one worker's handle expires.
+    Instead each use stamps the object's ``customTime``; a bucket lifecycle rule on
+    ``daysSinceCustomTime`` (see README) removes objects nobody has used since.
+    """
 
-        if any([result["summary"], result["rfq_requirements"], result["cad_findings"], result["mismatches"], result["recommendations"]]):
-            logger.info("[COMPARISON PARSER] Fallback parsing produced usable data")
-            return result
+    name = "gcs"
 
-        logger.error("[COMPARISON PARSER] Fallback parsing failed to extract data")
-        return None
+    def __init__(self, bucket_name: str, prefix: str, project: Optional[str] = None):
+        from google.cloud import storage  # type: ignore[reportMissingImports]
 
-    def inspect_drawing(self, file_bytes: bytes, mime_type: str) -> str:
-        """Analyze a CAD or welding drawing (image or PDF) and generate a detailed report."""
-        logger.info(f"=== START INSPECTION === (MIME type: {mime_type})")
+        self.bucket = storage.Client(project=project).bucket(bucket_name)
+        self.prefix = prefix
 
-        prompt = (
-            "You are an expert welding engineer analyzing a technical CAD or welding drawing. "
-            "Carefully examine the entire drawing and identify ALL welds present in the diagram.\n\n"
-            "INSTRUCTIONS:\n"
-            "1. Identify every weld symbol, weld callout, and welding annotation visible in the drawing.\n"
-            "2. Assign sequential serial numbers starting from W1, W2, W3, and continue for ALL welds found.\n"
-            "3. Extract part numbers, plate numbers (PL), component numbers, and any other identifiers EXACTLY as shown in the drawing.\n"
-            "4. Do NOT assume or invent part numbers - use only what is clearly visible in the drawing.\n"
-            "5. Identify all welds regardless of their type or location.\n\n"
-            "For each weld identified, provide:\n"
-            "- Serial No (W1, W2, W3, ... - assign sequentially for all welds found)\n"
-            "- Description (detailed description using EXACT part numbers, plate numbers, and component names as shown in the drawing)\n"
-            "- Welding Type (e.g., Fillet Weld, Double Fillet Weld, Groove Weld, etc. - identify from weld symbols)\n"
-            "- Welding Value (size in mm - extract exactly as specified in the drawing)\n"
-            "- Remarks (any notes, flags, or annotations like TYP, OF DRIVE, OF MOTOR, M, etc. - use exactly as shown)\n"
-            "- Position (location description referencing the exact parts, sections, or views shown)\n"
-            "- Confidence (High if clearly visible, Medium if partially visible, Low if uncertain)\n\n"
-            "CRITICAL OUTPUT REQUIREMENTS:\n"
-            "1. Output ONLY valid JSON format with NO additional text before or after.\n"
-            "2. The JSON structure must be:\n"
-            "   {\n"
-            "     \"welds\": [\n"
-            "       {\n"
-            "         \"Serial No\": \"W1\",\n"
-            "         \"Description\": \"...\",\n"
-            "         \"Welding Type\": \"...\",\n"
-            "         \"Welding Value\": \"...\",\n"
-            "         \"Remarks\": \"...\",\n"
-            "         \"Position\": \"...\",\n"
-            "         \"Confidence\": \"...\"\n"
-            "       },\n"
-            "       ...\n"
-            "     ],\n"
-            "     \"explanations\": \"Detailed explanations for each weld...\"\n"
-            "   }\n"
-            "3. Include ALL welds found - do not stop early. Continue until you have identified every weld in the drawing.\n"
-            "4. Use EXACT part numbers, plate numbers, and identifiers as they appear in the drawing (e.g., Part 1, PL10-21, Beam B11, etc.).\n"
-            "5. The \"welds\" array should contain one object per weld with all 7 fields.\n"
-            "6. The \"explanations\" field should contain detailed explanations for each weld, referencing the exact locations and symbols from the drawing.\n"
-            "7. Output ONLY valid JSON - no markdown, no code blocks, no explanations outside the JSON structure."
-        )
+    def put(self, data: bytes, mime_type: str, sha256: str) -> Tuple[types.Part, int, Optional[str]]:
+        blob = self.bucket.blob(f"{self.prefix}/{sha256}" if self.prefix else sha256)
+        blob.custom_time = datetime.now(timezone.utc)
+        # Content-addressed names: another worker may already have uploaded the same bytes
+        if blob.exists():
+            blob.patch()
+        else:
+            blob.upload_from_string(data, content_type=mime_type)
+            logger.info("[FILES] Uploaded %d bytes to gs://%s/%s", len(data), self.bucket.name, blob.name)
+        uri = f"gs://{self.bucket.name}/{blob.name}"
+        part = types.Part(file_data=types.FileData(file_uri=uri, mime_type=mime_type))
+        return part, 0, uri
 
-        response_text = self.client.chat(file_bytes, mime_type, prompt)
 
-        logger.info("=== INSPECTION COMPLETE ===")
-        return response_text
+def create_file_store(project: Optional[str] = None):
+    """GCS store when GEMINI_FILE_BUCKET is set (and google-cloud-storage is available), else inline."""
+    if GEMINI_FILE_BUCKET:
+        try:
+            return GcsFileStore(GEMINI_FILE_BUCKET, GEMINI_FILE_PREFIX, project)
+        except Exception as exc:
+            logger.warning("[FILES] Cannot use bucket %s (%s); falling back to inline files", GEMINI_FILE_BUCKET, exc)
+    return InlineFileStore()
 
-    def _get_comparison_prompt(self, part: str) -> str:
-        normalized = (part or "").strip().lower()
-        strategy_key = self._comparison_alias_map.get(normalized)
 
-        if not strategy_key:
-            if normalized:
-                logger.info("[COMPARE] Unknown part '%s'; defaulting to spark plug prompt", normalized)
-            strategy_key = "spark_plug"
+class FileHandleRegistry:
+    """Content-addressed TTL registry of FileHandles, bounded by encoded size."""
 
-        strategy = self._comparison_strategies.get(strategy_key)
-        if not strategy:
-            logger.warning(
-                "[COMPARE] Strategy '%s' not found; falling back to default spark plug prompt",
-                strategy_key,
-            )
-            strategy = self._comparison_strategies["spark_plug"]
+    def __init__(
+        self,
+        store=None,
+        ttl_seconds: int = GEMINI_FILE_HANDLE_TTL_SECONDS,
+        max_bytes: int = GEMINI_FILE_HANDLE_MAX_MB * 1024 * 1024,
+    ):
+        self.store = store or InlineFileStore()
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._handles: "OrderedDict[Tuple[str, str], FileHandle]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "bytes_encoded": 0, "bytes_reused": 0}
+
+    def get_or_create(self, data: bytes, mime_type: Optional[str], sha256: Optional[str] = None) -> FileHandle:
+        mime_type = mime_type or "application/octet-stream"
+        sha256 = sha256 or hashlib.sha256(data).hexdigest()
+        key = (sha256, mime_type)
+        now = time.time()
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is not None and now - handle.created_at < self.ttl_seconds:
+                self._handles.move_to_end(key)
+                self._stats["hits"] += 1
+                self._stats["bytes_reused"] += handle.size
+                return handle
+            if handle is not None:
+                self._drop(key)
+
+        part, memory_bytes, uri = self.store.put(data, mime_type, sha256)
+        handle = FileHandle(sha256, mime_type, len(data), part, memory_bytes, uri)
+
+        with self._lock:
+            self._stats["misses"] += 1
+            self._stats["bytes_encoded"] += len(data)
+            if key in self._handles:
+                self._drop(key)
+            self._handles[key] = handle
+            self._memory_bytes += memory_bytes
+            while self._memory_bytes > self.max_bytes and len(self._handles) > 1:
+                self._drop(next(iter(self._handles)))
+        return handle
+
+    def _drop(self, key: Tuple[str, str]) -> None:
+        handle = self._handles.pop(key)
+        self._memory_bytes -= handle.memory_bytes
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                **self._stats,
+                "store": self.store.name,
+                "handles": len(self._handles),
+                "memory_bytes": self._memory_bytes,
+            }
 
-        logger.info("[COMPARE] Using comparison strategy: %s (for part: %s)", strategy_key, normalized)
-        return strategy.build_prompt()
 
-    def compare_rfq_and_cad(
-        self,
-        rfq_input: Tuple[Union[bytes, str], Optional[str]],
-        cad_bytes: bytes,
-        cad_mime: str,
-        part: str = "spark_plug",
-    ) -> str:
-        """Compare RFQ document with CAD drawing and summarize alignment."""
-        logger.info("=== START RFQ VS CAD COMPARISON === (part=%s)", part or "spark_plug")
+# ----------------- Response Cache -----------------
+# Generation is deterministic (temperature 0), so identical requests can reuse a stored response
+GEMINI_CACHE_ENABLED = os.getenv("GEMINI_CACHE_ENABLED", "1").lower() not in ("0", "false", "no")
+GEMINI_CACHE_DIR = Path(os.getenv("GEMINI_CACHE_DIR", str(Path(__file__).resolve().parent / "output" / "gemini_cache")))
+GEMINI_CACHE_MEMORY_ENTRIES = int(os.getenv("GEMINI_CACHE_MEMORY_ENTRIES", "256"))
+GEMINI_CACHE_DISK_MB = int(os.getenv("GEMINI_CACHE_DISK_MB", "1024"))
+GEMINI_CACHE_TTL_SECONDS = int(os.getenv("GEMINI_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
 
-        prompt = self._get_comparison_prompt(part)
 
-        response_text = self.client.chat_with_files(
-            prompt,
-            [
-                rfq_input,
-                (cad_bytes, cad_mime),
-            ],
-        )
+class ResponseCache:
+    """Content-addressed cache of Gemini text responses with a memory LRU and a disk tier."""
 
-        logger.info("=== COMPARISON COMPLETE ===")
-        return response_text
+    def __init__(
+        self,
+        cache_dir: Path,
+        max_memory_entries: int = GEMINI_CACHE_MEMORY_ENTRIES,
+        max_disk_bytes: int = GEMINI_CACHE_DISK_MB * 1024 * 1024,
+        ttl_seconds: int = GEMINI_CACHE_TTL_SECONDS,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.max_memory_entries = max(0, max_memory_entries)
+        self.max_disk_bytes = max(0, max_disk_bytes)
+        self.ttl_seconds = ttl_seconds
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = 0
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "expired": 0,
+            "disk_evictions": 0,
+        }
+        if self.max_disk_bytes:
+            try:
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                self._disk_bytes = sum(path.stat().st_size for path in self.cache_dir.glob("*/*.json"))
+            except OSError as exc:
+                logger.warning("[CACHE] Disk tier disabled, cannot use %s: %s", self.cache_dir, exc)
+                self.max_disk_bytes = 0
 
     @staticmethod
-    def _normalize_value(value: str) -> str:
-        """
-        Normalize RFQ/CAD values so that formatting differences
-        (spaces, commas, diameter symbol, units, etc.) don't cause false mismatches.
+    def make_key(
+        model_name: str,
+        config: Dict,
+        prompt: str,
+        files: List[Tuple[Union[bytes, str, FileHandle], Optional[str]]],
+    ) -> str:
+        """SHA-256 over model, generation config, prompt and every file's bytes + MIME type.
 
-        Examples:
-        "Ø300 mm"    -> "300"
-        "Ø300"       -> "300"
-        "75,5 mm"    -> "75.5"
-        "4 x Ø23.5"  -> "4x23.5"
-        "22.2°"      -> "22.2"
-        "M14"        -> "m14"
+        Files contribute their own SHA-256, so a FileHandle and its raw bytes give the same key.
         """
-        if not value:
-            return ""
-
-        v = value.strip().lower()
-
-        # 1) normalize decimal separator
-        v = v.replace(",", ".")
+        hasher = hashlib.sha256()
 
-        # 2) remove diameter & degree symbols
-        v = v.replace("ø", "").replace("°", "")
+        def feed(tag: bytes, payload: bytes) -> None:
+            # Length-prefix every field so concatenations cannot collide
+            hasher.update(tag)
+            hasher.update(len(payload).to_bytes(8, "big"))
+            hasher.update(payload)
 
-        # 3) normalize multiplication/group notation: "4 x 23.5", "4-23.5" → "4x23.5"
-        v = v.replace("×", "x")
-        v = re.sub(r"\s*[-x]\s*", "x", v)
+        feed(b"model", model_name.encode("utf-8"))
+        feed(b"config", json.dumps(config, sort_keys=True, default=str).encode("utf-8"))
+        feed(b"prompt", prompt.encode("utf-8"))
+        for data, mime in files:
+            if isinstance(data, FileHandle):
+                feed(b"mime", data.mime_type.encode("utf-8"))
+                feed(b"file", data.sha256.encode("ascii"))
+            elif isinstance(data, bytes):
+                feed(b"mime", (mime or "application/octet-stream").encode("utf-8"))
+                feed(b"file", hashlib.sha256(data).hexdigest().encode("ascii"))
+            else:
+                feed(b"mime", (mime or "").encode("utf-8"))
+                feed(b"text", str(data).encode("utf-8"))
+        return hasher.hexdigest()
+
+    def _disk_path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, text = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    return text
+                del self._memory[key]
+                self._stats["expired"] += 1
+
+        disk_entry = self._read_disk(key, now)
+        with self._lock:
+            if disk_entry is None:
+                self._stats["misses"] += 1
+                return None
+            expires_at, text = disk_entry
+            self._stats["disk_hits"] += 1
+            self._remember(key, text, expires_at)
+        return text
+
+    def set(self, key: str, text: str) -> None:
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._remember(key, text, expires_at)
+            self._stats["stores"] += 1
+        self._write_disk(key, text, expires_at)
+
+    def _remember(self, key: str, text: str, expires_at: float) -> None:
+        if not self.max_memory_entries:
+            return
+        self._memory[key] = (expires_at, text)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _read_disk(self, key: str, now: float) -> Optional[Tuple[float, str]]:
+        if not self.max_disk_bytes:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                payload = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError):
+            logger.warning("[CACHE] Dropping unreadable cache entry %s", path.name)
+            self._remove_disk_entry(path)
+            return None
 
-        # 4) strip common units
-        units = [" mm", "mm", " in", "in"]
-        for unit in units:
-            if v.endswith(unit):
-                v = v[: -len(unit)].strip()
+        expires_at = payload.get("expires_at", 0)
+        text = payload.get("text")
+        if expires_at <= now or not isinstance(text, str):
+            with self._lock:
+                self._stats["expired"] += 1
+            self._remove_disk_entry(path)
+            return None
+
+        try:
+            # Touch so size-based eviction drops least recently used entries first
+            os.utime(path)
+        except OSError:
+            pass
+        return expires_at, text
+
+    def _write_disk(self, key: str, text: str, expires_at: float) -> None:
+        if not self.max_disk_bytes:
+            return
+        path = self._disk_path(key)
+        payload = json.dumps({"key": key, "expires_at": expires_at, "text": text}, ensure_ascii=False)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            previous = path.stat().st_size if path.exists() else 0
+            tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._disk_bytes += path.stat().st_size - previous
+                over_limit = self._disk_bytes > self.max_disk_bytes
+        except OSError as exc:
+            logger.warning("[CACHE] Failed to write cache entry: %s", exc)
+            return
+
+        if over_limit:
+            self._evict_disk()
+
+    def _remove_disk_entry(self, path: Path) -> None:
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except OSError:
+            return
+        with self._lock:
+            self._disk_bytes -= size
+
+    def _evict_disk(self) -> None:
+        """Delete least recently used entries until the disk tier is under 90% of its budget."""
+        entries = []
+        for path in self.cache_dir.glob("*/*.json"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_disk_bytes * 0.9)
+        evicted = 0
+        for _, size, path in entries:
+            if total <= target:
                 break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+
+        with self._lock:
+            self._disk_bytes = total
+            self._stats["disk_evictions"] += evicted
+        logger.info("[CACHE] Evicted %d disk entries (%d bytes remain)", evicted, total)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self._stats["memory_hits"] + self._stats["disk_hits"] + self._stats["misses"]
+            hits = self._stats["memory_hits"] + self._stats["disk_hits"]
+            return {
+                **self._stats,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_bytes": self._disk_bytes,
+            }
 
-        # 5) if pure number -> canonical numeric form
-        num_match = re.fullmatch(r"[-+]?\d*\.?\d+", v)
-        if num_match:
-            return num_match.group(0)
 
-        # 6) fallback: compact spaces/commas on the cleaned string
-        v = re.sub(r"[\s,]+", "", v)
-        return v.strip()
+# ----------------- Gemini Backends -----------------
+# Transport used by GeminiClient: vertex (default), record (vertex + store responses) or replay (offline)
+GEMINI_BACKEND = os.getenv("GEMINI_BACKEND", "vertex").strip().lower()
+GEMINI_RECORDINGS_DIR = Path(os.getenv("GEMINI_RECORDINGS_DIR", str(Path(__file__).resolve().parent / "output" / "gemini_recordings")))
+GEMINI_REPLAY_LATENCY = os.getenv("GEMINI_REPLAY_LATENCY", "recorded")
+GEMINI_FAULT_429_RATE = float(os.getenv("GEMINI_FAULT_429_RATE", "0"))
+GEMINI_FAULT_TRUNCATE_RATE = float(os.getenv("GEMINI_FAULT_TRUNCATE_RATE", "0"))
+GEMINI_FAULT_MALFORMED_RATE = float(os.getenv("GEMINI_FAULT_MALFORMED_RATE", "0"))
 
-    def _normalize_label(self, label: str) -> str:
-        """
-        Normalize parameter labels to create consistent dictionary keys for matching.
-        
-        Examples:
-        "Thread Size"    -> "threadsize"
-        "Thread_Size"    -> "threadsize"
-        "Part Number"    -> "partnumber"
-        "Hex Size"       -> "hexsize"
-        """
-        if not label:
-            return ""
-        
-        # Convert to lowercase and strip whitespace
-        normalized = label.strip().lower()
-        
-        # Replace common separators (spaces, underscores, hyphens) with nothing
-        normalized = re.sub(r"[\s_\-]+", "", normalized)
-        
-        return normalized
 
-    def _spec_list_to_dict(self, items: List[str]) -> Dict[str, Dict[str, str]]:
-        """Convert ['Thread Size: M14', ...] to key→{label,value} dict."""
-        specs: Dict[str, Dict[str, str]] = {}
-        pattern = re.compile(r"^\s*([^:]+?)\s*[:\-]\s*(.+?)\s*$")
-        for item in items:
-            match = pattern.match(item)
-            if not match:
-                continue
-            raw_label, raw_value = match.groups()
-            key = self._normalize_label(raw_label)
-            if not key:
-                continue
-            specs[key] = {"label": raw_label.strip(), "value": raw_value.strip()}
-        return specs
+def _finish_reason_of(response) -> Optional[str]:
+    """Return the first candidate's finish reason as a plain string (None if unavailable)."""
+    candidates = getattr(response, "candidates", None)
+    if not candidates:
+        return None
+    finish_reason = getattr(candidates[0], "finish_reason", None)
+    if finish_reason is None:
+        return None
+    return str(getattr(finish_reason, "value", finish_reason))
 
-    def build_metric_records(
-        self,
-        rfq_requirements: List[str],
-        cad_findings: List[str],
-    ) -> List[Dict]:
-        """
-        Build canonical metric records with backend-determined status.
-        
-        Returns a list of records with:
-        {
-            "key": normalized key (e.g., "threadsize"),
-            "label": original RFQ label (e.g., "Thread Size"),
-            "rfq_value": RFQ value string,
-            "cad_value": CAD value string (or "" if missing),
-            "match": "Match" | "Mismatch" | "Missing" | "Extra"
-        }
-        """
-        rfq_specs = self._spec_list_to_dict(rfq_requirements)
-        cad_specs = self._spec_list_to_dict(cad_findings)
-        
-        if not rfq_specs:
-            logger.info("[METRIC-RECORDS] No RFQ specs available")
-            return []
-        
-        records: List[Dict] = []
-        
-        # Process RFQ metrics
-        for key, rfq_spec in rfq_specs.items():
-            cad_spec = cad_specs.get(key)
-            cad_value = cad_spec.get("value", "").strip() if cad_spec else ""
-            rfq_value = rfq_spec.get("value", "").strip()
-            
-            # Determine status
-            if not cad_spec or not cad_value:
-                match_status = "Missing"
-            elif self._normalize_value(rfq_value) == self._normalize_value(cad_value):
-                match_status = "Match"
-            else:
-                match_status = "Mismatch"
-            
-            records.append({
-                "key": key,
-                "label": rfq_spec.get("label", ""),
-                "rfq_value": rfq_value,
-                "cad_value": cad_value,
-                "match": match_status,
-            })
-        
-        # Optionally include CAD-only metrics as "Extra"
-        for key, cad_spec in cad_specs.items():
-            if key not in rfq_specs:
-                records.append({
-                    "key": key,
-                    "label": cad_spec.get("label", ""),
-                    "rfq_value": "",
-                    "cad_value": cad_spec.get("value", "").strip(),
-                    "match": "Extra",
-                })
-        
-        logger.info("[METRIC-RECORDS] Built %d metric records", len(records))
-        return records
 
-    def _extract_cad_bboxes(
-        self,
-        cad_bytes: bytes,
-        cad_mime: str,
-        metric_records: List[Dict],
-    ) -> List[Dict]:
-        """
-        Ask Gemini for bounding boxes ONLY (no status/value decisions).
-        
-        Returns a list of entries such as:
-        {
-          "parameter": "Thread Length",
-          "key": "threadlength",
-          "bounding_box": [x1, y1, x2, y2]
+def _contents_to_jsonable(contents) -> List:
+    items = contents if isinstance(contents, list) else [contents]
+    jsonable = []
+    for item in items:
+        if isinstance(item, str):
+            jsonable.append({"text": item})
+        elif hasattr(item, "model_dump"):
+            jsonable.append(item.model_dump(mode="json", exclude_none=True))
+        else:
+            jsonable.append(str(item))
+    return jsonable
+
+
+def _first_prompt_text(contents) -> str:
+    """Return the first text part of a request (the instruction prompt)."""
+    for item in _contents_to_jsonable(contents):
+        if isinstance(item, dict):
+            if "text" in item:
+                return item["text"]
+            for part in item.get("parts", []):
+                if "text" in part:
+                    return part["text"]
+    return ""
+
+
+def _model_turn_text(contents) -> str:
+    """Return the text of any model turn in a multi-turn request (continuations)."""
+    texts = []
+    for item in _contents_to_jsonable(contents):
+        if isinstance(item, dict) and item.get("role") == "model":
+            texts.extend(part.get("text", "") for part in item.get("parts", []))
+    return "".join(texts)
+
+
+def request_fingerprint(model: str, contents, config: Dict) -> str:
+    """Stable SHA-256 of a generate_content request (model, config and every content part)."""
+    payload = json.dumps(
+        {"model": model, "config": config, "contents": _contents_to_jsonable(contents)},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class GeminiBackend(ABC):
+    """Transport used by GeminiClient. Every call returns ``(text, finish_reason)``."""
+
+    name = "base"
+
+    @abstractmethod
+    def generate(self, model: str, contents, config: Dict) -> Tuple[str, Optional[str]]:
+        ...
+
+    @abstractmethod
+    async def agenerate(self, model: str, contents, config: Dict) -> Tuple[str, Optional[str]]:
+        ...
+
+    @abstractmethod
+    def astream(self, model: str, contents, config: Dict) -> AsyncIterator[Tuple[str, Optional[str]]]:
+        """Yield ``(text_chunk, finish_reason)`` pairs; finish_reason is set on the final chunk."""
+
+
+class ContextCacheBackend(GeminiBackend):
+    """A backend that can also hold a prompt as cached content; ContextCacheManager only uses these."""
+
+    @abstractmethod
+    async def acreate_context_cache(self, model: str, prompt: str, ttl_seconds: int) -> Dict:
+        """Store ``prompt`` as cached content; returns ``{"name", "expires_at", "tokens"}``."""
+
+    @abstractmethod
+    async def arefresh_context_cache(self, name: str, ttl_seconds: int) -> float:
+        """Extend a cached-content handle; returns its new expiry (epoch seconds)."""
+
+
+class VertexBackend(ContextCacheBackend):
+    """Calls Gemini on Vertex AI through the google-genai SDK."""
+
+    name = "vertex"
+
+    def __init__(self, project: str, region: str):
+        self.client = genai.Client(
+            vertexai=True,
+            project=project,
+            location=region,
+        )
+
+    def generate(self, model: str, contents, config: Dict) -> Tuple[str, Optional[str]]:
+        response = self.client.models.generate_content(model=model, contents=contents, config=config)
+        return response.text or "", _finish_reason_of(response)
+
+    async def agenerate(self, model: str, contents, config: Dict) -> Tuple[str, Optional[str]]:
+        response = await self.client.aio.models.generate_content(model=model, contents=contents, config=config)
+        return response.text or "", _finish_reason_of(response)
+
+    async def astream(self, model: str, contents, config: Dict) -> AsyncIterator[Tuple[str, Optional[str]]]:
+        stream = await self.client.aio.models.generate_content_stream(model=model, contents=contents, config=config)
+        async for chunk in stream:
+            yield chunk.text or "", _finish_reason_of(chunk)
+
+    @staticmethod
+    def _expiry_of(cached, ttl_seconds: int) -> float:
+        expire_time = getattr(cached, "expire_time", None)
+        if expire_time is not None:
+            return expire_time.timestamp()
+        return time.time() + ttl_seconds
+
+    async def acreate_context_cache(self, model: str, prompt: str, ttl_seconds: int) -> Dict:
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        cached = await self.client.aio.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                contents=[types.Content(role="user", parts=[types.Part(text=prompt)])],
+                ttl=f"{int(ttl_seconds)}s",
+                display_name=f"cad-rfq-prompt-{digest[:16]}",
+            ),
+        )
+        usage = getattr(cached, "usage_metadata", None)
+        return {
+            "name": cached.name,
+            "expires_at": self._expiry_of(cached, ttl_seconds),
+            "tokens": int(getattr(usage, "total_token_count", None) or 0),
         }
-        """
-        # Build text block of metrics that have CAD values
-        metrics_with_cad = [
-            f"{record['label']}: {record['cad_value']}"
-            for record in metric_records
-            if record.get("cad_value") and record.get("match") != "Missing"
-        ]
-        
-        if not metrics_with_cad:
-            logger.info("[ANNOTATION] No metrics with CAD values to locate")
-            return []
-        
-        metrics_text = "\n".join(metrics_with_cad)
-        
-        prompt = (
-            "You are an expert in reading engineering drawings.\n"
-            "You will receive:\n"
-            "1) A list of metric names and their values (already determined from the drawing).\n"
-            "2) A CAD drawing image.\n\n"
-            "METRICS TO LOCATE (name: value):\n"
-            f"{metrics_text}\n\n"
-            "YOUR TASK:\n"
-            "For each metric in the list above, locate the corresponding dimension text/annotation on the drawing.\n"
-            "Draw a bounding box around the dimension text and any associated arrows or callouts.\n\n"
-            "CRITICAL RULES:\n"
-            "  - Use the metric name EXACTLY as provided in the \"parameter\" field.\n"
-            "  - Do NOT change or re-interpret the metric values.\n"
-            "  - Do NOT decide if values match or mismatch - that is already determined.\n"
-            "  - Only provide bounding boxes for dimensions you can clearly see on the drawing.\n"
-            "  - If you cannot find a metric, simply omit it from the output.\n"
-            "  - The bounding_box MUST be [x_min, y_min, x_max, y_max] with all values between 0 and 1,\n"
-            "    normalized relative to the image width/height (0 = left/top, 1 = right/bottom).\n\n"
-            "OUTPUT FORMAT:\n"
-            "Return ONLY a JSON array, no extra text, no markdown.\n"
-            "Example:\n"
-            "[\n"
-            "  {\n"
-            '    "parameter": "Thread Length",\n'
-            '    "bounding_box": [0.1, 0.2, 0.16, 0.22]\n'
-            "  },\n"
-            "  {\n"
-            '    "parameter": "Overall Length",\n'
-            '    "bounding_box": [0.25, 0.08, 0.32, 0.11]\n'
-            "  }\n"
-            "]\n"
+
+    async def arefresh_context_cache(self, name: str, ttl_seconds: int) -> float:
+        cached = await self.client.aio.caches.update(
+            name=name,
+            config=types.UpdateCachedContentConfig(ttl=f"{int(ttl_seconds)}s"),
         )
+        return self._expiry_of(cached, ttl_seconds)
+
+
+class RecordingStore:
+    """Directory of recorded responses, one JSON file per request fingerprint."""
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
 
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def load(self, key: str) -> Optional[Dict]:
         try:
-            response_text = self.client.chat_with_files(
-                prompt,
-                [
-                    (cad_bytes, cad_mime),
-                ],
-            )
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError):
+            logger.warning("[REPLAY] Unreadable recording %s", key[:12])
+            return None
 
-            cleaned = self._strip_markdown_fence(response_text).strip()
+    def save(self, key: str, entry: Dict) -> None:
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp_path = self._path(key).with_suffix(f".{uuid.uuid4().hex}.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key))
+        except OSError as exc:
+            logger.warning("[RECORD] Failed to save recording %s: %s", key[:12], exc)
+
+
+class RecordingBackend(GeminiBackend):
+    """Forwards to another backend and stores every response under its request fingerprint."""
+
+    name = "record"
+    # Not a ContextCacheBackend: recordings must hold the full prompt so replay fingerprints match
+
+    def __init__(self, inner: GeminiBackend, store: RecordingStore):
+        self.inner = inner
+        self.store = store
+
+    def _save(self, key: str, model: str, prompt: str, text: str, finish_reason: Optional[str], started: float, chunks=None) -> None:
+        entry = {
+            "model": model,
+            "prompt_head": prompt[:200],
+            "text": text,
+            "finish_reason": finish_reason,
+            "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+            "recorded_at": datetime.now().isoformat(),
+        }
+        if chunks is not None:
+            entry["chunks"] = chunks
+        self.store.save(key, entry)
+
+    def generate(self, model: str, contents, config: Dict) -> Tuple[str, Optional[str]]:
+        key = request_fingerprint(model, contents, config)
+        started = time.perf_counter()
+        text, finish_reason = self.inner.generate(model, contents, config)
+        self._save(key, model, _first_prompt_text(contents), text, finish_reason, started)
+        return text, finish_reason
+
+    async def agenerate(self, model: str, contents, config: Dict) -> Tuple[str, Optional[str]]:
+        key = await asyncio.to_thread(request_fingerprint, model, contents, config)
+        started = time.perf_counter()
+        text, finish_reason = await self.inner.agenerate(model, contents, config)
+        await asyncio.to_thread(self._save, key, model, _first_prompt_text(contents), text, finish_reason, started)
+        return text, finish_reason
+
+    async def astream(self, model: str, contents, config: Dict) -> AsyncIterator[Tuple[str, Optional[str]]]:
+        key = await asyncio.to_thread(request_fingerprint, model, contents, config)
+        started = time.perf_counter()
+        chunks: List[List] = []
+        finish_reason: Optional[str] = None
+        async for text, chunk_reason in self.inner.astream(model, contents, config):
+            chunks.append([text, chunk_reason])
+            finish_reason = chunk_reason or finish_reason
+            yield text, chunk_reason
+        full_text = "".join(text for text, _ in chunks)
+        await asyncio.to_thread(self._save, key, model, _first_prompt_text(contents), full_text, finish_reason, started, chunks)
+
+
+class LatencyModel:
+    """Synthetic latency distribution for replayed responses.
+
+    Spec strings (seconds unless noted):
+    - ``recorded`` or ``recorded:0.5`` - recorded latency, optionally scaled
+    - ``fixed:2.5``
+    - ``uniform:1,5``
+    - ``normal:20,5`` (mean, std; clipped at 0)
+    - ``lognormal:20,0.6`` (median, sigma)
+    """
+
+    def __init__(self, kind: str = "recorded", params: Tuple[float, ...] = (), seed: Optional[int] = None):
+        self.kind = kind
+        self.params = params
+        self._random = random.Random(seed)
+
+    @classmethod
+    def parse(cls, spec: str, seed: Optional[int] = None) -> "LatencyModel":
+        kind, _, raw_params = (spec or "recorded").strip().lower().partition(":")
+        params = tuple(float(value) for value in raw_params.split(",") if value.strip())
+        expected = {"recorded": (0, 1), "fixed": (1, 1), "uniform": (2, 2), "normal": (2, 2), "lognormal": (2, 2)}
+        if kind not in expected or not expected[kind][0] <= len(params) <= expected[kind][1]:
+            raise ValueError(f"Invalid latency spec '{spec}'")
+        return cls(kind, params, seed)
+
+    def sample(self, recorded_ms: Optional[float] = None) -> float:
+        if self.kind == "recorded":
+            scale = self.params[0] if self.params else 1.0
+            return max(0.0, (recorded_ms or 0.0) / 1000.0 * scale)
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return self._random.uniform(*self.params)
+        if self.kind == "normal":
+            return max(0.0, self._random.gauss(*self.params))
+        median, sigma = self.params
+        return self._random.lognormvariate(np.log(median), sigma)
+
+
+class ReplayMissError(KeyError):
+    """Raised when replay mode has no recording for a request."""
+
+
+class ReplayBackend(GeminiBackend):
+    """Serves recorded responses offline with synthetic latency.
+
+    ``fallback`` (prompt text -> response text) is used for requests that were never recorded.
+    """
+
+    name = "replay"
+
+    def __init__(
+        self,
+        store: RecordingStore,
+        latency: Optional[LatencyModel] = None,
+        fallback: Optional[Callable[[str], str]] = None,
+    ):
+        self.store = store
+        self.latency = latency or LatencyModel()
+        self.fallback = fallback
+
+    def _lookup(self, model: str, contents, config: Dict) -> Dict:
+        key = request_fingerprint(model, contents, config)
+        entry = self.store.load(key)
+        if entry is not None:
+            return entry
+        if self.fallback is not None:
+            text = self.fallback(_first_prompt_text(contents))
+            # Continuation requests carry the truncated answer as a model turn; return only the rest
+            partial = _model_turn_text(contents)
+            if partial and text.startswith(partial):
+                text = text[len(partial):]
+            return {"text": text, "finish_reason": "STOP"}
+        raise ReplayMissError(f"No recording for request {key[:12]}; record it first with GEMINI_BACKEND=record")
+
+    def generate(self, model: str, contents, config: Dict) -> Tuple[str, Optional[str]]:
+        entry = self._lookup(model, contents, config)
+        time.sleep(self.latency.sample(entry.get("latency_ms")))
+        return entry.get("text", ""), entry.get("finish_reason")
+
+    async def agenerate(self, model: str, contents, config: Dict) -> Tuple[str, Optional[str]]:
+        entry = await asyncio.to_thread(self._lookup, model, contents, config)
+        await asyncio.sleep(self.latency.sample(entry.get("latency_ms")))
+        return entry.get("text", ""), entry.get("finish_reason")
+
+    async def astream(self, model: str, contents, config: Dict) -> AsyncIterator[Tuple[str, Optional[str]]]:
+        entry = await asyncio.to_thread(self._lookup, model, contents, config)
+        chunks = entry.get("chunks")
+        if not chunks:
+            text = entry.get("text", "")
+            pieces = [text[i:i + 256] for i in range(0, len(text), 256)] or [""]
+            chunks = [[piece, None] for piece in pieces]
+            chunks[-1][1] = entry.get("finish_reason")
+        # Spread the sampled total latency evenly over the chunks
+        delay = self.latency.sample(entry.get("latency_ms")) / len(chunks)
+        for text, finish_reason in chunks:
+            await asyncio.sleep(delay)
+            yield text, finish_reason
+
+
+class FaultInjectingBackend(GeminiBackend):
+    """Wraps a backend and injects 429s, MAX_TOKENS truncation and malformed JSON at given rates."""
+
+    name = "faults"
+
+    def __init__(
+        self,
+        inner: GeminiBackend,
+        rate_429: float = 0.0,
+        rate_truncate: float = 0.0,
+        rate_malformed: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.inner = inner
+        self.rate_429 = rate_429
+        self.rate_truncate = rate_truncate
+        self.rate_malformed = rate_malformed
+        self._random = random.Random(seed)
+        self.injected = {"429": 0, "truncate": 0, "malformed": 0}
+
+    def _roll(self) -> Optional[str]:
+        value = self._random.random()
+        for fault, rate in (("429", self.rate_429), ("truncate", self.rate_truncate), ("malformed", self.rate_malformed)):
+            if value < rate:
+                self.injected[fault] += 1
+                return fault
+            value -= rate
+        return None
 
-            if not cleaned:
-                logger.warning("[ANNOTATION] Gemini returned empty bbox payload")
-                return []
+    @staticmethod
+    def _raise_429() -> None:
+        raise genai_errors.ClientError(
+            429,
+            {"error": {"code": 429, "message": "Resource exhausted (injected fault)", "status": "RESOURCE_EXHAUSTED"}},
+        )
 
-            parsed: Optional[Union[List, Dict]] = None
+    def _apply(self, fault: Optional[str], text: str, finish_reason: Optional[str]) -> Tuple[str, Optional[str]]:
+        if fault == "truncate" and len(text) > 1:
+            cut = int(len(text) * self._random.uniform(0.3, 0.9))
+            return text[:cut], "MAX_TOKENS"
+        if fault == "malformed" and text:
+            structural = [i for i, char in enumerate(text) if char in '{}[],:"']
+            if structural:
+                drop = self._random.choice(structural)
+                return text[:drop] + text[drop + 1:], finish_reason
+            return text + "}", finish_reason
+        return text, finish_reason
+
+    def generate(self, model: str, contents, config: Dict) -> Tuple[str, Optional[str]]:
+        fault = self._roll()
+        if fault == "429":
+            self._raise_429()
+        text, finish_reason = self.inner.generate(model, contents, config)
+        return self._apply(fault, text, finish_reason)
+
+    async def agenerate(self, model: str, contents, config: Dict) -> Tuple[str, Optional[str]]:
+        fault = self._roll()
+        if fault == "429":
+            self._raise_429()
+        text, finish_reason = await self.inner.agenerate(model, contents, config)
+        return self._apply(fault, text, finish_reason)
+
+    async def astream(self, model: str, contents, config: Dict) -> AsyncIterator[Tuple[str, Optional[str]]]:
+        fault = self._roll()
+        if fault == "429":
+            self._raise_429()
+        if fault is None:
+            async for item in self.inner.astream(model, contents, config):
+                yield item
+            return
+        # Faults are applied to the whole text, so buffer the stream and re-emit it
+        chunks = [item async for item in self.inner.astream(model, contents, config)]
+        finish_reason = next((reason for _, reason in reversed(chunks) if reason), None)
+        text, finish_reason = self._apply(fault, "".join(text for text, _ in chunks), finish_reason)
+        for i in range(0, len(text), 256):
+            yield text[i:i + 256], None
+        yield "", finish_reason
+
+
+class ContextCacheFaultInjectingBackend(FaultInjectingBackend, ContextCacheBackend):
+    """FaultInjectingBackend around a ContextCacheBackend; cache calls pass through without faults."""
+
+    async def acreate_context_cache(self, model: str, prompt: str, ttl_seconds: int) -> Dict:
+        return await self.inner.acreate_context_cache(model, prompt, ttl_seconds)
+
+    async def arefresh_context_cache(self, name: str, ttl_seconds: int) -> float:
+        return await self.inner.arefresh_context_cache(name, ttl_seconds)
+
+
+def inject_faults(backend: GeminiBackend, **rates) -> FaultInjectingBackend:
+    """Wrap ``backend`` with fault injection, keeping its context-cache capability if it has one."""
+    if isinstance(backend, ContextCacheBackend):
+        return ContextCacheFaultInjectingBackend(backend, **rates)
+    return FaultInjectingBackend(backend, **rates)
+
+
+def create_gemini_backend(project: str, region: str) -> GeminiBackend:
+    """Build the backend selected by GEMINI_BACKEND, wrapped with fault injection if configured."""
+    mode = GEMINI_BACKEND
+    if mode not in ("vertex", "record", "replay"):
+        logger.warning("[CONFIG] Unknown GEMINI_BACKEND '%s'; using vertex", mode)
+        mode = "vertex"
+
+    backend: GeminiBackend
+    if mode == "replay":
+        backend = ReplayBackend(RecordingStore(GEMINI_RECORDINGS_DIR), LatencyModel.parse(GEMINI_REPLAY_LATENCY))
+    elif mode == "record":
+        backend = RecordingBackend(VertexBackend(project, region), RecordingStore(GEMINI_RECORDINGS_DIR))
+    else:
+        backend = VertexBackend(project, region)
+
+    if GEMINI_FAULT_429_RATE or GEMINI_FAULT_TRUNCATE_RATE or GEMINI_FAULT_MALFORMED_RATE:
+        backend = inject_faults(
+            backend,
+            rate_429=GEMINI_FAULT_429_RATE,
+            rate_truncate=GEMINI_FAULT_TRUNCATE_RATE,
+            rate_malformed=GEMINI_FAULT_MALFORMED_RATE,
+        )
+    logger.info("[CONFIG] Gemini backend: %s", mode if backend.name != "faults" else f"{mode} + fault injection")
+    return backend
+
+
+# ----------------- Rate Limiting -----------------
+# Process-wide request rate and retry policy for Vertex calls
+# Upper bound for the adaptive number of in-flight Gemini requests per process
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "16"))
+GEMINI_RATE_LIMIT_RPS = float(os.getenv("GEMINI_RATE_LIMIT_RPS", "10"))
+GEMINI_RATE_LIMIT_BURST = int(os.getenv("GEMINI_RATE_LIMIT_BURST", "20"))
+GEMINI_MIN_CONCURRENCY = int(os.getenv("GEMINI_MIN_CONCURRENCY", "1"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "5"))
+GEMINI_RETRY_BASE_SECONDS = float(os.getenv("GEMINI_RETRY_BASE_SECONDS", "1.0"))
+GEMINI_RETRY_MAX_SECONDS = float(os.getenv("GEMINI_RETRY_MAX_SECONDS", "30.0"))
+
+# Status codes worth retrying; 429 and 503 also signal that we are over quota
+_RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+_THROTTLE_STATUS_CODES = {429, 503}
+
+
+class GeminiUnavailableError(HTTPException):
+    """Raised when Vertex keeps throttling or failing after all retries; surfaces as HTTP 503."""
+
+    def __init__(self, retry_after: float, detail: str):
+        super().__init__(
+            status_code=503,
+            detail=detail,
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
 
+
+class TokenBucket:
+    """Thread-safe token bucket; callers reserve a token and sleep until it is available."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Take a token (possibly going into debt) and return how long to wait for it."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire_blocking(self) -> None:
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def acquire(self) -> None:
+        wait = self._reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+    @property
+    def tokens(self) -> float:
+        with self._lock:
+            elapsed = time.monotonic() - self._updated
+            return min(self.burst, self._tokens + elapsed * self.rate)
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD concurrency limit: +1/limit per success, halve on throttling (at most once per cooldown)."""
+
+    def __init__(self, max_limit: int, min_limit: int = 1, decrease_factor: float = 0.5, cooldown_seconds: float = 2.0):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.decrease_factor = decrease_factor
+        self.cooldown_seconds = cooldown_seconds
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self.waiting = 0
+        self._last_decrease = 0.0
+        self._condition: Optional[asyncio.Condition] = None
+        self._loop = None
+
+    def _get_condition(self) -> asyncio.Condition:
+        loop = asyncio.get_running_loop()
+        if self._condition is None or self._loop is not loop:
+            self._condition = asyncio.Condition()
+            self._loop = loop
+        return self._condition
+
+    @asynccontextmanager
+    async def slot(self):
+        condition = self._get_condition()
+        async with condition:
+            self.waiting += 1
             try:
-                parsed = json.loads(cleaned)
-            except json.JSONDecodeError as e:
-                logger.debug("[ANNOTATION] Initial JSON parse failed (may be truncated), trying fallback strategies")
-                
-                # Strategy 1: Try to extract complete JSON objects from a potentially truncated array
-                # Find all complete JSON objects in the text
-                objects = []
-                depth = 0
-                start = -1
-                in_string = False
-                escape = False
-                
-                for i, char in enumerate(cleaned):
-                    if escape:
-                        escape = False
-                        continue
-                    if char == '\\':
-                        escape = True
-                        continue
-                    if char == '"' and not escape:
-                        in_string = not in_string
-                        continue
-                    if in_string:
-                        continue
-                    
-                    if char == '{':
-                        if depth == 0:
-                            start = i
-                        depth += 1
-                    elif char == '}':
-                        depth -= 1
-                        if depth == 0 and start >= 0:
-                            # Found a complete object
-                            try:
-                                obj_str = cleaned[start:i+1]
-                                obj = json.loads(obj_str)
-                                if isinstance(obj, dict):
-                                    objects.append(obj)
-                            except json.JSONDecodeError:
-                                pass
-                            start = -1
-                
-                if objects:
-                    logger.info(
-                        "[ANNOTATION] Extracted %d complete objects from truncated JSON",
-                        len(objects)
-                    )
-                    parsed = objects
-                else:
-                    # Strategy 2: Try to find JSON array or object with regex (less reliable)
-                    array_match = re.search(r'\[.*\]', cleaned, re.DOTALL)
-                    object_match = re.search(r'\{.*\}', cleaned, re.DOTALL)
-                    candidate = (
-                        array_match.group(0)
-                        if array_match
-                        else object_match.group(0)
-                        if object_match
-                        else None
-                    )
+                await condition.wait_for(lambda: self.in_flight < max(self.min_limit, int(self.limit)))
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            async with condition:
+                self.in_flight -= 1
+                condition.notify_all()
+
+    def on_success(self) -> None:
+        self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+
+    def on_throttle(self) -> None:
+        now = time.monotonic()
+        # Concurrent requests fail together; only react to the first of a burst
+        if now - self._last_decrease < self.cooldown_seconds:
+            return
+        self._last_decrease = now
+        previous = self.limit
+        self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+        logger.warning("[RATE-LIMIT] Throttled by Vertex; concurrency limit %.1f -> %.1f", previous, self.limit)
+
+
+class GeminiRateLimiter:
+    """Shared token bucket + AIMD concurrency controller + retry policy for all Gemini calls."""
+
+    def __init__(
+        self,
+        rate: float = GEMINI_RATE_LIMIT_RPS,
+        burst: int = GEMINI_RATE_LIMIT_BURST,
+        max_concurrency: int = GEMINI_MAX_CONCURRENCY,
+        min_concurrency: int = GEMINI_MIN_CONCURRENCY,
+        max_retries: int = GEMINI_MAX_RETRIES,
+        base_delay: float = GEMINI_RETRY_BASE_SECONDS,
+        max_delay: float = GEMINI_RETRY_MAX_SECONDS,
+    ):
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = AdaptiveConcurrencyLimiter(max_concurrency, min_concurrency)
+        self.max_retries = max(0, max_retries)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._random = random.Random()
+        self._stats = {"requests": 0, "retries": 0, "throttled": 0, "exhausted": 0}
 
-                    if candidate:
-                        try:
-                            parsed = json.loads(candidate)
-                        except json.JSONDecodeError:
-                            logger.warning(
-                                "[ANNOTATION] Failed to parse candidate JSON chunk (response likely truncated at MAX_TOKENS)"
-                            )
-                    else:
-                        logger.warning("[ANNOTATION] No JSON structure detected in bbox response")
+    @staticmethod
+    def status_code(exc: Exception) -> Optional[int]:
+        code = getattr(exc, "code", None)
+        return code if isinstance(code, int) else None
 
-            if parsed is None:
-                logger.warning("[ANNOTATION] Gemini bbox response was not valid JSON (response may be truncated)")
-                return []
+    def is_retryable(self, exc: Exception) -> bool:
+        if isinstance(exc, genai_errors.APIError):
+            return self.status_code(exc) in _RETRYABLE_STATUS_CODES
+        # Timeouts and dropped connections from the HTTP transport
+        return isinstance(exc, (TimeoutError, ConnectionError)) or type(exc).__module__.startswith("httpx")
 
-            # Support both raw list and {"annotations": [...]} style
-            if isinstance(parsed, dict) and "annotations" in parsed:
-                data = parsed.get("annotations")
-            else:
-                data = parsed
+    @staticmethod
+    def retry_after(exc: Exception) -> Optional[float]:
+        """Seconds requested by a Retry-After header (delta or HTTP date), if any."""
+        response = getattr(exc, "response", None)
+        headers = getattr(response, "headers", None)
+        if not headers:
+            return None
+        value = headers.get("Retry-After") or headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
 
-            if not isinstance(data, list):
-                logger.warning("[ANNOTATION] Bbox payload is not an array")
-                return []
+    def backoff(self, attempt: int, exc: Exception) -> float:
+        """Full-jitter exponential backoff, never shorter than the server's Retry-After."""
+        delay = self._random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        retry_after = self.retry_after(exc)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay * 4))
+        return delay
+
+    def record_request(self) -> None:
+        self._stats["requests"] += 1
+
+    def on_success(self) -> None:
+        self.concurrency.on_success()
+
+    def on_failure(self, exc: Exception, attempt: int) -> Optional[float]:
+        """Record a failed attempt; return the delay before retrying, or None to give up."""
+        code = self.status_code(exc)
+        if code in _THROTTLE_STATUS_CODES:
+            self._stats["throttled"] += 1
+            self.concurrency.on_throttle()
+        if not self.is_retryable(exc):
+            return None
+        if attempt >= self.max_retries:
+            self._stats["exhausted"] += 1
+            return None
+        self._stats["retries"] += 1
+        delay = self.backoff(attempt, exc)
+        logger.warning(
+            "[RATE-LIMIT] Gemini call failed (%s: %s); retry %d/%d in %.1fs",
+            code or type(exc).__name__,
+            str(exc)[:200],
+            attempt + 1,
+            self.max_retries,
+            delay,
+        )
+        return delay
+
+    def exhausted_error(self, exc: Exception, attempt: int) -> Exception:
+        """Error to raise once a retryable failure has used up its attempts."""
+        if not self.is_retryable(exc):
+            return exc
+        retry_after = self.retry_after(exc) or self.base_delay * (2 ** attempt)
+        return GeminiUnavailableError(
+            min(retry_after, self.max_delay),
+            "The AI model is temporarily overloaded. Please retry shortly.",
+        )
 
-            bbox_entries: List[Dict] = []
-            for entry in data:
-                if not isinstance(entry, dict):
-                    continue
-                parameter = str(entry.get("parameter", "")).strip()
-                bbox = entry.get("bounding_box") or entry.get("bbox")
-                if not parameter:
-                    continue
-                
-                # Validate bounding box format
-                if bbox is not None:
-                    if not isinstance(bbox, list) or len(bbox) != 4:
-                        logger.debug(
-                            "[ANNOTATION] Skipping invalid bbox format for parameter '%s': %s",
-                            parameter,
-                            bbox
-                        )
-                        continue
-                    # Ensure all values are numeric
-                    try:
-                        bbox = [float(x) for x in bbox]
-                    except (ValueError, TypeError):
-                        logger.debug(
-                            "[ANNOTATION] Skipping bbox with non-numeric values for parameter '%s': %s",
-                            parameter,
-                            bbox
-                        )
-                        continue
-                
-                # Map parameter back to metric record to get normalized key
-                normalized_key = self._normalize_label(parameter)
-                
-                bbox_entries.append({
-                    "parameter": parameter,
-                    "key": normalized_key,
-                    "bounding_box": bbox,
-                })
+    def stats(self) -> Dict:
+        return {
+            **self._stats,
+            "concurrency_limit": round(self.concurrency.limit, 2),
+            "max_concurrency": self.concurrency.max_limit,
+            "in_flight": self.concurrency.in_flight,
+            "queue_depth": self.concurrency.waiting,
+            "rate_per_second": self.bucket.rate,
+            "tokens_available": round(self.bucket.tokens, 2),
+        }
 
-            logger.info("[ANNOTATION] Extracted %d CAD bounding boxes", len(bbox_entries))
-            return bbox_entries
-            
-        except Exception as exc:
-            logger.warning("[ANNOTATION] Unable to extract CAD bounding boxes: %s", exc, exc_info=True)
-            return []
 
-    @staticmethod
-    def _normalize_bbox(
-        bbox: List[float],
-        width: int,
-        height: int,
-    ) -> Optional[Tuple[int, int, int, int]]:
-        """
-        Normalize model bbox into (x1, y1, x2, y2) in image pixels.
-        Returns None for invalid boxes.
-        """
-        if len(bbox) != 4:
-            return None
+# ----------------- Context Cache -----------------
+# Cached-content handles for the large static prompts (weld, comparison strategies, vendor)
+GEMINI_CONTEXT_CACHE_ENABLED = os.getenv("GEMINI_CONTEXT_CACHE_ENABLED", "1").lower() not in ("0", "false", "no")
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL_SECONDS", "3600"))
+# After a failed create (e.g. prompt below the model's minimum cacheable size), send inline this long
+GEMINI_CONTEXT_CACHE_RETRY_SECONDS = int(os.getenv("GEMINI_CONTEXT_CACHE_RETRY_SECONDS", "3600"))
 
-        x1, y1, x2, y2 = [float(b) for b in bbox]
-        img_max = float(max(width, height))
 
-        # --- Case A: normalized [0..1] ---
-        if 0 <= x1 <= 1 and 0 <= y1 <= 1 and 0 <= x2 <= 1 and 0 <= y2 <= 1:
-            x1 *= width
-            x2 *= width
-            y1 *= height
-            y2 *= height
+class ContextCacheManager:
+    """Lazily created, auto-refreshed cached-content handles keyed by (model, prompt hash).
 
-        # --- Case B: percent [0..100] ---
-        elif 0 <= x1 <= 100 and 0 <= y1 <= 100 and 0 <= x2 <= 100 and 0 <= y2 <= 100:
-            x1 = (x1 / 100) * width
-            x2 = (x2 / 100) * width
-            y1 = (y1 / 100) * height
-            y2 = (y2 / 100) * height
+    The first request for a prompt is sent inline while the handle is created in the
+    background; later requests reference the handle instead of re-sending the prompt.
+    Handles are extended shortly before they expire. Any failure means the prompt is
+    sent inline again, so callers never see an error caused by caching.
+    """
 
-        # --- Reject boxes excessively outside image (hallucinated) ---
-        if max(abs(x1), abs(y1), abs(x2), abs(y2)) > img_max * 2:
-            return None
+    def __init__(
+        self,
+        ttl_seconds: int = GEMINI_CONTEXT_CACHE_TTL_SECONDS,
+        retry_seconds: int = GEMINI_CONTEXT_CACHE_RETRY_SECONDS,
+        enabled: bool = GEMINI_CONTEXT_CACHE_ENABLED,
+    ):
+        self.ttl_seconds = max(60, ttl_seconds)
+        self.retry_seconds = max(0, retry_seconds)
+        # Refresh once less than 10% of the TTL is left
+        self.refresh_margin = max(30.0, self.ttl_seconds * 0.1)
+        self.enabled = enabled
+        self._handles: Dict[Tuple[str, str], Dict] = {}
+        self._failed_until: Dict[Tuple[str, str], float] = {}
+        self._pending: set = set()
+        self._tasks: set = set()
+        self._lock = threading.Lock()
+        self._stats = {
+            "created": 0,
+            "refreshed": 0,
+            "failures": 0,
+            "invalidated": 0,
+            "hits": 0,
+            "inline": 0,
+            "input_tokens_saved": 0,
+        }
 
-        # --- Handle width/height format [x, y, w, h] ---
-        if x2 > 0 and y2 > 0 and (x2 <= width and y2 <= height) and (x2 < x1 or y2 < y1):
-            w, h = x2, y2
-            x2 = x1 + w
-            y2 = y1 + h
+    @staticmethod
+    def _key(model: str, prompt: str) -> Tuple[str, str]:
+        return model, hashlib.sha256(prompt.encode("utf-8")).hexdigest()
 
-        # --- Clamp ---
-        x1 = max(0, min(int(round(x1)), width - 1))
-        x2 = max(0, min(int(round(x2)), width - 1))
-        y1 = max(0, min(int(round(y1)), height - 1))
-        y2 = max(0, min(int(round(y2)), height - 1))
+    def lookup(self, backend: GeminiBackend, model: str, prompt: str) -> Optional[str]:
+        """Return a cached-content name for ``prompt``, or None to send it inline.
 
-        # --- Reject inverted / zero-area boxes ---
-        if x2 <= x1 or y2 <= y1:
+        Must be called from the event loop: creation and refresh run as background tasks.
+        """
+        if not self.enabled or not isinstance(backend, ContextCacheBackend):
             return None
+        key = self._key(model, prompt)
+        now = time.time()
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is not None and handle["expires_at"] <= now + 5:
+                del self._handles[key]
+                handle = None
+            if handle is None:
+                self._stats["inline"] += 1
+                if now >= self._failed_until.get(key, 0.0):
+                    self._schedule(backend, key, prompt, None)
+                return None
+            if handle["expires_at"] - now < self.refresh_margin:
+                self._schedule(backend, key, prompt, handle["name"])
+            self._stats["hits"] += 1
+            self._stats["input_tokens_saved"] += handle["tokens"]
+            return handle["name"]
+
+    def invalidate(self, model: str, prompt: str, name: str) -> None:
+        """Forget a handle Vertex rejected (deleted or expired early)."""
+        key = self._key(model, prompt)
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is not None and handle["name"] == name:
+                del self._handles[key]
+                self._stats["invalidated"] += 1
+                # The request that found the handle stale re-sends the prompt after all
+                self._stats["input_tokens_saved"] -= handle["tokens"]
+        logger.warning("[CONTEXT CACHE] Handle %s rejected; sending prompt inline", name)
+
+    def _schedule(self, backend: GeminiBackend, key: Tuple[str, str], prompt: str, name: Optional[str]) -> None:
+        # Caller holds the lock
+        if key in self._pending:
+            return
+        self._pending.add(key)
+        task = asyncio.get_running_loop().create_task(self._create_or_refresh(backend, key, prompt, name))
+        # Keep a reference so the task is not garbage collected mid-flight
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _create_or_refresh(self, backend: GeminiBackend, key: Tuple[str, str], prompt: str, name: Optional[str]) -> None:
+        model, digest = key
+        try:
+            if name is not None:
+                try:
+                    expires_at = await backend.arefresh_context_cache(name, self.ttl_seconds)
+                    with self._lock:
+                        handle = self._handles.get(key)
+                        if handle is not None and handle["name"] == name:
+                            handle["expires_at"] = expires_at
+                        self._stats["refreshed"] += 1
+                    logger.info("[CONTEXT CACHE] Extended %s for prompt %s", name, digest[:12])
+                    return
+                except Exception as exc:
+                    logger.warning("[CONTEXT CACHE] Could not extend %s (%s); creating a new handle", name, exc)
+
+            handle = await backend.acreate_context_cache(model, prompt, self.ttl_seconds)
+            with self._lock:
+                self._handles[key] = handle
+                self._failed_until.pop(key, None)
+                self._stats["created"] += 1
+            logger.info(
+                "[CONTEXT CACHE] Created %s for prompt %s on %s (%d tokens)",
+                handle["name"], digest[:12], model, handle["tokens"],
+            )
+        except Exception as exc:
+            with self._lock:
+                self._failed_until[key] = time.time() + self.retry_seconds
+                self._stats["failures"] += 1
+            logger.warning(
+                "[CONTEXT CACHE] Could not cache prompt %s on %s (%s); sending it inline for %ds",
+                digest[:12], model, exc, self.retry_seconds,
+            )
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                **self._stats,
+                "enabled": self.enabled,
+                "handles": len(self._handles),
+                "ttl_seconds": self.ttl_seconds,
+            }
 
-        # --- Reject very tiny boxes ---
-        if (x2 - x1) < 3 or (y2 - y1) < 3:
-            return None
 
-        # --- Reject extremely large boxes (almost whole image) ---
-        box_area = (x2 - x1) * (y2 - y1)
-        img_area = width * height
-        if box_area > img_area * 0.80:
-            return None
+# ----------------- Gemini Client -----------------
+# Follow-up requests allowed when a response stops at MAX_TOKENS
+GEMINI_MAX_CONTINUATIONS = int(os.getenv("GEMINI_MAX_CONTINUATIONS", "3"))
 
-        return x1, y1, x2, y2
 
-    def _clamp_bbox(bbox: List[float], width: int, height: int) -> Tuple[int, int, int, int]:
-        x1, y1, x2, y2 = bbox
-        x1 = max(0, min(int(round(x1)), width - 1))
-        x2 = max(0, min(int(round(x2)), width - 1))
-        y1 = max(0, min(int(round(y1)), height - 1))
-        y2 = max(0, min(int(round(y2)), height - 1))
-        if x2 < x1:
-            x1, x2 = x2, x1
-        if y2 < y1:
-            y1, y2 = y2, y1
-        return x1, y1, x2, y2
+class GeminiClient:
+    """Wrapper around Gemini 2.5 Pro via Vertex AI SDK."""
 
-    def _annotate_cad_image(
-        self,
-        cad_bytes: bytes,
-        comparisons: List[Dict],
-    ) -> Optional[str]:
-        """Create annotated CAD image highlighting matches/mismatches."""
-        np_bytes = np.frombuffer(cad_bytes, np.uint8)
-        image = cv2.imdecode(np_bytes, cv2.IMREAD_COLOR)
-        if image is None:
-            logger.warning("[ANNOTATION] Unable to decode CAD image for annotation")
-            return None
+    _CONTINUE_PROMPT = (
+        "Your previous response was cut off because it reached the output token limit. "
+        "Continue EXACTLY from the last character of your previous response. "
+        "Do NOT repeat any earlier text, do NOT restart the document, and do NOT add markdown fences, "
+        "explanations, or any text other than the continuation itself."
+    )
+    # How far back to look for text the model repeated at the start of a continuation
+    _STITCH_WINDOW = 512
+    _MIN_OVERLAP = 8
 
-        height, width = image.shape[:2]
-        colors = {
-            "Match": (0, 180, 0),
-            "Mismatch": (0, 0, 255),
-            "Missing": (0, 215, 255),
-            "Extra": (255, 165, 0),  # Orange for CAD-only metrics
+    def __init__(
+        self,
+        project: str,
+        region: str,
+        model_name: str,
+        max_concurrency: int = GEMINI_MAX_CONCURRENCY,
+        cache: Optional[ResponseCache] = None,
+        max_continuations: int = GEMINI_MAX_CONTINUATIONS,
+        backend: Optional[GeminiBackend] = None,
+        rate_limiter: Optional[GeminiRateLimiter] = None,
+        files: Optional[FileHandleRegistry] = None,
+        context_cache: Optional[ContextCacheManager] = None,
+    ):
+        self.backend = backend or create_gemini_backend(project, region)
+        self.model_name = model_name
+        self.max_concurrency = max(1, max_concurrency)
+        # Token bucket + AIMD limit + retry policy; callers may share one limiter across clients
+        self.rate_limiter = rate_limiter or GeminiRateLimiter(max_concurrency=self.max_concurrency)
+        self.generation_config = {
+            "max_output_tokens": 16384,
+            "temperature": 0,  # Set to 0 for maximum determinism
         }
+        self.cache = cache
+        self.files = files or FileHandleRegistry(create_file_store(project))
+        self.context_cache = context_cache or ContextCacheManager()
+        self.max_continuations = max(0, max_continuations)
 
-        for record in comparisons:
-            bbox = record.get("bounding_box")
-            if not bbox or len(bbox) != 4:
+    def register_file(self, file_bytes: bytes, mime_type: Optional[str]) -> FileHandle:
+        """Encode/upload a file once and return a handle reusable by later calls."""
+        return self.files.get_or_create(file_bytes, mime_type)
+
+    async def aregister_file(self, file_bytes: bytes, mime_type: Optional[str]) -> FileHandle:
+        """Async variant of ``register_file`` (hashing/encoding runs in a thread)."""
+        return await asyncio.to_thread(self.files.get_or_create, file_bytes, mime_type)
+
+    def _build_contents(
+        self,
+        prompt: Optional[str],
+        files: List[Tuple[Union[bytes, str, FileHandle], Optional[str]]],
+    ) -> List[Union[str, types.Part]]:
+        # prompt is None when it is already held in a cached-content handle
+        contents: List[Union[str, types.Part]] = [prompt] if prompt is not None else []
+        for data, mime in files:
+            if isinstance(data, (bytes, FileHandle)):
+                handle = data if isinstance(data, FileHandle) else self.files.get_or_create(data, mime)
+                file_type = "PDF" if handle.mime_type == "application/pdf" else "image"
+                logger.info(f"Sending {file_type} to Gemini model {self.model_name}")
+                contents.append(handle.part)
+            else:
+                contents.append(str(data))
+        return contents
+
+    def _continuation_contents(self, contents: List[Union[str, types.Part]], partial_text: str) -> List[types.Content]:
+        """Replay the original request plus the truncated answer and ask the model to resume."""
+        user_parts = [part if isinstance(part, types.Part) else types.Part(text=part) for part in contents]
+        return [
+            types.Content(role="user", parts=user_parts),
+            types.Content(role="model", parts=[types.Part(text=partial_text)]),
+            types.Content(role="user", parts=[types.Part(text=self._CONTINUE_PROMPT)]),
+        ]
+
+    @classmethod
+    def _stitch(cls, previous: str, continuation: str) -> str:
+        """Return the part of ``continuation`` that is new relative to ``previous``.
+
+        Drops stray markdown fences and any text the model repeated from the end of
+        the truncated output, so the concatenation reads as one document.
+        """
+        piece = continuation
+        stripped = piece.lstrip()
+        if stripped.startswith("```"):
+            newline = stripped.find("\n")
+            piece = stripped[newline + 1:] if newline != -1 else ""
+        if piece.rstrip().endswith("```"):
+            piece = piece.rstrip()[:-3]
+
+        max_overlap = min(len(previous), len(piece), cls._STITCH_WINDOW)
+        for size in range(max_overlap, cls._MIN_OVERLAP - 1, -1):
+            if previous.endswith(piece[:size]):
+                return piece[size:]
+        return piece
+
+    def _generate(self, contents, config: Optional[Dict] = None) -> Tuple[str, Optional[str]]:
+        """Single blocking request with rate limiting and retry (no adaptive concurrency)."""
+        limiter = self.rate_limiter
+        attempt = 0
+        while True:
+            limiter.bucket.acquire_blocking()
+            limiter.record_request()
+            try:
+                text, finish_reason = self.backend.generate(self.model_name, contents, config or self.generation_config)
+            except Exception as exc:
+                delay = limiter.on_failure(exc, attempt)
+                if delay is None:
+                    error = limiter.exhausted_error(exc, attempt)
+                    if error is exc:
+                        raise
+                    raise error from exc
+                attempt += 1
+                time.sleep(delay)
                 continue
-            norm = self._normalize_bbox(bbox, width, height)
-            if not norm:
-                logger.debug(f"[ANNOTATION] Skipping invalid bbox: {bbox}")
+            limiter.on_success()
+            self._log_finish_reason(finish_reason)
+            return text, finish_reason
+
+    async def _agenerate(self, contents, config: Optional[Dict] = None) -> Tuple[str, Optional[str]]:
+        """Single request with token bucket, adaptive concurrency slot and retry."""
+        limiter = self.rate_limiter
+        attempt = 0
+        while True:
+            await limiter.bucket.acquire()
+            try:
+                async with limiter.concurrency.slot():
+                    limiter.record_request()
+                    text, finish_reason = await self.backend.agenerate(self.model_name, contents, config or self.generation_config)
+            except Exception as exc:
+                delay = limiter.on_failure(exc, attempt)
+                if delay is None:
+                    error = limiter.exhausted_error(exc, attempt)
+                    if error is exc:
+                        raise
+                    raise error from exc
+                attempt += 1
+                # Back off outside the slot so other requests can proceed
+                await asyncio.sleep(delay)
                 continue
+            limiter.on_success()
+            self._log_finish_reason(finish_reason)
+            return text, finish_reason
 
-            x1, y1, x2, y2 = norm
-            color = colors.get(record.get("match", ""), (255, 255, 255))
-            cv2.rectangle(image, (x1, y1), (x2, y2), color, 2)
-            label_text = f"{record.get('parameter', '')}: {record.get('match', '')}"
-            cv2.putText(
-                image,
-                label_text,
-                (x1, max(y1 - 8, 16)),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                0.5,
-                color,
-                2,
-                cv2.LINE_AA,
-            )
+    async def _astream(self, contents, config: Optional[Dict] = None) -> AsyncIterator[Tuple[str, Optional[str]]]:
+        """Stream one request, retrying failures that happen before the first chunk.
 
-        success, buffer = cv2.imencode(".png", image)
-        if not success:
-            logger.warning("[ANNOTATION] Failed to encode annotated image")
+        Each attempt holds a concurrency slot only while its upstream stream is open.
+        """
+        limiter = self.rate_limiter
+        attempt = 0
+        while True:
+            await limiter.bucket.acquire()
+            started = False
+            try:
+                async with limiter.concurrency.slot():
+                    limiter.record_request()
+                    async for item in self.backend.astream(self.model_name, contents, config or self.generation_config):
+                        started = True
+                        yield item
+            except Exception as exc:
+                if started:
+                    raise
+                delay = limiter.on_failure(exc, attempt)
+                if delay is None:
+                    error = limiter.exhausted_error(exc, attempt)
+                    if error is exc:
+                        raise
+                    raise error from exc
+                attempt += 1
+                # Back off outside the slot so other requests can proceed
+                await asyncio.sleep(delay)
+                continue
+            limiter.on_success()
+            return
+
+    def _generate_complete(self, contents: List[Union[str, types.Part]]) -> Tuple[str, Optional[str]]:
+        """Generate, issuing continuation requests while the output stops at MAX_TOKENS."""
+        text, finish_reason = self._generate(contents)
+        rounds = 0
+        while finish_reason == 'MAX_TOKENS' and text and rounds < self.max_continuations:
+            rounds += 1
+            logger.info("[CONTINUATION] Output hit MAX_TOKENS; requesting continuation %d/%d", rounds, self.max_continuations)
+            piece, finish_reason = self._generate(self._continuation_contents(contents, text))
+            text += self._stitch(text, piece)
+        if finish_reason == 'MAX_TOKENS':
+            logger.warning("[CONTINUATION] Output still truncated after %d continuation(s)", rounds)
+        return text, finish_reason
+
+    async def _agenerate_complete(
+        self,
+        contents: List[Union[str, types.Part]],
+        config: Optional[Dict] = None,
+    ) -> Tuple[str, Optional[str]]:
+        """Async variant of ``_generate_complete``."""
+        text, finish_reason = await self._agenerate(contents, config)
+        rounds = 0
+        while finish_reason == 'MAX_TOKENS' and text and rounds < self.max_continuations:
+            rounds += 1
+            logger.info("[CONTINUATION] Output hit MAX_TOKENS; requesting continuation %d/%d", rounds, self.max_continuations)
+            continuation_contents = await asyncio.to_thread(self._continuation_contents, contents, text)
+            piece, finish_reason = await self._agenerate(continuation_contents, config)
+            text += self._stitch(text, piece)
+        if finish_reason == 'MAX_TOKENS':
+            logger.warning("[CONTINUATION] Output still truncated after %d continuation(s)", rounds)
+        return text, finish_reason
+
+    @staticmethod
+    def _log_finish_reason(finish_reason: Optional[str]) -> None:
+        if finish_reason is None:
+            return
+        if finish_reason == 'MAX_TOKENS':
+            logger.warning("⚠ Response may have been truncated due to token limit")
+        logger.info(f"Finish reason: {finish_reason}")
+
+    def _cache_key(self, prompt: str, files: List[Tuple[Union[bytes, str, FileHandle], Optional[str]]]) -> Optional[str]:
+        if self.cache is None:
             return None
-        encoded = base64.b64encode(buffer).decode("utf-8")
-        return f"data:image/png;base64,{encoded}"
+        return ResponseCache.make_key(self.model_name, self.generation_config, prompt, files)
+
+    def _store_response(self, key: Optional[str], text: Optional[str], finish_reason: Optional[str]) -> None:
+        # Never cache empty or truncated output; a retry may do better
+        if key is None or not text or finish_reason == 'MAX_TOKENS':
+            return
+        self.cache.set(key, text)
+
+    def _context_request(self, prompt: str, cache_prompt: bool) -> Tuple[Optional[str], Dict]:
+        """Return ``(cached_content_name, config)``; the name is None when the prompt goes inline."""
+        if not cache_prompt:
+            return None, self.generation_config
+        name = self.context_cache.lookup(self.backend, self.model_name, prompt)
+        if name is None:
+            return None, self.generation_config
+        return name, {**self.generation_config, "cached_content": name}
 
-    def generate_auto_annotations(
-        self,
-        rfq_requirements: List[str],
-        cad_findings: List[str],
-        cad_bytes: bytes,
-        cad_mime: str,
-    ) -> Tuple[Optional[str], List[Dict]]:
+    @staticmethod
+    def _is_context_cache_error(exc: Exception, cached_content: str) -> bool:
+        """Whether ``exc`` rejects the cached-content handle itself rather than the request.
+
+        Vertex answers 400/403/404 for cached content that expired, was deleted or does not
+        match, but those codes also cover ordinary bad requests; only an error whose message
+        names cached content (or the handle) is treated as a stale cache.
         """
-        Build comparison records and annotated image using two-step flow:
-        1. build_metric_records: backend determines Match/Mismatch/Missing status
-        2. _extract_cad_bboxes: Gemini only provides bounding box locations
+        if not isinstance(exc, genai_errors.APIError) or exc.code not in (400, 403, 404):
+            return False
+        message = f"{exc.status or ''} {exc.message or ''}".lower()
+        return cached_content.lower() in message or "cachedcontent" in re.sub(r"[\s_]", "", message)
+
+    def chat(self, file_bytes: bytes, mime_type: str, prompt: str) -> str:
+        """Send single file + prompt to Gemini and return text response."""
+        return self.chat_with_files(prompt, [(file_bytes, mime_type)])
+
+    def chat_with_files(self, prompt: str, files: List[Tuple[Union[bytes, str, FileHandle], Optional[str]]]) -> str:
+        """Send multiple files + prompt to Gemini and return text response.
+
+        Blocking; use ``achat_with_files`` from async code.
         """
-        if not cad_mime.startswith("image/"):
-            logger.info("[ANNOTATION] CAD file is not an image; skipping auto-annotation")
-            return None, []
+        key = self._cache_key(prompt, files)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                logger.info("[CACHE] Hit for %s request %s", self.model_name, key[:12])
+                return cached
 
-        # Step 1: Build canonical metric records with backend-determined status
-        try:
-            metric_records = self.build_metric_records(rfq_requirements, cad_findings)
-        except Exception as exc:
-            logger.warning("[ANNOTATION] Unable to build metric records: %s", exc, exc_info=True)
-            return None, []
+        contents = self._build_contents(prompt, files)
 
-        if not metric_records:
-            logger.info("[ANNOTATION] No metric records available for annotation")
-            return None, []
+        text, finish_reason = self._generate_complete(contents)
+        self._store_response(key, text, finish_reason)
+        return text
 
-        # Step 2: Get bounding boxes from Gemini (no status/value decisions)
+    async def achat(self, file_bytes: bytes, mime_type: str, prompt: str, cache_prompt: bool = False) -> str:
+        """Async variant of ``chat``."""
+        return await self.achat_with_files(prompt, [(file_bytes, mime_type)], cache_prompt=cache_prompt)
+
+    async def achat_with_files(
+        self,
+        prompt: str,
+        files: List[Tuple[Union[bytes, str, FileHandle], Optional[str]]],
+        cache_prompt: bool = False,
+    ) -> str:
+        """Send multiple files + prompt to Gemini without blocking the event loop.
+
+        Calls are paced by the shared token bucket, limited by the adaptive concurrency
+        controller and retried with jittered backoff on 429/5xx responses.
+        Set ``cache_prompt`` for large static prompts so they are served from a
+        cached-content handle instead of being re-sent (see ``ContextCacheManager``).
+        """
+        # Hashing and base64 encoding of large drawings is CPU work; keep it off the loop
+        key = await asyncio.to_thread(self._cache_key, prompt, files)
+        if key is not None:
+            cached = await asyncio.to_thread(self.cache.get, key)
+            if cached is not None:
+                logger.info("[CACHE] Hit for %s request %s", self.model_name, key[:12])
+                return cached
+
+        cached_content, config = self._context_request(prompt, cache_prompt and bool(files))
+        contents = await asyncio.to_thread(self._build_contents, None if cached_content else prompt, files)
         try:
-            bbox_entries = self._extract_cad_bboxes(cad_bytes, cad_mime, metric_records)
+            text, finish_reason = await self._agenerate_complete(contents, config)
         except Exception as exc:
-            logger.warning("[ANNOTATION] Unable to extract CAD bounding boxes: %s", exc, exc_info=True)
-            bbox_entries = []
+            if cached_content is None or not self._is_context_cache_error(exc, cached_content):
+                raise
+            self.context_cache.invalidate(self.model_name, prompt, cached_content)
+            contents = await asyncio.to_thread(self._build_contents, prompt, files)
+            text, finish_reason = await self._agenerate_complete(contents)
 
-        # Step 3: Merge metric records with bounding boxes
-        bbox_lookup = {entry.get("key"): entry for entry in bbox_entries}
-        
-        comparison_records: List[Dict] = []
-        for record in metric_records:
-            bbox_entry = bbox_lookup.get(record.get("key"))
-            bbox = bbox_entry.get("bounding_box") if bbox_entry else None
-            
-            # Normalize bounding box format
-            if isinstance(bbox, list) and len(bbox) == 4:
-                bbox_values = [float(coord) for coord in bbox]
-            else:
-                bbox_values = None
+        await asyncio.to_thread(self._store_response, key, text, finish_reason)
+        return text
 
-            comparison_records.append({
-                "parameter": record.get("label", ""),
-                "rfq_value": record.get("rfq_value", ""),
-                "cad_value": record.get("cad_value", ""),
-                "match": record.get("match", "Missing"),
-                "bounding_box": bbox_values,
-            })
+    async def astream_with_files(
+        self,
+        prompt: str,
+        files: List[Tuple[Union[bytes, str, FileHandle], Optional[str]]],
+        cache_prompt: bool = False,
+    ) -> AsyncIterator[str]:
+        """Stream response text chunks from Gemini as they are generated.
+
+        Cache hits are replayed as a single chunk; completed streams are cached.
+        A stream that stops at MAX_TOKENS is resumed with continuation requests; the
+        first chunks of each continuation are buffered so repeated text can be dropped.
+        """
+        key = await asyncio.to_thread(self._cache_key, prompt, files)
+        if key is not None:
+            cached = await asyncio.to_thread(self.cache.get, key)
+            if cached is not None:
+                logger.info("[CACHE] Hit for %s request %s (stream)", self.model_name, key[:12])
+                yield cached
+                return
+
+        cached_content, config = self._context_request(prompt, cache_prompt and bool(files))
+        contents = await asyncio.to_thread(self._build_contents, None if cached_content else prompt, files)
+
+        chunks: List[str] = []
+        finish_reason: Optional[str] = None
+        request_contents = contents
+        rounds = 0
+        while True:
+            finish_reason = None
+            pending: Optional[str] = "" if rounds else None
+            try:
+                async for text, chunk_reason in self._astream(request_contents, config):
+                    finish_reason = chunk_reason or finish_reason
+                    if not text:
+                        continue
+                    if pending is not None:
+                        pending += text
+                        if len(pending) < self._STITCH_WINDOW:
+                            continue
+                        text = self._stitch("".join(chunks), pending)
+                        pending = None
+                    chunks.append(text)
+                    yield text
+            except Exception as exc:
+                # A rejected handle fails before any output; retry once with the prompt inline
+                if chunks or cached_content is None or not self._is_context_cache_error(exc, cached_content):
+                    raise
+                self.context_cache.invalidate(self.model_name, prompt, cached_content)
+                cached_content, config = None, self.generation_config
+                contents = await asyncio.to_thread(self._build_contents, prompt, files)
+                request_contents = contents
+                continue
+            if pending:
+                text = self._stitch("".join(chunks), pending)
+                chunks.append(text)
+                yield text
 
-        # Step 4: Create annotated image with only records that have bounding boxes
-        annotated_image = self._annotate_cad_image(
-            cad_bytes,
-            [record for record in comparison_records if record.get("bounding_box")],
+            self._log_finish_reason(finish_reason)
+            if finish_reason != 'MAX_TOKENS' or not chunks or rounds >= self.max_continuations:
+                break
+            rounds += 1
+            logger.info("[CONTINUATION] Stream hit MAX_TOKENS; requesting continuation %d/%d", rounds, self.max_continuations)
+            request_contents = self._continuation_contents(contents, "".join(chunks))
+
+        await asyncio.to_thread(self._store_response, key, "".join(chunks), finish_reason)
+
+
+# ----------------- Vendor Scoring -----------------
+# Deterministic weighted ranking of extracted vendor quotes; re-ranking never calls the model
+VENDOR_SCORE_WEIGHTS = os.getenv("VENDOR_SCORE_WEIGHTS", "price=0.5,delivery=0.3,warranty=0.2")
+VENDOR_COMPARISON_TTL_SECONDS = int(os.getenv("VENDOR_COMPARISON_TTL_SECONDS", str(24 * 3600)))
+VENDOR_COMPARISON_MAX_ENTRIES = int(os.getenv("VENDOR_COMPARISON_MAX_ENTRIES", "256"))
+# Stored vendor tables for /compare-vendor/rerank, shared by every worker process on the node
+VENDOR_COMPARISON_DB_PATH = Path(
+    os.getenv("VENDOR_COMPARISON_DB_PATH", str(Path(__file__).resolve().parent / "output" / "vendor_comparisons.db"))
+)
+
+VENDOR_SCORE_CRITERIA: Tuple[str, ...] = ("price", "delivery", "warranty")
+_LOWER_IS_BETTER = {"price", "delivery"}
+
+
+def normalize_score_weights(weights: Dict[str, float]) -> Dict[str, float]:
+    """Validate criterion weights and scale them to sum to 1 (missing criteria weigh 0)."""
+    unknown = set(weights) - set(VENDOR_SCORE_CRITERIA)
+    if unknown:
+        raise ValueError(f"Unknown scoring criteria: {', '.join(sorted(unknown))}")
+    values = {name: float(weights.get(name) or 0.0) for name in VENDOR_SCORE_CRITERIA}
+    if any(value < 0 or not math.isfinite(value) for value in values.values()):
+        raise ValueError("Weights must be finite and non-negative")
+    total = sum(values.values())
+    if total <= 0:
+        raise ValueError("At least one weight must be positive")
+    return {name: value / total for name, value in values.items()}
+
+
+def parse_score_weights(spec: str) -> Dict[str, float]:
+    """Parse ``"price=0.5,delivery=0.3,warranty=0.2"`` into normalized weights."""
+    weights: Dict[str, float] = {}
+    for item in (spec or "").split(","):
+        name, _, value = item.partition("=")
+        if name.strip():
+            weights[name.strip().lower()] = float(value)
+    return normalize_score_weights(weights)
+
+
+def vendor_number(value) -> Optional[float]:
+    """Best-effort numeric value of an extracted field ("₹1,250.50" -> 1250.5)."""
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value) if math.isfinite(value) else None
+    match = re.search(r"-?\d+(?:\.\d+)?", str(value).replace(",", ""))
+    return float(match.group(0)) if match else None
+
+
+def warranty_months(value) -> Optional[float]:
+    """Warranty period in months ("18 months", "2 years", "1 yr"; bare numbers are months)."""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.search(r"(\d+(?:\.\d+)?)\s*(years?|yrs?|months?|mos?|weeks?|wks?|days?)?", str(value).lower())
+    if not match:
+        return None
+    amount = float(match.group(1))
+    unit = match.group(2) or "month"
+    if unit.startswith("y"):
+        return amount * 12
+    if unit.startswith("w"):
+        return amount * 12 / 52
+    if unit.startswith("d"):
+        return amount / 30
+    return amount
+
+
+def _vendor_field(vendor: Dict, section: str, key: str):
+    value = vendor.get(section)
+    return value.get(key) if isinstance(value, dict) else None
+
+
+def vendor_features(vendors: List[Dict]) -> pd.DataFrame:
+    """One row per vendor with the raw criteria values (NaN when not extracted)."""
+    return pd.DataFrame({
+        "vendor_name": [str(vendor.get("vendor_name") or f"Vendor {i + 1}") for i, vendor in enumerate(vendors)],
+        "price": pd.Series([vendor_number(_vendor_field(vendor, "pricing", "unit_price_inr")) for vendor in vendors], dtype=float),
+        "delivery": pd.Series([vendor_number(_vendor_field(vendor, "delivery", "initial_days")) for vendor in vendors], dtype=float),
+        "warranty": pd.Series([warranty_months(vendor.get("warranty")) for vendor in vendors], dtype=float),
+    })
+
+
+def score_vendors(vendors: List[Dict], weights: Dict[str, float]) -> pd.DataFrame:
+    """Min-max normalize each criterion across vendors and apply the weights.
+
+    Criterion scores are in [0, 1] (1 = best); a missing value scores 0 and a criterion
+    on which all vendors tie scores 1. Rows come back sorted best first with a ``rank``.
+    """
+    frame = vendor_features(vendors)
+    criteria = list(VENDOR_SCORE_CRITERIA)
+    values = frame[criteria].to_numpy(dtype=float)
+    present = ~np.isnan(values)
+
+    low = np.where(present, values, np.inf).min(axis=0)
+    high = np.where(present, values, -np.inf).max(axis=0)
+    span = high - low
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scaled = (values - low) / np.where(span > 0, span, 1.0)
+    lower_is_better = np.array([name in _LOWER_IS_BETTER for name in criteria])
+    scaled = np.where(lower_is_better, 1.0 - scaled, scaled)
+    scaled = np.where(span > 0, scaled, 1.0)
+    scaled = np.where(present, scaled, 0.0)
+
+    weight_vector = np.array([weights[name] for name in criteria])
+    for i, name in enumerate(criteria):
+        frame[f"{name}_score"] = scaled[:, i]
+    frame["score"] = scaled @ weight_vector
+    frame = frame.sort_values(["score", "price"], ascending=[False, True], na_position="last", kind="mergesort")
+    frame["rank"] = np.arange(1, len(frame) + 1)
+    return frame
+
+
+def _nan_to_none(value) -> Optional[float]:
+    return None if value is None or pd.isna(value) else round(float(value), 4)
+
+
+def rank_vendors(vendors: List[Dict], weights: Dict[str, float]) -> Tuple[List[Dict], Dict[str, str]]:
+    """Return ``(ranking, comparison)`` for the ``vendors`` array of a vendor comparison."""
+    vendors = [vendor for vendor in vendors if isinstance(vendor, dict)]
+    if not vendors:
+        return [], {"best_price_vendor": "", "best_delivery_vendor": "", "best_warranty_vendor": "", "overall_recommendation": ""}
+
+    frame = score_vendors(vendors, weights)
+    ranking = [
+        {
+            "rank": int(row["rank"]),
+            "vendor_name": row["vendor_name"],
+            "score": round(float(row["score"]), 4),
+            "criteria": {name: round(float(row[f"{name}_score"]), 4) for name in VENDOR_SCORE_CRITERIA},
+            "values": {
+                "unit_price_inr": _nan_to_none(row["price"]),
+                "initial_days": _nan_to_none(row["delivery"]),
+                "warranty_months": _nan_to_none(row["warranty"]),
+            },
+        }
+        for _, row in frame.iterrows()
+    ]
+
+    def best(column: str, prefer_low: bool) -> str:
+        series = frame[column].dropna()
+        if series.empty:
+            return ""
+        return str(frame.loc[series.idxmin() if prefer_low else series.idxmax(), "vendor_name"])
+
+    comparison = {
+        "best_price_vendor": best("price", prefer_low=True),
+        "best_delivery_vendor": best("delivery", prefer_low=True),
+        "best_warranty_vendor": best("warranty", prefer_low=False),
+    }
+    top = ranking[0]["vendor_name"]
+    reasons = [
+        reason
+        for key, reason in (
+            ("best_price_vendor", "the lowest unit price"),
+            ("best_delivery_vendor", "the fastest initial delivery"),
+            ("best_warranty_vendor", "the longest warranty"),
         )
+        if comparison[key] == top
+    ]
+    detail = " and ".join(reasons) if reasons else "the most balanced price, delivery and warranty"
+    comparison["overall_recommendation"] = (
+        f"{top} offers the best overall value with {detail} (weighted score {ranking[0]['score']:.2f})."
+    )
+    return ranking, comparison
 
-        logger.info(
-            "[ANNOTATION] Generated %d annotation records (%d with bboxes)",
-            len(comparison_records),
-            len([r for r in comparison_records if r.get("bounding_box")]),
+
+class VendorComparisonStore(ABC):
+    """TTL/LRU store of extracted vendor tables, so a comparison can be re-ranked by id.
+
+    Only ``vendors`` is stored, since that is all re-ranking reads. Methods are blocking; call
+    them from a worker thread.
+    """
+
+    name = "base"
+
+    def __init__(self, ttl_seconds: int = VENDOR_COMPARISON_TTL_SECONDS, max_entries: int = VENDOR_COMPARISON_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max(1, max_entries)
+
+    @abstractmethod
+    def put(self, result: Dict) -> str:
+        """Store ``result``'s vendor table and return its comparison id."""
+
+    @abstractmethod
+    def get(self, comparison_id: str) -> Optional[Dict]:
+        """The stored entry, or None once it is unknown, expired or evicted."""
+
+
+class MemoryVendorComparisonStore(VendorComparisonStore):
+    """Vendor tables in this process only (single worker)."""
+
+    name = "memory"
+
+    def __init__(self, ttl_seconds: int = VENDOR_COMPARISON_TTL_SECONDS, max_entries: int = VENDOR_COMPARISON_MAX_ENTRIES):
+        super().__init__(ttl_seconds, max_entries)
+        self._entries: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, result: Dict) -> str:
+        comparison_id = uuid.uuid4().hex
+        with self._lock:
+            self._entries[comparison_id] = (time.time(), {"vendors": result.get("vendors") or []})
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return comparison_id
+
+    def get(self, comparison_id: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(comparison_id)
+            if entry is None:
+                return None
+            if time.time() - entry[0] > self.ttl_seconds:
+                del self._entries[comparison_id]
+                return None
+            self._entries.move_to_end(comparison_id)
+            return entry[1]
+
+
+class SqliteVendorComparisonStore(VendorComparisonStore):
+    """Vendor tables in SQLite (WAL), so any worker process on the node can re-rank."""
+
+    name = "sqlite"
+
+    def __init__(
+        self,
+        path: Path,
+        ttl_seconds: int = VENDOR_COMPARISON_TTL_SECONDS,
+        max_entries: int = VENDOR_COMPARISON_MAX_ENTRIES,
+        busy_timeout_ms: int = 5000,
+    ):
+        import sqlite3
+
+        super().__init__(ttl_seconds, max_entries)
+        self._sqlite3 = sqlite3
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS vendor_comparisons "
+            "(id TEXT PRIMARY KEY, created_at REAL NOT NULL, accessed_at REAL NOT NULL, data TEXT NOT NULL)"
         )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_vendor_comparisons_accessed ON vendor_comparisons (accessed_at)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._sqlite3.connect(str(self.path), timeout=self.busy_timeout_ms / 1000, isolation_level=None)
+            conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+            self._local.conn = conn
+        return conn
+
+    def put(self, result: Dict) -> str:
+        comparison_id = uuid.uuid4().hex
+        entry = {"vendors": result.get("vendors") or []}
+        now = time.time()
+        conn = self._connect()
+        conn.execute(
+            "INSERT INTO vendor_comparisons (id, created_at, accessed_at, data) VALUES (?, ?, ?, ?)",
+            (comparison_id, now, now, json.dumps(entry, ensure_ascii=False, default=str)),
+        )
+        conn.execute("DELETE FROM vendor_comparisons WHERE created_at < ?", (now - self.ttl_seconds,))
+        conn.execute(
+            "DELETE FROM vendor_comparisons WHERE id NOT IN "
+            "(SELECT id FROM vendor_comparisons ORDER BY accessed_at DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+        return comparison_id
+
+    def get(self, comparison_id: str) -> Optional[Dict]:
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT data FROM vendor_comparisons WHERE id = ? AND created_at >= ?",
+            (comparison_id, time.time() - self.ttl_seconds),
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE vendor_comparisons SET accessed_at = ? WHERE id = ?", (time.time(), comparison_id))
+        return json.loads(row[0])
 
-        return annotated_image, comparison_records
 
-    def parse_json_response(self, response_text: str):
-        """Parse JSON response from Gemini and extract welds and explanations.
-        
-        Returns:
-            tuple: (welds_list, explanations_string) or (None, None) if parsing fails
+def create_vendor_comparison_store() -> VendorComparisonStore:
+    """SQLite store at VENDOR_COMPARISON_DB_PATH, or per-process memory if the file is unusable."""
+    try:
+        return SqliteVendorComparisonStore(VENDOR_COMPARISON_DB_PATH)
+    except Exception as exc:
+        logger.warning(
+            "[VENDOR-COMPARE] Cannot open %s (%s); keeping comparisons in memory", VENDOR_COMPARISON_DB_PATH, exc
+        )
+    return MemoryVendorComparisonStore()
+
+
+# ----------------- Three-Way Matching -----------------
+# Relative tolerances for line quantities, unit prices and document totals
+MATCH_QTY_TOLERANCE = float(os.getenv("MATCH_QTY_TOLERANCE", "0.0"))
+MATCH_PRICE_TOLERANCE = float(os.getenv("MATCH_PRICE_TOLERANCE", "0.02"))
+# Cosine similarity two line descriptions need before they are treated as the same item
+MATCH_DESCRIPTION_THRESHOLD = float(os.getenv("MATCH_DESCRIPTION_THRESHOLD", "0.5"))
+
+MATCH_DOCUMENT_TYPES = ("PO", "GRN", "Invoice")
+# Which legs compare prices; a GRN records what arrived, not what it cost
+_MATCH_PAIRS = (("PO", "GRN", False), ("PO", "Invoice", True), ("GRN", "Invoice", False))
+_DESCRIPTION_DIMENSIONS = 512
+_SUPPLIER_SUFFIXES = {
+    "pvt", "private", "ltd", "limited", "llp", "llc", "inc", "incorporated",
+    "co", "company", "corp", "corporation", "gmbh", "plc", "the",
+}
+
+
+def normalize_document_type(value) -> Optional[str]:
+    """Map the extracted ``document_type`` onto PO / GRN / Invoice (other types pass through)."""
+    text = str(value or "").strip()
+    lowered = text.lower()
+    if not lowered:
+        return None
+    if lowered in ("po", "purchase order") or "purchase order" in lowered:
+        return "PO"
+    if lowered == "grn" or "goods receipt" in lowered or "goods received" in lowered:
+        return "GRN"
+    if "invoice" in lowered:
+        return "Invoice"
+    return text
+
+
+def normalize_order_number(value) -> Optional[str]:
+    """Index key for an order number: "PO # 4500-0123" and "po45000123" both become "45000123"."""
+    key = re.sub(r"[^A-Z0-9]", "", str(value or "").upper())
+    key = re.sub(r"^(PO|PONO|ORDERNO|ORDER)(?=\d)", "", key)
+    return key or None
+
+
+def normalize_supplier(value) -> Optional[str]:
+    """Index key for a supplier: lowercase words without punctuation or legal-form suffixes."""
+    words = re.findall(r"[a-z0-9]+", str(value or "").lower())
+    words = [word for word in words if word not in _SUPPLIER_SUFFIXES]
+    return " ".join(words) or None
+
+
+def match_keys(extracted: Optional[Dict]) -> Tuple[Optional[str], Optional[str]]:
+    """(order key, supplier key) a document is matched under; both None for unmatched types."""
+    extracted = extracted or {}
+    if normalize_document_type(extracted.get("document_type")) not in MATCH_DOCUMENT_TYPES:
+        return None, None
+    return normalize_order_number(extracted.get("order_number")), normalize_supplier(extracted.get("supplier"))
+
+
+def _description_vectors(descriptions: List[str]) -> np.ndarray:
+    """L2-normalized hashed bag of words and character trigrams, one row per description."""
+    vectors = np.zeros((len(descriptions), _DESCRIPTION_DIMENSIONS), dtype=np.float32)
+    for row, description in enumerate(descriptions):
+        text = " ".join(re.findall(r"[a-z0-9]+", description.lower()))
+        features = text.split() + [text[i:i + 3] for i in range(max(0, len(text) - 2))]
+        for feature in features:
+            digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=4).digest()
+            vectors[row, int.from_bytes(digest, "big") % _DESCRIPTION_DIMENSIONS] += 1.0
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+def _within(a: np.ndarray, b: np.ndarray, tolerance: float) -> np.ndarray:
+    """Element-wise relative comparison; pairs with a missing value count as agreeing."""
+    scale = np.maximum(np.maximum(np.abs(a), np.abs(b)), 1e-9)
+    ok = np.abs(a - b) <= tolerance * scale + 1e-9
+    return ok | np.isnan(a) | np.isnan(b)
+
+
+class MatchDocument:
+    """The parts of an extracted document the matcher needs, with line items as arrays."""
+
+    def __init__(self, doc_id: str, extracted: Dict, created_at: str = ""):
+        self.id = doc_id
+        self.created_at = created_at
+        self.document_type = normalize_document_type(extracted.get("document_type"))
+        self.order_key = normalize_order_number(extracted.get("order_number"))
+        self.supplier_key = normalize_supplier(extracted.get("supplier"))
+        self.total = vendor_number(extracted.get("total_amount"))
+        items = [item for item in extracted.get("line_items") or [] if isinstance(item, dict)]
+        self.descriptions = [str(item.get("description") or "") for item in items]
+        self.quantities = np.array([vendor_number(item.get("quantity")) for item in items], dtype=float)
+        self.unit_prices = np.array([vendor_number(item.get("unit_price")) for item in items], dtype=float)
+        self.vectors = _description_vectors(self.descriptions)
+
+
+def compare_line_items(left: MatchDocument, right: MatchDocument, compare_price: bool) -> Dict:
+    """Pair up two documents' line items and check quantities (and prices) within tolerance.
+
+    Similarities for every pair come from one matrix product; pairs are then taken greedily,
+    most similar first.
+    """
+    lines: List[Dict] = []
+    if len(left.descriptions) and len(right.descriptions):
+        similarity = left.vectors @ right.vectors.T
+        order = np.argsort(similarity, axis=None)[::-1]
+        rows, cols = np.unravel_index(order, similarity.shape)
+        keep = similarity[rows, cols] >= MATCH_DESCRIPTION_THRESHOLD
+        rows, cols = rows[keep], cols[keep]
+    else:
+        similarity = np.zeros((len(left.descriptions), len(right.descriptions)))
+        rows = cols = np.array([], dtype=int)
+
+    used_left, used_right = set(), set()
+    pairs: List[Tuple[int, int]] = []
+    for i, j in zip(rows.tolist(), cols.tolist()):
+        if i in used_left or j in used_right:
+            continue
+        used_left.add(i)
+        used_right.add(j)
+        pairs.append((i, j))
+
+    if pairs:
+        li = np.array([i for i, _ in pairs])
+        ri = np.array([j for _, j in pairs])
+        qty_ok = _within(left.quantities[li], right.quantities[ri], MATCH_QTY_TOLERANCE)
+        price_ok = (
+            _within(left.unit_prices[li], right.unit_prices[ri], MATCH_PRICE_TOLERANCE)
+            if compare_price
+            else np.ones(len(pairs), dtype=bool)
+        )
+        for k, (i, j) in enumerate(pairs):
+            issues = []
+            if not qty_ok[k]:
+                issues.append("quantity")
+            if not price_ok[k]:
+                issues.append("price")
+            lines.append({
+                "left": left.descriptions[i],
+                "right": right.descriptions[j],
+                "similarity": round(float(similarity[i, j]), 3),
+                "left_quantity": _nan_to_none(left.quantities[i]),
+                "right_quantity": _nan_to_none(right.quantities[j]),
+                "left_unit_price": _nan_to_none(left.unit_prices[i]),
+                "right_unit_price": _nan_to_none(right.unit_prices[j]),
+                "status": "mismatch" if issues else "match",
+                "issues": issues,
+            })
+    for i, description in enumerate(left.descriptions):
+        if i not in used_left:
+            lines.append({"left": description, "right": None, "status": "missing", "issues": ["unmatched_line"]})
+    for j, description in enumerate(right.descriptions):
+        if j not in used_right:
+            lines.append({"left": None, "right": description, "status": "missing", "issues": ["unmatched_line"]})
+
+    total_ok = True
+    if compare_price and left.total is not None and right.total is not None:
+        total_ok = bool(_within(np.array([left.total]), np.array([right.total]), MATCH_PRICE_TOLERANCE)[0])
+    matched = sum(1 for line in lines if line["status"] == "match")
+    return {
+        "left": left.id,
+        "right": right.id,
+        "lines": lines,
+        "matched_lines": matched,
+        "line_count": len(lines),
+        "total_ok": total_ok,
+        "ok": total_ok and matched == len(lines),
+    }
+
+
+class MatchingEngine:
+    """Three-way PO / GRN / Invoice matching over in-memory hash indexes.
+
+    Documents are indexed by normalized order number and by supplier, so matching a new
+    document touches only its own order group (or, without an order number, the same
+    supplier's documents). The engine is filled per match from the store's indexed
+    match-key columns (``DocumentStore.find_match_candidates``), never from a full scan.
+    """
+
+    def __init__(self):
+        self._documents: Dict[str, MatchDocument] = {}
+        self._by_order: Dict[str, Dict[str, List[str]]] = {}
+        self._by_supplier: Dict[str, Dict[str, List[str]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._documents
+
+    def add(self, doc_id: str, extracted: Dict, created_at: str = "") -> MatchDocument:
+        """Index (or re-index) a document's extraction."""
+        self.remove(doc_id)
+        document = MatchDocument(doc_id, extracted, created_at)
+        self._documents[doc_id] = document
+        if document.document_type in MATCH_DOCUMENT_TYPES:
+            if document.order_key:
+                self._by_order.setdefault(document.order_key, {}).setdefault(document.document_type, []).append(doc_id)
+            if document.supplier_key:
+                self._by_supplier.setdefault(document.supplier_key, {}).setdefault(document.document_type, []).append(doc_id)
+        return document
+
+    def remove(self, doc_id: str) -> None:
+        document = self._documents.pop(doc_id, None)
+        if document is None:
+            return
+        for index, key in ((self._by_order, document.order_key), (self._by_supplier, document.supplier_key)):
+            ids = index.get(key, {}).get(document.document_type)
+            if ids and doc_id in ids:
+                ids.remove(doc_id)
+
+    def _latest(self, ids: List[str]) -> Optional[MatchDocument]:
+        documents = [self._documents[doc_id] for doc_id in ids if doc_id in self._documents]
+        return max(documents, key=lambda d: (d.created_at, d.id)) if documents else None
+
+    def _group(self, document: MatchDocument) -> Dict[str, MatchDocument]:
+        group = {document.document_type: document}
+        if document.order_key:
+            for doc_type, ids in self._by_order.get(document.order_key, {}).items():
+                if doc_type != document.document_type:
+                    latest = self._latest(ids)
+                    if latest is not None:
+                        group[doc_type] = latest
+            return group
+        # No order number: take the same supplier's document whose lines agree best
+        for doc_type, ids in self._by_supplier.get(document.supplier_key, {}).items() if document.supplier_key else ():
+            if doc_type == document.document_type:
+                continue
+            best, best_score = None, 0.5
+            for doc_id in ids:
+                candidate = self._documents.get(doc_id)
+                if candidate is None:
+                    continue
+                # Score on paired descriptions only; quantity differences are for the match itself
+                lines = compare_line_items(document, candidate, compare_price=False)["lines"]
+                score = sum(1 for line in lines if line["status"] != "missing") / max(1, len(lines))
+                if score > best_score:
+                    best, best_score = candidate, score
+            if best is not None:
+                group[doc_type] = best
+        return group
+
+    def match(self, doc_id: str) -> Optional[Dict]:
+        """Match an indexed document against its group; None for types that are not matched."""
+        document = self._documents.get(doc_id)
+        if document is None or document.document_type not in MATCH_DOCUMENT_TYPES:
+            return None
+        group = self._group(document)
+        comparisons = [
+            {"pair": f"{left}-{right}", **compare_line_items(group[left], group[right], compare_price)}
+            for left, right, compare_price in _MATCH_PAIRS
+            if left in group and right in group
+        ]
+        missing = [doc_type for doc_type in MATCH_DOCUMENT_TYPES if doc_type not in group]
+        if any(not comparison["ok"] for comparison in comparisons):
+            status = "exception"
+        elif missing:
+            status = "partial"
+        else:
+            status = "match"
+        return {
+            "status": status,
+            "order_number": document.order_key,
+            "documents": {doc_type: member.id for doc_type, member in group.items()},
+            "missing": missing,
+            "comparisons": comparisons,
+            "matched_at": datetime.now().isoformat(),
+        }
+
+    def stats(self) -> Dict:
+        return {
+            "documents": len(self._documents),
+            "order_groups": len(self._by_order),
+            "suppliers": len(self._by_supplier),
+        }
+
+
+# ----------------- Background Jobs -----------------
+# Long-running analyses run on a bounded worker pool, independent of the HTTP connection
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+# Finished jobs are kept this long (and at most JOB_MAX_RETAINED of them) for polling
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", "3600"))
+JOB_MAX_RETAINED = int(os.getenv("JOB_MAX_RETAINED", "200"))
+# On shutdown, queued and running jobs get this long to finish before workers are cancelled
+JOB_DRAIN_SECONDS = float(os.getenv("JOB_DRAIN_SECONDS", "30"))
+# Job records: `sqlite` rows at JOB_DB_PATH shared by every worker process, results as files in
+# JOB_RESULTS_DIR; `memory` keeps both in this process (single worker only)
+JOB_STORE = os.getenv("JOB_STORE", "sqlite").strip().lower()
+JOB_DB_PATH = Path(os.getenv("JOB_DB_PATH", str(Path(__file__).resolve().parent / "output" / "jobs.db")))
+JOB_RESULTS_DIR = Path(os.getenv("JOB_RESULTS_DIR", str(Path(__file__).resolve().parent / "output" / "job_results")))
+# How often an event stream re-reads a job that is running in another worker process
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1.0"))
+
+JOB_TERMINAL_STATUSES = ("completed", "failed")
+_JOB_COLUMNS = ("id", "kind", "status", "created_at", "started_at", "finished_at", "error", "status_code")
+
+
+def _iso_or_none(timestamp: Optional[float]) -> Optional[str]:
+    return datetime.fromtimestamp(timestamp).isoformat() if timestamp is not None else None
+
+
+class Job:
+    """One submitted analysis: queued -> running -> completed | failed."""
+
+    def __init__(self, kind: str, work: Callable[[], Awaitable[Dict]]):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.result: Optional[Dict] = None
+        self.error: Optional[str] = None
+        self.status_code: Optional[int] = None
+        self.work: Optional[Callable[[], Awaitable[Dict]]] = work
+        # Replaced on every transition so waiters can subscribe to the next change
+        self.changed = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.status in JOB_TERMINAL_STATUSES
+
+    def notify(self) -> None:
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def record(self) -> Dict:
+        """The job's row in the job store (everything but the result)."""
+        return {column: getattr(self, column) for column in _JOB_COLUMNS}
+
+
+def job_snapshot(record: Dict, result: Optional[Dict] = None) -> Dict:
+    """Response body for ``/jobs/{job_id}`` from a job store row and its result."""
+    data = {
+        "job_id": record["id"],
+        "kind": record["kind"],
+        "status": record["status"],
+        "created_at": _iso_or_none(record["created_at"]),
+        "started_at": _iso_or_none(record["started_at"]),
+        "finished_at": _iso_or_none(record["finished_at"]),
+    }
+    if record["status"] == "completed":
+        data["result"] = result
+    elif record["status"] == "failed":
+        data["error"] = record["error"]
+        data["status_code"] = record["status_code"]
+    return data
+
+
+class JobStore(ABC):
+    """Where job state and results live once they leave the worker that ran the job.
+
+    Methods are blocking; call them from a worker thread.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    def save(self, record: Dict, result: Optional[Dict] = None) -> None:
+        """Insert or replace a job's row, and its result when one is given."""
+
+    @abstractmethod
+    def load(self, job_id: str) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    def load_result(self, job_id: str) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    def purge(self, finished_before: float, max_retained: int) -> int:
+        """Drop jobs finished before ``finished_before`` and the oldest finished jobs over the cap."""
+
+    @abstractmethod
+    def counts(self) -> Dict[str, int]:
+        ...
+
+
+class MemoryJobStore(JobStore):
+    """Per-process job store; jobs are only visible to the worker that accepted them."""
+
+    name = "memory"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records: "OrderedDict[str, Dict]" = OrderedDict()
+        self._results: Dict[str, Dict] = {}
+
+    def save(self, record: Dict, result: Optional[Dict] = None) -> None:
+        with self._lock:
+            self._records[record["id"]] = dict(record)
+            if result is not None:
+                self._results[record["id"]] = result
+
+    def load(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            record = self._records.get(job_id)
+            return dict(record) if record else None
+
+    def load_result(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            return self._results.get(job_id)
+
+    def purge(self, finished_before: float, max_retained: int) -> int:
+        with self._lock:
+            finished = [r for r in self._records.values() if r["status"] in JOB_TERMINAL_STATUSES]
+            finished.sort(key=lambda r: r["finished_at"] or 0)
+            overflow = len(finished) - max_retained
+            expired = [r["id"] for i, r in enumerate(finished) if i < overflow or (r["finished_at"] or 0) < finished_before]
+            for job_id in expired:
+                self._records.pop(job_id, None)
+                self._results.pop(job_id, None)
+            return len(expired)
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            statuses = [r["status"] for r in self._records.values()]
+        return {status: statuses.count(status) for status in set(statuses)}
+
+
+class SqliteJobStore(JobStore):
+    """Job rows in SQLite (WAL) and results as JSON files, shared by every worker process on the node.
+
+    Results can carry base64 images, so they stay on disk and are read only when a finished job
+    is fetched.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: Path, results_dir: Path, busy_timeout_ms: int = 5000):
+        import sqlite3
+
+        self._sqlite3 = sqlite3
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.results_dir = Path(results_dir)
+        self.results_dir.mkdir(parents=True, exist_ok=True)
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                error TEXT,
+                status_code INTEGER
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_finished ON jobs (status, finished_at)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._sqlite3.connect(str(self.path), timeout=self.busy_timeout_ms / 1000, isolation_level=None)
+            conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _result_path(self, job_id: str) -> Path:
+        return self.results_dir / f"{job_id}.json"
+
+    def save(self, record: Dict, result: Optional[Dict] = None) -> None:
+        if result is not None:
+            # Write the file before the row says "completed", via a rename so readers never see half of it
+            path = self._result_path(record["id"])
+            tmp = path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(result, ensure_ascii=False, default=str), encoding="utf-8")
+            os.replace(tmp, path)
+        self._connect().execute(
+            f"INSERT OR REPLACE INTO jobs ({', '.join(_JOB_COLUMNS)}) VALUES ({', '.join('?' * len(_JOB_COLUMNS))})",
+            tuple(record[column] for column in _JOB_COLUMNS),
+        )
+
+    def load(self, job_id: str) -> Optional[Dict]:
+        row = self._connect().execute(f"SELECT {', '.join(_JOB_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(zip(_JOB_COLUMNS, row)) if row else None
+
+    def load_result(self, job_id: str) -> Optional[Dict]:
+        try:
+            return json.loads(self._result_path(job_id).read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+
+    def purge(self, finished_before: float, max_retained: int) -> int:
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT id FROM jobs WHERE status IN ('completed', 'failed') "
+            "AND (finished_at < ? OR id NOT IN ("
+            "  SELECT id FROM jobs WHERE status IN ('completed', 'failed') ORDER BY finished_at DESC LIMIT ?"
+            "))",
+            (finished_before, max(0, max_retained)),
+        ).fetchall()
+        for (job_id,) in rows:
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            self._result_path(job_id).unlink(missing_ok=True)
+        return len(rows)
+
+    def counts(self) -> Dict[str, int]:
+        return dict(self._connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+
+def create_job_store() -> JobStore:
+    """SQLite store at JOB_DB_PATH unless JOB_STORE=memory (or the file is unusable)."""
+    if JOB_STORE != "memory":
+        try:
+            return SqliteJobStore(JOB_DB_PATH, JOB_RESULTS_DIR)
+        except Exception as exc:
+            logger.warning("[JOBS] Cannot open %s (%s); falling back to in-memory job store", JOB_DB_PATH, exc)
+    return MemoryJobStore()
+
+
+class JobManager:
+    """Bounded queue plus a fixed pool of worker tasks for long-running analyses.
+
+    Submitting returns immediately; the work keeps running if the client disconnects. Every
+    transition is written to the job store, so any worker process can answer ``/jobs/{job_id}``;
+    only jobs queued or running here are held in memory. Finished jobs are retained for
+    ``ttl_seconds`` (and at most ``max_retained``).
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        workers: int = JOB_WORKERS,
+        queue_size: int = JOB_QUEUE_SIZE,
+        ttl_seconds: int = JOB_TTL_SECONDS,
+        max_retained: int = JOB_MAX_RETAINED,
+        drain_seconds: float = JOB_DRAIN_SECONDS,
+    ):
+        self.store = store
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.ttl_seconds = ttl_seconds
+        self.max_retained = max(1, max_retained)
+        self.drain_seconds = drain_seconds
+        self._active: Dict[str, Job] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._last_purge = 0.0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def start(self) -> None:
+        """Start the worker pool on the running loop (idempotent)."""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._tasks:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [loop.create_task(self._worker(index)) for index in range(self.workers)]
+        logger.info("[JOBS] Started %d workers (queue size %d, %s store)", self.workers, self.queue_size, self.store.name)
+
+    async def shutdown(self) -> None:
+        """Let queued and running jobs finish (up to ``drain_seconds``), then stop the workers."""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=self.drain_seconds)
+        except asyncio.TimeoutError:
+            logger.warning("[JOBS] %d job(s) still pending after %.0fs drain", self._queue.qsize(), self.drain_seconds)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info("[JOBS] Workers stopped")
+
+    async def submit(self, kind: str, work: Callable[[], Awaitable[Dict]]) -> Job:
+        """Queue ``work`` (a coroutine factory returning the result dict); 503 when the queue is full."""
+        self.start()
+        await self._purge()
+        job = Job(kind, work)
+        if self._queue.full():
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Job queue is full, retry later",
+                headers={"Retry-After": "30"},
+            )
+        await asyncio.to_thread(self.store.save, job.record())
+        self._active[job.id] = job
+        self._queue.put_nowait(job)
+        self.submitted += 1
+        logger.info("[JOBS] Queued %s job %s (queue depth %d)", kind, job.id, self._queue.qsize())
+        return job
+
+    async def get(self, job_id: str) -> Optional[Dict]:
+        """The job's ``/jobs/{job_id}`` payload, whichever worker process ran it; None if unknown."""
+        job = self._active.get(job_id)
+        if job is not None:
+            return job_snapshot(job.record())
+        record = await asyncio.to_thread(self.store.load, job_id)
+        if record is None:
+            return None
+        result = await asyncio.to_thread(self.store.load_result, job_id) if record["status"] == "completed" else None
+        return job_snapshot(record, result)
+
+    async def wait(self, job_id: str, seen_status: str, timeout: float) -> None:
+        """Wait until the job may have left ``seen_status``, or ``timeout`` elapses.
+
+        Jobs running here wake the waiter directly; jobs in other processes are re-read every
+        JOB_POLL_SECONDS.
         """
-        original_response = response_text
+        job = self._active.get(job_id)
+        if job is None:
+            await asyncio.sleep(min(timeout, JOB_POLL_SECONDS))
+            return
+        changed = job.changed
+        if job.status != seen_status:
+            return
         try:
-            logger.info(f"[JSON PARSER] Starting JSON parsing. Raw response length: {len(response_text)} chars")
-            logger.info(f"[JSON PARSER] Raw response (first 500 chars): {response_text[:500]}")
-            
-            # Try to extract JSON from response (might have code blocks or extra text)
-            response_text = response_text.strip()
-            
-            # Remove markdown code blocks if present
-            had_markdown = False
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]  # Remove ```json
-                had_markdown = True
-                logger.info("[JSON PARSER] Removed ```json markdown block")
-            elif response_text.startswith("```"):
-                response_text = response_text[3:]  # Remove ```
-                had_markdown = True
-                logger.info("[JSON PARSER] Removed ``` markdown block")
-            
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]  # Remove closing ```
-                had_markdown = True
-                logger.info("[JSON PARSER] Removed closing ``` markdown block")
-            
-            response_text = response_text.strip()
-            
-            if had_markdown:
-                logger.info(f"[JSON PARSER] After markdown removal (first 500 chars): {response_text[:500]}")
-            
-            # Find JSON object in the text
-            json_start = response_text.find("{")
-            json_end = response_text.rfind("}") + 1
-            
-            if json_start == -1 or json_end == 0:
-                logger.warning("⚠ No JSON object found in response.")
-                logger.warning(f"[JSON PARSER] Response text (first 1000 chars): {original_response[:1000]}")
-                return None, None
-            
-            json_str = response_text[json_start:json_end]
-            logger.info(f"[JSON PARSER] Extracted JSON string length: {len(json_str)} chars")
-            logger.info(f"[JSON PARSER] Extracted JSON (first 500 chars): {json_str[:500]}")
-            
-            # Fix common JSON syntax errors from LLM before parsing
-            # Fix 1: Remove period before colon (e.g., "key":. "value" -> "key": "value")
-            original_json = json_str
-            json_str = re.sub(r':\s*\.\s*"', ': "', json_str)
-            json_str = re.sub(r':\s*\.\s*(\d+)', r': \1', json_str)
-            json_str = re.sub(r':\s*\.\s*([A-Z])', r': "\1', json_str)
-            if json_str != original_json:
-                logger.info("[JSON PARSER] Fixed period-before-colon syntax errors")
-            
-            # Try to parse JSON with better error handling
+            await asyncio.wait_for(changed.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            job = await self._queue.get()
             try:
-                data = json.loads(json_str)
-            except json.JSONDecodeError as parse_error:
-                # Log the error position and surrounding context
-                error_pos = getattr(parse_error, 'pos', None)
-                if error_pos:
-                    logger.error(f"[JSON PARSER] JSON decode error at position {error_pos}")
-                    # Show context around the error
-                    start = max(0, error_pos - 100)
-                    end = min(len(json_str), error_pos + 100)
-                    logger.error(f"[JSON PARSER] Context around error: ...{json_str[start:end]}...")
-                    logger.error(f"[JSON PARSER] Error line/column: line {getattr(parse_error, 'lineno', '?')}, col {getattr(parse_error, 'colno', '?')}")
-                
-                # Try to extract welds array even if full JSON is broken
-                logger.warning("[JSON PARSER] Attempting to extract welds array from broken JSON...")
-                
-                # Find the welds array and extract individual weld objects
-                welds_start = json_str.find('"welds": [')
-                if welds_start >= 0:
-                    # Extract welds array content
-                    array_start = json_str.find('[', welds_start)
-                    bracket_count = 1
-                    array_end = -1
-                    for i in range(array_start + 1, min(len(json_str), array_start + 50000)):  # Limit search
-                        if json_str[i] == '[':
-                            bracket_count += 1
-                        elif json_str[i] == ']':
-                            bracket_count -= 1
-                            if bracket_count == 0:
-                                array_end = i + 1
-                                break
-                    
-                    if array_end > array_start:
-                        welds_array_str = json_str[array_start:array_end]
-                        try:
-                            welds_array = json.loads(welds_array_str)
-                            data = {"welds": welds_array, "explanations": ""}
-                            logger.info(f"[JSON PARSER] ✅ Successfully extracted {len(welds_array)} welds from broken JSON")
-                        except:
-                            # Try extracting individual weld objects using regex
-                            weld_objects = []
-                            # Pattern to match a complete weld object (from Serial No to Confidence)
-                            weld_pattern = r'\{\s*"Serial No"[^}]*"Confidence"[^}]*\}'
-                            matches = re.finditer(weld_pattern, welds_array_str, re.DOTALL)
-                            for match in matches:
-                                try:
-                                    weld_obj = json.loads(match.group(0))
-                                    weld_objects.append(weld_obj)
-                                except:
-                                    pass
-                            
-                            if weld_objects:
-                                data = {"welds": weld_objects, "explanations": ""}
-                                logger.info(f"[JSON PARSER] ✅ Extracted {len(weld_objects)} welds using regex fallback")
-                            else:
-                                logger.error("[JSON PARSER] Could not extract any welds")
-                                raise parse_error
-                    else:
-                        logger.error("[JSON PARSER] Could not find welds array end")
-                        raise parse_error
-                else:
-                    logger.error("[JSON PARSER] Could not find welds array")
-                    raise parse_error
-            logger.info(f"[JSON PARSER] Successfully parsed JSON. Keys: {list(data.keys())}")
-            
-            # Extract welds array
-            welds = data.get("welds", [])
-            explanations = data.get("explanations", "")
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job) -> None:
+        job.status = "running"
+        job.started_at = time.time()
+        await asyncio.to_thread(self.store.save, job.record())
+        job.notify()
+        try:
+            job.result = await job.work()
+            job.status = "completed"
+            self.completed += 1
+        except asyncio.CancelledError:
+            job.status, job.error, job.status_code = "failed", "Job cancelled during shutdown", 503
+            self.failed += 1
+            raise
+        except HTTPException as exc:
+            job.status, job.error, job.status_code = "failed", str(exc.detail), exc.status_code
+            self.failed += 1
+        except Exception as exc:
+            logger.error("[JOBS] %s job %s failed: %s", job.kind, job.id, exc, exc_info=True)
+            job.status, job.error, job.status_code = "failed", str(exc), 500
+            self.failed += 1
+        finally:
+            # Drop the closure so the uploaded bytes are not retained with the result
+            job.work = None
+            job.finished_at = time.time()
+            try:
+                # Shielded so a shutdown cancellation still records the final state
+                await asyncio.shield(asyncio.to_thread(self.store.save, job.record(), job.result))
+            except Exception as exc:
+                logger.error("[JOBS] Could not store job %s: %s", job.id, exc)
+            # The result now lives in the store; waiters re-read it from there
+            job.result = None
+            self._active.pop(job.id, None)
+            job.notify()
+        logger.info(
+            "[JOBS] %s job %s %s in %.2fs",
+            job.kind,
+            job.id,
+            job.status,
+            job.finished_at - job.started_at,
+        )
+
+    async def _purge(self) -> None:
+        """Apply ``ttl_seconds`` and ``max_retained``, at most once a minute per process."""
+        now = time.time()
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        try:
+            await asyncio.to_thread(self.store.purge, now - self.ttl_seconds, self.max_retained)
+        except Exception as exc:
+            logger.warning("[JOBS] Purge failed: %s", exc)
+
+    def stats(self) -> Dict:
+        """Counters for this process plus job counts by status across all workers (blocking)."""
+        statuses = [job.status for job in self._active.values()]
+        return {
+            "store": self.store.name,
+            "workers": len(self._tasks),
+            "queue_size": self.queue_size,
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "queued": statuses.count("queued"),
+            "running": statuses.count("running"),
+            "stored": self.store.counts(),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "ttl_seconds": self.ttl_seconds,
+        }
+
+
+# ----------------- DOCX Text -----------------
+# Extracted DOCX text stops at this many characters (roughly a quarter as many tokens)
+DOCX_MAX_TEXT_CHARS = int(os.getenv("DOCX_MAX_TEXT_CHARS", "400000"))
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_DOCX_TRUNCATED = "[... document truncated ...]"
+
+
+class _DocxTable:
+    """Row/cell state for one (possibly nested) table while it is being parsed."""
+
+    def __init__(self):
+        self.row: List[str] = []
+        self.cell: List[str] = []
+        self.merged = False
+
+
+def extract_docx_text(file_bytes: bytes, max_chars: int = DOCX_MAX_TEXT_CHARS) -> str:
+    """Body text of a DOCX in document order, with tables as " | "-delimited rows.
+
+    ``word/document.xml`` is streamed out of the zip and parsed incrementally, and each element
+    is discarded once used, so memory stays flat on long documents. Horizontally merged cells
+    (``gridSpan``) appear once, and merge continuation cells (``vMerge``, legacy ``hMerge``) are
+    skipped instead of repeating the text before them; cells are never dropped for equal text.
+    Nested tables are flattened into their enclosing cell. Output stops at ``max_chars``.
+    """
+    import zipfile
+    from xml.etree.ElementTree import iterparse
+
+    lines: List[str] = []
+    size = 0
+    tables: List[_DocxTable] = []
+    paragraph: List[str] = []
+
+    def emit(line: str, depth: int) -> bool:
+        """Add a line to the body, or to the enclosing cell when ``depth`` tables are open."""
+        nonlocal size
+        if depth:
+            tables[depth - 1].cell.append(line)
+            return True
+        lines.append(line)
+        size += len(line) + 1
+        return size < max_chars
+
+    with zipfile.ZipFile(io.BytesIO(file_bytes)) as archive, archive.open("word/document.xml") as xml:
+        for event, element in iterparse(xml, events=("start", "end")):
+            tag = element.tag
+            if event == "start":
+                if tag == f"{_W}tbl":
+                    tables.append(_DocxTable())
+                elif tag == f"{_W}tc" and tables:
+                    tables[-1].cell, tables[-1].merged = [], False
+                elif tag in (f"{_W}vMerge", f"{_W}hMerge") and tables and element.get(f"{_W}val", "continue") == "continue":
+                    tables[-1].merged = True
+                continue
+
+            if tag == f"{_W}t":
+                paragraph.append(element.text or "")
+            elif tag == f"{_W}tab":
+                paragraph.append("\t")
+            elif tag in (f"{_W}br", f"{_W}cr"):
+                paragraph.append(" ")
+            elif tag == f"{_W}p":
+                text = "".join(paragraph).strip()
+                paragraph = []
+                element.clear()
+                if text and not emit(text, len(tables)):
+                    lines.append(_DOCX_TRUNCATED)
+                    break
+            elif tag == f"{_W}tc" and tables:
+                table = tables[-1]
+                text = " ".join(table.cell).strip()
+                if text and not table.merged:
+                    table.row.append(text)
+                element.clear()
+            elif tag == f"{_W}tr" and tables:
+                row, tables[-1].row = tables[-1].row, []
+                element.clear()
+                # A row belongs to its own table; it is emitted into whatever encloses that table
+                if row and not emit(" | ".join(row), len(tables) - 1):
+                    lines.append(_DOCX_TRUNCATED)
+                    break
+            elif tag == f"{_W}tbl" and tables:
+                tables.pop()
+                element.clear()
+    return "\n".join(lines).strip()
+
+
+# ----------------- Welding Inspector -----------------
+class WeldingInspector:
+    _WELD_PROMPT = (
+        "You are an expert welding engineer analyzing a technical CAD or welding drawing. "
+        "Carefully examine the entire drawing and identify ALL welds present in the diagram.\n\n"
+        "INSTRUCTIONS:\n"
+        "1. Identify every weld symbol, weld callout, and welding annotation visible in the drawing.\n"
+        "2. Assign sequential serial numbers starting from W1, W2, W3, and continue for ALL welds found.\n"
+        "3. Extract part numbers, plate numbers (PL), component numbers, and any other identifiers EXACTLY as shown in the drawing.\n"
+        "4. Do NOT assume or invent part numbers - use only what is clearly visible in the drawing.\n"
+        "5. Identify all welds regardless of their type or location.\n\n"
+        "For each weld identified, provide:\n"
+        "- Serial No (W1, W2, W3, ... - assign sequentially for all welds found)\n"
+        "- Description (detailed description using EXACT part numbers, plate numbers, and component names as shown in the drawing)\n"
+        "- Welding Type (e.g., Fillet Weld, Double Fillet Weld, Groove Weld, etc. - identify from weld symbols)\n"
+        "- Welding Value (size in mm - extract exactly as specified in the drawing)\n"
+        "- Remarks (any notes, flags, or annotations like TYP, OF DRIVE, OF MOTOR, M, etc. - use exactly as shown)\n"
+        "- Position (location description referencing the exact parts, sections, or views shown)\n"
+        "- Confidence (High if clearly visible, Medium if partially visible, Low if uncertain)\n\n"
+        "CRITICAL OUTPUT REQUIREMENTS:\n"
+        "1. Output ONLY valid JSON format with NO additional text before or after.\n"
+        "2. The JSON structure must be:\n"
+        "   {\n"
+        "     \"welds\": [\n"
+        "       {\n"
+        "         \"Serial No\": \"W1\",\n"
+        "         \"Description\": \"...\",\n"
+        "         \"Welding Type\": \"...\",\n"
+        "         \"Welding Value\": \"...\",\n"
+        "         \"Remarks\": \"...\",\n"
+        "         \"Position\": \"...\",\n"
+        "         \"Confidence\": \"...\"\n"
+        "       },\n"
+        "       ...\n"
+        "     ],\n"
+        "     \"explanations\": \"Detailed explanations for each weld...\"\n"
+        "   }\n"
+        "3. Include ALL welds found - do not stop early. Continue until you have identified every weld in the drawing.\n"
+        "4. Use EXACT part numbers, plate numbers, and identifiers as they appear in the drawing (e.g., Part 1, PL10-21, Beam B11, etc.).\n"
+        "5. The \"welds\" array should contain one object per weld with all 7 fields.\n"
+        "6. The \"explanations\" field should contain detailed explanations for each weld, referencing the exact locations and symbols from the drawing.\n"
+        "7. Output ONLY valid JSON - no markdown, no code blocks, no explanations outside the JSON structure."
+    )
+
+    # Appended to a comparison prompt in single-pass mode so no separate bbox request is needed
+    _LOCATE_INSTRUCTIONS = (
+        "\nADDITIONAL OUTPUT - FINDING LOCATIONS:\n"
+        "Also add a \"cad_locations\" array to the same JSON object. For every entry in cad_findings, "
+        "locate that dimension text on the drawing and draw a bounding box around the text and any "
+        "associated arrows or callouts:\n"
+        '  "cad_locations": [{"parameter": "Thread Size", "bounding_box": [x_min, y_min, x_max, y_max]}, ...]\n'
+        "  - \"parameter\" must be the metric name exactly as written before the colon in cad_findings.\n"
+        "  - bounding_box values must be between 0 and 1, normalized to the image width/height "
+        "(0 = left/top, 1 = right/bottom).\n"
+        "  - Omit findings you cannot clearly see. Do not change any other field because of this step.\n"
+    )
+
+    def __init__(self, client: GeminiClient):
+        self.client = client
+        self.word_mime_types = {
+            "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+            "application/msword",
+        }
+        strategies: List[ComparisonPromptStrategy] = [
+            SparkPlugComparisonStrategy(),
+            BrakeDiscComparisonStrategy(),
+            HornComparisonStrategy(),
+        ]
+        self._comparison_strategies: Dict[str, ComparisonPromptStrategy] = {
+            strategy.part_key: strategy for strategy in strategies
+        }
+        self._comparison_alias_map: Dict[str, str] = {}
+        for strategy in strategies:
+            self._comparison_alias_map[strategy.part_key] = strategy.part_key
+            for alias in strategy.aliases:
+                self._comparison_alias_map[alias] = strategy.part_key
+
+    @staticmethod
+    def _extract_docx_text(file_bytes: bytes) -> str:
+        """Extract meaningful text (including tables, in document order) from a DOCX file."""
+        combined = extract_docx_text(file_bytes)
+        return combined if combined else "RFQ document (DOCX) contained no extractable text."
+
+    def _prepare_rfq_input(self, rfq_bytes: bytes, rfq_mime: str) -> Tuple[Union[bytes, str], Optional[str]]:
+        """Prepare RFQ input for Gemini, converting DOCX files to plain text."""
+        if rfq_mime == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
+            try:
+                text_content = self._extract_docx_text(rfq_bytes)
+                logger.info("[COMPARE] Converted DOCX RFQ to plain text for Gemini input")
+                return text_content, None
+            except Exception as exc:
+                logger.error("[COMPARE] Failed to read DOCX RFQ", exc_info=True)
+                raise HTTPException(
+                    status_code=400,
+                    detail="Unable to read DOCX file. Please ensure the document is not corrupted."
+                ) from exc
+        if rfq_mime == "application/msword":
+            raise HTTPException(
+                status_code=400,
+                detail="Legacy .doc files are not supported. Please upload the RFQ as PDF or convert it to DOCX."
+            )
+        return rfq_bytes, rfq_mime
+
+    @staticmethod
+    def _strip_markdown_fence(text: str) -> str:
+        """Remove surrounding markdown fences (``` or ```json)."""
+        text = text.strip()
+        if text.startswith("```json"):
+            text = text[7:]
+        elif text.startswith("```"):
+            text = text[3:]
+        if text.endswith("```"):
+            text = text[:-3]
+        return text.strip()
+
+    @staticmethod
+    def _quote_unquoted_keys(text: str) -> str:
+        """Ensure object keys are wrapped in double quotes for valid JSON parsing."""
+        pattern = re.compile(r'(?m)^(?P<indent>\s*)(?P<key>[A-Za-z][A-Za-z0-9_\-\s]*?)\s*:(?=\s)')
+
+        def replacer(match: re.Match) -> str:
+            indent = match.group("indent")
+            key = match.group("key").strip()
+            # Skip keys that are already quoted
+            if key.startswith('"') and key.endswith('"'):
+                return match.group(0)
+            return f'{indent}"{key}":'
+
+        return pattern.sub(replacer, text)
+
+    @staticmethod
+    def _clean_list_item(value: str) -> str:
+        cleaned = value.strip().strip(",")
+        if cleaned.startswith('"') and cleaned.endswith('"'):
+            cleaned = cleaned[1:-1]
+        return cleaned.strip()
+
+    def _extract_list_section(self, text: str, key: str) -> List[str]:
+        """Extract an array section even if formatting is slightly invalid."""
+        items: List[str] = []
+        # Primary: look for JSON-style array
+        array_pattern = re.compile(
+            rf'\b{key}\b\s*[:=]\s*\[(?P<body>.*?)\]',
+            re.IGNORECASE | re.DOTALL,
+        )
+        match = array_pattern.search(text)
+        if match:
+            body = match.group("body")
+            # Prefer quoted strings
+            quoted_items = re.findall(r'"([^"]+)"', body)
+            if quoted_items:
+                items.extend(item.strip() for item in quoted_items if item.strip())
+            else:
+                # Fall back to comma-separated entries
+                for part in body.split(","):
+                    cleaned = self._clean_list_item(part)
+                    if cleaned:
+                        items.append(cleaned)
+            if items:
+                return items
+
+        # Secondary: capture bullet list following the key
+        lines = text.replace("\r", "").split("\n")
+        collecting = False
+        for line in lines:
+            stripped = line.strip()
+            if not collecting:
+                if re.match(rf'^\s*{key}\s*[:=]?\s*$', stripped, re.IGNORECASE):
+                    collecting = True
+                continue
+
+            if not stripped:
+                break
+
+            if re.match(r'^[A-Za-z0-9_]+\s*[:=]', stripped):
+                # Next top-level field detected
+                break
+
+            if stripped.startswith(("-", "*")):
+                stripped = stripped[1:].strip()
+
+            cleaned = self._clean_list_item(stripped)
+            if cleaned:
+                items.append(cleaned)
+
+        return items
+
+    def _parse_comparison_fallback(self, text: str):
+        """Fallback parser when JSON decoding fails."""
+        logger.info("[COMPARISON PARSER] Attempting fallback parsing heuristics")
+        normalized = text.replace("\r", "")
+
+        result = {
+            "match": False,
+            "confidence": "",
+            "summary": "",
+            "rfq_requirements": [],
+            "cad_findings": [],
+            "mismatches": [],
+            "recommendations": "",
+        }
+
+        match_match = re.search(r'\bmatch\b\s*[:=]\s*(true|false)', normalized, re.IGNORECASE)
+        if match_match:
+            result["match"] = match_match.group(1).lower() == "true"
+
+        confidence_match = re.search(r'\bconfidence\b\s*[:=]\s*"?(High|Medium|Low)"?', normalized, re.IGNORECASE)
+        if confidence_match:
+            result["confidence"] = confidence_match.group(1).capitalize()
+
+        summary_match = re.search(r'\bsummary\b\s*[:=]\s*"([^"]+)"', normalized)
+        if summary_match:
+            result["summary"] = summary_match.group(1).strip()
+        else:
+            summary_match = re.search(r'\bsummary\b\s*[:=]\s*(.+)', normalized)
+            if summary_match:
+                result["summary"] = summary_match.group(1).strip().rstrip(",")
+
+        for section in ("rfq_requirements", "cad_findings", "mismatches"):
+            extracted = self._extract_list_section(normalized, section)
+            if extracted:
+                result[section] = extracted
+
+        rec_list = self._extract_list_section(normalized, "recommendations")
+        if rec_list:
+            result["recommendations"] = "; ".join(rec_list)
+        else:
+            rec_match = re.search(r'\brecommendations?\b\s*[:=]\s*"([^"]+)"', normalized, re.IGNORECASE)
+            if rec_match:
+                result["recommendations"] = rec_match.group(1).strip()
+            else:
+                rec_match = re.search(r'\brecommendations?\b\s*[:=]\s*(.+)', normalized, re.IGNORECASE)
+                if rec_match:
+                    result["recommendations"] = rec_match.group(1).strip()
+
+        if any([result["summary"], result["rfq_requirements"], result["cad_findings"], result["mismatches"], result["recommendations"]]):
+            logger.info("[COMPARISON PARSER] Fallback parsing produced usable data")
+            return result
+
+        logger.error("[COMPARISON PARSER] Fallback parsing failed to extract data")
+        return None
+
+    async def inspect_drawing(self, file_bytes: bytes, mime_type: str) -> str:
+        """Analyze a CAD or welding drawing (image or PDF) and generate a detailed report.
+
+        Multi-page PDFs are split and the pages analyzed concurrently (see ``_inspect_pages``).
+        """
+        logger.info(f"=== START INSPECTION === (MIME type: {mime_type})")
+
+        chunks: List[Tuple[bytes, List[int]]] = []
+        if mime_type == "application/pdf" and GEMINI_PDF_FANOUT:
+            chunks = await asyncio.to_thread(split_pdf_pages, file_bytes, GEMINI_PDF_PAGES_PER_REQUEST)
+
+        if len(chunks) > 1:
+            response_text = await self._inspect_pages(chunks)
+        else:
+            response_text = await self.client.achat(file_bytes, mime_type, self._WELD_PROMPT, cache_prompt=True)
+
+        logger.info("=== INSPECTION COMPLETE ===")
+        return response_text
+
+    async def _inspect_pages(self, chunks: List[Tuple[bytes, List[int]]]) -> str:
+        """Analyze PDF page groups concurrently and merge them into one weld report.
+
+        Serial numbers are reassigned globally (W1..Wn in page order), each weld gets a
+        ``Page`` field, and the result has the same JSON shape as a single-request report.
+        """
+        logger.info("[PAGES] Analyzing %d page group(s) concurrently", len(chunks))
+        responses = await asyncio.gather(
+            *(self.client.achat(chunk, "application/pdf", self._WELD_PROMPT, cache_prompt=True) for chunk, _ in chunks),
+            return_exceptions=True,
+        )
+
+        merged: List[Dict] = []
+        explanations: List[str] = []
+        failures: List[BaseException] = []
+        for (_, pages), response in zip(chunks, responses):
+            page_label = f"{pages[0]}-{pages[-1]}" if len(pages) > 1 else str(pages[0])
+            if isinstance(response, BaseException):
+                logger.warning("[PAGES] Page %s failed: %s", page_label, response)
+                failures.append(response)
+                explanations.append(f"Page {page_label}: analysis failed ({response}).")
+                continue
+
+            welds, page_explanations = await asyncio.to_thread(self.parse_json_response, response)
+            serial_map: Dict[str, str] = {}
+            for weld in welds or []:
+                serial = f"W{len(merged) + 1}"
+                if weld.get("Serial No"):
+                    serial_map[weld["Serial No"]] = serial
+                merged.append({**weld, "Serial No": serial, "Page": page_label})
+
+            if page_explanations:
+                # Point the page's own W-numbers at the global ones
+                text = re.sub(
+                    r"\bW\d+\b",
+                    lambda match: serial_map.get(match.group(0), match.group(0)),
+                    str(page_explanations),
+                )
+                explanations.append(f"Page {page_label}: {text}")
+
+        if len(failures) == len(chunks):
+            raise failures[0]
+
+        logger.info("[PAGES] Merged %d welds from %d page group(s)", len(merged), len(chunks))
+        return json.dumps({"welds": merged, "explanations": "\n\n".join(explanations)}, ensure_ascii=False)
+
+    async def stream_inspect_drawing(self, file_bytes: bytes, mime_type: str) -> AsyncIterator[str]:
+        """Streaming variant of ``inspect_drawing`` that yields raw response text chunks."""
+        logger.info(f"=== START STREAMING INSPECTION === (MIME type: {mime_type})")
+        async for chunk in self.client.astream_with_files(self._WELD_PROMPT, [(file_bytes, mime_type)], cache_prompt=True):
+            yield chunk
+        logger.info("=== STREAMING INSPECTION COMPLETE ===")
+
+    def _get_comparison_prompt(self, part: str) -> str:
+        normalized = (part or "").strip().lower()
+        strategy_key = self._comparison_alias_map.get(normalized)
+
+        if not strategy_key:
+            if normalized:
+                logger.info("[COMPARE] Unknown part '%s'; defaulting to spark plug prompt", normalized)
+            strategy_key = "spark_plug"
+
+        strategy = self._comparison_strategies.get(strategy_key)
+        if not strategy:
+            logger.warning(
+                "[COMPARE] Strategy '%s' not found; falling back to default spark plug prompt",
+                strategy_key,
+            )
+            strategy = self._comparison_strategies["spark_plug"]
+
+        logger.info("[COMPARE] Using comparison strategy: %s (for part: %s)", strategy_key, normalized)
+        return strategy.build_prompt()
+
+    async def compare_rfq_and_cad(
+        self,
+        rfq_input: Tuple[Union[bytes, str], Optional[str]],
+        cad_bytes: bytes,
+        cad_mime: str,
+        part: str = "spark_plug",
+        cad_file: Optional[FileHandle] = None,
+        locate: bool = False,
+    ) -> str:
+        """Compare RFQ document with CAD drawing and summarize alignment.
+
+        Pass ``cad_file`` (from ``GeminiClient.aregister_file``) to reuse an already encoded drawing.
+        With ``locate`` the response also carries ``cad_locations`` (a bbox per CAD finding).
+        """
+        logger.info("=== START RFQ VS CAD COMPARISON === (part=%s, locate=%s)", part or "spark_plug", locate)
+
+        prompt = self._get_comparison_prompt(part)
+        if locate:
+            prompt += self._LOCATE_INSTRUCTIONS
+
+        response_text = await self.client.achat_with_files(
+            prompt,
+            [
+                rfq_input,
+                (cad_file or cad_bytes, cad_mime),
+            ],
+            cache_prompt=True,
+        )
+
+        logger.info("=== COMPARISON COMPLETE ===")
+        return response_text
+
+    @staticmethod
+    def _normalize_value(value: str) -> str:
+        """
+        Normalize RFQ/CAD values so that formatting differences
+        (spaces, commas, diameter symbol, units, etc.) don't cause false mismatches.
+
+        Examples:
+        "Ø300 mm"    -> "300"
+        "Ø300"       -> "300"
+        "75,5 mm"    -> "75.5"
+        "4 x Ø23.5"  -> "4x23.5"
+        "22.2°"      -> "22.2"
+        "M14"        -> "m14"
+        """
+        if not value:
+            return ""
+
+        v = value.strip().lower()
+
+        # 1) normalize decimal separator
+        v = v.replace(",", ".")
+
+        # 2) remove diameter & degree symbols
+        v = v.replace("ø", "").replace("°", "")
+
+        # 3) normalize multiplication/group notation: "4 x 23.5", "4-23.5" → "4x23.5"
+        v = v.replace("×", "x")
+        v = re.sub(r"\s*[-x]\s*", "x", v)
+
+        # 4) strip common units
+        units = [" mm", "mm", " in", "in"]
+        for unit in units:
+            if v.endswith(unit):
+                v = v[: -len(unit)].strip()
+                break
+
+        # 5) if pure number -> canonical numeric form
+        num_match = re.fullmatch(r"[-+]?\d*\.?\d+", v)
+        if num_match:
+            return num_match.group(0)
+
+        # 6) fallback: compact spaces/commas on the cleaned string
+        v = re.sub(r"[\s,]+", "", v)
+        return v.strip()
+
+    def _normalize_label(self, label: str) -> str:
+        """
+        Normalize parameter labels to create consistent dictionary keys for matching.
+        
+        Examples:
+        "Thread Size"    -> "threadsize"
+        "Thread_Size"    -> "threadsize"
+        "Part Number"    -> "partnumber"
+        "Hex Size"       -> "hexsize"
+        """
+        if not label:
+            return ""
+        
+        # Convert to lowercase and strip whitespace
+        normalized = label.strip().lower()
+        
+        # Replace common separators (spaces, underscores, hyphens) with nothing
+        normalized = re.sub(r"[\s_\-]+", "", normalized)
+        
+        return normalized
+
+    def _spec_list_to_dict(self, items: List[str]) -> Dict[str, Dict[str, str]]:
+        """Convert ['Thread Size: M14', ...] to key→{label,value} dict."""
+        specs: Dict[str, Dict[str, str]] = {}
+        pattern = re.compile(r"^\s*([^:]+?)\s*[:\-]\s*(.+?)\s*$")
+        for item in items:
+            match = pattern.match(item)
+            if not match:
+                continue
+            raw_label, raw_value = match.groups()
+            key = self._normalize_label(raw_label)
+            if not key:
+                continue
+            specs[key] = {"label": raw_label.strip(), "value": raw_value.strip()}
+        return specs
+
+    def build_metric_records(
+        self,
+        rfq_requirements: List[str],
+        cad_findings: List[str],
+    ) -> List[Dict]:
+        """
+        Build canonical metric records with backend-determined status.
+        
+        Returns a list of records with:
+        {
+            "key": normalized key (e.g., "threadsize"),
+            "label": original RFQ label (e.g., "Thread Size"),
+            "rfq_value": RFQ value string,
+            "cad_value": CAD value string (or "" if missing),
+            "match": "Match" | "Mismatch" | "Missing" | "Extra"
+        }
+        """
+        rfq_specs = self._spec_list_to_dict(rfq_requirements)
+        cad_specs = self._spec_list_to_dict(cad_findings)
+        
+        if not rfq_specs:
+            logger.info("[METRIC-RECORDS] No RFQ specs available")
+            return []
+        
+        records: List[Dict] = []
+        
+        # Process RFQ metrics
+        for key, rfq_spec in rfq_specs.items():
+            cad_spec = cad_specs.get(key)
+            cad_value = cad_spec.get("value", "").strip() if cad_spec else ""
+            rfq_value = rfq_spec.get("value", "").strip()
+            
+            # Determine status
+            if not cad_spec or not cad_value:
+                match_status = "Missing"
+            elif self._normalize_value(rfq_value) == self._normalize_value(cad_value):
+                match_status = "Match"
+            else:
+                match_status = "Mismatch"
+            
+            records.append({
+                "key": key,
+                "label": rfq_spec.get("label", ""),
+                "rfq_value": rfq_value,
+                "cad_value": cad_value,
+                "match": match_status,
+            })
+        
+        # Optionally include CAD-only metrics as "Extra"
+        for key, cad_spec in cad_specs.items():
+            if key not in rfq_specs:
+                records.append({
+                    "key": key,
+                    "label": cad_spec.get("label", ""),
+                    "rfq_value": "",
+                    "cad_value": cad_spec.get("value", "").strip(),
+                    "match": "Extra",
+                })
+        
+        logger.info("[METRIC-RECORDS] Built %d metric records", len(records))
+        return records
+
+    async def _extract_cad_bboxes(
+        self,
+        cad_bytes: bytes,
+        cad_mime: str,
+        metric_records: List[Dict],
+        cad_file: Optional[FileHandle] = None,
+    ) -> List[Dict]:
+        """
+        Ask Gemini for bounding boxes ONLY (no status/value decisions).
+        
+        Returns a list of entries such as:
+        {
+          "parameter": "Thread Length",
+          "key": "threadlength",
+          "bounding_box": [x1, y1, x2, y2]
+        }
+        """
+        # Build text block of metrics that have CAD values
+        metrics_with_cad = [
+            f"{record['label']}: {record['cad_value']}"
+            for record in metric_records
+            if record.get("cad_value") and record.get("match") != "Missing"
+        ]
+        
+        if not metrics_with_cad:
+            logger.info("[ANNOTATION] No metrics with CAD values to locate")
+            return []
+        
+        metrics_text = "\n".join(metrics_with_cad)
+        
+        prompt = (
+            "You are an expert in reading engineering drawings.\n"
+            "You will receive:\n"
+            "1) A list of metric names and their values (already determined from the drawing).\n"
+            "2) A CAD drawing image.\n\n"
+            "METRICS TO LOCATE (name: value):\n"
+            f"{metrics_text}\n\n"
+            "YOUR TASK:\n"
+            "For each metric in the list above, locate the corresponding dimension text/annotation on the drawing.\n"
+            "Draw a bounding box around the dimension text and any associated arrows or callouts.\n\n"
+            "CRITICAL RULES:\n"
+            "  - Use the metric name EXACTLY as provided in the \"parameter\" field.\n"
+            "  - Do NOT change or re-interpret the metric values.\n"
+            "  - Do NOT decide if values match or mismatch - that is already determined.\n"
+            "  - Only provide bounding boxes for dimensions you can clearly see on the drawing.\n"
+            "  - If you cannot find a metric, simply omit it from the output.\n"
+            "  - The bounding_box MUST be [x_min, y_min, x_max, y_max] with all values between 0 and 1,\n"
+            "    normalized relative to the image width/height (0 = left/top, 1 = right/bottom).\n\n"
+            "OUTPUT FORMAT:\n"
+            "Return ONLY a JSON array, no extra text, no markdown.\n"
+            "Example:\n"
+            "[\n"
+            "  {\n"
+            '    "parameter": "Thread Length",\n'
+            '    "bounding_box": [0.1, 0.2, 0.16, 0.22]\n'
+            "  },\n"
+            "  {\n"
+            '    "parameter": "Overall Length",\n'
+            '    "bounding_box": [0.25, 0.08, 0.32, 0.11]\n'
+            "  }\n"
+            "]\n"
+        )
+
+        try:
+            response_text = await self.client.achat_with_files(
+                prompt,
+                [
+                    (cad_file or cad_bytes, cad_mime),
+                ],
+            )
+
+            cleaned = self._strip_markdown_fence(response_text).strip()
+
+            if not cleaned:
+                logger.warning("[ANNOTATION] Gemini returned empty bbox payload")
+                return []
+
+            parsed: Optional[Union[List, Dict]] = None
+
+            try:
+                parsed = json.loads(cleaned)
+            except json.JSONDecodeError as e:
+                logger.debug("[ANNOTATION] Initial JSON parse failed (may be truncated), trying fallback strategies")
+                
+                # Strategy 1: Try to extract complete JSON objects from a potentially truncated array
+                # Find all complete JSON objects in the text
+                objects = []
+                depth = 0
+                start = -1
+                in_string = False
+                escape = False
+                
+                for i, char in enumerate(cleaned):
+                    if escape:
+                        escape = False
+                        continue
+                    if char == '\\':
+                        escape = True
+                        continue
+                    if char == '"' and not escape:
+                        in_string = not in_string
+                        continue
+                    if in_string:
+                        continue
+                    
+                    if char == '{':
+                        if depth == 0:
+                            start = i
+                        depth += 1
+                    elif char == '}':
+                        depth -= 1
+                        if depth == 0 and start >= 0:
+                            # Found a complete object
+                            try:
+                                obj_str = cleaned[start:i+1]
+                                obj = json.loads(obj_str)
+                                if isinstance(obj, dict):
+                                    objects.append(obj)
+                            except json.JSONDecodeError:
+                                pass
+                            start = -1
+                
+                if objects:
+                    logger.info(
+                        "[ANNOTATION] Extracted %d complete objects from truncated JSON",
+                        len(objects)
+                    )
+                    parsed = objects
+                else:
+                    # Strategy 2: Try to find JSON array or object with regex (less reliable)
+                    array_match = re.search(r'\[.*\]', cleaned, re.DOTALL)
+                    object_match = re.search(r'\{.*\}', cleaned, re.DOTALL)
+                    candidate = (
+                        array_match.group(0)
+                        if array_match
+                        else object_match.group(0)
+                        if object_match
+                        else None
+                    )
+
+                    if candidate:
+                        try:
+                            parsed = json.loads(candidate)
+                        except json.JSONDecodeError:
+                            logger.warning(
+                                "[ANNOTATION] Failed to parse candidate JSON chunk (response likely truncated at MAX_TOKENS)"
+                            )
+                    else:
+                        logger.warning("[ANNOTATION] No JSON structure detected in bbox response")
+
+            if parsed is None:
+                logger.warning("[ANNOTATION] Gemini bbox response was not valid JSON (response may be truncated)")
+                return []
+
+            # Support both raw list and {"annotations": [...]} style
+            if isinstance(parsed, dict) and "annotations" in parsed:
+                data = parsed.get("annotations")
+            else:
+                data = parsed
+
+            if not isinstance(data, list):
+                logger.warning("[ANNOTATION] Bbox payload is not an array")
+                return []
+
+            bbox_entries = self._bbox_entries(data)
+            logger.info("[ANNOTATION] Extracted %d CAD bounding boxes", len(bbox_entries))
+            return bbox_entries
+            
+        except Exception as exc:
+            logger.warning("[ANNOTATION] Unable to extract CAD bounding boxes: %s", exc, exc_info=True)
+            return []
+
+    def _bbox_entries(self, data: List) -> List[Dict]:
+        """Validate ``[{"parameter", "bounding_box"}, ...]`` items into keyed bbox entries."""
+        bbox_entries: List[Dict] = []
+        for entry in data:
+            if not isinstance(entry, dict):
+                continue
+            parameter = str(entry.get("parameter", "")).strip()
+            bbox = entry.get("bounding_box") or entry.get("bbox")
+            if not parameter:
+                continue
+            
+            # Validate bounding box format
+            if bbox is not None:
+                if not isinstance(bbox, list) or len(bbox) != 4:
+                    logger.debug(
+                        "[ANNOTATION] Skipping invalid bbox format for parameter '%s': %s",
+                        parameter,
+                        bbox
+                    )
+                    continue
+                # Ensure all values are numeric
+                try:
+                    bbox = [float(x) for x in bbox]
+                except (ValueError, TypeError):
+                    logger.debug(
+                        "[ANNOTATION] Skipping bbox with non-numeric values for parameter '%s': %s",
+                        parameter,
+                        bbox
+                    )
+                    continue
+            
+            # Map parameter back to metric record to get normalized key
+            normalized_key = self._normalize_label(parameter)
+            
+            bbox_entries.append({
+                "parameter": parameter,
+                "key": normalized_key,
+                "bounding_box": bbox,
+            })
+
+        return bbox_entries
+
+    @staticmethod
+    def _normalize_bbox(
+        bbox: List[float],
+        width: int,
+        height: int,
+    ) -> Optional[Tuple[int, int, int, int]]:
+        """
+        Normalize model bbox into (x1, y1, x2, y2) in image pixels.
+        Returns None for invalid boxes.
+        """
+        if len(bbox) != 4:
+            return None
+
+        x1, y1, x2, y2 = [float(b) for b in bbox]
+        img_max = float(max(width, height))
+
+        # --- Case A: normalized [0..1] ---
+        if 0 <= x1 <= 1 and 0 <= y1 <= 1 and 0 <= x2 <= 1 and 0 <= y2 <= 1:
+            x1 *= width
+            x2 *= width
+            y1 *= height
+            y2 *= height
+
+        # --- Case B: percent [0..100] ---
+        elif 0 <= x1 <= 100 and 0 <= y1 <= 100 and 0 <= x2 <= 100 and 0 <= y2 <= 100:
+            x1 = (x1 / 100) * width
+            x2 = (x2 / 100) * width
+            y1 = (y1 / 100) * height
+            y2 = (y2 / 100) * height
+
+        # --- Reject boxes excessively outside image (hallucinated) ---
+        if max(abs(x1), abs(y1), abs(x2), abs(y2)) > img_max * 2:
+            return None
+
+        # --- Handle width/height format [x, y, w, h] ---
+        if x2 > 0 and y2 > 0 and (x2 <= width and y2 <= height) and (x2 < x1 or y2 < y1):
+            w, h = x2, y2
+            x2 = x1 + w
+            y2 = y1 + h
+
+        # --- Clamp ---
+        x1 = max(0, min(int(round(x1)), width - 1))
+        x2 = max(0, min(int(round(x2)), width - 1))
+        y1 = max(0, min(int(round(y1)), height - 1))
+        y2 = max(0, min(int(round(y2)), height - 1))
+
+        # --- Reject inverted / zero-area boxes ---
+        if x2 <= x1 or y2 <= y1:
+            return None
+
+        # --- Reject very tiny boxes ---
+        if (x2 - x1) < 3 or (y2 - y1) < 3:
+            return None
+
+        # --- Reject extremely large boxes (almost whole image) ---
+        box_area = (x2 - x1) * (y2 - y1)
+        img_area = width * height
+        if box_area > img_area * 0.80:
+            return None
+
+        return x1, y1, x2, y2
+
+    def _clamp_bbox(bbox: List[float], width: int, height: int) -> Tuple[int, int, int, int]:
+        x1, y1, x2, y2 = bbox
+        x1 = max(0, min(int(round(x1)), width - 1))
+        x2 = max(0, min(int(round(x2)), width - 1))
+        y1 = max(0, min(int(round(y1)), height - 1))
+        y2 = max(0, min(int(round(y2)), height - 1))
+        if x2 < x1:
+            x1, x2 = x2, x1
+        if y2 < y1:
+            y1, y2 = y2, y1
+        return x1, y1, x2, y2
+
+    def _annotate_cad_image(
+        self,
+        cad_bytes: bytes,
+        comparisons: List[Dict],
+    ) -> Optional[str]:
+        """Create annotated CAD image highlighting matches/mismatches."""
+        np_bytes = np.frombuffer(cad_bytes, np.uint8)
+        image = cv2.imdecode(np_bytes, cv2.IMREAD_COLOR)
+        if image is None:
+            logger.warning("[ANNOTATION] Unable to decode CAD image for annotation")
+            return None
+
+        height, width = image.shape[:2]
+        colors = {
+            "Match": (0, 180, 0),
+            "Mismatch": (0, 0, 255),
+            "Missing": (0, 215, 255),
+            "Extra": (255, 165, 0),  # Orange for CAD-only metrics
+        }
+
+        for record in comparisons:
+            bbox = record.get("bounding_box")
+            if not bbox or len(bbox) != 4:
+                continue
+            norm = self._normalize_bbox(bbox, width, height)
+            if not norm:
+                logger.debug(f"[ANNOTATION] Skipping invalid bbox: {bbox}")
+                continue
+
+            x1, y1, x2, y2 = norm
+            color = colors.get(record.get("match", ""), (255, 255, 255))
+            cv2.rectangle(image, (x1, y1), (x2, y2), color, 2)
+            label_text = f"{record.get('parameter', '')}: {record.get('match', '')}"
+            cv2.putText(
+                image,
+                label_text,
+                (x1, max(y1 - 8, 16)),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.5,
+                color,
+                2,
+                cv2.LINE_AA,
+            )
+
+        success, buffer = cv2.imencode(".png", image)
+        if not success:
+            logger.warning("[ANNOTATION] Failed to encode annotated image")
+            return None
+        encoded = base64.b64encode(buffer).decode("utf-8")
+        return f"data:image/png;base64,{encoded}"
+
+    async def generate_auto_annotations(
+        self,
+        rfq_requirements: List[str],
+        cad_findings: List[str],
+        cad_bytes: bytes,
+        cad_mime: str,
+        cad_file: Optional[FileHandle] = None,
+        image_transform: Optional[ImageTransform] = None,
+        known_bboxes: Optional[List[Dict]] = None,
+    ) -> Tuple[Optional[str], List[Dict]]:
+        """
+        Build comparison records and annotated image using two-step flow:
+        1. build_metric_records: backend determines Match/Mismatch/Missing status
+        2. _extract_cad_bboxes: Gemini only provides bounding box locations
+
+        When ``cad_file`` holds a preprocessed drawing, pass its ``image_transform`` so the
+        boxes are mapped back onto the original ``cad_bytes``.
+        ``known_bboxes`` (from a single-pass comparison) skips step 2 for every metric it
+        locates; only the remaining ones are sent to ``_extract_cad_bboxes``.
+        """
+        if not cad_mime.startswith("image/"):
+            logger.info("[ANNOTATION] CAD file is not an image; skipping auto-annotation")
+            return None, []
+
+        # Step 1: Build canonical metric records with backend-determined status
+        try:
+            metric_records = self.build_metric_records(rfq_requirements, cad_findings)
+        except Exception as exc:
+            logger.warning("[ANNOTATION] Unable to build metric records: %s", exc, exc_info=True)
+            return None, []
+
+        if not metric_records:
+            logger.info("[ANNOTATION] No metric records available for annotation")
+            return None, []
+
+        # Step 2: Get bounding boxes from Gemini (no status/value decisions)
+        bbox_entries = [entry for entry in known_bboxes or [] if entry.get("bounding_box")]
+        located = {entry.get("key") for entry in bbox_entries}
+        pending_records = [record for record in metric_records if record.get("key") not in located]
+        if known_bboxes is not None:
+            logger.info(
+                "[ANNOTATION] Single pass located %d metric(s); %d left for a bbox request",
+                len(metric_records) - len(pending_records),
+                len(pending_records),
+            )
+        try:
+            # _extract_cad_bboxes returns early (no request) when nothing locatable is pending
+            bbox_entries += await self._extract_cad_bboxes(cad_bytes, cad_mime, pending_records, cad_file=cad_file)
+        except Exception as exc:
+            logger.warning("[ANNOTATION] Unable to extract CAD bounding boxes: %s", exc, exc_info=True)
+
+        # Step 3: Merge metric records with bounding boxes
+        bbox_lookup = {entry.get("key"): entry for entry in bbox_entries}
+        
+        comparison_records: List[Dict] = []
+        for record in metric_records:
+            bbox_entry = bbox_lookup.get(record.get("key"))
+            bbox = bbox_entry.get("bounding_box") if bbox_entry else None
+            
+            # Normalize bounding box format
+            if isinstance(bbox, list) and len(bbox) == 4:
+                bbox_values = [float(coord) for coord in bbox]
+            else:
+                bbox_values = None
+
+            # Boxes refer to the preprocessed image Gemini saw; express them on the original
+            if bbox_values and image_transform is not None:
+                pixel_box = self._normalize_bbox(bbox_values, image_transform.width, image_transform.height)
+                bbox_values = image_transform.box_to_original(pixel_box) if pixel_box else None
+
+            comparison_records.append({
+                "parameter": record.get("label", ""),
+                "rfq_value": record.get("rfq_value", ""),
+                "cad_value": record.get("cad_value", ""),
+                "match": record.get("match", "Missing"),
+                "bounding_box": bbox_values,
+            })
+
+        # Step 4: Create annotated image with only records that have bounding boxes
+        # Decoding/encoding the full-resolution drawing is CPU-bound; run it in a thread
+        annotated_image = await asyncio.to_thread(
+            self._annotate_cad_image,
+            cad_bytes,
+            [record for record in comparison_records if record.get("bounding_box")],
+        )
+
+        logger.info(
+            "[ANNOTATION] Generated %d annotation records (%d with bboxes)",
+            len(comparison_records),
+            len([r for r in comparison_records if r.get("bounding_box")]),
+        )
+
+        return annotated_image, comparison_records
+
+    WELD_FIELDS: Tuple[str, ...] = (
+        "Serial No",
+        "Description",
+        "Welding Type",
+        "Welding Value",
+        "Remarks",
+        "Position",
+        "Confidence",
+    )
+
+    # Added by multi-page analysis; kept only when present
+    WELD_PROVENANCE_FIELDS: Tuple[str, ...] = ("Page",)
+
+    @classmethod
+    def _normalize_weld(cls, weld: Dict) -> Dict[str, str]:
+        """Ensure all expected weld keys exist and are strings."""
+        normalized = {field: str(weld.get(field, "")) for field in cls.WELD_FIELDS}
+        for field in cls.WELD_PROVENANCE_FIELDS:
+            if weld.get(field):
+                normalized[field] = str(weld[field])
+        return normalized
+
+    @staticmethod
+    def _fix_llm_json(json_str: str) -> str:
+        """Fix common JSON syntax errors from the LLM (e.g. "key":. "value")."""
+        json_str = re.sub(r':\s*\.\s*"', ': "', json_str)
+        json_str = re.sub(r':\s*\.\s*(\d+)', r': \1', json_str)
+        json_str = re.sub(r':\s*\.\s*([A-Z])', r': "\1', json_str)
+        return json_str
+
+    def parse_json_response(self, response_text: str):
+        """Parse JSON response from Gemini and extract welds and explanations.
+        
+        Returns:
+            tuple: (welds_list, explanations_string) or (None, None) if parsing fails
+        """
+        original_response = response_text
+        try:
+            logger.info(f"[JSON PARSER] Starting JSON parsing. Raw response length: {len(response_text)} chars")
+            logger.info(f"[JSON PARSER] Raw response (first 500 chars): {response_text[:500]}")
+            
+            # Try to extract JSON from response (might have code blocks or extra text)
+            response_text = response_text.strip()
+            
+            # Remove markdown code blocks if present
+            had_markdown = False
+            if response_text.startswith("```json"):
+                response_text = response_text[7:]  # Remove ```json
+                had_markdown = True
+                logger.info("[JSON PARSER] Removed ```json markdown block")
+            elif response_text.startswith("```"):
+                response_text = response_text[3:]  # Remove ```
+                had_markdown = True
+                logger.info("[JSON PARSER] Removed ``` markdown block")
+            
+            if response_text.endswith("```"):
+                response_text = response_text[:-3]  # Remove closing ```
+                had_markdown = True
+                logger.info("[JSON PARSER] Removed closing ``` markdown block")
+            
+            response_text = response_text.strip()
+            
+            if had_markdown:
+                logger.info(f"[JSON PARSER] After markdown removal (first 500 chars): {response_text[:500]}")
+            
+            # Find JSON object in the text
+            json_start = response_text.find("{")
+            json_end = response_text.rfind("}") + 1
+            
+            if json_start == -1 or json_end == 0:
+                logger.warning("⚠ No JSON object found in response.")
+                logger.warning(f"[JSON PARSER] Response text (first 1000 chars): {original_response[:1000]}")
+                return None, None
+            
+            json_str = response_text[json_start:json_end]
+            logger.info(f"[JSON PARSER] Extracted JSON string length: {len(json_str)} chars")
+            logger.info(f"[JSON PARSER] Extracted JSON (first 500 chars): {json_str[:500]}")
+            
+            # Fix common JSON syntax errors from LLM before parsing
+            # Fix 1: Remove period before colon (e.g., "key":. "value" -> "key": "value")
+            original_json = json_str
+            json_str = self._fix_llm_json(json_str)
+            if json_str != original_json:
+                logger.info("[JSON PARSER] Fixed period-before-colon syntax errors")
+            
+            # Try to parse JSON with better error handling
+            try:
+                data = json.loads(json_str)
+            except json.JSONDecodeError as parse_error:
+                # Log the error position and surrounding context
+                error_pos = getattr(parse_error, 'pos', None)
+                if error_pos:
+                    logger.error(f"[JSON PARSER] JSON decode error at position {error_pos}")
+                    # Show context around the error
+                    start = max(0, error_pos - 100)
+                    end = min(len(json_str), error_pos + 100)
+                    logger.error(f"[JSON PARSER] Context around error: ...{json_str[start:end]}...")
+                    logger.error(f"[JSON PARSER] Error line/column: line {getattr(parse_error, 'lineno', '?')}, col {getattr(parse_error, 'colno', '?')}")
+                
+                # Try to extract welds array even if full JSON is broken
+                logger.warning("[JSON PARSER] Attempting to extract welds array from broken JSON...")
+                
+                # Find the welds array and extract individual weld objects
+                welds_start = json_str.find('"welds": [')
+                if welds_start >= 0:
+                    # Extract welds array content
+                    array_start = json_str.find('[', welds_start)
+                    bracket_count = 1
+                    array_end = -1
+                    for i in range(array_start + 1, min(len(json_str), array_start + 50000)):  # Limit search
+                        if json_str[i] == '[':
+                            bracket_count += 1
+                        elif json_str[i] == ']':
+                            bracket_count -= 1
+                            if bracket_count == 0:
+                                array_end = i + 1
+                                break
+                    
+                    if array_end > array_start:
+                        welds_array_str = json_str[array_start:array_end]
+                        try:
+                            welds_array = json.loads(welds_array_str)
+                            data = {"welds": welds_array, "explanations": ""}
+                            logger.info(f"[JSON PARSER] ✅ Successfully extracted {len(welds_array)} welds from broken JSON")
+                        except:
+                            # Try extracting individual weld objects using regex
+                            weld_objects = []
+                            # Pattern to match a complete weld object (from Serial No to Confidence)
+                            weld_pattern = r'\{\s*"Serial No"[^}]*"Confidence"[^}]*\}'
+                            matches = re.finditer(weld_pattern, welds_array_str, re.DOTALL)
+                            for match in matches:
+                                try:
+                                    weld_obj = json.loads(match.group(0))
+                                    weld_objects.append(weld_obj)
+                                except:
+                                    pass
+                            
+                            if weld_objects:
+                                data = {"welds": weld_objects, "explanations": ""}
+                                logger.info(f"[JSON PARSER] ✅ Extracted {len(weld_objects)} welds using regex fallback")
+                            else:
+                                logger.error("[JSON PARSER] Could not extract any welds")
+                                raise parse_error
+                    else:
+                        logger.error("[JSON PARSER] Could not find welds array end")
+                        raise parse_error
+                else:
+                    logger.error("[JSON PARSER] Could not find welds array")
+                    raise parse_error
+            logger.info(f"[JSON PARSER] Successfully parsed JSON. Keys: {list(data.keys())}")
+            
+            # Extract welds array
+            welds = data.get("welds", [])
+            explanations = data.get("explanations", "")
             
             logger.info(f"[JSON PARSER] Found {len(welds)} welds in JSON response")
             
@@ -1373,16 +4311,7 @@ class WeldingInspector:
             # Convert to list of dictionaries with consistent keys
             result = []
             for idx, weld in enumerate(welds):
-                # Ensure all expected keys exist
-                weld_dict = {
-                    "Serial No": str(weld.get("Serial No", "")),
-                    "Description": str(weld.get("Description", "")),
-                    "Welding Type": str(weld.get("Welding Type", "")),
-                    "Welding Value": str(weld.get("Welding Value", "")),
-                    "Remarks": str(weld.get("Remarks", "")),
-                    "Position": str(weld.get("Position", "")),
-                    "Confidence": str(weld.get("Confidence", ""))
-                }
+                weld_dict = self._normalize_weld(weld)
                 result.append(weld_dict)
                 if idx < 2:  # Log first 2 welds as sample
                     logger.info(f"[JSON PARSER] Sample weld {idx + 1}: {list(weld_dict.keys())}")
@@ -1398,572 +4327,2771 @@ class WeldingInspector:
             logger.error(f"[JSON PARSER] Full response length: {len(original_response)} chars")
             return None, None
 
-    def parse_vendor_comparison_response(self, response_text: str):
-        """Parse vendor comparison JSON response from Gemini."""
-        original_response = response_text
-        try:
-            response_text = self._strip_markdown_fence(response_text)
-            normalized_text = self._quote_unquoted_keys(response_text)
+    def parse_vendor_comparison_response(self, response_text: str):
+        """Parse vendor comparison JSON response from Gemini."""
+        original_response = response_text
+        try:
+            response_text = self._strip_markdown_fence(response_text)
+            normalized_text = self._quote_unquoted_keys(response_text)
+
+            json_start = normalized_text.find("{")
+            json_end = normalized_text.rfind("}") + 1
+
+            if json_start == -1 or json_end <= json_start:
+                logger.error("[VENDOR-COMPARISON PARSER] JSON object not found")
+                return None
+
+            json_str = normalized_text[json_start:json_end]
+
+            data = json.loads(json_str)
+            
+            logger.info("[VENDOR-COMPARISON PARSER] Parsed JSON keys: %s", list(data.keys()))
+            
+            # Validate structure
+            vendors = data.get("vendors", [])
+            comparison = data.get("comparison", {})
+            
+            if not isinstance(vendors, list):
+                logger.error("[VENDOR-COMPARISON PARSER] 'vendors' is not a list")
+                return None
+            
+            result = {
+                "vendors": vendors,
+                "comparison": comparison,
+            }
+
+            logger.info(
+                "[VENDOR-COMPARISON PARSER] Extracted: vendors=%d",
+                len(vendors),
+            )
+
+            logger.info("[VENDOR-COMPARISON PARSER] Parsed vendor comparison response successfully")
+            return result
+
+        except json.JSONDecodeError as exc:
+            logger.error("[VENDOR-COMPARISON PARSER] JSON decode error", exc_info=True)
+            logger.error(f"[VENDOR-COMPARISON PARSER] Response text (first 1000 chars): {original_response[:1000]}")
+            return None
+        except Exception:
+            logger.error("[VENDOR-COMPARISON PARSER] Unexpected error", exc_info=True)
+            logger.error(f"[VENDOR-COMPARISON PARSER] Response text (first 1000 chars): {original_response[:1000]}")
+            return None
+
+    # Per-vendor extraction prompt for map-reduce comparison (one RFQ per request)
+    _VENDOR_EXTRACT_PROMPT = (
+        "You are given ONE RFQ (Request for Quotation) document from a single vendor. "
+        "Extract structured information from it strictly based on the content found inside the document.\n\n"
+
+        "RULES:\n"
+        "1. Only extract information that explicitly appears in the RFQ.\n"
+        "2. Never assume, guess, infer, or hallucinate missing data; set missing fields to null.\n"
+        "3. Never use external product knowledge of any kind.\n"
+        "4. If numbers appear in words (e.g., 'five'), convert them into numeric form.\n"
+        "5. Normalize currency into INR (₹) whenever possible.\n"
+        "6. Use integers for day-based fields and floats for price fields.\n"
+        "7. This prompt must work for ANY product category (automotive, electrical, industrial, etc.).\n\n"
+
+        "OUTPUT FORMAT (STRICT JSON ONLY, ONE OBJECT):\n"
+        "{\n"
+        "  \"vendor_name\": \"\",\n"
+        "  \"certification_level\": \"\",\n"
+        "  \"pricing\": {\n"
+        "    \"unit_price_inr\": 0,\n"
+        "    \"extended_price\": 0,\n"
+        "    \"quantity_discount\": \"\",\n"
+        "    \"shipping_terms\": \"\"\n"
+        "  },\n"
+        "  \"delivery\": {\n"
+        "    \"initial_days\": 0,\n"
+        "    \"subsequent_days\": 0,\n"
+        "    \"emergency_days\": 0\n"
+        "  },\n"
+        "  \"warranty\": \"\",\n"
+        "  \"technical\": {\n"
+        "    \"product_type\": \"\",\n"
+        "    \"part_number\": \"\",\n"
+        "    \"dimensions\": {},\n"
+        "    \"specifications\": {}\n"
+        "  }\n"
+        "}\n\n"
+
+        "FINAL OUTPUT RULES:\n"
+        "- Output must be valid JSON only.\n"
+        "- No markdown, no explanation, no commentary.\n"
+        "- Only include what the RFQ explicitly provides.\n"
+    )
+
+    def parse_vendor_extraction_response(self, response_text: str) -> Optional[Dict]:
+        """Parse a single-vendor extraction response (also accepts ``{"vendors": [...]}``)."""
+        try:
+            normalized_text = self._quote_unquoted_keys(self._strip_markdown_fence(response_text))
+            json_start = normalized_text.find("{")
+            json_end = normalized_text.rfind("}") + 1
+            if json_start == -1 or json_end <= json_start:
+                logger.error("[VENDOR-EXTRACT PARSER] JSON object not found")
+                return None
+            data = json.loads(normalized_text[json_start:json_end])
+        except json.JSONDecodeError:
+            logger.error("[VENDOR-EXTRACT PARSER] JSON decode error", exc_info=True)
+            logger.error("[VENDOR-EXTRACT PARSER] Response text (first 1000 chars): %s", response_text[:1000])
+            return None
+
+        if isinstance(data.get("vendors"), list) and data["vendors"]:
+            data = data["vendors"][0]
+        return data if isinstance(data, dict) else None
+
+    async def extract_vendor_rfq(self, rfq_input: Union[bytes, str, FileHandle], mime_type: Optional[str], filename: str) -> Dict:
+        """Extract one vendor's fields from its RFQ (the map step of ``compare_vendor_rfqs``).
+
+        Identical files hit the response cache, which is keyed by file content.
+        """
+        response_text = await self.client.achat_with_files(
+            self._VENDOR_EXTRACT_PROMPT,
+            [(rfq_input, mime_type)],
+            cache_prompt=True,
+        )
+        vendor = await asyncio.to_thread(self.parse_vendor_extraction_response, response_text)
+        if vendor is None:
+            raise ValueError(f"Unable to parse vendor fields from {filename}")
+        if not vendor.get("vendor_name"):
+            vendor["vendor_name"] = Path(filename).stem
+        vendor["source_file"] = filename
+        return vendor
+
+    async def compare_vendor_rfqs(
+        self,
+        rfq_inputs: List[Tuple[Union[bytes, str, FileHandle], Optional[str], str]],
+        weights: Dict[str, float],
+    ) -> Dict:
+        """Map-reduce vendor comparison: one concurrent extraction per RFQ, then a local reduce.
+
+        The reduce is ``rank_vendors`` with the given weights. Files that fail are reported
+        under ``failed_files`` instead of failing the comparison.
+        """
+        logger.info("[VENDOR-COMPARE] Extracting %d vendors concurrently", len(rfq_inputs))
+        results = await asyncio.gather(
+            *(self.extract_vendor_rfq(rfq_input, mime_type, filename) for rfq_input, mime_type, filename in rfq_inputs),
+            return_exceptions=True,
+        )
+
+        vendors: List[Dict] = []
+        failed_files: List[Dict[str, str]] = []
+        for (_, _, filename), result in zip(rfq_inputs, results):
+            if isinstance(result, BaseException):
+                logger.warning("[VENDOR-COMPARE] Extraction failed for %s: %s", filename, result)
+                failed_files.append({"filename": filename, "error": str(result)})
+            else:
+                vendors.append(result)
+
+        if not vendors:
+            raise HTTPException(status_code=502, detail="Unable to extract vendor data from any RFQ file")
+
+        ranking, comparison = rank_vendors(vendors, weights)
+        return {
+            "vendors": vendors,
+            "comparison": comparison,
+            "ranking": ranking,
+            "failed_files": failed_files,
+        }
+
+    def parse_comparison_response(self, response_text: str):
+        """Parse comparison JSON response from Gemini."""
+        original_response = response_text
+        try:
+            response_text = self._strip_markdown_fence(response_text)
+            normalized_text = self._quote_unquoted_keys(response_text)
+
+            json_start = normalized_text.find("{")
+            json_end = normalized_text.rfind("}") + 1
+
+            if json_start == -1 or json_end <= json_start:
+                logger.error("[COMPARISON PARSER] JSON object not found")
+                return None
+
+            json_str = normalized_text[json_start:json_end]
+
+            data = json.loads(json_str)
+            
+            logger.info("[COMPARISON PARSER] Parsed JSON keys: %s", list(data.keys()))
+            
+            # Handle old format with "metrics" array (convert to new format)
+            if "metrics" in data and "rfq_requirements" not in data:
+                logger.warning("[COMPARISON PARSER] Detected old format with 'metrics' array, converting to new format")
+                metrics = data.get("metrics", [])
+                rfq_requirements = []
+                cad_findings = []
+                mismatches_list = []
+                
+                for metric in metrics:
+                    if isinstance(metric, dict):
+                        metric_name = metric.get("metric", "")
+                        rfq_val = metric.get("rfq", "")
+                        cad_val = metric.get("cad", "")
+                        status = metric.get("status", "")
+                        
+                        if metric_name:
+                            rfq_requirements.append(f"{metric_name}: {rfq_val}" if rfq_val else f"{metric_name}: —")
+                            cad_findings.append(f"{metric_name}: {cad_val}" if cad_val else f"{metric_name}: —")
+                            
+                            if status in ["Mismatch", "Missing in CAD"]:
+                                mismatches_list.append(f"{metric_name}: RFQ {rfq_val} vs CAD {cad_val} - {status}")
+                
+                # Also check mismatches array if present
+                if "mismatches" in data:
+                    for mismatch in data.get("mismatches", []):
+                        if isinstance(mismatch, dict):
+                            metric_name = mismatch.get("metric", "")
+                            rfq_val = mismatch.get("rfq", "")
+                            cad_val = mismatch.get("cad", "")
+                            status = mismatch.get("status", "")
+                            if metric_name:
+                                mismatches_list.append(f"{metric_name}: RFQ {rfq_val} vs CAD {cad_val} - {status}")
+                        elif isinstance(mismatch, str):
+                            mismatches_list.append(mismatch)
+                
+                result = {
+                    "match": bool(data.get("match", False)),
+                    "confidence": str(data.get("confidence", "")),
+                    "summary": str(data.get("summary", "")),
+                    "rfq_requirements": rfq_requirements,
+                    "cad_findings": cad_findings,
+                    "mismatches": mismatches_list,
+                    "recommendations": str(data.get("recommendations", "")),
+                }
+            else:
+                # Standard format
+                result = {
+                    "match": bool(data.get("match", False)),
+                    "confidence": str(data.get("confidence", "")),
+                    "summary": str(data.get("summary", "")),
+                    "rfq_requirements": [str(item) for item in data.get("rfq_requirements", [])],
+                    "cad_findings": [str(item) for item in data.get("cad_findings", [])],
+                    "mismatches": [str(item) for item in data.get("mismatches", [])],
+                    "recommendations": str(data.get("recommendations", "")),
+                }
+                if isinstance(data.get("cad_locations"), list):
+                    result["cad_locations"] = data["cad_locations"]
+            
+            logger.info(
+                "[COMPARISON PARSER] Extracted: rfq_count=%d, cad_count=%d, mismatch_count=%d",
+                len(result["rfq_requirements"]),
+                len(result["cad_findings"]),
+                len(result["mismatches"]),
+            )
+            
+            if len(result["rfq_requirements"]) == 0 and len(result["cad_findings"]) == 0:
+                logger.warning(
+                    "[COMPARISON PARSER] WARNING: Both rfq_requirements and cad_findings are empty! "
+                    "This may indicate the response format doesn't match expectations."
+                )
+
+            logger.info("[COMPARISON PARSER] Parsed comparison response successfully")
+            return result
+
+        except json.JSONDecodeError as exc:
+            logger.error("[COMPARISON PARSER] JSON decode error", exc_info=True)
+            logger.error(f"[COMPARISON PARSER] Response text (first 1000 chars): {original_response[:1000]}")
+            fallback_result = self._parse_comparison_fallback(response_text)
+            if fallback_result:
+                return fallback_result
+            return None
+        except Exception:
+            logger.error("[COMPARISON PARSER] Unexpected error", exc_info=True)
+            logger.error(f"[COMPARISON PARSER] Response text (first 1000 chars): {original_response[:1000]}")
+            fallback_result = self._parse_comparison_fallback(response_text)
+            if fallback_result:
+                return fallback_result
+            return None
+
+
+# ----------------- Streaming Weld Parser -----------------
+class IncrementalWeldParser:
+    """Incrementally parse a streamed weld report and emit each weld as soon as it closes.
+
+    The parser scans every character once: it looks for the ``"welds": [`` array,
+    then tracks string/escape state and brace depth so that each top-level object
+    in the array is decoded the moment its closing brace arrives.
+    """
+
+    _WELDS_ARRAY_PATTERN = re.compile(r'"welds"\s*:\s*\[')
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._phase = "seek"  # seek -> array -> done
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._object_start = -1
+        self.welds: List[Dict[str, str]] = []
+
+    def feed(self, chunk: str) -> List[Dict[str, str]]:
+        """Consume a text chunk and return welds completed by it."""
+        self._buffer += chunk
+        completed: List[Dict[str, str]] = []
+
+        if self._phase == "seek":
+            # Step back a little so a key split across chunks is still found
+            match = self._WELDS_ARRAY_PATTERN.search(self._buffer, max(0, self._pos - 16))
+            if not match:
+                self._pos = len(self._buffer)
+                return completed
+            self._pos = match.end()
+            self._phase = "array"
+
+        if self._phase != "array":
+            return completed
+
+        buffer = self._buffer
+        for i in range(self._pos, len(buffer)):
+            char = buffer[i]
+            if self._escape:
+                self._escape = False
+                continue
+            if self._in_string:
+                if char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+            if char == '"':
+                self._in_string = True
+            elif char == "{":
+                if self._depth == 0:
+                    self._object_start = i
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0 and self._object_start >= 0:
+                    weld = self._decode_object(buffer[self._object_start:i + 1])
+                    if weld is not None:
+                        self.welds.append(weld)
+                        completed.append(weld)
+                    self._object_start = -1
+            elif char == "]" and self._depth == 0:
+                self._phase = "done"
+                self._pos = i + 1
+                return completed
+
+        self._pos = len(buffer)
+        return completed
+
+    @staticmethod
+    def _decode_object(object_str: str) -> Optional[Dict[str, str]]:
+        for candidate in (object_str, WeldingInspector._fix_llm_json(object_str)):
+            try:
+                obj = json.loads(candidate)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(obj, dict):
+                return WeldingInspector._normalize_weld(obj)
+        logger.warning("[STREAM PARSER] Skipping undecodable weld object: %s", object_str[:200])
+        return None
+
+    @property
+    def text(self) -> str:
+        return self._buffer
+
+
+# Initialize client and inspector
+response_cache = ResponseCache(GEMINI_CACHE_DIR) if GEMINI_CACHE_ENABLED else None
+# One limiter per process so every endpoint draws from the same quota budget
+gemini_rate_limiter = GeminiRateLimiter()
+client = GeminiClient(PROJECT, REGION, MODEL, cache=response_cache, rate_limiter=gemini_rate_limiter)
+inspector = WeldingInspector(client)
+try:
+    vendor_score_weights = parse_score_weights(VENDOR_SCORE_WEIGHTS)
+except ValueError as exc:
+    logger.warning("[CONFIG] Invalid VENDOR_SCORE_WEIGHTS '%s' (%s); using defaults", VENDOR_SCORE_WEIGHTS, exc)
+    vendor_score_weights = parse_score_weights("price=0.5,delivery=0.3,warranty=0.2")
+vendor_comparisons = create_vendor_comparison_store()
+job_manager = JobManager(create_job_store())
+
+
+@app.get("/")
+def root():
+    return {"message": "Welding Inspector API", "status": "running"}
+
+@app.get("/health")
+def health():
+    """Health check endpoint."""
+    return {"status": "healthy", "service": "Welding Inspector API"}
+
+@app.get("/gemini/stats")
+def gemini_stats():
+    """Runtime counters for the Gemini client."""
+    return {
+        "model": client.model_name,
+        "backend": client.backend.name,
+        "injected_faults": getattr(client.backend, "injected", None),
+        "max_concurrency": client.max_concurrency,
+        "rate_limiter": client.rate_limiter.stats(),
+        "files": client.files.stats(),
+        "cache": client.cache.stats() if client.cache else None,
+        "context_cache": {**client.context_cache.stats(), "supported": isinstance(client.backend, ContextCacheBackend)},
+    }
+
+@app.get("/supply-chain/health")
+def supply_chain_health():
+    """Health check for supply chain endpoints."""
+    return {
+        "status": "healthy",
+        "service": "Supply Chain Document Automation",
+        "endpoints": {
+            "upload": "/supply-chain/upload",
+            "status": "/supply-chain/status/{document_id}",
+            "documents": "/supply-chain/documents",
+            "approve": "/supply-chain/approve/{document_id}",
+            "reject": "/supply-chain/reject/{document_id}",
+            "pipeline": "/supply-chain/pipeline",
+            "events": "/supply-chain/events",
+            "classifier": "/supply-chain/classifier",
+            "erp": "/supply-chain/erp",
+        },
+        "store": document_store.name,
+        "document_count": document_store.count(),
+        "classifier": document_classifier.stats(),
+        "erp": erp_batcher.stats(),
+        "pipeline": supply_chain_pipeline.stats(),
+    }
+
+
+# ----------------- Upload Reader -----------------
+# Uploads are streamed in chunks, capped, type-sniffed and hashed before they are accepted
+UPLOAD_MAX_MB = int(os.getenv("UPLOAD_MAX_MB", "20"))
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+DRAWING_UPLOAD_TYPES = {"application/pdf", "image/png", "image/jpeg", "image/webp"}
+DOCUMENT_UPLOAD_TYPES = {"application/pdf", "application/msword", DOCX_MIME}
+
+_ZIP_MAGIC = b"PK\x03\x04"
+
+
+def sniff_mime_type(head: bytes) -> Optional[str]:
+    """MIME type from the leading bytes of a file; ZIP containers are reported as DOCX until checked."""
+    if head.startswith(b"%PDF-"):
+        return "application/pdf"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head.startswith(_ZIP_MAGIC):
+        return DOCX_MIME
+    if head.startswith(b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"):
+        # OLE2 compound file: legacy .doc
+        return "application/msword"
+    return None
+
+
+def _is_docx(data: bytes) -> bool:
+    import zipfile
+
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            return "word/document.xml" in archive.namelist()
+    except zipfile.BadZipFile:
+        return False
+
+
+class UploadedFile:
+    """A validated upload: its bytes, sniffed MIME type and SHA-256."""
+
+    def __init__(self, filename: str, mime_type: str, data: bytes, sha256: str):
+        self.filename = filename
+        self.mime_type = mime_type
+        self.data = data
+        self.sha256 = sha256
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+
+async def read_upload(
+    file: UploadFile,
+    allowed_types: set,
+    label: str,
+    type_error: str,
+    max_bytes: int = UPLOAD_MAX_MB * 1024 * 1024,
+) -> UploadedFile:
+    """Read ``file`` in chunks, rejecting it as soon as it is too large or of the wrong type.
+
+    The chunks are hashed as they arrive and joined once at the end; every consumer needs the
+    bytes in memory anyway, so the upload is held exactly once. The type comes from the file's
+    magic bytes, not the client's ``content_type``. ``label`` names the file in error messages;
+    ``type_error`` is the message for a disallowed type.
+    """
+    max_mb = max_bytes / (1024 * 1024)
+    declared_size = getattr(file, "size", None)
+    if declared_size is not None and declared_size > max_bytes:
+        raise HTTPException(status_code=400, detail=f"{label} exceeds {max_mb:.0f}MB limit")
+
+    hasher = hashlib.sha256()
+    size = 0
+    mime_type: Optional[str] = None
+    chunks: List[bytes] = []
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        if mime_type is None:
+            mime_type = sniff_mime_type(chunk)
+            if mime_type not in allowed_types:
+                raise HTTPException(status_code=400, detail=type_error)
+        size += len(chunk)
+        if size > max_bytes:
+            raise HTTPException(status_code=400, detail=f"{label} exceeds {max_mb:.0f}MB limit")
+        hasher.update(chunk)
+        chunks.append(chunk)
+
+    if size == 0:
+        raise HTTPException(status_code=400, detail=f"{label} is empty")
+    data = b"".join(chunks)
+    del chunks
+    if mime_type == DOCX_MIME and not await asyncio.to_thread(_is_docx, data):
+        raise HTTPException(status_code=400, detail=type_error)
+
+    if file.content_type and file.content_type != mime_type:
+        logger.info("[UPLOAD] %s declared %s but contains %s", file.filename, file.content_type, mime_type)
+    return UploadedFile(file.filename or "", mime_type, data, hasher.hexdigest())
+
+
+async def _read_drawing_upload(file: UploadFile) -> Tuple[bytes, str]:
+    """Validate and read an uploaded drawing (image or PDF); returns (bytes, mime_type)."""
+    upload = await read_upload(
+        file,
+        DRAWING_UPLOAD_TYPES,
+        "File",
+        f"File must be an image (PNG, JPG, JPEG, WEBP) or PDF. Received: {file.content_type}",
+    )
+    logger.info(f"Processing file: {file.filename}, type: {upload.mime_type}, size: {upload.size} bytes")
+    return upload.data, upload.mime_type
+
+
+async def _run_analysis(file_bytes: bytes, mime_type: str) -> Dict:
+    """Weld analysis of a validated drawing (shared by ``/analyze`` and ``/jobs/analyze``)."""
+    file_bytes, mime_type, _ = await asyncio.to_thread(preprocess_drawing_image, file_bytes, mime_type)
+
+    # Analyze the file (image or PDF)
+    report = await inspector.inspect_drawing(file_bytes, mime_type)
+    
+    logger.info(f"[ENDPOINT] Raw LLM report length: {len(report)} chars")
+    logger.info(f"[ENDPOINT] Raw LLM report (first 500 chars): {report[:500]}")
+    
+    # Parse JSON response
+    table_data, explanations = inspector.parse_json_response(report)
+    
+    if table_data is None:
+        # Fallback: try to parse as markdown table if JSON parsing fails
+        logger.warning("[ENDPOINT] JSON parsing failed, attempting markdown fallback")
+        table_data = inspector.parse_table(report) if hasattr(inspector, 'parse_table') else None
+        if "EXPLANATIONS:" in report:
+            explanations = report.split("EXPLANATIONS:", 1)[1].strip()
+    
+    if table_data is not None:
+        logger.info(f"[ENDPOINT] Parsed table_data: {len(table_data)} rows")
+        if len(table_data) > 0:
+            logger.info(f"[ENDPOINT] Table keys: {list(table_data[0].keys())}")
+            logger.info(f"[ENDPOINT] Sample row: {table_data[0] if table_data else 'N/A'}")
+    else:
+        logger.warning("[ENDPOINT] ⚠ table_data is None - no table data to send to frontend")
+    
+    response_data = {
+        "success": True,
+        "report": report,
+        "table": table_data,
+        "explanations": explanations or ""
+    }
+    
+    logger.info(f"[ENDPOINT] Sending response: success={response_data['success']}, table_rows={len(table_data) if table_data else 0}, has_explanations={bool(explanations)}")
+    return response_data
+
+
+@app.post("/analyze")
+async def analyze_image(file: UploadFile = File(...)):
+    """Upload an image or PDF and analyze it for welding information."""
+    try:
+        file_bytes, mime_type = await _read_drawing_upload(file)
+        return JSONResponse(await _run_analysis(file_bytes, mime_type))
+
+    except HTTPException:
+        # Re-raise HTTP exceptions as-is
+        raise
+    except Exception as e:
+        logger.error(f"Error analyzing file: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=500, 
+            detail=f"Error analyzing file: {str(e)}"
+        )
+
+
+@app.post("/analyze/stream")
+async def analyze_image_stream(file: UploadFile = File(...)):
+    """Stream welding analysis results as NDJSON.
+
+    Emits one line per event:
+    - {"type": "weld", "index": n, "weld": {...}} as soon as each weld object is complete
+    - {"type": "explanations", "explanations": "..."} once the response has finished
+    - {"type": "done", "count": n, "report": "..."} with the raw report
+    - {"type": "error", "message": "..."} if generation fails mid-stream
+    """
+    file_bytes, mime_type = await _read_drawing_upload(file)
+    file_bytes, mime_type, _ = await asyncio.to_thread(preprocess_drawing_image, file_bytes, mime_type)
+
+    async def event_stream():
+        parser = IncrementalWeldParser()
+        try:
+            async for chunk in inspector.stream_inspect_drawing(file_bytes, mime_type):
+                for weld in parser.feed(chunk):
+                    event = {"type": "weld", "index": len(parser.welds) - 1, "weld": weld}
+                    yield json.dumps(event, ensure_ascii=False) + "\n"
+
+            report = parser.text
+            table_data, explanations = inspector.parse_json_response(report)
+            if table_data and len(table_data) > len(parser.welds):
+                # The full parse recovered welds the incremental scan could not (malformed stream)
+                for index, weld in enumerate(table_data[len(parser.welds):], start=len(parser.welds)):
+                    yield json.dumps({"type": "weld", "index": index, "weld": weld}, ensure_ascii=False) + "\n"
+            count = max(len(parser.welds), len(table_data or []))
+
+            yield json.dumps({"type": "explanations", "explanations": explanations or ""}, ensure_ascii=False) + "\n"
+            yield json.dumps({"type": "done", "count": count, "report": report}, ensure_ascii=False) + "\n"
+            logger.info("[STREAM] Streamed %d welds", count)
+        except Exception as exc:
+            logger.error("[STREAM] Error during streaming analysis: %s", exc, exc_info=True)
+            yield json.dumps({"type": "error", "message": f"Error analyzing file: {str(exc)}"}) + "\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def _read_compare_uploads(rfq: UploadFile, cad: UploadFile) -> Tuple[bytes, str, bytes, str]:
+    """Validate and read the ``/compare`` uploads; returns (rfq_bytes, rfq_mime, cad_bytes, cad_mime)."""
+    rfq_upload = await read_upload(
+        rfq,
+        DOCUMENT_UPLOAD_TYPES,
+        "RFQ file",
+        "RFQ file must be a PDF or Word document (.doc, .docx)",
+    )
+    cad_upload = await read_upload(
+        cad,
+        DRAWING_UPLOAD_TYPES,
+        "CAD file",
+        "CAD file must be an image (PNG, JPG, JPEG, WEBP) or PDF",
+    )
+
+    logger.info(
+        "[COMPARE] Processing RFQ %s (%d bytes) and CAD %s (%d bytes)",
+        rfq.filename,
+        rfq_upload.size,
+        cad.filename,
+        cad_upload.size,
+    )
+    return rfq_upload.data, rfq_upload.mime_type, cad_upload.data, cad_upload.mime_type
+
+
+async def _run_comparison(
+    rfq_bytes: bytes,
+    rfq_mime: str,
+    cad_bytes: bytes,
+    cad_mime: str,
+    part_selection: str,
+    single_pass: Optional[bool] = None,
+) -> Dict:
+    """RFQ vs CAD comparison plus annotation (shared by ``/compare`` and ``/jobs/compare``)."""
+    is_cad_image = cad_mime.startswith("image/")
+    # DOCX parsing is CPU work; keep it off the event loop
+    rfq_input = await asyncio.to_thread(inspector._prepare_rfq_input, rfq_bytes, rfq_mime)
+    # Shrink the drawing for Gemini; annotation still happens on the original cad_bytes
+    gemini_cad_bytes, gemini_cad_mime, cad_transform = await asyncio.to_thread(
+        preprocess_drawing_image, cad_bytes, cad_mime
+    )
+    # Encode the drawing once; the comparison and bbox calls both reuse this handle
+    cad_file = await inspector.client.aregister_file(gemini_cad_bytes, gemini_cad_mime)
+    # Boxes are only used to annotate images, so PDFs never need the locate step
+    locate = is_cad_image and (GEMINI_COMPARE_SINGLE_PASS if single_pass is None else single_pass)
+    comparison_text = await inspector.compare_rfq_and_cad(
+        rfq_input,
+        cad_bytes,
+        cad_mime,
+        part=part_selection,
+        cad_file=cad_file,
+        locate=locate,
+    )
+
+    result = inspector.parse_comparison_response(comparison_text)
+
+    if result is None:
+        logger.error("[COMPARE] Failed to parse comparison response for part: %s", part_selection)
+        logger.error("[COMPARE] Raw response (first 2000 chars): %s", comparison_text[:2000] if comparison_text else "None")
+        raise HTTPException(status_code=500, detail="Unable to parse comparison response")
+    
+    logger.info(
+        "[COMPARE] Parsed result for part '%s': match=%s, rfq_count=%d, cad_count=%d, mismatch_count=%d",
+        part_selection,
+        result.get("match"),
+        len(result.get("rfq_requirements", [])),
+        len(result.get("cad_findings", [])),
+        len(result.get("mismatches", [])),
+    )
+
+    cad_locations = result.pop("cad_locations", None)
+    known_bboxes = inspector._bbox_entries(cad_locations) if locate and isinstance(cad_locations, list) else None
+
+    annotated_image = None
+    annotation_records: List[Dict] = []
+    try:
+        annotated_image, annotation_records = await inspector.generate_auto_annotations(
+            result.get("rfq_requirements", []),
+            result.get("cad_findings", []),
+            cad_bytes,
+            cad_mime,
+            cad_file=cad_file,
+            image_transform=cad_transform,
+            known_bboxes=known_bboxes,
+        )
+    except Exception as annotation_exc:
+        logger.warning(
+            "[COMPARE] Auto-annotation failed: %s",
+            annotation_exc,
+            exc_info=True,
+        )
+
+    response_data = {
+        "success": True,
+        **result,
+        "annotated_image": annotated_image,
+        "annotations": annotation_records,
+    }
+
+    logger.info(
+        "[COMPARE] Comparison result: match=%s, confidence=%s",
+        result.get("match"),
+        result.get("confidence"),
+    )
+    return response_data
+
+
+@app.post("/compare")
+async def compare_rfq_cad(
+    rfq: UploadFile = File(...),
+    cad: UploadFile = File(...),
+    part: str = Form("spark_plug"),
+    single_pass: Optional[bool] = Form(None),
+):
+    """Upload RFQ (PDF) and CAD (image/PDF) to compare alignment.
+
+    ``single_pass`` (default ``GEMINI_COMPARE_SINGLE_PASS``) asks the comparison call for the
+    annotation boxes as well, so only findings without a box need a second Gemini call.
+    """
+    try:
+        rfq_bytes, rfq_mime, cad_bytes, cad_mime = await _read_compare_uploads(rfq, cad)
+
+        part_selection = (part or "spark_plug").strip() or "spark_plug"
+        logger.info("[COMPARE] Part selection: %s", part_selection)
+
+        return JSONResponse(await _run_comparison(rfq_bytes, rfq_mime, cad_bytes, cad_mime, part_selection, single_pass))
+
+    except HTTPException:
+        raise
+    except Exception as exc:
+        logger.error("[COMPARE] Unexpected error: %s", exc, exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error comparing files: {str(exc)}")
+
+
+async def _read_vendor_uploads(files: List[UploadFile]) -> List[Tuple[bytes, str, str]]:
+    """Validate and read the ``/compare-vendor`` uploads; returns (bytes, mime, filename) per file."""
+    if not files or len(files) < 2:
+        raise HTTPException(
+            status_code=400,
+            detail="At least 2 RFQ files are required for comparison",
+        )
+
+    uploads: List[Tuple[bytes, str, str]] = []
+    for idx, file in enumerate(files):
+        upload = await read_upload(
+            file,
+            DOCUMENT_UPLOAD_TYPES,
+            f"File {idx + 1} ({file.filename})",
+            f"File {idx + 1} ({file.filename}) must be a PDF or Word document (.doc, .docx)",
+        )
+        uploads.append((upload.data, upload.mime_type, file.filename or f"file_{idx + 1}"))
+    return uploads
+
+
+async def _run_vendor_comparison(uploads: List[Tuple[bytes, str, str]], map_reduce: Optional[bool] = None) -> Dict:
+    """Multi-vendor RFQ comparison (shared by ``/compare-vendor`` and ``/jobs/compare-vendor``)."""
+    rfq_inputs: List[Tuple[Union[bytes, str], Optional[str], str]] = []
+    for file_bytes, rfq_mime, filename in uploads:
+        rfq_input = await asyncio.to_thread(inspector._prepare_rfq_input, file_bytes, rfq_mime)
+        rfq_inputs.append((rfq_input[0], rfq_input[1], filename))
+
+    logger.info(
+        "[VENDOR-COMPARE] Processing %d vendor RFQ files",
+        len(rfq_inputs),
+    )
+
+    if GEMINI_VENDOR_MAP_REDUCE if map_reduce is None else map_reduce:
+        result = await inspector.compare_vendor_rfqs(rfq_inputs, vendor_score_weights)
+        logger.info(
+            "[VENDOR-COMPARE] Map-reduce result: vendors=%d, failed=%d",
+            len(result["vendors"]),
+            len(result["failed_files"]),
+        )
+        comparison_id = await asyncio.to_thread(vendor_comparisons.put, result)
+        return {"success": True, "comparison_id": comparison_id, "weights": vendor_score_weights, **result}
+
+    vendor_prompt = (
+        "You are given multiple RFQ (Request for Quotation) documents from different vendors. "
+        "All RFQs refer to the same item or item category, but each vendor may present information "
+        "in different formats, wording styles, and layout structures.\n\n"
+
+        "YOUR OBJECTIVE:\n"
+        "Extract structured information from each RFQ and produce a normalized multi-vendor comparison "
+        "strictly based on the content found inside the documents.\n\n"
+
+        "GLOBAL RULES (APPLY TO ALL STEPS):\n"
+        "1. Treat each RFQ as a separate vendor entry, even if vendor names look similar.\n"
+        "2. Only extract information that explicitly appears in each RFQ.\n"
+        "3. Never assume, guess, infer, or hallucinate missing data.\n"
+        "4. If a field is missing for a vendor, set it to null.\n"
+        "5. Never copy values from one vendor into another vendor’s fields.\n"
+        "6. Never use external product knowledge of any kind.\n"
+        "7. If numbers appear in words (e.g., 'five'), convert them into numeric form.\n"
+        "8. Normalize currency into INR (₹) whenever possible.\n"
+        "9. Use integers for day-based fields and floats for price fields.\n"
+        "10. This prompt must work for ANY product category (automotive, electrical, industrial, etc.). "
+        "    Never restrict assumptions to a specific domain.\n\n"
+
+        "FIELDS TO EXTRACT (IF PRESENT):\n"
+        "- certification_level\n"
+        "- unit_price_inr\n"
+        "- extended_price\n"
+        "- quantity_discount\n"
+        "- shipping_terms\n"
+        "- delivery_initial_days\n"
+        "- delivery_subsequent_days\n"
+        "- delivery_emergency_days\n"
+        "- warranty_period\n"
+        "- technical.product_type\n"
+        "- technical.part_number\n"
+        "- technical.dimensions\n"
+        "- technical.specifications\n\n"
+
+        "OUTPUT FORMAT (STRICT JSON ONLY):\n"
+        "{\n"
+        "  \"vendors\": [\n"
+        "    {\n"
+        "      \"vendor_name\": \"\",\n"
+        "      \"certification_level\": \"\",\n"
+        "      \"pricing\": {\n"
+        "        \"unit_price_inr\": 0,\n"
+        "        \"extended_price\": 0,\n"
+        "        \"quantity_discount\": \"\",\n"
+        "        \"shipping_terms\": \"\"\n"
+        "      },\n"
+        "      \"delivery\": {\n"
+        "        \"initial_days\": 0,\n"
+        "        \"subsequent_days\": 0,\n"
+        "        \"emergency_days\": 0\n"
+        "      },\n"
+        "      \"warranty\": \"\",\n"
+        "      \"technical\": {\n"
+        "        \"product_type\": \"\",\n"
+        "        \"part_number\": \"\",\n"
+        "        \"dimensions\": {},\n"
+        "        \"specifications\": {}\n"
+        "      }\n"
+        "    }\n"
+        "  ],\n"
+        "  \"comparison\": {\n"
+        "    \"best_price_vendor\": \"\",\n"
+        "    \"best_delivery_vendor\": \"\",\n"
+        "    \"best_warranty_vendor\": \"\",\n"
+        "    \"overall_recommendation\": \"\"\n"
+        "  }\n"
+        "}\n\n"
+
+        "RECOMMENDATION RULES (CRITICAL):\n"
+        "- The 'overall_recommendation' field must recommend ONLY ONE vendor (the single best overall choice).\n"
+        "- Select the vendor that offers the best overall value considering price, delivery time, warranty, and other factors.\n"
+        "- The recommendation text must start with the vendor name and explain why this ONE vendor is recommended.\n"
+        "- Do NOT recommend multiple vendors. Choose only the top 1 vendor.\n"
+        "- Example format: \"[Vendor Name] offers the best overall value with [reasons].\"\n"
+        "- The vendor name in overall_recommendation must exactly match one of the vendor_name values from the vendors array.\n\n"
+
+        "FINAL OUTPUT RULES:\n"
+        "- Output must be valid JSON only.\n"
+        "- No markdown, no explanation, no commentary.\n"
+        "- No additional notes before or after the JSON.\n"
+        "- Do not hallucinate any fields or values.\n"
+        "- Only include what the RFQs explicitly provide.\n"
+        "- overall_recommendation must mention exactly ONE vendor name.\n"
+    )
+
+    # Prepare files for Gemini
+    gemini_files: List[Tuple[Union[bytes, str, FileHandle], Optional[str]]] = []
+    for rfq_input, mime_type, filename in rfq_inputs:
+        gemini_files.append((rfq_input, mime_type))
+
+    logger.info("[VENDOR-COMPARE] Sending %d files to Gemini", len(gemini_files))
+
+    response_text = await inspector.client.achat_with_files(vendor_prompt, gemini_files, cache_prompt=True)
+
+    logger.info("[VENDOR-COMPARE] Received response from Gemini")
+
+    result = inspector.parse_vendor_comparison_response(response_text)
+
+    if result is None:
+        logger.error("[VENDOR-COMPARE] Failed to parse vendor comparison response")
+        logger.error("[VENDOR-COMPARE] Raw response (first 2000 chars): %s", response_text[:2000] if response_text else "None")
+        raise HTTPException(status_code=500, detail="Unable to parse vendor comparison response")
+
+    logger.info(
+        "[VENDOR-COMPARE] Parsed result: vendors=%d",
+        len(result.get("vendors", [])),
+    )
+
+    # Keep the model's comparison block here, but add the deterministic ranking alongside
+    result["ranking"], _ = rank_vendors(result["vendors"], vendor_score_weights)
+    comparison_id = await asyncio.to_thread(vendor_comparisons.put, result)
+
+    response_data = {
+        "success": True,
+        "comparison_id": comparison_id,
+        "weights": vendor_score_weights,
+        **result,
+    }
+    return response_data
+
+
+@app.post("/compare-vendor")
+async def compare_vendor_rfqs(
+    files: TypingList[UploadFile] = File(...),
+    map_reduce: Optional[bool] = Form(None),
+):
+    """Upload multiple vendor RFQ documents and compare them.
+
+    ``map_reduce`` (default ``GEMINI_VENDOR_MAP_REDUCE``) extracts each vendor in its own
+    concurrent call and builds the comparison locally; files that fail are listed in
+    ``failed_files``. Otherwise all RFQs go to Gemini in a single request.
+
+    Every response carries a deterministic ``ranking`` and a ``comparison_id`` that
+    ``/compare-vendor/rerank`` accepts.
+    """
+    try:
+        uploads = await _read_vendor_uploads(files)
+        return JSONResponse(await _run_vendor_comparison(uploads, map_reduce))
+
+    except HTTPException:
+        raise
+    except Exception as exc:
+        logger.error("[VENDOR-COMPARE] Unexpected error: %s", exc, exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error comparing vendor RFQs: {str(exc)}")
+
+
+@app.post("/compare-vendor/rerank")
+async def rerank_vendor_comparison(
+    comparison_id: Optional[str] = Form(None),
+    vendors: Optional[str] = Form(None),
+    price_weight: Optional[float] = Form(None),
+    delivery_weight: Optional[float] = Form(None),
+    warranty_weight: Optional[float] = Form(None),
+):
+    """Re-rank a ``/compare-vendor`` result with new priorities (no Gemini call).
+
+    Pass the ``comparison_id`` of a stored result, or the response's ``vendors`` array as a JSON
+    string; the latter needs no server state, so it works against any instance.
+
+    Without any weight the configured ``VENDOR_SCORE_WEIGHTS`` apply; once one weight is
+    given, omitted criteria weigh 0. Weights are normalized to sum to 1.
+    """
+    if vendors is not None:
+        try:
+            stored = {"vendors": json.loads(vendors)}
+        except ValueError:
+            raise HTTPException(status_code=400, detail="vendors must be a JSON array")
+        if not isinstance(stored["vendors"], list) or not all(isinstance(v, dict) for v in stored["vendors"]):
+            raise HTTPException(status_code=400, detail="vendors must be a JSON array of vendor objects")
+    elif comparison_id:
+        stored = await asyncio.to_thread(vendor_comparisons.get, comparison_id)
+        if stored is None:
+            raise HTTPException(status_code=404, detail="Comparison not found or expired")
+    else:
+        raise HTTPException(status_code=400, detail="Provide comparison_id or vendors")
+
+    overrides = {"price": price_weight, "delivery": delivery_weight, "warranty": warranty_weight}
+    if all(value is None for value in overrides.values()):
+        weights = vendor_score_weights
+    else:
+        try:
+            weights = normalize_score_weights({name: value or 0.0 for name, value in overrides.items()})
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=str(exc))
+
+    ranking, comparison = rank_vendors(stored["vendors"], weights)
+    return JSONResponse({
+        "success": True,
+        "comparison_id": comparison_id,
+        "weights": weights,
+        "vendors": stored["vendors"],
+        "comparison": comparison,
+        "ranking": ranking,
+    })
+
+
+# ----------------- Job Endpoints -----------------
+# Async variants of /analyze, /compare and /compare-vendor: submit, then poll or subscribe
+
+def _job_accepted(job: Job) -> JSONResponse:
+    return JSONResponse(
+        status_code=202,
+        content={
+            "success": True,
+            "job_id": job.id,
+            "status": job.status,
+            "status_url": f"/jobs/{job.id}",
+            "events_url": f"/jobs/{job.id}/events",
+        },
+    )
+
+
+@app.post("/jobs/analyze")
+async def submit_analysis_job(file: UploadFile = File(...)):
+    """Queue a weld analysis; the result is served by ``/jobs/{job_id}``."""
+    file_bytes, mime_type = await _read_drawing_upload(file)
+    job = await job_manager.submit("analyze", lambda: _run_analysis(file_bytes, mime_type))
+    return _job_accepted(job)
+
+
+@app.post("/jobs/compare")
+async def submit_comparison_job(
+    rfq: UploadFile = File(...),
+    cad: UploadFile = File(...),
+    part: str = Form("spark_plug"),
+    single_pass: Optional[bool] = Form(None),
+):
+    """Queue an RFQ vs CAD comparison (same form fields as ``/compare``)."""
+    rfq_bytes, rfq_mime, cad_bytes, cad_mime = await _read_compare_uploads(rfq, cad)
+    part_selection = (part or "spark_plug").strip() or "spark_plug"
+    job = await job_manager.submit(
+        "compare",
+        lambda: _run_comparison(rfq_bytes, rfq_mime, cad_bytes, cad_mime, part_selection, single_pass),
+    )
+    return _job_accepted(job)
+
+
+@app.post("/jobs/compare-vendor")
+async def submit_vendor_comparison_job(
+    files: TypingList[UploadFile] = File(...),
+    map_reduce: Optional[bool] = Form(None),
+):
+    """Queue a multi-vendor RFQ comparison (same form fields as ``/compare-vendor``)."""
+    uploads = await _read_vendor_uploads(files)
+    job = await job_manager.submit("compare-vendor", lambda: _run_vendor_comparison(uploads, map_reduce))
+    return _job_accepted(job)
+
+
+@app.get("/jobs")
+def job_stats():
+    """Worker pool and queue counters."""
+    return job_manager.stats()
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Poll a job; ``result`` is included once it has completed, ``error`` if it failed."""
+    snapshot = await job_manager.get(job_id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return JSONResponse(snapshot)
+
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    """Server-sent events: one ``status`` event per transition, ending with ``completed`` or ``failed``.
+
+    The final event carries the same payload as ``GET /jobs/{job_id}``. Closing the stream
+    does not cancel the job.
+    """
+    snapshot = await job_manager.get(job_id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+
+    async def event_stream():
+        current, last_status, idle = snapshot, None, 0.0
+        while True:
+            if current is None:
+                return
+            status = current["status"]
+            if status != last_status:
+                last_status, idle = status, 0.0
+                event = status if status in JOB_TERMINAL_STATUSES else "status"
+                yield f"event: {event}\ndata: {json.dumps(current, ensure_ascii=False)}\n\n"
+            if status in JOB_TERMINAL_STATUSES:
+                return
+            started = time.monotonic()
+            await job_manager.wait(job_id, last_status, timeout=15.0)
+            idle += time.monotonic() - started
+            current = await job_manager.get(job_id)
+            if idle >= 15.0 and current is not None and current["status"] == last_status:
+                # Comment line keeps proxies from closing an idle stream
+                idle = 0.0
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# ----------------- Supply Chain Text Layer -----------------
+# Born-digital PDFs/DOCX are read locally first; only scans go to the model as files
+SUPPLY_CHAIN_TEXT_FAST_PATH = os.getenv("SUPPLY_CHAIN_TEXT_FAST_PATH", "1").lower() not in ("0", "false", "no")
+# Less text than this means a scan (or an image-only PDF)
+SUPPLY_CHAIN_MIN_TEXT_CHARS = int(os.getenv("SUPPLY_CHAIN_MIN_TEXT_CHARS", "200"))
+# Text sent to the model is cut at this length
+SUPPLY_CHAIN_MAX_TEXT_CHARS = int(os.getenv("SUPPLY_CHAIN_MAX_TEXT_CHARS", "60000"))
+# Line totals must add up to the document total within this fraction to skip the model
+SUPPLY_CHAIN_TOTAL_TOLERANCE = 0.02
+
+_DOCUMENT_TYPE_KEYWORDS = (
+    ("GRN", ("goods receipt note", "goods received note", "goods receipt", "grn")),
+    ("Invoice", ("tax invoice", "commercial invoice", "invoice")),
+    ("BoL", ("bill of lading", "b/l")),
+    ("Packing List", ("packing list",)),
+    ("QC Cert", ("quality certificate", "certificate of conformity", "test certificate", "inspection certificate")),
+    ("PO", ("purchase order",)),
+)
+_ORDER_NUMBER_RE = re.compile(
+    r"\b(?:P\.?[ ]?O\.?|purchase[ ]+order|order)[ \t]*(?:no\.?|number|num|#)?[ \t]*[:#.\-]?[ \t]*"
+    r"((?=[A-Z\-/]*\d)[A-Z0-9][A-Z0-9\-/]{2,})",
+    re.IGNORECASE,
+)
+_SUPPLIER_RE = re.compile(r"^\s*(?:supplier|vendor|seller|sold\s+by|from)\s*(?:name)?\s*[:\-]\s*(.+)$", re.IGNORECASE | re.MULTILINE)
+_DATE_LABEL_RE = re.compile(r"\b(?:order\s+date|po\s+date|invoice\s+date|date)\b\s*[:\-]?\s*([^\n|]{6,30})", re.IGNORECASE)
+_TOTAL_RE = re.compile(
+    r"\b(grand\s+total|total\s+amount|invoice\s+total|amount\s+payable|net\s+payable|total)\b[^\n\d]{0,20}?([\d,]+(?:\.\d+)?)",
+    re.IGNORECASE,
+)
+_MONTHS = {m: i + 1 for i, m in enumerate(("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"))}
+_NUMBER_TOKEN_RE = re.compile(r"^[₹$€£]?\(?-?[\d,]+(?:\.\d+)?\)?$")
+
+
+def extract_pdf_text(data: bytes) -> str:
+    """Text layer of a PDF ("" for scans, unreadable files, or when pypdf is not installed)."""
+    try:
+        from pypdf import PdfReader  # type: ignore[reportMissingImports]
+    except ImportError:
+        return ""
+    try:
+        reader = PdfReader(io.BytesIO(data))
+        if reader.is_encrypted:
+            reader.decrypt("")
+        return "\n".join(page.extract_text() or "" for page in reader.pages).strip()
+    except Exception as exc:
+        logger.info("[SUPPLY-CHAIN] No PDF text layer (%s)", exc)
+        return ""
+
+
+def extract_document_text(data: bytes, mime_type: str) -> str:
+    """Local text of a supply-chain document; "" when it has none. CPU-bound; run it in a thread."""
+    if mime_type == "application/pdf":
+        return extract_pdf_text(data)
+    if mime_type == DOCX_MIME:
+        try:
+            return WeldingInspector._extract_docx_text(data)
+        except Exception as exc:
+            logger.info("[SUPPLY-CHAIN] Unable to read DOCX text (%s)", exc)
+    return ""
+
+
+def keyword_document_types(text: str) -> List[str]:
+    """Document types whose keywords appear near the top of ``text``, earliest first.
+
+    The title comes first in a document, so ``[0]`` is the best guess; anything after it is a
+    mention ("Invoice To:" on a PO) that makes the guess ambiguous.
+    """
+    head = text[:1500].lower()
+    positions = []
+    for doc_type, keywords in _DOCUMENT_TYPE_KEYWORDS:
+        found = [m.start() for k in keywords for m in [re.search(rf"\b{re.escape(k)}\b", head)] if m]
+        if found:
+            positions.append((min(found), doc_type))
+    return [doc_type for _, doc_type in sorted(positions)]
+
+
+def _parse_date(text: str) -> Optional[str]:
+    """First date in ``text`` as YYYY-MM-DD; numeric dates are read day-first."""
+    match = re.search(r"(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})", text)
+    if match:
+        year, month, day = (int(g) for g in match.groups())
+    else:
+        match = re.search(r"(\d{1,2})[-/.](\d{1,2})[-/.](\d{2,4})", text)
+        if match:
+            day, month, year = (int(g) for g in match.groups())
+            if month > 12 and day <= 12:
+                day, month = month, day
+        else:
+            match = re.search(r"(\d{1,2})\s*([A-Za-z]{3})[a-z]*\.?,?\s*(\d{4})", text)
+            if match and match.group(2).lower() in _MONTHS:
+                day, month, year = int(match.group(1)), _MONTHS[match.group(2).lower()], int(match.group(3))
+            else:
+                match = re.search(r"([A-Za-z]{3})[a-z]*\.?\s*(\d{1,2}),?\s*(\d{4})", text)
+                if not match or match.group(1).lower() not in _MONTHS:
+                    return None
+                month, day, year = _MONTHS[match.group(1).lower()], int(match.group(2)), int(match.group(3))
+    if year < 100:
+        year += 2000
+    try:
+        return datetime(year, month, day).date().isoformat()
+    except ValueError:
+        return None
+
 
-            json_start = normalized_text.find("{")
-            json_end = normalized_text.rfind("}") + 1
+def _detect_currency(text: str) -> Optional[str]:
+    for currency, pattern in (("INR", r"₹|\bINR\b|\bRs\.?\s"), ("USD", r"\$|\bUSD\b"), ("EUR", r"€|\bEUR\b"), ("GBP", r"£|\bGBP\b")):
+        if re.search(pattern, text):
+            return currency
+    return None
+
+
+def _table_line_items(text: str) -> List[Dict]:
+    """Rows ending in quantity, unit price and total where quantity x price = total.
+
+    Works on the " | "-joined table rows from DOCX and on whitespace-aligned PDF tables; the
+    arithmetic check keeps headers, addresses and tax lines out.
+    """
+    items: List[Dict] = []
+    for line in text.splitlines():
+        cells = [c.strip() for c in line.split("|")] if "|" in line else re.split(r"\s{2,}|\t", line.strip())
+        cells = [c for c in cells if c]
+        if len(cells) < 4:
+            # Single-spaced PDF rows: peel numeric tokens off the end
+            tokens = line.split()
+            tail = []
+            while tokens and _NUMBER_TOKEN_RE.match(tokens[-1]) and len(tail) < 3:
+                tail.insert(0, tokens.pop())
+            if len(tail) < 3 or not tokens:
+                continue
+            cells = [" ".join(tokens)] + tail
+        numbers = [vendor_number(c) if _NUMBER_TOKEN_RE.match(c.replace(" ", "")) else None for c in cells]
+        if len(numbers) < 4 or None in numbers[-3:]:
+            continue
+        quantity, unit_price, total = numbers[-3:]
+        if not quantity or not unit_price or abs(quantity * unit_price - total) > max(0.01, 0.005 * abs(total)):
+            continue
+        description = " ".join(c for c, n in zip(cells[:-3], numbers[:-3]) if n is None).strip()
+        if not description:
+            continue
+        items.append({"description": description, "quantity": quantity, "unit_price": unit_price, "total": total})
+    return items
+
+
+def parse_document_text(text: str) -> Tuple[Dict, bool]:
+    """Deterministic extraction from a document's text layer.
+
+    Returns ``(fields, complete)``. ``complete`` means every core field was found and the line
+    items add up to the stated total, so the result can be used without a model call.
+    """
+    matches = keyword_document_types(text)
+    document_type = matches[0] if matches else None
+
+    order_match = _ORDER_NUMBER_RE.search(text)
+    supplier_match = _SUPPLIER_RE.search(text)
+    date_match = _DATE_LABEL_RE.search(text)
+    totals = [(label.lower(), vendor_number(value)) for label, value in _TOTAL_RE.findall(text)]
+    # The grand total is usually labelled as such; otherwise the largest "total" wins
+    grand = [value for label, value in totals if value is not None and not label.startswith("total")]
+    plain = [value for label, value in totals if value is not None]
+    total_amount = grand[-1] if grand else (max(plain) if plain else None)
+    line_items = _table_line_items(text)
+
+    fields = {
+        "document_type": document_type,
+        "supplier": supplier_match.group(1).strip() if supplier_match else None,
+        "order_number": order_match.group(1).strip() if order_match else None,
+        "order_date": _parse_date(date_match.group(1)) if date_match else None,
+        "total_amount": total_amount,
+        "currency": _detect_currency(text),
+        "line_items": line_items,
+        "delivery_address": None,
+        "payment_terms": None,
+        "confidence": "high",
+    }
+    line_sum = sum(item["total"] for item in line_items)
+    complete = bool(
+        document_type
+        # Several type keywords (a PO with an "Invoice To:" block) leave the type to the model
+        and len(matches) == 1
+        and fields["supplier"]
+        and fields["order_number"]
+        and total_amount
+        and line_items
+        # A total that includes tax or freight will not add up; the model handles those
+        and abs(line_sum - total_amount) <= SUPPLY_CHAIN_TOTAL_TOLERANCE * total_amount
+    )
+    return fields, complete
+
+
+# ----------------- Supply Chain Document Classifier -----------------
+# Documents classified at least this confidently get their type's short prompt instead of the generic one
+SUPPLY_CHAIN_CLASSIFIER_THRESHOLD = float(os.getenv("SUPPLY_CHAIN_CLASSIFIER_THRESHOLD", "0.85"))
+# Labelled documents needed before the learned model replaces the title keywords
+SUPPLY_CHAIN_CLASSIFIER_MIN_SAMPLES = int(os.getenv("SUPPLY_CHAIN_CLASSIFIER_MIN_SAMPLES", "20"))
+# How often the model is retrained from the store, and on how many of the newest documents
+SUPPLY_CHAIN_CLASSIFIER_RETRAIN_SECONDS = float(os.getenv("SUPPLY_CHAIN_CLASSIFIER_RETRAIN_SECONDS", "900"))
+SUPPLY_CHAIN_CLASSIFIER_MAX_SAMPLES = int(os.getenv("SUPPLY_CHAIN_CLASSIFIER_MAX_SAMPLES", "5000"))
+# Leading text kept on each document for training
+SUPPLY_CHAIN_CLASSIFIER_TEXT_CHARS = 2000
+
+SUPPLY_CHAIN_DOCUMENT_TYPES = ("PO", "BoL", "GRN", "Invoice", "Packing List", "QC Cert")
+_CLASSIFIER_DIMENSIONS = 4096
+
+_CONFIDENCE_FIELD = ("confidence", "high|medium|low based on document clarity")
+_PRICED_LINE = {"description": "item description", "quantity": "number", "unit_price": "number", "total": "number"}
+_QUANTITY_LINE = {"description": "item description", "quantity": "number"}
+# Type-specific schemas: only the fields that type carries, in the generic prompt's key names
+_SUPPLY_CHAIN_TYPE_SCHEMAS = {
+    "PO": ("purchase order", (
+        ("supplier", "supplier name"),
+        ("order_number", "PO number"),
+        ("order_date", "PO date in YYYY-MM-DD format"),
+        ("total_amount", "number"),
+        ("currency", "currency code (INR, USD, etc.)"),
+        ("line_items", [_PRICED_LINE]),
+        ("delivery_address", "delivery address"),
+        ("payment_terms", "payment terms"),
+        _CONFIDENCE_FIELD,
+    )),
+    "Invoice": ("invoice", (
+        ("supplier", "supplier (seller) name"),
+        ("invoice_number", "invoice number"),
+        ("order_number", "PO number the invoice refers to"),
+        ("order_date", "invoice date in YYYY-MM-DD format"),
+        ("total_amount", "number"),
+        ("currency", "currency code (INR, USD, etc.)"),
+        ("line_items", [_PRICED_LINE]),
+        ("payment_terms", "payment terms"),
+        _CONFIDENCE_FIELD,
+    )),
+    "GRN": ("goods receipt note", (
+        ("supplier", "supplier name"),
+        ("order_number", "PO number the receipt refers to"),
+        ("order_date", "receipt date in YYYY-MM-DD format"),
+        ("line_items", [_QUANTITY_LINE]),
+        ("delivery_address", "receiving location"),
+        _CONFIDENCE_FIELD,
+    )),
+    "BoL": ("bill of lading", (
+        ("supplier", "shipper name"),
+        ("order_number", "PO or booking number"),
+        ("order_date", "shipment date in YYYY-MM-DD format"),
+        ("line_items", [_QUANTITY_LINE]),
+        ("delivery_address", "consignee address"),
+        _CONFIDENCE_FIELD,
+    )),
+    "Packing List": ("packing list", (
+        ("supplier", "supplier name"),
+        ("order_number", "PO number"),
+        ("order_date", "date in YYYY-MM-DD format"),
+        ("line_items", [_QUANTITY_LINE]),
+        ("delivery_address", "ship-to address"),
+        _CONFIDENCE_FIELD,
+    )),
+    "QC Cert": ("quality certificate", (
+        ("supplier", "manufacturer or supplier name"),
+        ("order_number", "PO number"),
+        ("order_date", "certificate date in YYYY-MM-DD format"),
+        ("line_items", [_QUANTITY_LINE]),
+        _CONFIDENCE_FIELD,
+    )),
+}
+SUPPLY_CHAIN_TYPE_PROMPTS = {
+    doc_type: (
+        f"Extract the following fields from the attached {label} in JSON format:\n"
+        f"{json.dumps(dict(schema), indent=2)}\n\n"
+        "Use null for fields that are not present. Output ONLY valid JSON, no markdown, no explanations."
+    )
+    for doc_type, (label, schema) in _SUPPLY_CHAIN_TYPE_SCHEMAS.items()
+}
+
+
+def canonical_document_type(value) -> Optional[str]:
+    """One of SUPPLY_CHAIN_DOCUMENT_TYPES for an extracted ``document_type``, or None."""
+    doc_type = normalize_document_type(value)
+    if doc_type in SUPPLY_CHAIN_DOCUMENT_TYPES:
+        return doc_type
+    lowered = str(doc_type or "").lower()
+    if "lading" in lowered or lowered in ("bol", "b/l"):
+        return "BoL"
+    if "packing" in lowered:
+        return "Packing List"
+    if "cert" in lowered or lowered in ("qc", "coc"):
+        return "QC Cert"
+    return None
+
+
+def _classifier_features(text: str) -> np.ndarray:
+    """Hashed counts of words, title words and a few layout markers in a document's text."""
+    text = text[:SUPPLY_CHAIN_CLASSIFIER_TEXT_CHARS]
+    features = re.findall(r"[a-z][a-z0-9]+", text.lower())
+    # Words near the top carry the title; count them again under their own keys
+    features += ["^" + word for word in re.findall(r"[a-z][a-z0-9]+", text[:300].lower())]
+    for line in text.splitlines():
+        if "|" in line or len(re.findall(r"\d[\d,]*(?:\.\d+)?", line)) >= 3:
+            features.append("~table_row")
+    features += ["~amount"] * len(re.findall(r"[₹$€£]|\b(?:INR|USD|EUR|GBP|Rs\.?)\s*\d", text))
+    features += ["~weight"] * len(re.findall(r"\b\d[\d,.]*\s*(?:kg|kgs|mt|lbs)\b", text, re.IGNORECASE))
+    vector = np.zeros(_CLASSIFIER_DIMENSIONS, dtype=np.float64)
+    for feature in features:
+        digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=4).digest()
+        vector[int.from_bytes(digest, "big") % _CLASSIFIER_DIMENSIONS] += 1.0
+    return vector
+
+
+class DocumentTypeClassifier:
+    """Multinomial naive Bayes over the text layer, trained from stored ``document_type`` labels.
+
+    Until SUPPLY_CHAIN_CLASSIFIER_MIN_SAMPLES labelled documents exist it answers from the
+    title keywords the text-layer rules use.
+    """
+
+    def __init__(self):
+        self.trained_at = 0.0
+        # (labels, log prior, log likelihood, sample count), replaced whole by train() so a
+        # prediction on another thread never mixes two models
+        self._model: Optional[Tuple[Tuple[str, ...], np.ndarray, np.ndarray, int]] = None
+        self.training_lock = threading.Lock()
+
+    @property
+    def trained(self) -> bool:
+        return self._model is not None
+
+    @property
+    def labels(self) -> Tuple[str, ...]:
+        model = self._model
+        return model[0] if model else ()
+
+    @property
+    def samples(self) -> int:
+        model = self._model
+        return model[3] if model else 0
+
+    def due(self) -> bool:
+        return time.time() - self.trained_at >= SUPPLY_CHAIN_CLASSIFIER_RETRAIN_SECONDS
+
+    def train(self, samples: List[Tuple[str, str]]) -> bool:
+        """Fit on ``(text, document_type)`` pairs; returns False (keeping the old model) if too few."""
+        self.trained_at = time.time()
+        labels = tuple(sorted({label for _, label in samples}))
+        if len(samples) < SUPPLY_CHAIN_CLASSIFIER_MIN_SAMPLES or len(labels) < 2:
+            return False
+        features = np.stack([_classifier_features(text) for text, _ in samples])
+        targets = np.array([labels.index(label) for _, label in samples])
+        counts = np.stack([features[targets == k].sum(axis=0) for k in range(len(labels))]) + 1.0
+        log_likelihood = np.log(counts / counts.sum(axis=1, keepdims=True))
+        log_prior = np.log(np.bincount(targets, minlength=len(labels)) / len(samples))
+        self._model = (labels, log_prior, log_likelihood, len(samples))
+        return True
+
+    def predict(self, text: str) -> Tuple[Optional[str], float]:
+        """Most likely document type and its probability."""
+        model = self._model
+        if model is None:
+            matches = keyword_document_types(text)
+            if not matches:
+                return None, 0.0
+            # One title keyword is a clear signal; several (an invoice citing its PO) are not
+            return matches[0], 0.9 if len(matches) == 1 else 0.5
+        labels, log_prior, log_likelihood, _ = model
+        scores = log_prior + log_likelihood @ _classifier_features(text)
+        probabilities = np.exp(scores - scores.max())
+        probabilities /= probabilities.sum()
+        best = int(np.argmax(probabilities))
+        return labels[best], float(probabilities[best])
+
+    def stats(self) -> Dict:
+        model = self._model
+        return {
+            "trained": model is not None,
+            "samples": model[3] if model else 0,
+            "labels": list(model[0]) if model else [],
+            "trained_at": datetime.fromtimestamp(self.trained_at).isoformat() if self.trained_at else None,
+            "threshold": SUPPLY_CHAIN_CLASSIFIER_THRESHOLD,
+        }
 
-            if json_start == -1 or json_end <= json_start:
-                logger.error("[VENDOR-COMPARISON PARSER] JSON object not found")
-                return None
 
-            json_str = normalized_text[json_start:json_end]
+# ----------------- ERP Sink -----------------
+# Approved and completed documents are batched into the ERP instead of written one at a time
+ERP_SINK = os.getenv("ERP_SINK", "sqlite").strip().lower()
+ERP_SINK_PATH = Path(os.getenv("ERP_SINK_PATH", str(Path(__file__).resolve().parent / "output" / "erp_updates.db")))
+ERP_DEAD_LETTER_PATH = Path(
+    os.getenv("ERP_DEAD_LETTER_PATH", str(Path(__file__).resolve().parent / "output" / "erp_dead_letter.jsonl"))
+)
+# A batch is flushed once it has this many updates or its oldest update is this old
+ERP_BATCH_SIZE = int(os.getenv("ERP_BATCH_SIZE", "50"))
+ERP_FLUSH_SECONDS = float(os.getenv("ERP_FLUSH_SECONDS", "5"))
+# Attempts per batch before its updates go to the dead-letter file
+ERP_MAX_ATTEMPTS = int(os.getenv("ERP_MAX_ATTEMPTS", "5"))
+ERP_RETRY_BASE_SECONDS = float(os.getenv("ERP_RETRY_BASE_SECONDS", "1"))
 
-            data = json.loads(json_str)
-            
-            logger.info("[VENDOR-COMPARISON PARSER] Parsed JSON keys: %s", list(data.keys()))
-            
-            # Validate structure
-            vendors = data.get("vendors", [])
-            comparison = data.get("comparison", {})
-            
-            if not isinstance(vendors, list):
-                logger.error("[VENDOR-COMPARISON PARSER] 'vendors' is not a list")
-                return None
-            
-            result = {
-                "vendors": vendors,
-                "comparison": comparison,
-            }
 
-            logger.info(
-                "[VENDOR-COMPARISON PARSER] Extracted: vendors=%d",
-                len(vendors),
+def erp_idempotency_key(document: Dict, kind: str) -> str:
+    """Stable key for one ERP update: the document, its order number and what happened to it."""
+    order_number = normalize_order_number((document.get("extracted_data") or {}).get("order_number")) or "-"
+    return f"{document['id']}:{order_number}:{kind}"
+
+
+def erp_payload(document: Dict, kind: str) -> Dict:
+    """The ERP update for a document: its extraction, match result and review outcome."""
+    extracted = document.get("extracted_data") or {}
+    return {
+        "idempotency_key": erp_idempotency_key(document, kind),
+        "kind": kind,
+        "document_id": document["id"],
+        "document_type": extracted.get("document_type"),
+        "supplier": extracted.get("supplier"),
+        "order_number": extracted.get("order_number"),
+        "order_date": extracted.get("order_date"),
+        "total_amount": extracted.get("total_amount"),
+        "currency": extracted.get("currency"),
+        "line_items": extracted.get("line_items") or [],
+        "match_status": (document.get("match") or {}).get("status"),
+        "status": document.get("status"),
+        "queued_at": datetime.now().isoformat(),
+    }
+
+
+class ErpSink(ABC):
+    """Destination for batched ERP updates.
+
+    ``write_batch`` receives up to ERP_BATCH_SIZE payloads and must be idempotent on
+    ``idempotency_key``: a batch that failed part-way is retried whole. It is called from a
+    worker thread; raise to have the batch retried.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    def write_batch(self, updates: List[Dict]) -> None:
+        ...
+
+
+class SqliteErpSink(ErpSink):
+    """Local stand-in for the ERP: one row per idempotency key, repeats ignored."""
+
+    name = "sqlite"
+
+    def __init__(self, path: Path, busy_timeout_ms: int = 5000):
+        import sqlite3
+
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._sqlite3 = sqlite3
+        self.busy_timeout_ms = busy_timeout_ms
+        with self._transaction() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS erp_updates (
+                    idempotency_key TEXT PRIMARY KEY,
+                    document_id TEXT NOT NULL,
+                    order_number TEXT,
+                    kind TEXT NOT NULL,
+                    written_at TEXT NOT NULL,
+                    payload TEXT NOT NULL
+                )
+                """
             )
 
-            logger.info("[VENDOR-COMPARISON PARSER] Parsed vendor comparison response successfully")
-            return result
+    @contextmanager
+    def _transaction(self):
+        # Batches are infrequent; a short-lived connection per write keeps the sink thread-agnostic
+        conn = self._sqlite3.connect(str(self.path), timeout=self.busy_timeout_ms / 1000)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def write_batch(self, updates: List[Dict]) -> None:
+        written_at = datetime.now().isoformat()
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO erp_updates (idempotency_key, document_id, order_number, kind, written_at, payload) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        update["idempotency_key"],
+                        update["document_id"],
+                        update.get("order_number"),
+                        update["kind"],
+                        written_at,
+                        json.dumps(update, ensure_ascii=False, default=str),
+                    )
+                    for update in updates
+                ],
+            )
 
-        except json.JSONDecodeError as exc:
-            logger.error("[VENDOR-COMPARISON PARSER] JSON decode error", exc_info=True)
-            logger.error(f"[VENDOR-COMPARISON PARSER] Response text (first 1000 chars): {original_response[:1000]}")
-            return None
-        except Exception:
-            logger.error("[VENDOR-COMPARISON PARSER] Unexpected error", exc_info=True)
-            logger.error(f"[VENDOR-COMPARISON PARSER] Response text (first 1000 chars): {original_response[:1000]}")
-            return None
 
-    def parse_comparison_response(self, response_text: str):
-        """Parse comparison JSON response from Gemini."""
-        original_response = response_text
+class JsonlErpSink(ErpSink):
+    """Local stand-in for the ERP: appends one JSON line per update, skipping keys already written."""
+
+    name = "jsonl"
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._written = set()
+        if self.path.exists():
+            with self.path.open("r", encoding="utf-8") as handle:
+                for line in handle:
+                    try:
+                        self._written.add(json.loads(line)["idempotency_key"])
+                    except (ValueError, KeyError, TypeError):
+                        continue
+
+    def write_batch(self, updates: List[Dict]) -> None:
+        with self._lock:
+            fresh = [update for update in updates if update["idempotency_key"] not in self._written]
+            if not fresh:
+                return
+            with self.path.open("a", encoding="utf-8") as handle:
+                handle.writelines(json.dumps(update, ensure_ascii=False, default=str) + "\n" for update in fresh)
+            self._written.update(update["idempotency_key"] for update in fresh)
+
+
+def create_erp_sink() -> ErpSink:
+    """ERP_SINK=sqlite (default, at ERP_SINK_PATH) or jsonl; an unusable SQLite file falls back to JSONL."""
+    if ERP_SINK != "jsonl":
         try:
-            response_text = self._strip_markdown_fence(response_text)
-            normalized_text = self._quote_unquoted_keys(response_text)
+            return SqliteErpSink(ERP_SINK_PATH)
+        except Exception as exc:
+            logger.warning("[ERP] Cannot open %s (%s); falling back to JSONL sink", ERP_SINK_PATH, exc)
+    return JsonlErpSink(ERP_SINK_PATH.with_suffix(".jsonl"))
 
-            json_start = normalized_text.find("{")
-            json_end = normalized_text.rfind("}") + 1
 
-            if json_start == -1 or json_end <= json_start:
-                logger.error("[COMPARISON PARSER] JSON object not found")
-                return None
+class ErpUpdateBatcher:
+    """Collects ERP updates and writes them to a sink in batches.
 
-            json_str = normalized_text[json_start:json_end]
+    A batch goes out when ``batch_size`` updates are pending or the oldest has waited
+    ``flush_seconds``. Failed writes are retried with full-jitter exponential backoff; after
+    ``max_attempts`` the batch is appended to the dead-letter file. Each document's
+    ``erp_status`` follows along: queued, synced or dead_letter.
+    """
 
-            data = json.loads(json_str)
-            
-            logger.info("[COMPARISON PARSER] Parsed JSON keys: %s", list(data.keys()))
-            
-            # Handle old format with "metrics" array (convert to new format)
-            if "metrics" in data and "rfq_requirements" not in data:
-                logger.warning("[COMPARISON PARSER] Detected old format with 'metrics' array, converting to new format")
-                metrics = data.get("metrics", [])
-                rfq_requirements = []
-                cad_findings = []
-                mismatches_list = []
-                
-                for metric in metrics:
-                    if isinstance(metric, dict):
-                        metric_name = metric.get("metric", "")
-                        rfq_val = metric.get("rfq", "")
-                        cad_val = metric.get("cad", "")
-                        status = metric.get("status", "")
-                        
-                        if metric_name:
-                            rfq_requirements.append(f"{metric_name}: {rfq_val}" if rfq_val else f"{metric_name}: —")
-                            cad_findings.append(f"{metric_name}: {cad_val}" if cad_val else f"{metric_name}: —")
-                            
-                            if status in ["Mismatch", "Missing in CAD"]:
-                                mismatches_list.append(f"{metric_name}: RFQ {rfq_val} vs CAD {cad_val} - {status}")
-                
-                # Also check mismatches array if present
-                if "mismatches" in data:
-                    for mismatch in data.get("mismatches", []):
-                        if isinstance(mismatch, dict):
-                            metric_name = mismatch.get("metric", "")
-                            rfq_val = mismatch.get("rfq", "")
-                            cad_val = mismatch.get("cad", "")
-                            status = mismatch.get("status", "")
-                            if metric_name:
-                                mismatches_list.append(f"{metric_name}: RFQ {rfq_val} vs CAD {cad_val} - {status}")
-                        elif isinstance(mismatch, str):
-                            mismatches_list.append(mismatch)
-                
-                result = {
-                    "match": bool(data.get("match", False)),
-                    "confidence": str(data.get("confidence", "")),
-                    "summary": str(data.get("summary", "")),
-                    "rfq_requirements": rfq_requirements,
-                    "cad_findings": cad_findings,
-                    "mismatches": mismatches_list,
-                    "recommendations": str(data.get("recommendations", "")),
-                }
-            else:
-                # Standard format
-                result = {
-                    "match": bool(data.get("match", False)),
-                    "confidence": str(data.get("confidence", "")),
-                    "summary": str(data.get("summary", "")),
-                    "rfq_requirements": [str(item) for item in data.get("rfq_requirements", [])],
-                    "cad_findings": [str(item) for item in data.get("cad_findings", [])],
-                    "mismatches": [str(item) for item in data.get("mismatches", [])],
-                    "recommendations": str(data.get("recommendations", "")),
-                }
-            
-            logger.info(
-                "[COMPARISON PARSER] Extracted: rfq_count=%d, cad_count=%d, mismatch_count=%d",
-                len(result["rfq_requirements"]),
-                len(result["cad_findings"]),
-                len(result["mismatches"]),
+    def __init__(
+        self,
+        sink: ErpSink,
+        batch_size: int = ERP_BATCH_SIZE,
+        flush_seconds: float = ERP_FLUSH_SECONDS,
+        max_attempts: int = ERP_MAX_ATTEMPTS,
+        dead_letter_path: Path = ERP_DEAD_LETTER_PATH,
+    ):
+        self.sink = sink
+        self.batch_size = max(1, batch_size)
+        self.flush_seconds = flush_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.dead_letter_path = Path(dead_letter_path)
+        # Keyed by idempotency key, so an update queued twice is sent once
+        self._pending: "OrderedDict[str, Dict]" = OrderedDict()
+        self._oldest = 0.0
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._random = random.Random()
+        self.batches = 0
+        self.written = 0
+        self.retries = 0
+        self.dead_lettered = 0
+
+    def start(self) -> None:
+        """Start the flush loop on the running loop (idempotent)."""
+        if self._task is not None and not self._task.done():
+            return
+        self._wake = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        logger.info(
+            "[ERP] Batcher started (%s sink; %d per batch or every %.1fs)",
+            self.sink.name, self.batch_size, self.flush_seconds,
+        )
+
+    async def shutdown(self) -> None:
+        """Stop the flush loop and write whatever is still pending."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        while self._pending:
+            await self._flush()
+        logger.info("[ERP] Batcher stopped")
+
+    def enqueue(self, document: Dict, kind: str) -> str:
+        """Queue an ERP update for ``document`` and return its idempotency key."""
+        payload = erp_payload(document, kind)
+        first = not self._pending
+        if first:
+            self._oldest = time.monotonic()
+        self._pending[payload["idempotency_key"]] = payload
+        # The first update starts the flush window; a full batch goes out right away
+        if self._wake is not None and (first or len(self._pending) >= self.batch_size):
+            self._wake.set()
+        return payload["idempotency_key"]
+
+    async def _run(self) -> None:
+        while True:
+            if self._pending and (
+                len(self._pending) >= self.batch_size or time.monotonic() - self._oldest >= self.flush_seconds
+            ):
+                try:
+                    await self._flush()
+                except Exception as exc:
+                    logger.error("[ERP] Flush failed: %s", exc, exc_info=True)
+                continue
+            # Sleep until the window closes, or until enqueue() starts a window or fills a batch
+            timeout = max(0.0, self._oldest + self.flush_seconds - time.monotonic()) if self._pending else None
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _flush(self) -> None:
+        keys = list(self._pending)[: self.batch_size]
+        batch = [self._pending.pop(key) for key in keys]
+        self._oldest = time.monotonic()
+        error = None
+        try:
+            for attempt in range(self.max_attempts):
+                try:
+                    await asyncio.to_thread(self.sink.write_batch, batch)
+                    error = None
+                    break
+                except Exception as exc:
+                    error = exc
+                    if attempt + 1 < self.max_attempts:
+                        self.retries += 1
+                        delay = self._random.uniform(0, ERP_RETRY_BASE_SECONDS * (2 ** attempt))
+                        logger.warning("[ERP] Batch of %d failed (%s); retrying in %.1fs", len(batch), exc, delay)
+                        await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            # Shutdown interrupted a retry: put the batch back so the final drain writes it
+            for update in reversed(batch):
+                self._pending[update["idempotency_key"]] = update
+                self._pending.move_to_end(update["idempotency_key"], last=False)
+            raise
+        self.batches += 1
+        if error is None:
+            self.written += len(batch)
+            fields = {"erp_status": "synced", "erp_synced_at": datetime.now().isoformat()}
+        else:
+            self.dead_lettered += len(batch)
+            await asyncio.to_thread(self._dead_letter, batch, error)
+            logger.error("[ERP] Batch of %d dead-lettered after %d attempts: %s", len(batch), self.max_attempts, error)
+            fields = {"erp_status": "dead_letter", "erp_error": str(error)}
+        for update in batch:
+            await update_document(update["document_id"], {**fields, "erp_key": update["idempotency_key"]}, event="erp")
+
+    def _dead_letter(self, batch: List[Dict], error: Exception) -> None:
+        self.dead_letter_path.parent.mkdir(parents=True, exist_ok=True)
+        failed_at = datetime.now().isoformat()
+        with self.dead_letter_path.open("a", encoding="utf-8") as handle:
+            for update in batch:
+                record = {"failed_at": failed_at, "error": str(error), "update": update}
+                handle.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+    def stats(self) -> Dict:
+        return {
+            "sink": self.sink.name,
+            "pending": len(self._pending),
+            "batch_size": self.batch_size,
+            "flush_seconds": self.flush_seconds,
+            "batches": self.batches,
+            "written": self.written,
+            "retries": self.retries,
+            "dead_lettered": self.dead_lettered,
+        }
+
+
+async def requeue_erp_updates() -> int:
+    """Queue again the updates a previous process accepted but never wrote (``erp_status`` queued)."""
+    documents = await asyncio.to_thread(
+        document_store.find_by_erp_status, "queued", ["status", "extracted_data", "match"]
+    )
+    for document in documents:
+        erp_batcher.enqueue(document, "approved" if document.get("status") == "approved" else "completed")
+    if documents:
+        logger.info("[ERP] Re-queued %d update(s) left over from a previous run", len(documents))
+    return len(documents)
+
+
+erp_batcher = ErpUpdateBatcher(create_erp_sink())
+
+
+# ----------------- Supply Chain Document Automation -----------------
+# Documents move through one bounded queue per stage; each stage has its own worker pool
+SUPPLY_CHAIN_STAGES = ("intake", "parsing", "review", "matching", "erp")
+SUPPLY_CHAIN_STAGE_WORKERS = {
+    "intake": int(os.getenv("SUPPLY_CHAIN_INTAKE_WORKERS", "2")),
+    # Parsing is the Gemini call; the shared rate limiter still paces it across the process
+    "parsing": int(os.getenv("SUPPLY_CHAIN_PARSING_WORKERS", "4")),
+    "review": int(os.getenv("SUPPLY_CHAIN_REVIEW_WORKERS", "2")),
+    "matching": int(os.getenv("SUPPLY_CHAIN_MATCHING_WORKERS", "2")),
+    "erp": int(os.getenv("SUPPLY_CHAIN_ERP_WORKERS", "2")),
+}
+# Per-stage queue bound; a full stage blocks the one before it, a full intake queue answers 503
+SUPPLY_CHAIN_QUEUE_SIZE = int(os.getenv("SUPPLY_CHAIN_QUEUE_SIZE", "200"))
+# On shutdown, queued documents get this long to work through the remaining stages
+SUPPLY_CHAIN_DRAIN_SECONDS = float(os.getenv("SUPPLY_CHAIN_DRAIN_SECONDS", "60"))
+
+SUPPLY_CHAIN_EXTRACTION_PROMPT = (
+    "You are an expert document analyst specializing in supply chain documents. "
+    "Analyze the attached document and extract all relevant information.\n\n"
+    "The document could be a Purchase Order (PO), Bill of Lading (BoL), "
+    "Goods Receipt Note (GRN), Invoice, Packing List, or Quality Certificate.\n\n"
+    "Extract the following information in JSON format:\n"
+    "{\n"
+    '  "document_type": "PO|BoL|GRN|Invoice|Packing List|QC Cert",\n'
+    '  "supplier": "supplier name",\n'
+    '  "order_number": "PO/order number if available",\n'
+    '  "order_date": "date in YYYY-MM-DD format",\n'
+    '  "total_amount": "amount as number",\n'
+    '  "currency": "currency code (INR, USD, etc.)",\n'
+    '  "line_items": [\n'
+    '    {\n'
+    '      "description": "item description",\n'
+    '      "quantity": number,\n'
+    '      "unit_price": number,\n'
+    '      "total": number\n'
+    '    }\n'
+    '  ],\n'
+    '  "delivery_address": "address if available",\n'
+    '  "payment_terms": "payment terms if available",\n'
+    '  "confidence": "high|medium|low based on document clarity"\n'
+    "}\n\n"
+    "Output ONLY valid JSON, no markdown, no explanations."
+)
+
+
+class SupplyChainDocument:
+    """A document in flight through the pipeline; the bytes are dropped once parsed."""
+
+    def __init__(self, doc_id: str, file_bytes: bytes, mime_type: str, sha256: Optional[str] = None):
+        self.id = doc_id
+        self.file_bytes: Optional[bytes] = file_bytes
+        self.mime_type = mime_type
+        self.sha256 = sha256
+        self.extracted_data: Optional[Dict] = None
+        self.enqueued_at = time.time()
+
+
+class SupplyChainPipeline:
+    """Queue-backed five-stage pipeline with a fixed worker pool per stage.
+
+    Each stage hands the document to the next stage's queue when it is done. Queues are
+    bounded, so a slow stage (usually parsing) applies backpressure upstream instead of
+    letting uploads fan out into unbounded concurrent Gemini calls.
+    """
+
+    def __init__(
+        self,
+        handlers: Dict[str, Callable[[SupplyChainDocument], Awaitable[None]]],
+        workers: Dict[str, int] = SUPPLY_CHAIN_STAGE_WORKERS,
+        queue_size: int = SUPPLY_CHAIN_QUEUE_SIZE,
+        drain_seconds: float = SUPPLY_CHAIN_DRAIN_SECONDS,
+    ):
+        self.stages = [stage for stage in SUPPLY_CHAIN_STAGES if stage in handlers]
+        self.handlers = handlers
+        self.workers = {stage: max(1, workers.get(stage, 1)) for stage in self.stages}
+        self.queue_size = max(1, queue_size)
+        self.drain_seconds = drain_seconds
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._busy = {stage: 0 for stage in self.stages}
+        self._processed = {stage: 0 for stage in self.stages}
+        self._failed = {stage: 0 for stage in self.stages}
+        self._wait_seconds = {stage: 0.0 for stage in self.stages}
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def start(self) -> None:
+        """Start every stage's workers on the running loop (idempotent)."""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._tasks:
+            return
+        self._loop = loop
+        self._queues = {stage: asyncio.Queue(maxsize=self.queue_size) for stage in self.stages}
+        self._tasks = [
+            loop.create_task(self._worker(stage))
+            for stage in self.stages
+            for _ in range(self.workers[stage])
+        ]
+        logger.info(
+            "[SUPPLY-CHAIN] Pipeline started (%s; queue size %d)",
+            ", ".join(f"{stage}={count}" for stage, count in self.workers.items()),
+            self.queue_size,
+        )
+
+    async def shutdown(self) -> None:
+        """Drain the stages in order (up to ``drain_seconds`` in total), then stop the workers."""
+        if not self._tasks:
+            return
+        deadline = time.monotonic() + self.drain_seconds
+        try:
+            # Joining upstream first means its documents have been handed to the next queue
+            for stage in self.stages:
+                await asyncio.wait_for(self._queues[stage].join(), timeout=max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            logger.warning(
+                "[SUPPLY-CHAIN] Documents still queued after %.0fs drain: %s",
+                self.drain_seconds,
+                {stage: queue.qsize() for stage, queue in self._queues.items()},
+            )
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info("[SUPPLY-CHAIN] Pipeline stopped")
+
+    def free_slots(self) -> int:
+        """How many more documents the intake queue accepts right now."""
+        self.start()
+        return self.queue_size - self._queues[self.stages[0]].qsize()
+
+    def reserve(self, count: int) -> None:
+        """Reject a batch of ``count`` documents with 503 unless intake has room for all of them."""
+        if self.free_slots() < count:
+            self.rejected += count
+            raise HTTPException(
+                status_code=503,
+                detail="Supply chain pipeline is busy, retry later",
+                headers={"Retry-After": "30"},
             )
-            
-            if len(result["rfq_requirements"]) == 0 and len(result["cad_findings"]) == 0:
-                logger.warning(
-                    "[COMPARISON PARSER] WARNING: Both rfq_requirements and cad_findings are empty! "
-                    "This may indicate the response format doesn't match expectations."
-                )
 
-            logger.info("[COMPARISON PARSER] Parsed comparison response successfully")
-            return result
+    def submit(self, document: SupplyChainDocument) -> None:
+        """Queue ``document`` for intake; 503 when the intake queue is full."""
+        self.reserve(1)
+        self._queues[self.stages[0]].put_nowait(document)
+        self.submitted += 1
+
+    async def _worker(self, stage: str) -> None:
+        queue = self._queues[stage]
+        index = self.stages.index(stage)
+        next_queue = self._queues[self.stages[index + 1]] if index + 1 < len(self.stages) else None
+        while True:
+            document = await queue.get()
+            try:
+                self._wait_seconds[stage] += time.time() - document.enqueued_at
+                self._busy[stage] += 1
+                try:
+                    await self.handlers[stage](document)
+                finally:
+                    self._busy[stage] -= 1
+                self._processed[stage] += 1
+                if next_queue is None:
+                    self.completed += 1
+                else:
+                    document.enqueued_at = time.time()
+                    # Blocks while the next stage is full, which is the backpressure we want
+                    await next_queue.put(document)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                self._failed[stage] += 1
+                logger.error("[SUPPLY-CHAIN] %s stage failed for %s: %s", stage, document.id, exc, exc_info=True)
+                try:
+                    await update_status(document.id, "error", 0, 0, error=str(exc))
+                except Exception as status_exc:
+                    # A failed status write must not take the worker down with it
+                    logger.error("[SUPPLY-CHAIN] Cannot record error for %s: %s", document.id, status_exc)
+            finally:
+                queue.task_done()
+
+    def stats(self) -> Dict:
+        return {
+            "running": bool(self._tasks),
+            "queue_size": self.queue_size,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "stages": {
+                stage: {
+                    "workers": self.workers[stage],
+                    "queue_depth": self._queues[stage].qsize() if stage in self._queues else 0,
+                    "busy": self._busy[stage],
+                    "processed": self._processed[stage],
+                    "failed": self._failed[stage],
+                    "avg_wait_seconds": round(
+                        self._wait_seconds[stage] / max(1, self._processed[stage] + self._failed[stage]), 3
+                    ),
+                }
+                for stage in self.stages
+            },
+        }
 
-        except json.JSONDecodeError as exc:
-            logger.error("[COMPARISON PARSER] JSON decode error", exc_info=True)
-            logger.error(f"[COMPARISON PARSER] Response text (first 1000 chars): {original_response[:1000]}")
-            fallback_result = self._parse_comparison_fallback(response_text)
-            if fallback_result:
-                return fallback_result
-            return None
-        except Exception:
-            logger.error("[COMPARISON PARSER] Unexpected error", exc_info=True)
-            logger.error(f"[COMPARISON PARSER] Response text (first 1000 chars): {original_response[:1000]}")
-            fallback_result = self._parse_comparison_fallback(response_text)
-            if fallback_result:
-                return fallback_result
-            return None
 
+# ----------------- Supply Chain Document Store -----------------
+# SQLite (WAL) file shared by every uvicorn worker on the node; "memory" keeps a per-process dict
+SUPPLY_CHAIN_STORE = os.getenv("SUPPLY_CHAIN_STORE", "sqlite").strip().lower()
+SUPPLY_CHAIN_DB_PATH = Path(os.getenv("SUPPLY_CHAIN_DB_PATH", str(Path(__file__).resolve().parent / "output" / "supply_chain.db")))
+# Upper bound for the ``limit`` of one /supply-chain/documents page
+SUPPLY_CHAIN_MAX_PAGE_SIZE = int(os.getenv("SUPPLY_CHAIN_MAX_PAGE_SIZE", "500"))
+# Documents older than this are purged (0 keeps everything)
+SUPPLY_CHAIN_RETENTION_DAYS = float(os.getenv("SUPPLY_CHAIN_RETENTION_DAYS", "90"))
 
-# Initialize client and inspector
-client = GeminiClient(PROJECT, REGION, MODEL)
-inspector = WeldingInspector(client)
+# Status events stay replayable (by sequence number) for this long; the memory store keeps the last N
+SUPPLY_CHAIN_EVENT_TTL_SECONDS = int(os.getenv("SUPPLY_CHAIN_EVENT_TTL_SECONDS", str(24 * 3600)))
+SUPPLY_CHAIN_EVENT_BUFFER = int(os.getenv("SUPPLY_CHAIN_EVENT_BUFFER", "10000"))
+# Event streams re-check the store this often for events written by other worker processes
+SUPPLY_CHAIN_EVENT_POLL_SECONDS = float(os.getenv("SUPPLY_CHAIN_EVENT_POLL_SECONDS", "1.0"))
 
+# Re-uploads of identical bytes: "reuse" creates a new document but copies the earlier extraction
+# (no model call), "link" returns the existing document instead, "off" processes every upload
+SUPPLY_CHAIN_DEDUP = os.getenv("SUPPLY_CHAIN_DEDUP", "reuse").strip().lower()
 
-@app.get("/")
-def root():
-    return {"message": "Welding Inspector API", "status": "running"}
+_PURGE_INTERVAL_SECONDS = 3600
+# Record fields mirrored into SQLite columns; projections limited to these skip the JSON decode
+_DOCUMENT_COLUMNS = ("id", "status", "stage", "progress", "created_at", "updated_at")
 
-@app.get("/health")
-def health():
-    """Health check endpoint."""
-    return {"status": "healthy", "service": "Welding Inspector API"}
 
-@app.get("/supply-chain/health")
-def supply_chain_health():
-    """Health check for supply chain endpoints."""
-    return {
-        "status": "healthy",
-        "service": "Supply Chain Document Automation",
-        "endpoints": {
-            "upload": "/supply-chain/upload",
-            "status": "/supply-chain/status/{document_id}",
-            "documents": "/supply-chain/documents",
-            "approve": "/supply-chain/approve/{document_id}",
-            "reject": "/supply-chain/reject/{document_id}",
-        },
-        "document_count": len(document_status_store),
+def encode_document_cursor(created_at: str, doc_id: str) -> str:
+    """Opaque keyset cursor: the (created_at, id) of the last document on a page."""
+    raw = json.dumps([created_at, doc_id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_document_cursor(cursor: str) -> Tuple[str, str]:
+    """Inverse of ``encode_document_cursor``; raises ValueError on anything else."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, doc_id = json.loads(raw)
+    except Exception as exc:
+        raise ValueError("Invalid cursor") from exc
+    if not isinstance(created_at, str) or not isinstance(doc_id, str):
+        raise ValueError("Invalid cursor")
+    return created_at, doc_id
+
+
+def _project_document(document: Dict, fields: Optional[List[str]]) -> Dict:
+    if not fields:
+        return dict(document)
+    projected = {"id": document["id"]}
+    for field in fields:
+        if field in document:
+            projected[field] = document[field]
+    return projected
+
+
+def _document_supplier(document: Dict) -> Optional[str]:
+    supplier = (document.get("extracted_data") or {}).get("supplier")
+    if supplier is None:
+        return None
+    return str(supplier).strip() or None
+
+
+def _status_fields(
+    status: str,
+    stage: int,
+    progress: int,
+    extracted_data: Optional[Dict] = None,
+    error: Optional[str] = None,
+) -> Dict:
+    fields = {
+        "status": status,
+        "stage": stage,
+        "progress": progress,
+        "updated_at": datetime.now().isoformat(),
     }
+    if extracted_data:
+        fields["extracted_data"] = extracted_data
+    if error:
+        fields["error"] = error
+    return fields
+
 
+class DocumentStore(ABC):
+    """Storage for supply-chain document records (plain dicts keyed by ``id``)."""
 
-@app.post("/analyze")
-async def analyze_image(file: UploadFile = File(...)):
-    """Upload an image or PDF and analyze it for welding information."""
-    try:
-        # Validate file type - accept images and PDFs
-        if not file.content_type:
-            raise HTTPException(status_code=400, detail="File type not specified")
-        
-        is_image = file.content_type.startswith("image/")
-        is_pdf = file.content_type == "application/pdf"
-        
-        if not (is_image or is_pdf):
-            raise HTTPException(
-                status_code=400, 
-                detail=f"File must be an image (PNG, JPG, JPEG, WEBP) or PDF. Received: {file.content_type}"
-            )
+    name = "base"
 
-        # Read file bytes
-        file_bytes = await file.read()
-        
-        # Validate file size (max 20MB)
-        max_size = 20 * 1024 * 1024  # 20MB
-        if len(file_bytes) > max_size:
-            raise HTTPException(
-                status_code=400,
-                detail=f"File size exceeds maximum allowed size of 20MB. Received: {len(file_bytes) / (1024 * 1024):.2f}MB"
-            )
-        
-        if len(file_bytes) == 0:
-            raise HTTPException(status_code=400, detail="File is empty")
-        
-        logger.info(f"Processing file: {file.filename}, type: {file.content_type}, size: {len(file_bytes)} bytes")
-        
-        # Detect MIME type
-        mime_type = file.content_type or mimetypes.guess_type(file.filename or "")[0] or "image/jpeg"
-        
-        # For PDFs, ensure correct MIME type
-        if is_pdf and mime_type != "application/pdf":
-            mime_type = "application/pdf"
+    @abstractmethod
+    def create(self, document: Dict) -> None:
+        ...
 
-        # Analyze the file (image or PDF)
-        report = inspector.inspect_drawing(file_bytes, mime_type)
-        
-        logger.info(f"[ENDPOINT] Raw LLM report length: {len(report)} chars")
-        logger.info(f"[ENDPOINT] Raw LLM report (first 500 chars): {report[:500]}")
-        
-        # Parse JSON response
-        table_data, explanations = inspector.parse_json_response(report)
-        
-        if table_data is None:
-            # Fallback: try to parse as markdown table if JSON parsing fails
-            logger.warning("[ENDPOINT] JSON parsing failed, attempting markdown fallback")
-            table_data = inspector.parse_table(report) if hasattr(inspector, 'parse_table') else None
-            if "EXPLANATIONS:" in report:
-                explanations = report.split("EXPLANATIONS:", 1)[1].strip()
-        
-        if table_data is not None:
-            logger.info(f"[ENDPOINT] Parsed table_data: {len(table_data)} rows")
-            if len(table_data) > 0:
-                logger.info(f"[ENDPOINT] Table keys: {list(table_data[0].keys())}")
-                logger.info(f"[ENDPOINT] Sample row: {table_data[0] if table_data else 'N/A'}")
-        else:
-            logger.warning("[ENDPOINT] ⚠ table_data is None - no table data to send to frontend")
-        
-        response_data = {
-            "success": True,
-            "report": report,
-            "table": table_data,
-            "explanations": explanations or ""
-        }
-        
-        logger.info(f"[ENDPOINT] Sending response: success={response_data['success']}, table_rows={len(table_data) if table_data else 0}, has_explanations={bool(explanations)}")
-        
-        return JSONResponse(response_data)
+    @abstractmethod
+    def get(self, doc_id: str) -> Optional[Dict]:
+        ...
 
-    except HTTPException:
-        # Re-raise HTTP exceptions as-is
-        raise
-    except Exception as e:
-        logger.error(f"Error analyzing file: {str(e)}", exc_info=True)
-        raise HTTPException(
-            status_code=500, 
-            detail=f"Error analyzing file: {str(e)}"
-        )
+    @abstractmethod
+    def update(
+        self, doc_id: str, fields: Union[Dict, Callable[[Dict], Dict]], event: Optional[str] = None
+    ) -> Optional[Dict]:
+        """Atomically merge ``fields`` into the record; returns it, or None if it does not exist.
 
+        ``fields`` may be a function of the current record (for read-modify-write changes such as
+        counters); it is called inside the same lock or transaction as the write. With ``event``,
+        the updated record is appended to the event log in the same step.
+        """
 
-@app.post("/compare")
-async def compare_rfq_cad(
-    rfq: UploadFile = File(...),
-    cad: UploadFile = File(...),
-    part: str = Form("spark_plug"),
-):
-    """Upload RFQ (PDF) and CAD (image/PDF) to compare alignment."""
-    try:
-        allowed_rfq_types = {
-            "application/pdf",
-            "application/msword",
-            "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-        }
+    @abstractmethod
+    def find_by_sha256(self, sha256: str, limit: int = 20) -> List[Dict]:
+        """Documents uploaded with these exact bytes, newest first."""
 
-        if not rfq.content_type or rfq.content_type not in allowed_rfq_types:
-            raise HTTPException(
-                status_code=400,
-                detail="RFQ file must be a PDF or Word document (.doc, .docx)",
-            )
+    @abstractmethod
+    def find_match_candidates(
+        self, order_key: Optional[str], supplier_key: Optional[str], limit: int = 500
+    ) -> List[Dict]:
+        """Matchable documents with this order key or, without one, this supplier key; newest first."""
 
-        if not cad.content_type:
-            raise HTTPException(status_code=400, detail="CAD file type not specified")
+    @abstractmethod
+    def find_by_erp_status(self, erp_status: str, fields: Optional[List[str]] = None) -> List[Dict]:
+        """Every document whose ``erp_status`` is ``erp_status``, oldest first."""
 
-        is_cad_image = cad.content_type.startswith("image/")
-        is_cad_pdf = cad.content_type == "application/pdf"
+    @abstractmethod
+    def events_since(
+        self,
+        seq: int,
+        document_id: Optional[str] = None,
+        batch_id: Optional[str] = None,
+        limit: int = 500,
+    ) -> List[Dict]:
+        """Logged events with a sequence number above ``seq``, oldest first."""
 
-        if not (is_cad_image or is_cad_pdf):
-            raise HTTPException(
-                status_code=400,
-                detail="CAD file must be an image (PNG, JPG, JPEG, WEBP) or PDF",
-            )
+    @abstractmethod
+    def last_event_seq(self) -> int:
+        ...
 
-        rfq_bytes = await rfq.read()
-        cad_bytes = await cad.read()
+    @abstractmethod
+    def purge_events(self, older_than: float) -> int:
+        """Drop events logged before the epoch timestamp ``older_than``."""
 
-        if len(rfq_bytes) == 0 or len(cad_bytes) == 0:
-            raise HTTPException(status_code=400, detail="Uploaded files cannot be empty")
+    @abstractmethod
+    def list(
+        self,
+        status: Optional[str] = None,
+        limit: int = 50,
+        offset: int = 0,
+        cursor: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+    ) -> Tuple[List[Dict], int, Optional[str]]:
+        """Newest first, optionally filtered by status; returns (page, total, next_cursor).
+
+        With ``cursor`` (a previous ``next_cursor``) the page starts after that document and
+        ``offset`` is ignored. ``fields`` limits each record to those keys plus ``id``.
+        """
 
-        max_size = 20 * 1024 * 1024
-        if len(rfq_bytes) > max_size or len(cad_bytes) > max_size:
-            raise HTTPException(status_code=400, detail="Each file must be <= 20MB")
+    @abstractmethod
+    def count(self) -> int:
+        ...
 
-        rfq_mime = rfq.content_type if rfq.content_type in allowed_rfq_types else "application/pdf"
-        cad_mime = cad.content_type if is_cad_image else "application/pdf"
+    @abstractmethod
+    def purge(self, older_than: str) -> int:
+        """Delete records created before the ISO timestamp ``older_than``; returns how many."""
 
-        logger.info(
-            "[COMPARE] Processing RFQ %s (%d bytes) and CAD %s (%d bytes)",
-            rfq.filename,
-            len(rfq_bytes),
-            cad.filename,
-            len(cad_bytes),
-        )
+    def update_status(
+        self,
+        doc_id: str,
+        status: str,
+        stage: int,
+        progress: int,
+        extracted_data: Optional[Dict] = None,
+        error: Optional[str] = None,
+    ) -> Optional[Dict]:
+        event = "error" if error else "extracted_data" if extracted_data else "status"
+        return self.update(doc_id, _status_fields(status, stage, progress, extracted_data, error), event=event)
+
+
+class MemoryDocumentStore(DocumentStore):
+    """Per-process dict; only consistent with a single uvicorn worker.
+
+    Ordered ``(created_at, id)`` indexes are maintained per status and overall, so a page
+    is a bisect plus a slice instead of a filter and sort over every record.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self._documents: Dict[str, Dict] = {}
+        # Ascending (created_at, id) keys; None is the index over every status
+        self._indexes: Dict[Optional[str], List[Tuple[str, str]]] = {None: []}
+        self._by_sha256: Dict[str, List[str]] = {}
+        # ("order" | "supplier", match key) -> ids, mirroring the SQLite store's match-key columns
+        self._by_match_key: Dict[Tuple[str, str], List[str]] = {}
+        self._events: deque = deque(maxlen=max(1, SUPPLY_CHAIN_EVENT_BUFFER))
+        self._event_seq = 0
+        self._lock = threading.Lock()
 
-        part_selection = (part or "spark_plug").strip() or "spark_plug"
-        logger.info("[COMPARE] Part selection: %s", part_selection)
+    @staticmethod
+    def _key(document: Dict) -> Tuple[str, str]:
+        return (document.get("created_at") or "", document["id"])
+
+    def _index_add(self, status: Optional[str], key: Tuple[str, str]) -> None:
+        bisect.insort(self._indexes.setdefault(status, []), key)
+
+    def _index_remove(self, status: Optional[str], key: Tuple[str, str]) -> None:
+        index = self._indexes.get(status)
+        if not index:
+            return
+        position = bisect.bisect_left(index, key)
+        if position < len(index) and index[position] == key:
+            del index[position]
+        if status is not None and not index:
+            del self._indexes[status]
+
+    def _unindex(self, document: Dict) -> None:
+        key = self._key(document)
+        self._index_remove(None, key)
+        self._index_remove(document.get("status"), key)
+
+    def _reindex(self, document: Dict) -> None:
+        key = self._key(document)
+        self._index_add(None, key)
+        self._index_add(document.get("status"), key)
 
-        rfq_input = inspector._prepare_rfq_input(rfq_bytes, rfq_mime)
-        comparison_text = inspector.compare_rfq_and_cad(
-            rfq_input,
-            cad_bytes,
-            cad_mime,
-            part=part_selection,
+    @staticmethod
+    def _match_index_keys(document: Dict) -> List[Tuple[str, str]]:
+        order_key, supplier_key = match_keys(document.get("extracted_data"))
+        return [(kind, key) for kind, key in (("order", order_key), ("supplier", supplier_key)) if key]
+
+    def _match_index(self, doc_id: str, keys: List[Tuple[str, str]], add: bool) -> None:
+        for key in keys:
+            ids = self._by_match_key.setdefault(key, [])
+            if add:
+                ids.append(doc_id)
+            elif doc_id in ids:
+                ids.remove(doc_id)
+            if not ids:
+                del self._by_match_key[key]
+
+    def create(self, document: Dict) -> None:
+        with self._lock:
+            existing = self._documents.get(document["id"])
+            if existing is not None:
+                self._unindex(existing)
+                self._match_index(existing["id"], self._match_index_keys(existing), add=False)
+            elif document.get("sha256"):
+                self._by_sha256.setdefault(document["sha256"], []).append(document["id"])
+            self._documents[document["id"]] = dict(document)
+            self._reindex(document)
+            self._match_index(document["id"], self._match_index_keys(document), add=True)
+
+    def find_by_sha256(self, sha256: str, limit: int = 20) -> List[Dict]:
+        with self._lock:
+            documents = [dict(self._documents[doc_id]) for doc_id in self._by_sha256.get(sha256, [])]
+        documents.sort(key=lambda d: (d.get("created_at", ""), d["id"]), reverse=True)
+        return documents[:limit]
+
+    def find_match_candidates(
+        self, order_key: Optional[str], supplier_key: Optional[str], limit: int = 500
+    ) -> List[Dict]:
+        key = ("order", order_key) if order_key else ("supplier", supplier_key) if supplier_key else None
+        if key is None:
+            return []
+        with self._lock:
+            documents = [dict(self._documents[doc_id]) for doc_id in self._by_match_key.get(key, [])]
+        documents.sort(key=lambda d: (d.get("created_at", ""), d["id"]), reverse=True)
+        return documents[:limit]
+
+    def find_by_erp_status(self, erp_status: str, fields: Optional[List[str]] = None) -> List[Dict]:
+        # Only ever called at startup, when a per-process store has nothing to scan
+        with self._lock:
+            documents = [document for document in self._documents.values() if document.get("erp_status") == erp_status]
+            documents.sort(key=self._key)
+            return [_project_document(document, fields) for document in documents]
+
+    def get(self, doc_id: str) -> Optional[Dict]:
+        with self._lock:
+            document = self._documents.get(doc_id)
+            return dict(document) if document is not None else None
+
+    def update(
+        self, doc_id: str, fields: Union[Dict, Callable[[Dict], Dict]], event: Optional[str] = None
+    ) -> Optional[Dict]:
+        with self._lock:
+            document = self._documents.get(doc_id)
+            if document is None:
+                return None
+            old_key, old_status = self._key(document), document.get("status")
+            old_match_keys = self._match_index_keys(document)
+            document.update(fields(dict(document)) if callable(fields) else fields)
+            if self._key(document) != old_key or document.get("status") != old_status:
+                self._index_remove(None, old_key)
+                self._index_remove(old_status, old_key)
+                self._reindex(document)
+            match_index_keys = self._match_index_keys(document)
+            if match_index_keys != old_match_keys:
+                self._match_index(doc_id, old_match_keys, add=False)
+                self._match_index(doc_id, match_index_keys, add=True)
+            if event:
+                self._event_seq += 1
+                self._events.append({
+                    "seq": self._event_seq,
+                    "event": event,
+                    "document_id": doc_id,
+                    "batch_id": document.get("batch_id"),
+                    "logged_at": time.time(),
+                    "data": dict(document),
+                })
+            return dict(document)
+
+    def events_since(
+        self,
+        seq: int,
+        document_id: Optional[str] = None,
+        batch_id: Optional[str] = None,
+        limit: int = 500,
+    ) -> List[Dict]:
+        with self._lock:
+            # The log is ordered by seq, so only the tail past ``seq`` needs scanning
+            tail = []
+            for entry in reversed(self._events):
+                if entry["seq"] <= seq:
+                    break
+                tail.append(entry)
+        matches = [
+            entry for entry in reversed(tail)
+            if (not document_id or entry["document_id"] == document_id)
+            and (not batch_id or entry["batch_id"] == batch_id)
+        ]
+        return matches[:limit]
+
+    def last_event_seq(self) -> int:
+        with self._lock:
+            return self._event_seq
+
+    def purge_events(self, older_than: float) -> int:
+        removed = 0
+        with self._lock:
+            while self._events and self._events[0]["logged_at"] < older_than:
+                self._events.popleft()
+                removed += 1
+        return removed
+
+    def list(
+        self,
+        status: Optional[str] = None,
+        limit: int = 50,
+        offset: int = 0,
+        cursor: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+    ) -> Tuple[List[Dict], int, Optional[str]]:
+        after = decode_document_cursor(cursor) if cursor else None
+        limit = max(0, limit)
+        with self._lock:
+            index = self._indexes.get(status or None, [])
+            # Newest first: walk the ascending index backwards from the cursor (or the end)
+            end = bisect.bisect_left(index, after) if after else len(index) - max(0, offset)
+            start = max(0, end - limit)
+            keys = index[start:max(0, end)][::-1]
+            page = [_project_document(self._documents[doc_id], fields) for _, doc_id in keys]
+            total = len(index)
+        next_cursor = encode_document_cursor(*keys[-1]) if keys and start > 0 else None
+        return page, total, next_cursor
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self._documents)
+
+    def purge(self, older_than: str) -> int:
+        with self._lock:
+            expired = [d for d in self._documents.values() if d.get("created_at", "") < older_than]
+            for document in expired:
+                self._unindex(document)
+                self._match_index(document["id"], self._match_index_keys(document), add=False)
+                del self._documents[document["id"]]
+                siblings = self._by_sha256.get(document.get("sha256"))
+                if siblings is not None:
+                    siblings.remove(document["id"])
+                    if not siblings:
+                        del self._by_sha256[document["sha256"]]
+        return len(expired)
+
+
+class SqliteDocumentStore(DocumentStore):
+    """SQLite in WAL mode: every worker process on the node reads and writes the same file.
+
+    The full record is kept as JSON; status, stage, supplier, match keys, ERP status and
+    timestamps are mirrored into indexed columns. Each update is a read-merge-write inside
+    ``BEGIN IMMEDIATE``, so concurrent writers from different processes cannot lose each
+    other's fields. Listings are keyset scans over ``(status, created_at, id)``; per-status
+    totals are kept current by triggers.
+    """
+
+    name = "sqlite"
+
+    _SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS documents (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            stage INTEGER NOT NULL DEFAULT 0,
+            progress INTEGER NOT NULL DEFAULT 0,
+            supplier TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT,
+            sha256 TEXT,
+            order_key TEXT,
+            supplier_key TEXT,
+            erp_status TEXT,
+            data TEXT NOT NULL
+        )
+        """,
+        "DROP INDEX IF EXISTS idx_documents_status_created",
+        "DROP INDEX IF EXISTS idx_documents_created",
+        "CREATE INDEX IF NOT EXISTS idx_documents_status_created_id ON documents (status, created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_documents_created_id ON documents (created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_documents_supplier ON documents (supplier)",
+        "CREATE TABLE IF NOT EXISTS document_counts (status TEXT PRIMARY KEY, count INTEGER NOT NULL)",
+        """
+        CREATE TABLE IF NOT EXISTS document_events (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            event TEXT NOT NULL,
+            document_id TEXT NOT NULL,
+            batch_id TEXT,
+            logged_at REAL NOT NULL,
+            data TEXT NOT NULL
         )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_document_events_document ON document_events (document_id, seq)",
+        "CREATE INDEX IF NOT EXISTS idx_document_events_batch ON document_events (batch_id, seq)",
+        "CREATE INDEX IF NOT EXISTS idx_document_events_logged ON document_events (logged_at)",
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_documents_count_insert AFTER INSERT ON documents BEGIN
+            INSERT INTO document_counts (status, count) VALUES (NEW.status, 1)
+                ON CONFLICT (status) DO UPDATE SET count = count + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_documents_count_delete AFTER DELETE ON documents BEGIN
+            UPDATE document_counts SET count = count - 1 WHERE status = OLD.status;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_documents_count_update AFTER UPDATE OF status ON documents
+        WHEN OLD.status IS NOT NEW.status BEGIN
+            UPDATE document_counts SET count = count - 1 WHERE status = OLD.status;
+            INSERT INTO document_counts (status, count) VALUES (NEW.status, 1)
+                ON CONFLICT (status) DO UPDATE SET count = count + 1;
+        END
+        """,
+    )
+
+    def __init__(self, path: Path, busy_timeout_ms: int = 5000):
+        import sqlite3
+
+        self._sqlite3 = sqlite3
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.busy_timeout_ms = busy_timeout_ms
+        # One connection per thread: endpoints, stage workers and to_thread calls all share the store
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            had_counts = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'document_counts'"
+            ).fetchone()
+            for statement in self._SCHEMA:
+                conn.execute(statement)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(documents)")}
+            if "sha256" not in columns:
+                conn.execute("ALTER TABLE documents ADD COLUMN sha256 TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_sha256 ON documents (sha256, created_at)")
+            if "order_key" not in columns:
+                conn.execute("ALTER TABLE documents ADD COLUMN order_key TEXT")
+                conn.execute("ALTER TABLE documents ADD COLUMN supplier_key TEXT")
+                # Databases created before the match-key columns existed: fill them in once
+                keys = [
+                    (*match_keys(json.loads(data).get("extracted_data")), doc_id)
+                    for doc_id, data in conn.execute("SELECT id, data FROM documents").fetchall()
+                ]
+                conn.executemany("UPDATE documents SET order_key = ?, supplier_key = ? WHERE id = ?", keys)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_order_key ON documents (order_key, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_supplier_key ON documents (supplier_key, created_at)")
+            if "erp_status" not in columns:
+                conn.execute("ALTER TABLE documents ADD COLUMN erp_status TEXT")
+                conn.execute(
+                    "UPDATE documents SET erp_status = json_extract(data, '$.erp_status') WHERE data LIKE '%\"erp_status\"%'"
+                )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_erp_status ON documents (erp_status, created_at)")
+            if not had_counts:
+                # Databases created before the counts table existed: seed it once
+                conn.execute(
+                    "INSERT INTO document_counts (status, count) SELECT status, COUNT(*) FROM documents GROUP BY status"
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._sqlite3.connect(str(self.path), timeout=self.busy_timeout_ms / 1000, isolation_level=None)
+            conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+            # WAL + NORMAL: commits survive a process crash; only an OS crash can lose the last ones
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # Columns written from the record on every create and update, in ``_row`` order
+    _ROW_COLUMNS = (
+        "status", "stage", "progress", "supplier", "order_key", "supplier_key", "erp_status", "created_at",
+        "updated_at", "data",
+    )
 
-        result = inspector.parse_comparison_response(comparison_text)
+    @staticmethod
+    def _row(document: Dict) -> Tuple:
+        return (
+            document.get("status") or "uploaded",
+            int(document.get("stage") or 0),
+            int(document.get("progress") or 0),
+            _document_supplier(document),
+            *match_keys(document.get("extracted_data")),
+            document.get("erp_status"),
+            document.get("created_at") or datetime.now().isoformat(),
+            document.get("updated_at"),
+            json.dumps(document, ensure_ascii=False, default=str),
+        )
 
-        if result is None:
-            logger.error("[COMPARE] Failed to parse comparison response for part: %s", part_selection)
-            logger.error("[COMPARE] Raw response (first 2000 chars): %s", comparison_text[:2000] if comparison_text else "None")
-            raise HTTPException(status_code=500, detail="Unable to parse comparison response")
-        
-        logger.info(
-            "[COMPARE] Parsed result for part '%s': match=%s, rfq_count=%d, cad_count=%d, mismatch_count=%d",
-            part_selection,
-            result.get("match"),
-            len(result.get("rfq_requirements", [])),
-            len(result.get("cad_findings", [])),
-            len(result.get("mismatches", [])),
+    def create(self, document: Dict) -> None:
+        conn = self._connect()
+        columns = (*self._ROW_COLUMNS, "id", "sha256")
+        # An upsert rather than INSERT OR REPLACE: REPLACE's implicit delete skips the count trigger
+        conn.execute(
+            f"INSERT INTO documents ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+            "ON CONFLICT (id) DO UPDATE SET "
+            + ", ".join(f"{column} = excluded.{column}" for column in columns if column != "id"),
+            (*self._row(document), document["id"], document.get("sha256")),
         )
 
-        annotated_image = None
-        annotation_records: List[Dict] = []
+    def find_by_sha256(self, sha256: str, limit: int = 20) -> List[Dict]:
+        rows = self._connect().execute(
+            "SELECT data FROM documents WHERE sha256 = ? ORDER BY created_at DESC LIMIT ?",
+            (sha256, max(1, limit)),
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def find_match_candidates(
+        self, order_key: Optional[str], supplier_key: Optional[str], limit: int = 500
+    ) -> List[Dict]:
+        column, key = ("order_key", order_key) if order_key else ("supplier_key", supplier_key)
+        if not key:
+            return []
+        rows = self._connect().execute(
+            f"SELECT data FROM documents WHERE {column} = ? ORDER BY created_at DESC LIMIT ?",
+            (key, max(1, limit)),
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def find_by_erp_status(self, erp_status: str, fields: Optional[List[str]] = None) -> List[Dict]:
+        rows = self._connect().execute(
+            "SELECT data FROM documents WHERE erp_status = ? ORDER BY created_at, id", (erp_status,)
+        ).fetchall()
+        return [_project_document(json.loads(row[0]), fields) for row in rows]
+
+    def get(self, doc_id: str) -> Optional[Dict]:
+        row = self._connect().execute("SELECT data FROM documents WHERE id = ?", (doc_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(
+        self, doc_id: str, fields: Union[Dict, Callable[[Dict], Dict]], event: Optional[str] = None
+    ) -> Optional[Dict]:
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            annotated_image, annotation_records = inspector.generate_auto_annotations(
-                result.get("rfq_requirements", []),
-                result.get("cad_findings", []),
-                cad_bytes,
-                cad_mime,
-            )
-        except Exception as annotation_exc:
-            logger.warning(
-                "[COMPARE] Auto-annotation failed: %s",
-                annotation_exc,
-                exc_info=True,
+            row = conn.execute("SELECT data FROM documents WHERE id = ?", (doc_id,)).fetchone()
+            if row is None:
+                conn.execute("ROLLBACK")
+                return None
+            document = json.loads(row[0])
+            document.update(fields(dict(document)) if callable(fields) else fields)
+            values = self._row(document)
+            conn.execute(
+                f"UPDATE documents SET {', '.join(f'{column} = ?' for column in self._ROW_COLUMNS)} WHERE id = ?",
+                (*values, doc_id),
             )
+            if event:
+                conn.execute(
+                    "INSERT INTO document_events (event, document_id, batch_id, logged_at, data) VALUES (?, ?, ?, ?, ?)",
+                    (event, doc_id, document.get("batch_id"), time.time(), values[-1]),
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return document
 
-        response_data = {
-            "success": True,
-            **result,
-            "annotated_image": annotated_image,
-            "annotations": annotation_records,
-        }
+    def events_since(
+        self,
+        seq: int,
+        document_id: Optional[str] = None,
+        batch_id: Optional[str] = None,
+        limit: int = 500,
+    ) -> List[Dict]:
+        conditions, params = ["seq > ?"], [seq]
+        if document_id:
+            conditions.append("document_id = ?")
+            params.append(document_id)
+        if batch_id:
+            conditions.append("batch_id = ?")
+            params.append(batch_id)
+        rows = self._connect().execute(
+            "SELECT seq, event, document_id, batch_id, logged_at, data FROM document_events "
+            f"WHERE {' AND '.join(conditions)} ORDER BY seq LIMIT ?",
+            (*params, max(1, limit)),
+        ).fetchall()
+        return [
+            {"seq": s, "event": e, "document_id": d, "batch_id": b, "logged_at": t, "data": json.loads(data)}
+            for s, e, d, b, t, data in rows
+        ]
 
-        logger.info(
-            "[COMPARE] Comparison result: match=%s, confidence=%s",
-            result.get("match"),
-            result.get("confidence"),
-        )
+    def last_event_seq(self) -> int:
+        return self._connect().execute("SELECT COALESCE(MAX(seq), 0) FROM document_events").fetchone()[0]
 
-        return JSONResponse(response_data)
+    def purge_events(self, older_than: float) -> int:
+        return self._connect().execute("DELETE FROM document_events WHERE logged_at < ?", (older_than,)).rowcount
 
-    except HTTPException:
-        raise
-    except Exception as exc:
-        logger.error("[COMPARE] Unexpected error: %s", exc, exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Error comparing files: {str(exc)}")
+    def list(
+        self,
+        status: Optional[str] = None,
+        limit: int = 50,
+        offset: int = 0,
+        cursor: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+    ) -> Tuple[List[Dict], int, Optional[str]]:
+        conn = self._connect()
+        conditions, params = [], []
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        if cursor:
+            conditions.append("(created_at, id) < (?, ?)")
+            params.extend(decode_document_cursor(cursor))
+            offset = 0
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        columns_only = bool(fields) and set(fields) <= set(_DOCUMENT_COLUMNS)
+        select = ", ".join(_DOCUMENT_COLUMNS) if columns_only else "id, created_at, data"
+        # A read transaction keeps the page and the total on the same snapshot
+        conn.execute("BEGIN")
+        try:
+            rows = conn.execute(
+                f"SELECT {select} FROM documents {where} ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?",
+                (*params, max(0, limit) + 1, max(0, offset)),
+            ).fetchall()
+            if status:
+                row = conn.execute("SELECT count FROM document_counts WHERE status = ?", (status,)).fetchone()
+            else:
+                row = conn.execute("SELECT SUM(count) FROM document_counts").fetchone()
+        finally:
+            conn.execute("COMMIT")
+        total = (row[0] if row else 0) or 0
+        has_more = len(rows) > max(0, limit)
+        rows = rows[:max(0, limit)]
+        if columns_only:
+            page = [_project_document(dict(zip(_DOCUMENT_COLUMNS, row)), fields) for row in rows]
+            last = (rows[-1][4], rows[-1][0]) if rows else None
+        else:
+            page = [_project_document(json.loads(row[2]), fields) for row in rows]
+            last = (rows[-1][1], rows[-1][0]) if rows else None
+        next_cursor = encode_document_cursor(*last) if has_more and last else None
+        return page, total, next_cursor
 
+    def count(self) -> int:
+        return self._connect().execute("SELECT COALESCE(SUM(count), 0) FROM document_counts").fetchone()[0]
 
-@app.post("/compare-vendor")
-async def compare_vendor_rfqs(
-    files: TypingList[UploadFile] = File(...),
-):
-    """Upload multiple vendor RFQ documents and compare them."""
-    try:
-        allowed_rfq_types = {
-            "application/pdf",
-            "application/msword",
-            "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-        }
+    def purge(self, older_than: str) -> int:
+        return self._connect().execute("DELETE FROM documents WHERE created_at < ?", (older_than,)).rowcount
 
-        if not files or len(files) < 2:
-            raise HTTPException(
-                status_code=400,
-                detail="At least 2 RFQ files are required for comparison",
-            )
 
-        # Validate all files
-        rfq_inputs: List[Tuple[Union[bytes, str], Optional[str], str]] = []
-        for idx, file in enumerate(files):
-            if not file.content_type or file.content_type not in allowed_rfq_types:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"File {idx + 1} ({file.filename}) must be a PDF or Word document (.doc, .docx)",
-                )
-            
-            file_bytes = await file.read()
-            if len(file_bytes) == 0:
-                raise HTTPException(status_code=400, detail=f"File {idx + 1} ({file.filename}) is empty")
+def create_document_store() -> DocumentStore:
+    """SQLite store at SUPPLY_CHAIN_DB_PATH unless SUPPLY_CHAIN_STORE=memory (or the file is unusable)."""
+    if SUPPLY_CHAIN_STORE != "memory":
+        try:
+            return SqliteDocumentStore(SUPPLY_CHAIN_DB_PATH)
+        except Exception as exc:
+            logger.warning("[SUPPLY-CHAIN] Cannot open %s (%s); falling back to in-memory store", SUPPLY_CHAIN_DB_PATH, exc)
+    return MemoryDocumentStore()
 
-            max_size = 20 * 1024 * 1024
-            if len(file_bytes) > max_size:
-                raise HTTPException(status_code=400, detail=f"File {idx + 1} ({file.filename}) exceeds 20MB limit")
 
-            rfq_mime = file.content_type if file.content_type in allowed_rfq_types else "application/pdf"
-            rfq_input = inspector._prepare_rfq_input(file_bytes, rfq_mime)
-            rfq_inputs.append((rfq_input[0], rfq_input[1], file.filename or f"file_{idx + 1}"))
+_last_purge = 0.0
+_last_event_purge = 0.0
 
-        logger.info(
-            "[VENDOR-COMPARE] Processing %d vendor RFQ files",
-            len(rfq_inputs),
-        )
 
-        vendor_prompt = (
-            "You are given multiple RFQ (Request for Quotation) documents from different vendors. "
-            "All RFQs refer to the same item or item category, but each vendor may present information "
-            "in different formats, wording styles, and layout structures.\n\n"
-
-            "YOUR OBJECTIVE:\n"
-            "Extract structured information from each RFQ and produce a normalized multi-vendor comparison "
-            "strictly based on the content found inside the documents.\n\n"
-
-            "GLOBAL RULES (APPLY TO ALL STEPS):\n"
-            "1. Treat each RFQ as a separate vendor entry, even if vendor names look similar.\n"
-            "2. Only extract information that explicitly appears in each RFQ.\n"
-            "3. Never assume, guess, infer, or hallucinate missing data.\n"
-            "4. If a field is missing for a vendor, set it to null.\n"
-            "5. Never copy values from one vendor into another vendor’s fields.\n"
-            "6. Never use external product knowledge of any kind.\n"
-            "7. If numbers appear in words (e.g., 'five'), convert them into numeric form.\n"
-            "8. Normalize currency into INR (₹) whenever possible.\n"
-            "9. Use integers for day-based fields and floats for price fields.\n"
-            "10. This prompt must work for ANY product category (automotive, electrical, industrial, etc.). "
-            "    Never restrict assumptions to a specific domain.\n\n"
-
-            "FIELDS TO EXTRACT (IF PRESENT):\n"
-            "- certification_level\n"
-            "- unit_price_inr\n"
-            "- extended_price\n"
-            "- quantity_discount\n"
-            "- shipping_terms\n"
-            "- delivery_initial_days\n"
-            "- delivery_subsequent_days\n"
-            "- delivery_emergency_days\n"
-            "- warranty_period\n"
-            "- technical.product_type\n"
-            "- technical.part_number\n"
-            "- technical.dimensions\n"
-            "- technical.specifications\n\n"
-
-            "OUTPUT FORMAT (STRICT JSON ONLY):\n"
-            "{\n"
-            "  \"vendors\": [\n"
-            "    {\n"
-            "      \"vendor_name\": \"\",\n"
-            "      \"certification_level\": \"\",\n"
-            "      \"pricing\": {\n"
-            "        \"unit_price_inr\": 0,\n"
-            "        \"extended_price\": 0,\n"
-            "        \"quantity_discount\": \"\",\n"
-            "        \"shipping_terms\": \"\"\n"
-            "      },\n"
-            "      \"delivery\": {\n"
-            "        \"initial_days\": 0,\n"
-            "        \"subsequent_days\": 0,\n"
-            "        \"emergency_days\": 0\n"
-            "      },\n"
-            "      \"warranty\": \"\",\n"
-            "      \"technical\": {\n"
-            "        \"product_type\": \"\",\n"
-            "        \"part_number\": \"\",\n"
-            "        \"dimensions\": {},\n"
-            "        \"specifications\": {}\n"
-            "      }\n"
-            "    }\n"
-            "  ],\n"
-            "  \"comparison\": {\n"
-            "    \"best_price_vendor\": \"\",\n"
-            "    \"best_delivery_vendor\": \"\",\n"
-            "    \"best_warranty_vendor\": \"\",\n"
-            "    \"overall_recommendation\": \"\"\n"
-            "  }\n"
-            "}\n\n"
-
-            "RECOMMENDATION RULES (CRITICAL):\n"
-            "- The 'overall_recommendation' field must recommend ONLY ONE vendor (the single best overall choice).\n"
-            "- Select the vendor that offers the best overall value considering price, delivery time, warranty, and other factors.\n"
-            "- The recommendation text must start with the vendor name and explain why this ONE vendor is recommended.\n"
-            "- Do NOT recommend multiple vendors. Choose only the top 1 vendor.\n"
-            "- Example format: \"[Vendor Name] offers the best overall value with [reasons].\"\n"
-            "- The vendor name in overall_recommendation must exactly match one of the vendor_name values from the vendors array.\n\n"
-
-            "FINAL OUTPUT RULES:\n"
-            "- Output must be valid JSON only.\n"
-            "- No markdown, no explanation, no commentary.\n"
-            "- No additional notes before or after the JSON.\n"
-            "- Do not hallucinate any fields or values.\n"
-            "- Only include what the RFQs explicitly provide.\n"
-            "- overall_recommendation must mention exactly ONE vendor name.\n"
-        )
+def purge_expired_documents() -> None:
+    """Apply SUPPLY_CHAIN_RETENTION_DAYS and SUPPLY_CHAIN_EVENT_TTL_SECONDS, each at most hourly.
 
-        # Prepare files for Gemini
-        gemini_files: List[Tuple[Union[bytes, str], Optional[str]]] = []
-        for rfq_input, mime_type, filename in rfq_inputs:
-            gemini_files.append((rfq_input, mime_type))
+    Events are trimmed even when document retention is off, since each holds a copy of its document.
+    """
+    global _last_purge, _last_event_purge
+    now = time.time()
+    if now - _last_event_purge >= _PURGE_INTERVAL_SECONDS:
+        _last_event_purge = now
+        try:
+            document_store.purge_events(now - SUPPLY_CHAIN_EVENT_TTL_SECONDS)
+        except Exception as exc:
+            logger.warning("[SUPPLY-CHAIN] Event purge failed: %s", exc)
+    if SUPPLY_CHAIN_RETENTION_DAYS <= 0 or now - _last_purge < _PURGE_INTERVAL_SECONDS:
+        return
+    _last_purge = now
+    cutoff = datetime.fromtimestamp(now - SUPPLY_CHAIN_RETENTION_DAYS * 86400).isoformat()
+    try:
+        removed = document_store.purge(cutoff)
+    except Exception as exc:
+        logger.warning("[SUPPLY-CHAIN] Document purge failed: %s", exc)
+        return
+    if removed:
+        logger.info("[SUPPLY-CHAIN] Purged %d document(s) created before %s", removed, cutoff)
 
-        logger.info("[VENDOR-COMPARE] Sending %d files to Gemini", len(gemini_files))
 
-        response_text = inspector.client.chat_with_files(vendor_prompt, gemini_files)
+class DocumentEventNotifier:
+    """Wakes this process's event streams as soon as a status change is written here.
 
-        logger.info("[VENDOR-COMPARE] Received response from Gemini")
+    Changes written by other worker processes are picked up by the streams' periodic re-check.
+    """
 
-        result = inspector.parse_vendor_comparison_response(response_text)
+    def __init__(self):
+        self._changed = asyncio.Event()
 
-        if result is None:
-            logger.error("[VENDOR-COMPARE] Failed to parse vendor comparison response")
-            logger.error("[VENDOR-COMPARE] Raw response (first 2000 chars): %s", response_text[:2000] if response_text else "None")
-            raise HTTPException(status_code=500, detail="Unable to parse vendor comparison response")
+    def notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
 
-        logger.info(
-            "[VENDOR-COMPARE] Parsed result: vendors=%d",
-            len(result.get("vendors", [])),
-        )
+    async def wait(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
 
-        response_data = {
-            "success": True,
-            **result,
-        }
 
-        return JSONResponse(response_data)
+async def update_document(doc_id: str, fields: Dict, event: str = "status") -> Optional[Dict]:
+    """Merge ``fields`` into a document, log ``event`` for its subscribers and wake the streams.
 
-    except HTTPException:
-        raise
-    except Exception as exc:
-        logger.error("[VENDOR-COMPARE] Unexpected error: %s", exc, exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Error comparing vendor RFQs: {str(exc)}")
+    The store write (a ``BEGIN IMMEDIATE`` transaction that may wait on other workers) runs in
+    a thread; the streams are woken back on the loop.
+    """
+    document = await asyncio.to_thread(document_store.update, doc_id, fields, event)
+    if document is not None:
+        document_events.notify()
+    return document
 
 
-# ----------------- Supply Chain Document Automation -----------------
+document_store = create_document_store()
+document_events = DocumentEventNotifier()
+document_classifier = DocumentTypeClassifier()
 
-# In-memory storage for document processing status (in production, use Redis or database)
-document_status_store: Dict[str, Dict] = {}
 
 @app.post("/supply-chain/upload")
 async def upload_supply_chain_documents(
@@ -1974,53 +7102,77 @@ async def upload_supply_chain_documents(
         if not files:
             raise HTTPException(status_code=400, detail="No files provided")
         
-        allowed_types = {
-            "application/pdf",
-            "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            "application/msword",
-        }
-        
-        max_size = 20 * 1024 * 1024  # 20MB
+        # Accept the whole batch or none of it, before any file is read
+        supply_chain_pipeline.reserve(len(files))
         
-        document_ids = []
+        documents: List[UploadedFile] = []
         for file in files:
-            if file.content_type not in allowed_types:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"File {file.filename} must be PDF or Word document"
-                )
-            
-            file_bytes = await file.read()
-            if len(file_bytes) > max_size:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"File {file.filename} exceeds 20MB limit"
-                )
-            
+            documents.append(await read_upload(
+                file,
+                DOCUMENT_UPLOAD_TYPES,
+                f"File {file.filename}",
+                f"File {file.filename} must be PDF or Word document",
+            ))
+
+        # Exact re-uploads of earlier documents (see SUPPLY_CHAIN_DEDUP)
+        previous = {upload.sha256: await asyncio.to_thread(_previous_upload, upload.sha256) for upload in documents}
+        linked = {sha for sha, original in previous.items() if original and SUPPLY_CHAIN_DEDUP == "link"}
+
+        batch_id = f"BATCH-{uuid.uuid4().hex[:8].upper()}"
+        document_ids = []
+        duplicates = []
+        repeated: List[Dict] = []
+        records: List[Tuple[Dict, UploadedFile]] = []
+        for upload in documents:
+            original = previous[upload.sha256]
+            if upload.sha256 in linked:
+                repeated.append(original)
+                document_ids.append(original["id"])
+                duplicates.append({"filename": upload.filename, "document_id": original["id"], "duplicate_of": original["id"]})
+                continue
+
             # Generate document ID
-            import uuid
             doc_id = f"DOC-{uuid.uuid4().hex[:8].upper()}"
             
             # Store initial status
-            document_status_store[doc_id] = {
+            record = {
                 "id": doc_id,
-                "filename": file.filename,
+                "batch_id": batch_id,
+                "filename": upload.filename,
                 "status": "uploaded",
                 "stage": 1,
                 "progress": 0,
                 "created_at": datetime.now().isoformat(),
-                "file_size": len(file_bytes),
+                "file_size": upload.size,
+                "sha256": upload.sha256,
             }
-            
-            # Start async processing
-            import asyncio
-            asyncio.create_task(process_supply_chain_document(doc_id, file_bytes, file.content_type))
-            
+            if original and original.get("extracted_data"):
+                record["duplicate_of"] = original["id"]
+                duplicates.append({"filename": upload.filename, "document_id": doc_id, "duplicate_of": original["id"]})
+            records.append((record, upload))
             document_ids.append(doc_id)
+
+        await asyncio.to_thread(_create_documents, [record for record, _ in records])
+
+        # Re-check after the awaits above; nothing yields between here and the last submit
+        try:
+            supply_chain_pipeline.reserve(len(records))
+        except HTTPException as exc:
+            for record, _ in records:
+                await update_status(record["id"], "error", 0, 0, error=str(exc.detail))
+            raise
+        for record, upload in records:
+            supply_chain_pipeline.submit(SupplyChainDocument(record["id"], upload.data, upload.mime_type, upload.sha256))
         
+        for original in repeated:
+            await asyncio.to_thread(_record_duplicate, original)
+        await asyncio.to_thread(purge_expired_documents)
         return JSONResponse({
             "success": True,
             "document_ids": document_ids,
+            "duplicates": duplicates,
+            "batch_id": batch_id,
+            "events_url": f"/supply-chain/events?batch_id={batch_id}",
             "message": f"Uploaded {len(document_ids)} document(s). Processing started."
         })
     
@@ -2031,108 +7183,275 @@ async def upload_supply_chain_documents(
         raise HTTPException(status_code=500, detail=f"Error uploading documents: {str(exc)}")
 
 
-async def process_supply_chain_document(doc_id: str, file_bytes: bytes, mime_type: str):
-    """Process a supply chain document through the 5-stage pipeline."""
+def _previous_upload(sha256: str, exclude_id: Optional[str] = None) -> Optional[Dict]:
+    """Newest earlier document with the same bytes: one with an extraction first, else one still in flight."""
+    if SUPPLY_CHAIN_DEDUP not in ("reuse", "link"):
+        return None
+    candidates = [d for d in document_store.find_by_sha256(sha256) if d["id"] != exclude_id]
+    for document in candidates:
+        if document.get("extracted_data"):
+            return document
+    for document in candidates:
+        if document.get("status") not in ("error", "rejected") and not document.get("error"):
+            return document
+    return None
+
+
+def _create_documents(records: List[Dict]) -> None:
+    for record in records:
+        document_store.create(record)
+
+
+def _record_duplicate(original: Dict) -> None:
+    # Counted from the stored record inside the update, so concurrent re-uploads all register
+    document_store.update(original["id"], lambda document: {
+        "duplicate_count": int(document.get("duplicate_count") or 0) + 1,
+        "last_duplicate_at": datetime.now().isoformat(),
+    })
+
+
+# Stage handlers: each one does its stage's work and records the status on entry
+
+async def _intake_stage(document: SupplyChainDocument) -> None:
+    """Stage 1: Intake (the upload has already been validated and stored)."""
+    await update_status(document.id, "intake", 1, 20)
+
+
+async def _parsing_stage(document: SupplyChainDocument) -> None:
+    """Stage 2: AI Parsing & Normalization (local text layer first, Gemini when needed)."""
+    await update_status(document.id, "parsing", 2, 40)
+    file_bytes, document.file_bytes = document.file_bytes, None
+    original = await asyncio.to_thread(_previous_upload, document.sha256, document.id) if document.sha256 else None
+    if original and original.get("extracted_data"):
+        # Same bytes were extracted before: copy the result instead of calling the model again
+        document.extracted_data = original["extracted_data"]
+        fields = _status_fields("parsing", 2, 60, extracted_data=document.extracted_data)
+        await update_document(document.id, {**fields, "duplicate_of": original["id"]}, event="extracted_data")
+        await asyncio.to_thread(_record_duplicate, original)
+        logger.info("[SUPPLY-CHAIN] %s duplicates %s; reused its extraction", document.id, original["id"])
+        return
     try:
-        # Stage 1: Intake (already done)
-        update_status(doc_id, "intake", 1, 20)
-        
-        # Stage 2: AI Parsing & Normalization
-        await asyncio.sleep(1)  # Simulate processing
-        update_status(doc_id, "parsing", 2, 40)
-        
-        # Extract document data using Gemini
-        extraction_prompt = (
-            "You are an expert document analyst specializing in supply chain documents. "
-            "Analyze the attached document and extract all relevant information.\n\n"
-            "The document could be a Purchase Order (PO), Bill of Lading (BoL), "
-            "Goods Receipt Note (GRN), Invoice, Packing List, or Quality Certificate.\n\n"
-            "Extract the following information in JSON format:\n"
-            "{\n"
-            '  "document_type": "PO|BoL|GRN|Invoice|Packing List|QC Cert",\n'
-            '  "supplier": "supplier name",\n'
-            '  "order_number": "PO/order number if available",\n'
-            '  "order_date": "date in YYYY-MM-DD format",\n'
-            '  "total_amount": "amount as number",\n'
-            '  "currency": "currency code (INR, USD, etc.)",\n'
-            '  "line_items": [\n'
-            '    {\n'
-            '      "description": "item description",\n'
-            '      "quantity": number,\n'
-            '      "unit_price": number,\n'
-            '      "total": number\n'
-            '    }\n'
-            '  ],\n'
-            '  "delivery_address": "address if available",\n'
-            '  "payment_terms": "payment terms if available",\n'
-            '  "confidence": "high|medium|low based on document clarity"\n'
-            "}\n\n"
-            "Output ONLY valid JSON, no markdown, no explanations."
-        )
-        
-        extracted_data = None
-        try:
-            response_text = inspector.client.chat(file_bytes, mime_type, extraction_prompt)
-            # Parse JSON response
-            import json
-            response_text = response_text.strip()
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.startswith("```"):
-                response_text = response_text[3:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
-            response_text = response_text.strip()
-            
-            extracted_data = json.loads(response_text)
-            update_status(doc_id, "parsing", 2, 60, extracted_data=extracted_data)
-        except Exception as parse_exc:
-            logger.error(f"[SUPPLY-CHAIN] Parsing error for {doc_id}: {parse_exc}")
-            update_status(doc_id, "parsing", 2, 60, error=str(parse_exc))
-        
-        # Stage 3: Confidence & Human Review
-        await asyncio.sleep(0.5)
-        update_status(doc_id, "review", 3, 70)
-        
-        # Stage 4: Matching (simplified - in production, match against existing POs)
-        await asyncio.sleep(0.5)
-        update_status(doc_id, "matching", 4, 85)
-        
-        # Stage 5: ERP Update
-        await asyncio.sleep(0.5)
-        update_status(doc_id, "completed", 5, 100)
-        
-    except Exception as exc:
-        logger.error(f"[SUPPLY-CHAIN] Processing error for {doc_id}: {exc}", exc_info=True)
-        update_status(doc_id, "error", 0, 0, error=str(exc))
+        text, extra = "", {}
+        if SUPPLY_CHAIN_TEXT_FAST_PATH:
+            text = await asyncio.to_thread(extract_document_text, file_bytes, document.mime_type)
+        if len(text) >= SUPPLY_CHAIN_MIN_TEXT_CHARS:
+            extra["text_excerpt"] = text[:SUPPLY_CHAIN_CLASSIFIER_TEXT_CHARS]
+            fields, complete = await asyncio.to_thread(parse_document_text, text)
+            if complete:
+                document.extracted_data, extraction_method = fields, "text-rules"
+            else:
+                # Digital document the rules could not finish: the model reads the text, not the file
+                if document_classifier.due():
+                    await asyncio.to_thread(train_document_classifier)
+                doc_type, confidence = document_classifier.predict(text)
+                routed = doc_type in SUPPLY_CHAIN_TYPE_PROMPTS and confidence >= SUPPLY_CHAIN_CLASSIFIER_THRESHOLD
+                extra["classification"] = {"type": doc_type, "confidence": round(confidence, 3), "routed": routed}
+                prompt = SUPPLY_CHAIN_TYPE_PROMPTS[doc_type] if routed else SUPPLY_CHAIN_EXTRACTION_PROMPT
+                response_text = await inspector.client.achat_with_files(
+                    prompt, [(text[:SUPPLY_CHAIN_MAX_TEXT_CHARS], None)], cache_prompt=True
+                )
+                document.extracted_data, extraction_method = json.loads(inspector._strip_markdown_fence(response_text)), "text-model"
+                if routed:
+                    # The short prompts do not ask for the type; it is the one we routed on
+                    document.extracted_data["document_type"] = doc_type
+        else:
+            response_text = await inspector.client.achat(
+                file_bytes, document.mime_type, SUPPLY_CHAIN_EXTRACTION_PROMPT, cache_prompt=True
+            )
+            document.extracted_data, extraction_method = json.loads(inspector._strip_markdown_fence(response_text)), "multimodal"
+
+        fields = _status_fields("parsing", 2, 60, extracted_data=document.extracted_data)
+        await update_document(document.id, {**fields, **extra, "extraction_method": extraction_method}, event="extracted_data")
+        logger.info("[SUPPLY-CHAIN] %s extracted via %s", document.id, extraction_method)
+    except Exception as parse_exc:
+        logger.error(f"[SUPPLY-CHAIN] Parsing error for {document.id}: {parse_exc}")
+        await update_status(document.id, "parsing", 2, 60, error=str(parse_exc))
+
+
+async def _review_stage(document: SupplyChainDocument) -> None:
+    """Stage 3: Confidence & Human Review."""
+    await update_status(document.id, "review", 3, 70)
+
 
+def train_document_classifier() -> Dict:
+    """Retrain the document-type classifier from stored text excerpts and their extracted types.
 
-def update_status(doc_id: str, status: str, stage: int, progress: int, extracted_data: Optional[Dict] = None, error: Optional[str] = None):
-    """Update document processing status."""
-    if doc_id not in document_status_store:
+    Documents whose type came from the classifier's own routing or from the text-layer keyword
+    rules only count once a reviewer has approved them, so the model does not learn from its
+    own guesses or echo the rules it is meant to improve on.
+    """
+    if not document_classifier.training_lock.acquire(blocking=False):
+        return document_classifier.stats()
+    try:
+        samples: List[Tuple[str, str]] = []
+        cursor = None
+        while len(samples) < SUPPLY_CHAIN_CLASSIFIER_MAX_SAMPLES:
+            page, _, cursor = document_store.list(
+                limit=500,
+                cursor=cursor,
+                fields=["status", "extracted_data", "text_excerpt", "classification", "extraction_method"],
+            )
+            for record in page:
+                label = canonical_document_type((record.get("extracted_data") or {}).get("document_type"))
+                if not label or not record.get("text_excerpt"):
+                    continue
+                unreviewed = record.get("status") != "approved"
+                if unreviewed and (
+                    (record.get("classification") or {}).get("routed") or record.get("extraction_method") == "text-rules"
+                ):
+                    continue
+                samples.append((record["text_excerpt"], label))
+            if not cursor:
+                break
+        if document_classifier.train(samples[:SUPPLY_CHAIN_CLASSIFIER_MAX_SAMPLES]):
+            logger.info("[SUPPLY-CHAIN] Document classifier trained on %d document(s)", document_classifier.samples)
+        return document_classifier.stats()
+    finally:
+        document_classifier.training_lock.release()
+
+
+def _match_document(doc_id: str, extracted: Dict) -> Optional[Dict]:
+    """Match one document against the candidates sharing its order number (or supplier).
+
+    Candidates come from the store's indexed match-key columns, so every worker sees every
+    other worker's extractions without keeping (or rebuilding) an index of its own.
+    """
+    engine = MatchingEngine()
+    for record in document_store.find_match_candidates(*match_keys(extracted)):
+        if record.get("extracted_data"):
+            engine.add(record["id"], record["extracted_data"], record.get("created_at", ""))
+    if doc_id not in engine:
+        engine.add(doc_id, extracted, datetime.now().isoformat())
+    return engine.match(doc_id)
+
+
+async def _matching_stage(document: SupplyChainDocument) -> None:
+    """Stage 4: Three-way matching of POs, GRNs and invoices on order number (or supplier)."""
+    await update_status(document.id, "matching", 4, 85)
+    if not document.extracted_data:
         return
-    
-    document_status_store[doc_id].update({
-        "status": status,
-        "stage": stage,
-        "progress": progress,
-        "updated_at": datetime.now().isoformat(),
-    })
-    
-    if extracted_data:
-        document_status_store[doc_id]["extracted_data"] = extracted_data
-    
-    if error:
-        document_status_store[doc_id]["error"] = error
+    result = await asyncio.to_thread(_match_document, document.id, document.extracted_data)
+    if result is None:
+        return
+    # The result describes the whole order group, so every member gets it
+    for member_id in result["documents"].values():
+        await update_document(member_id, {"match": result}, event="match")
+    logger.info(
+        "[MATCHING] %s: %s (%s)",
+        document.id,
+        result["status"],
+        ", ".join(f"{doc_type}={doc_id}" for doc_type, doc_id in result["documents"].items()),
+    )
+
+
+async def _erp_stage(document: SupplyChainDocument) -> None:
+    """Stage 5: ERP Update, queued for the next batch write rather than written here."""
+    fields = _status_fields("completed", 5, 100)
+    if document.extracted_data:
+        fields["erp_status"] = "queued"
+    record = await update_document(document.id, fields)
+    if record is not None and document.extracted_data:
+        erp_batcher.enqueue(record, "completed")
+
+
+supply_chain_pipeline = SupplyChainPipeline({
+    "intake": _intake_stage,
+    "parsing": _parsing_stage,
+    "review": _review_stage,
+    "matching": _matching_stage,
+    "erp": _erp_stage,
+})
+
+
+async def update_status(doc_id: str, status: str, stage: int, progress: int, extracted_data: Optional[Dict] = None, error: Optional[str] = None):
+    """Update document processing status and publish it to the event streams."""
+    if await asyncio.to_thread(document_store.update_status, doc_id, status, stage, progress, extracted_data, error):
+        document_events.notify()
+
+
+@app.get("/supply-chain/pipeline")
+def supply_chain_pipeline_stats():
+    """Per-stage worker counts, queue depths and throughput counters."""
+    return supply_chain_pipeline.stats()
+
+
+@app.get("/supply-chain/erp")
+def supply_chain_erp_stats():
+    """ERP batcher state: sink, pending updates and write/retry/dead-letter counters."""
+    return erp_batcher.stats()
+
+
+@app.get("/supply-chain/classifier")
+def supply_chain_classifier_stats():
+    """State of the local document-type classifier that picks the extraction prompt."""
+    return document_classifier.stats()
+
+
+@app.post("/supply-chain/classifier/train")
+async def train_supply_chain_classifier():
+    """Retrain the document-type classifier from the stored documents now."""
+    return await asyncio.to_thread(train_document_classifier)
 
 
 @app.get("/supply-chain/status/{document_id}")
 async def get_document_status(document_id: str):
     """Get real-time processing status for a document."""
-    if document_id not in document_status_store:
+    document = await asyncio.to_thread(document_store.get, document_id)
+    if document is None:
         raise HTTPException(status_code=404, detail="Document not found")
     
-    return JSONResponse(document_status_store[document_id])
+    return JSONResponse(document)
+
+
+@app.get("/supply-chain/events")
+async def stream_document_events(
+    document_id: Optional[str] = None,
+    batch_id: Optional[str] = None,
+    since: Optional[int] = None,
+    last_event_id: Optional[str] = Header(None),
+):
+    """Server-sent events for supply-chain status changes.
+
+    Each event is ``status``, ``extracted_data``, ``match``, ``erp`` or ``error``; its ``id`` is a sequence number and
+    its data is the updated document. Filter by ``document_id`` or ``batch_id`` (returned by
+    ``/supply-chain/upload``). Reconnecting with ``Last-Event-ID`` (or ``since``) replays every
+    event after that sequence number. Filtered streams start from the beginning of the retained log,
+    the unfiltered stream from now.
+    """
+    if since is None and last_event_id:
+        try:
+            since = int(last_event_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+    if since is None:
+        since = 0 if (document_id or batch_id) else await asyncio.to_thread(document_store.last_event_seq)
+
+    async def event_stream():
+        last_seq = since
+        idle = 0.0
+        while True:
+            events = await asyncio.to_thread(document_store.events_since, last_seq, document_id, batch_id)
+            for entry in events:
+                last_seq = entry["seq"]
+                yield (
+                    f"id: {entry['seq']}\nevent: {entry['event']}\n"
+                    f"data: {json.dumps(entry['data'], ensure_ascii=False, default=str)}\n\n"
+                )
+            if events:
+                idle = 0.0
+                continue
+            await document_events.wait(SUPPLY_CHAIN_EVENT_POLL_SECONDS)
+            idle += SUPPLY_CHAIN_EVENT_POLL_SECONDS
+            if idle >= 15.0:
+                idle = 0.0
+                # Comment line keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.get("/supply-chain/documents")
@@ -2140,23 +7459,34 @@ async def get_all_documents(
     status: Optional[str] = None,
     limit: int = 50,
     offset: int = 0,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
 ):
-    """Get all documents with optional filtering."""
+    """Get all documents with optional filtering.
+
+    Pass the returned ``next_cursor`` as ``cursor`` to fetch the next page (``offset`` is then
+    ignored). ``fields`` is a comma-separated list of record keys to return; ``id`` is always included.
+    """
+    limit = max(1, min(limit, SUPPLY_CHAIN_MAX_PAGE_SIZE))
+    field_list = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+    if cursor:
+        try:
+            decode_document_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
     try:
-        documents = list(document_status_store.values())
-        
-        if status:
-            documents = [d for d in documents if d.get("status") == status]
-        
-        # Sort by created_at descending
-        documents.sort(key=lambda x: x.get("created_at", ""), reverse=True)
+        # Newest first, served from the (status, created_at, id) index
+        documents, total, next_cursor = await asyncio.to_thread(
+            document_store.list, status=status, limit=limit, offset=offset, cursor=cursor, fields=field_list
+        )
         
         return JSONResponse({
             "success": True,
-            "documents": documents[offset:offset + limit],
-            "total": len(documents),
+            "documents": documents,
+            "total": total,
             "limit": limit,
             "offset": offset,
+            "next_cursor": next_cursor,
         })
     except Exception as exc:
         logger.error("[SUPPLY-CHAIN] Error getting documents: %s", exc, exc_info=True)
@@ -2167,42 +7497,48 @@ async def get_all_documents(
             "total": 0,
             "limit": limit,
             "offset": offset,
+            "next_cursor": None,
         })
 
 
 @app.post("/supply-chain/approve/{document_id}")
 async def approve_document(document_id: str):
-    """Approve a document for payment processing."""
-    if document_id not in document_status_store:
+    """Approve a document for payment processing; the ERP update goes out with the next batch."""
+    existing = await asyncio.to_thread(document_store.get, document_id)
+    if existing is None:
         raise HTTPException(status_code=404, detail="Document not found")
-    
-    document_status_store[document_id].update({
+    if not existing.get("extracted_data"):
+        raise HTTPException(status_code=409, detail="Document has no extracted data to approve yet")
+    document = await update_document(document_id, {
         "status": "approved",
         "approved_at": datetime.now().isoformat(),
+        "erp_status": "queued",
     })
+    if document is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+    erp_batcher.enqueue(document, "approved")
     
     return JSONResponse({
         "success": True,
         "message": "Document approved",
-        "document": document_status_store[document_id],
+        "document": document,
     })
 
 
 @app.post("/supply-chain/reject/{document_id}")
 async def reject_document(document_id: str, reason: str = Form("")):
     """Reject a document."""
-    if document_id not in document_status_store:
-        raise HTTPException(status_code=404, detail="Document not found")
-    
-    document_status_store[document_id].update({
+    document = await update_document(document_id, {
         "status": "rejected",
         "rejected_at": datetime.now().isoformat(),
         "rejection_reason": reason,
     })
+    if document is None:
+        raise HTTPException(status_code=404, detail="Document not found")
     
     return JSONResponse({
         "success": True,
         "message": "Document rejected",
-        "document": document_status_store[document_id],
+        "document": document,
     })
 
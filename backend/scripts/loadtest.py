@@ -0,0 +1,437 @@
+"""
+Offline load test for the Welding Inspector API.
+
+Drives the FastAPI app concurrently against the replay Gemini backend, so no
+Vertex quota is spent, and reports throughput, latency percentiles and
+event-loop lag per endpoint.
+
+Requests that were recorded with GEMINI_BACKEND=record are replayed from
+GEMINI_RECORDINGS_DIR; anything else gets a synthetic response shaped like the
+real one for that endpoint.
+
+Usage (from backend/):
+    python scripts/loadtest.py
+    python scripts/loadtest.py --requests 100 --concurrency 20 --latency lognormal:20,0.5
+    python scripts/loadtest.py --endpoints analyze compare --fault-429 0.05 --fault-truncate 0.1
+    python scripts/loadtest.py --url http://localhost:8000   # running server; lag = /health probe latency
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+ENDPOINTS = ("analyze", "analyze-stream", "compare", "compare-single-pass", "compare-vendor", "supply-chain")
+
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+_VENDOR_CYCLE = itertools.cycle(range(3))
+
+
+# ----------------- Synthetic Gemini responses -----------------
+def synthetic_response(prompt: str) -> str:
+    """Return a response shaped like the real one for whichever prompt is being replayed."""
+    if "expert welding engineer" in prompt:
+        welds = [
+            {
+                "Serial No": f"W{i}",
+                "Description": f"Fillet weld joining PL{10 + i} to Beam B{i}",
+                "Welding Type": "Fillet Weld",
+                "Welding Value": "6",
+                "Remarks": "TYP",
+                "Position": f"Section A-A, joint {i}",
+                "Confidence": "High",
+            }
+            for i in range(1, 13)
+        ]
+        return json.dumps({"welds": welds, "explanations": "Synthetic weld report for load testing."})
+
+    if "METRICS TO LOCATE" in prompt:
+        block = prompt.split("METRICS TO LOCATE (name: value):\n", 1)[-1].split("\n\n", 1)[0]
+        boxes = []
+        for i, line in enumerate(filter(None, block.splitlines())):
+            name = line.split(":", 1)[0].strip()
+            top = 0.05 + 0.06 * (i % 14)
+            boxes.append({"parameter": name, "bounding_box": [0.1, top, 0.3, top + 0.04]})
+        return json.dumps(boxes)
+
+    if "multiple RFQ" in prompt or "ONE RFQ" in prompt:
+        vendors = [
+            {
+                "vendor_name": f"Vendor {name}",
+                "certification_level": "ISO 9001",
+                "pricing": {"unit_price_inr": price, "extended_price": price * 100, "quantity_discount": "", "shipping_terms": "FOB"},
+                "delivery": {"initial_days": days, "subsequent_days": days // 2, "emergency_days": 3},
+                "warranty": warranty,
+                "technical": {"product_type": "Spark Plug", "part_number": "FR7DC", "dimensions": {}, "specifications": {}},
+            }
+            for name, price, days, warranty in (("A", 180.0, 14, "12 months"), ("B", 165.0, 21, "18 months"), ("C", 172.5, 10, "6 months"))
+        ]
+        if "ONE RFQ" in prompt:
+            # Per-vendor extraction only sees the prompt here, so rotate through the vendors
+            return json.dumps(vendors[next(_VENDOR_CYCLE)])
+        comparison = {
+            "best_price_vendor": "Vendor B",
+            "best_delivery_vendor": "Vendor C",
+            "best_warranty_vendor": "Vendor B",
+            "overall_recommendation": "Vendor B offers the best overall value with the lowest price and longest warranty.",
+        }
+        return json.dumps({"vendors": vendors, "comparison": comparison})
+
+    if "supply chain documents" in prompt:
+        return json.dumps({
+            "document_type": "PO",
+            "supplier": "Acme Components",
+            "order_number": "PO-2024-0042",
+            "order_date": "2024-05-01",
+            "total_amount": 12500.0,
+            "currency": "INR",
+            "line_items": [{"description": "Spark plug FR7DC", "quantity": 100, "unit_price": 125.0, "total": 12500.0}],
+            "delivery_address": "Plant 2",
+            "payment_terms": "Net 30",
+            "confidence": "high",
+        })
+
+    # RFQ vs CAD comparison prompts
+    metrics = [("Thread Size", "M14"), ("Overall Length", "52 mm"), ("Hex Size", "20.8 mm"), ("Electrode Gap", "0.8 mm")]
+    result = {
+        "match": True,
+        "confidence": "High",
+        "summary": "Synthetic comparison for load testing.",
+        "rfq_requirements": [f"{name}: {value}" for name, value in metrics],
+        "cad_findings": [f"{name}: {value}" for name, value in metrics],
+        "mismatches": [],
+        "recommendations": "Proceed.",
+    }
+    if "cad_locations" in prompt:
+        # Leave the last finding unlocated so the bbox fallback request is exercised too
+        result["cad_locations"] = [
+            {"parameter": name, "bounding_box": [0.1, 0.05 + 0.1 * i, 0.3, 0.09 + 0.1 * i]}
+            for i, (name, _) in enumerate(metrics[:-1])
+        ]
+    return json.dumps(result)
+
+
+# ----------------- Synthetic upload payloads -----------------
+def make_drawing_png() -> bytes:
+    import cv2
+    import numpy as np
+
+    image = np.full((1200, 1600, 3), 255, np.uint8)
+    for i in range(12):
+        cv2.rectangle(image, (80 + i * 110, 200), (160 + i * 110, 900), (0, 0, 0), 2)
+        cv2.putText(image, f"PL{10 + i}", (85 + i * 110, 190), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 1)
+    ok, buffer = cv2.imencode(".png", image)
+    return buffer.tobytes()
+
+
+def make_rfq_docx(vendor: str) -> bytes:
+    from docx import Document
+
+    document = Document()
+    document.add_heading(f"Request for Quotation - {vendor}", level=1)
+    document.add_paragraph("Part: Bosch FR7DC spark plug. Thread size M14, overall length 52 mm.")
+    table = document.add_table(rows=1, cols=3)
+    table.rows[0].cells[0].text = "Item"
+    table.rows[0].cells[1].text = "Qty"
+    table.rows[0].cells[2].text = "Unit Price"
+    for i in range(20):
+        row = table.add_row().cells
+        row[0].text = f"Line {i + 1}"
+        row[1].text = "100"
+        row[2].text = "125.00"
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+
+def make_pdf(text: str) -> bytes:
+    """Build a minimal one-page PDF with a text layer."""
+    stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode("latin-1")
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R /Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length " + str(len(stream)).encode() + b" >>\nstream\n" + stream + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(f"{number} 0 obj\n".encode() + body + b"\nendobj\n")
+    xref = out.tell()
+    out.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+    for offset in offsets:
+        out.write(f"{offset:010d} 00000 n \n".encode())
+    out.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    return out.getvalue()
+
+
+# ----------------- Scenarios -----------------
+class Payloads:
+    def __init__(self, drawing: Optional[Path], rfq: Optional[Path]):
+        self.drawing = drawing.read_bytes() if drawing else make_drawing_png()
+        self.drawing_mime = _guess_mime(drawing) if drawing else "image/png"
+        self.rfq = rfq.read_bytes() if rfq else make_rfq_docx("Vendor A")
+        self.rfq_mime = _guess_mime(rfq) if rfq else DOCX_MIME
+        self.vendor_rfqs = [make_rfq_docx(f"Vendor {name}") for name in "ABC"]
+        self.supply_chain_pdf = make_pdf("PURCHASE ORDER PO-2024-0042 Acme Components Total 12500.00 INR")
+
+
+def _guess_mime(path: Path) -> str:
+    import mimetypes
+
+    return mimetypes.guess_type(str(path))[0] or "application/octet-stream"
+
+
+async def run_analyze(http, payloads: Payloads) -> int:
+    response = await http.post("/analyze", files={"file": ("drawing.png", payloads.drawing, payloads.drawing_mime)})
+    return response.status_code
+
+
+async def run_analyze_stream(http, payloads: Payloads) -> int:
+    async with http.stream("POST", "/analyze/stream", files={"file": ("drawing.png", payloads.drawing, payloads.drawing_mime)}) as response:
+        async for _ in response.aiter_lines():
+            pass
+        return response.status_code
+
+
+async def run_compare(http, payloads: Payloads, single_pass: bool = False) -> int:
+    response = await http.post(
+        "/compare",
+        files={"rfq": ("rfq.docx", payloads.rfq, payloads.rfq_mime), "cad": ("drawing.png", payloads.drawing, payloads.drawing_mime)},
+        data={"part": "spark_plug", "single_pass": str(single_pass).lower()},
+    )
+    return response.status_code
+
+
+async def run_compare_single_pass(http, payloads: Payloads) -> int:
+    return await run_compare(http, payloads, single_pass=True)
+
+
+async def run_compare_vendor(http, payloads: Payloads) -> int:
+    files = [("files", (f"vendor_{i}.docx", data, DOCX_MIME)) for i, data in enumerate(payloads.vendor_rfqs)]
+    response = await http.post("/compare-vendor", files=files)
+    return response.status_code
+
+
+async def run_supply_chain(http, payloads: Payloads, timeout: float = 300.0) -> int:
+    """Upload one document and poll until the pipeline finishes (latency = upload to completion)."""
+    response = await http.post("/supply-chain/upload", files={"files": ("po.pdf", payloads.supply_chain_pdf, "application/pdf")})
+    if response.status_code != 200:
+        return response.status_code
+    document_id = response.json()["document_ids"][0]
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        status = await http.get(f"/supply-chain/status/{document_id}")
+        if status.status_code != 200:
+            return status.status_code
+        if status.json().get("status") in ("completed", "error", "approved", "rejected"):
+            return 200 if status.json().get("status") != "error" else 500
+        await asyncio.sleep(0.2)
+    return 504
+
+
+SCENARIOS: Dict[str, Callable] = {
+    "analyze": run_analyze,
+    "analyze-stream": run_analyze_stream,
+    "compare": run_compare,
+    "compare-single-pass": run_compare_single_pass,
+    "compare-vendor": run_compare_vendor,
+    "supply-chain": run_supply_chain,
+}
+
+
+# ----------------- Measurement -----------------
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+async def monitor_loop_lag(samples: List[float], stop: asyncio.Event, interval: float = 0.05) -> None:
+    """Measure how late the event loop wakes a sleeping task (in-process mode)."""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, time.perf_counter() - started - interval))
+
+
+async def monitor_health_probe(http, samples: List[float], stop: asyncio.Event, interval: float = 0.25) -> None:
+    """Measure /health latency as a proxy for server loop lag (remote mode)."""
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            await http.get("/health")
+        except Exception:
+            pass
+        samples.append(time.perf_counter() - started)
+        await asyncio.sleep(interval)
+
+
+async def run_endpoint(http, name: str, payloads: Payloads, requests: int, concurrency: int, remote: bool) -> Dict:
+    scenario = SCENARIOS[name]
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+
+    async def one() -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                code = await scenario(http, payloads)
+            except Exception as exc:
+                code = type(exc).__name__
+            latencies.append(time.perf_counter() - started)
+            statuses[str(code)] = statuses.get(str(code), 0) + 1
+
+    lag_samples: List[float] = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(
+        monitor_health_probe(http, lag_samples, stop) if remote else monitor_loop_lag(lag_samples, stop)
+    )
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await monitor
+
+    return {
+        "endpoint": name,
+        "requests": requests,
+        "errors": sum(count for code, count in statuses.items() if code != "200"),
+        "statuses": statuses,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(requests / elapsed, 3) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 1),
+            "p90": round(percentile(latencies, 90) * 1000, 1),
+            "p99": round(percentile(latencies, 99) * 1000, 1),
+            "max": round(max(latencies, default=0.0) * 1000, 1),
+            "mean": round(statistics.fmean(latencies) * 1000, 1) if latencies else 0.0,
+        },
+        "loop_lag_ms" if not remote else "health_probe_ms": {
+            "p50": round(percentile(lag_samples, 50) * 1000, 1),
+            "p99": round(percentile(lag_samples, 99) * 1000, 1),
+            "max": round(max(lag_samples, default=0.0) * 1000, 1),
+        },
+    }
+
+
+def print_report(results: List[Dict]) -> None:
+    lag_key = "loop_lag_ms" if results and "loop_lag_ms" in results[0] else "health_probe_ms"
+    # Wide enough for the longest endpoint name, plus a space before the numbers
+    width = max(len(name) for name in ("endpoint", *ENDPOINTS, *(result["endpoint"] for result in results))) + 1
+    header = f"{'endpoint':<{width}}{'reqs':>6}{'errs':>6}{'rps':>9}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'lag p99':>10}{'lag max':>10}"
+    print()
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        latency = result["latency_ms"]
+        lag = result[lag_key]
+        print(
+            f"{result['endpoint']:<{width}}{result['requests']:>6}{result['errors']:>6}{result['throughput_rps']:>9.2f}"
+            f"{latency['p50']:>10.1f}{latency['p90']:>10.1f}{latency['p99']:>10.1f}{latency['max']:>10.1f}"
+            f"{lag['p99']:>10.1f}{lag['max']:>10.1f}"
+        )
+    print()
+    if lag_key == "health_probe_ms":
+        print("lag columns: /health probe latency measured during the run")
+
+
+# ----------------- Main -----------------
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline load test for the Welding Inspector API")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument("--requests", type=int, default=20, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=10, help="concurrent requests per endpoint")
+    parser.add_argument("--url", help="target a running server instead of the in-process app")
+    parser.add_argument("--latency", default="lognormal:2,0.5", help="replay latency spec (see LatencyModel)")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--fault-429", type=float, default=0.0)
+    parser.add_argument("--fault-truncate", type=float, default=0.0)
+    parser.add_argument("--fault-malformed", type=float, default=0.0)
+    parser.add_argument("--max-concurrency", type=int, help="GEMINI_MAX_CONCURRENCY for the in-process app")
+    parser.add_argument("--with-cache", action="store_true", help="keep the Gemini response cache enabled")
+    parser.add_argument("--drawing", type=Path, help="drawing to upload instead of the synthetic PNG")
+    parser.add_argument("--rfq", type=Path, help="RFQ to upload instead of the synthetic DOCX")
+    parser.add_argument("--json", type=Path, help="also write results as JSON to this file")
+    return parser.parse_args(argv)
+
+
+def load_app(args: argparse.Namespace):
+    """Import api.py wired to the replay backend (with optional fault injection)."""
+    os.environ["GEMINI_BACKEND"] = "replay"
+    if not args.with_cache:
+        os.environ["GEMINI_CACHE_ENABLED"] = "0"
+    if args.max_concurrency:
+        os.environ["GEMINI_MAX_CONCURRENCY"] = str(args.max_concurrency)
+    os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "loadtest")
+    sys.path.insert(0, str(BACKEND_DIR))
+
+    import api
+
+    backend = api.ReplayBackend(
+        api.RecordingStore(api.GEMINI_RECORDINGS_DIR),
+        api.LatencyModel.parse(args.latency, seed=args.seed),
+        fallback=synthetic_response,
+    )
+    if args.fault_429 or args.fault_truncate or args.fault_malformed:
+        backend = api.inject_faults(
+            backend,
+            rate_429=args.fault_429,
+            rate_truncate=args.fault_truncate,
+            rate_malformed=args.fault_malformed,
+            seed=args.seed,
+        )
+    api.client.backend = backend
+    return api
+
+
+async def main_async(args: argparse.Namespace) -> List[Dict]:
+    import httpx
+
+    payloads = Payloads(args.drawing, args.rfq)
+    results: List[Dict] = []
+    timeout = httpx.Timeout(600.0)
+
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, timeout=timeout) as http:
+            for name in args.endpoints:
+                print(f"Running {name} ({args.requests} requests, concurrency {args.concurrency})...", flush=True)
+                results.append(await run_endpoint(http, name, payloads, args.requests, args.concurrency, remote=True))
+        return results
+
+    api = load_app(args)
+    transport = httpx.ASGITransport(app=api.app)
+    async with api.app.router.lifespan_context(api.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=timeout) as http:
+            for name in args.endpoints:
+                print(f"Running {name} ({args.requests} requests, concurrency {args.concurrency})...", flush=True)
+                results.append(await run_endpoint(http, name, payloads, args.requests, args.concurrency, remote=False))
+    if isinstance(api.client.backend, api.FaultInjectingBackend):
+        print(f"Injected faults: {api.client.backend.injected}")
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    results = asyncio.run(main_async(args))
+    print_report(results)
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2), encoding="utf-8")
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
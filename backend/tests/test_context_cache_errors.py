@@ -0,0 +1,38 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+api = pytest.importorskip("api")
+errors = pytest.importorskip("google.genai.errors")
+
+HANDLE = "projects/p/locations/us-central1/cachedContents/123"
+
+
+def _error(code, message):
+    return errors.APIError(code, {"error": {"message": message, "status": "INVALID_ARGUMENT"}})
+
+
+@pytest.mark.parametrize(
+    "code, message",
+    [
+        (400, "Cached content is expired or does not exist"),
+        (404, f"{HANDLE} not found"),
+        (403, "Permission denied on resource cached_content"),
+    ],
+)
+def test_errors_naming_the_cache_are_stale_cache_errors(code, message):
+    assert api.GeminiClient._is_context_cache_error(_error(code, message), HANDLE)
+
+
+@pytest.mark.parametrize(
+    "code, message",
+    [
+        (400, "Request contains an invalid argument"),
+        (404, "Publisher model not found"),
+        (500, "Cached content backend unavailable"),
+    ],
+)
+def test_other_request_errors_are_not_retried_inline(code, message):
+    assert not api.GeminiClient._is_context_cache_error(_error(code, message), HANDLE)
@@ -0,0 +1,59 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+api = pytest.importorskip("api")
+
+
+class ScriptedBackend(api.GeminiBackend):
+    name = "scripted"
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def generate(self, model, contents, config):
+        self.requests.append(contents)
+        return self.responses.pop(0)
+
+    async def agenerate(self, model, contents, config):
+        return self.generate(model, contents, config)
+
+    async def astream(self, model, contents, config):
+        yield self.generate(model, contents, config)
+
+
+def test_repeated_overlap_is_dropped():
+    previous = '{"welds": [{"Serial No": "W1", "Description": "flange to'
+    assert api.GeminiClient._stitch(previous, '"Description": "flange to pipe"}]}') == ' pipe"}]}'
+
+
+def test_short_overlap_is_kept():
+    # Below _MIN_OVERLAP a match is more likely chance than repetition
+    assert api.GeminiClient._stitch('{"a": "x", "b', '"b": 1}') == '"b": 1}'
+
+
+def test_markdown_fences_are_stripped():
+    assert api.GeminiClient._stitch('{"welds": [', '```json\n{"Serial No": "W2"}]}\n```') == '{"Serial No": "W2"}]}\n'
+
+
+def test_continuation_replays_request_and_partial_answer():
+    client = api.GeminiClient("project", "region", "gemini", backend=ScriptedBackend())
+    contents = client._continuation_contents(["prompt"], "partial")
+    assert [content.role for content in contents] == ["user", "model", "user"]
+    assert contents[0].parts[0].text == "prompt"
+    assert contents[1].parts[0].text == "partial"
+    assert contents[2].parts[0].text == api.GeminiClient._CONTINUE_PROMPT
+
+
+def test_truncated_output_is_continued_and_stitched():
+    backend = ScriptedBackend(
+        ('{"welds": [{"Serial No": "W1", "Description": "flange to', "MAX_TOKENS"),
+        ('"Description": "flange to pipe"}]}', "STOP"),
+    )
+    client = api.GeminiClient("project", "region", "gemini", backend=backend, max_continuations=2)
+    text = client.chat_with_files("prompt", [])
+    assert text == '{"welds": [{"Serial No": "W1", "Description": "flange to pipe"}]}'
+    assert len(backend.requests) == 2
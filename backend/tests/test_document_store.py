@@ -0,0 +1,86 @@
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+api = pytest.importorskip("api")
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return api.MemoryDocumentStore()
+    return api.SqliteDocumentStore(tmp_path / "documents.db")
+
+
+def test_concurrent_duplicates_are_all_counted(store, monkeypatch):
+    monkeypatch.setattr(api, "document_store", store)
+    store.create({"id": "DOC-1", "status": "completed", "created_at": "2025-01-01T00:00:00"})
+    # Every thread holds the same stale snapshot, as concurrent uploads would
+    snapshot = store.get("DOC-1")
+
+    def record():
+        for _ in range(25):
+            api._record_duplicate(snapshot)
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert store.get("DOC-1")["duplicate_count"] == 100
+
+
+def test_queued_erp_updates_are_found_by_status(store):
+    store.create({"id": "DOC-1", "status": "completed", "created_at": "2025-01-01T00:00:00", "erp_status": "queued"})
+    store.create({"id": "DOC-2", "status": "approved", "created_at": "2025-01-02T00:00:00"})
+    store.create({"id": "DOC-3", "status": "completed", "created_at": "2025-01-03T00:00:00"})
+    store.update("DOC-2", {"erp_status": "queued"})
+    store.update("DOC-3", {"erp_status": "synced"})
+
+    queued = store.find_by_erp_status("queued", ["status"])
+    assert queued == [{"id": "DOC-1", "status": "completed"}, {"id": "DOC-2", "status": "approved"}]
+    store.update("DOC-1", {"erp_status": "synced"})
+    assert [document["id"] for document in store.find_by_erp_status("queued")] == ["DOC-2"]
+
+
+def test_events_are_trimmed_with_document_retention_off(store, monkeypatch):
+    monkeypatch.setattr(api, "document_store", store)
+    monkeypatch.setattr(api, "SUPPLY_CHAIN_RETENTION_DAYS", 0)
+    monkeypatch.setattr(api, "SUPPLY_CHAIN_EVENT_TTL_SECONDS", 0)
+    monkeypatch.setattr(api, "_last_purge", 0.0)
+    monkeypatch.setattr(api, "_last_event_purge", 0.0)
+    store.create({"id": "DOC-1", "status": "uploaded", "created_at": "2000-01-01T00:00:00"})
+    store.update("DOC-1", {"status": "intake"}, event="status")
+
+    api.purge_expired_documents()
+    assert store.events_since(0) == []
+    assert store.get("DOC-1") is not None
+
+
+def test_failed_event_purge_does_not_block_document_purge(store, monkeypatch):
+    monkeypatch.setattr(api, "document_store", store)
+    monkeypatch.setattr(api, "SUPPLY_CHAIN_RETENTION_DAYS", 1)
+    monkeypatch.setattr(api, "_last_purge", 0.0)
+    monkeypatch.setattr(api, "_last_event_purge", 0.0)
+
+    def broken(older_than):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(store, "purge_events", broken)
+    store.create({"id": "DOC-1", "status": "uploaded", "created_at": "2000-01-01T00:00:00"})
+
+    api.purge_expired_documents()
+    assert store.get("DOC-1") is None
+
+
+def test_count_follows_creates_status_changes_and_purges(store):
+    assert store.count() == 0
+    store.create({"id": "DOC-1", "status": "uploaded", "created_at": "2000-01-01T00:00:00"})
+    store.create({"id": "DOC-2", "status": "uploaded", "created_at": "2025-01-01T00:00:00"})
+    store.update("DOC-2", {"status": "completed"})
+    assert store.count() == 2
+    assert store.purge("2020-01-01T00:00:00") == 1
+    assert store.count() == 1
@@ -0,0 +1,46 @@
+import io
+import sys
+import zipfile
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+api = pytest.importorskip("api")
+
+W = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+
+
+def _docx(body: str) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.writestr("word/document.xml", f"<w:document {W}><w:body>{body}</w:body></w:document>")
+    return buffer.getvalue()
+
+
+def _cell(text: str, props: str = "") -> str:
+    return f"<w:tc><w:tcPr>{props}</w:tcPr><w:p><w:r><w:t>{text}</w:t></w:r></w:p></w:tc>"
+
+
+def _row(*cells: str) -> str:
+    return "<w:tr>" + "".join(cells) + "</w:tr>"
+
+
+def test_equal_neighbouring_cells_are_kept():
+    table = "<w:tbl>" + _row(_cell("Nut M12"), _cell("5"), _cell("5"), _cell("25")) + "</w:tbl>"
+    assert api.extract_docx_text(_docx(table)) == "Nut M12 | 5 | 5 | 25"
+
+
+def test_merge_continuations_are_skipped():
+    table = "<w:tbl>" + _row(
+        _cell("Spec", '<w:hMerge w:val="restart"/>'),
+        _cell("Spec", "<w:hMerge/>"),
+        _cell("Grade", "<w:vMerge/>"),
+    ) + "</w:tbl>"
+    assert api.extract_docx_text(_docx(table)) == "Spec"
+
+
+def test_body_order_is_kept():
+    body = "<w:p><w:r><w:t>Before</w:t></w:r></w:p><w:tbl>" + _row(_cell("A"), _cell("B")) + "</w:tbl>"
+    body += "<w:p><w:r><w:t>After</w:t></w:r></w:p>"
+    assert api.extract_docx_text(_docx(body)) == "Before\nA | B\nAfter"
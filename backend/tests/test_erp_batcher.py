@@ -0,0 +1,136 @@
+import asyncio
+import json
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+api = pytest.importorskip("api")
+
+
+class RecordingSink(api.ErpSink):
+    name = "recording"
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.attempts = 0
+        self.batches = []
+
+    def write_batch(self, updates):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise ConnectionError("ERP unavailable")
+        self.batches.append([update["document_id"] for update in updates])
+
+
+@pytest.fixture
+def documents(monkeypatch):
+    store = api.MemoryDocumentStore()
+    monkeypatch.setattr(api, "document_store", store)
+    monkeypatch.setattr(api, "ERP_RETRY_BASE_SECONDS", 0)
+    for i in range(3):
+        store.create({
+            "id": f"DOC-{i}",
+            "status": "completed",
+            "created_at": f"2025-01-0{i + 1}T00:00:00",
+            "extracted_data": {"order_number": f"PO-{i}"},
+        })
+    return store
+
+
+async def _wait_for(condition, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def test_full_batch_is_written_without_waiting(documents, tmp_path):
+    sink = RecordingSink()
+    batcher = api.ErpUpdateBatcher(sink, batch_size=2, flush_seconds=60, dead_letter_path=tmp_path / "dead.jsonl")
+
+    async def run():
+        batcher.start()
+        for i in range(3):
+            batcher.enqueue(documents.get(f"DOC-{i}"), "completed")
+        await _wait_for(lambda: sink.batches)
+        pending = batcher.stats()["pending"]
+        await batcher.shutdown()
+        return pending
+
+    assert asyncio.run(run()) == 1
+    assert sink.batches == [["DOC-0", "DOC-1"], ["DOC-2"]]
+    assert documents.get("DOC-0")["erp_status"] == "synced"
+
+
+def test_partial_batch_is_written_when_the_window_closes(documents, tmp_path):
+    sink = RecordingSink()
+    batcher = api.ErpUpdateBatcher(sink, batch_size=10, flush_seconds=0.05, dead_letter_path=tmp_path / "dead.jsonl")
+
+    async def run():
+        batcher.start()
+        batcher.enqueue(documents.get("DOC-0"), "completed")
+        await _wait_for(lambda: sink.batches)
+        await batcher.shutdown()
+
+    asyncio.run(run())
+    assert sink.batches == [["DOC-0"]]
+
+
+def test_update_queued_twice_is_sent_once(documents, tmp_path):
+    sink = RecordingSink()
+    batcher = api.ErpUpdateBatcher(sink, dead_letter_path=tmp_path / "dead.jsonl")
+    first = batcher.enqueue(documents.get("DOC-0"), "completed")
+    assert batcher.enqueue(documents.get("DOC-0"), "completed") == first
+    asyncio.run(batcher._flush())
+    assert sink.batches == [["DOC-0"]]
+
+
+def test_failing_batch_is_retried_then_dead_lettered(documents, tmp_path):
+    sink = RecordingSink(failures=3)
+    dead_letter = tmp_path / "dead.jsonl"
+    batcher = api.ErpUpdateBatcher(sink, max_attempts=3, dead_letter_path=dead_letter)
+    batcher.enqueue(documents.get("DOC-0"), "completed")
+
+    asyncio.run(batcher._flush())
+    assert sink.attempts == 3
+    assert batcher.stats()["retries"] == 2
+    assert batcher.stats()["dead_lettered"] == 1
+    record = json.loads(dead_letter.read_text(encoding="utf-8"))
+    assert record["update"]["idempotency_key"] == api.erp_idempotency_key(documents.get("DOC-0"), "completed")
+    assert "ERP unavailable" in record["error"]
+    assert documents.get("DOC-0")["erp_status"] == "dead_letter"
+
+
+def test_batch_recovers_within_its_attempts(documents, tmp_path):
+    sink = RecordingSink(failures=1)
+    batcher = api.ErpUpdateBatcher(sink, max_attempts=3, dead_letter_path=tmp_path / "dead.jsonl")
+    batcher.enqueue(documents.get("DOC-0"), "completed")
+
+    asyncio.run(batcher._flush())
+    assert sink.batches == [["DOC-0"]]
+    assert not (tmp_path / "dead.jsonl").exists()
+    assert documents.get("DOC-0")["erp_status"] == "synced"
+
+
+def _update(document_id="DOC-0"):
+    return api.erp_payload({"id": document_id, "extracted_data": {"order_number": "PO-0"}}, "completed")
+
+
+def test_sqlite_sink_ignores_repeated_keys(tmp_path):
+    sink = api.SqliteErpSink(tmp_path / "erp.db")
+    sink.write_batch([_update()])
+    sink.write_batch([_update(), _update("DOC-1")])
+    with sqlite3.connect(str(tmp_path / "erp.db")) as conn:
+        keys = [row[0] for row in conn.execute("SELECT idempotency_key FROM erp_updates ORDER BY idempotency_key")]
+    assert keys == [_update()["idempotency_key"], _update("DOC-1")["idempotency_key"]]
+
+
+def test_jsonl_sink_ignores_repeated_keys_across_restarts(tmp_path):
+    path = tmp_path / "erp.jsonl"
+    api.JsonlErpSink(path).write_batch([_update()])
+    api.JsonlErpSink(path).write_batch([_update(), _update("DOC-1")])
+    lines = path.read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["document_id"] for line in lines] == ["DOC-0", "DOC-1"]
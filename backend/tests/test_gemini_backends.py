@@ -0,0 +1,46 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+api = pytest.importorskip("api")
+
+
+class EchoBackend(api.GeminiBackend):
+    name = "echo"
+
+    def generate(self, model, contents, config):
+        return "ok", "STOP"
+
+    async def agenerate(self, model, contents, config):
+        return "ok", "STOP"
+
+    async def astream(self, model, contents, config):
+        yield "ok", "STOP"
+
+
+class CachingEchoBackend(EchoBackend, api.ContextCacheBackend):
+    async def acreate_context_cache(self, model, prompt, ttl_seconds):
+        return {"name": "cachedContents/1", "expires_at": 0.0, "tokens": 0}
+
+    async def arefresh_context_cache(self, name, ttl_seconds):
+        return 0.0
+
+
+def test_incomplete_backends_cannot_be_built():
+    class Partial(api.ContextCacheBackend, EchoBackend):
+        pass
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_fault_injection_keeps_the_context_cache_capability():
+    assert isinstance(api.inject_faults(CachingEchoBackend(), rate_429=0.5), api.ContextCacheBackend)
+    assert not isinstance(api.inject_faults(EchoBackend(), rate_429=0.5), api.ContextCacheBackend)
+
+
+def test_prompts_go_inline_for_backends_without_context_cache():
+    manager = api.ContextCacheManager(enabled=True)
+    assert manager.lookup(EchoBackend(), "gemini", "prompt " * 10000) is None
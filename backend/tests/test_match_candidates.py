@@ -0,0 +1,63 @@
+import json
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+api = pytest.importorskip("api")
+
+
+def _document(doc_id, created_at, document_type, order_number, supplier="Acme Steel Pvt Ltd"):
+    return {
+        "id": doc_id,
+        "status": "uploaded",
+        "created_at": created_at,
+        "extracted_data": {"document_type": document_type, "order_number": order_number, "supplier": supplier},
+    }
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return api.MemoryDocumentStore()
+    return api.SqliteDocumentStore(tmp_path / "documents.db")
+
+
+def test_candidates_follow_order_and_supplier_keys(store):
+    store.create(_document("po", "2025-01-01T00:00:00", "PO", "PO # 4500-0123"))
+    store.create(_document("grn", "2025-01-02T00:00:00", "GRN", "po45000123"))
+    store.create(_document("other", "2025-01-03T00:00:00", "Invoice", "999", supplier="Other Ltd"))
+    store.create(_document("bol", "2025-01-04T00:00:00", "BoL", "45000123"))
+
+    ids = [record["id"] for record in store.find_match_candidates("45000123", None)]
+    assert ids == ["grn", "po"]
+    ids = [record["id"] for record in store.find_match_candidates(None, "acme steel")]
+    assert ids == ["grn", "po"]
+    assert store.find_match_candidates(None, None) == []
+
+    store.update("grn", {"extracted_data": {"document_type": "GRN", "order_number": "777"}})
+    assert [record["id"] for record in store.find_match_candidates("45000123", None)] == ["po"]
+    assert [record["id"] for record in store.find_match_candidates("777", None)] == ["grn"]
+
+
+def test_mirrored_columns_are_backfilled_on_old_databases(tmp_path):
+    path = tmp_path / "documents.db"
+    conn = sqlite3.connect(str(path))
+    conn.execute(
+        "CREATE TABLE documents (id TEXT PRIMARY KEY, status TEXT NOT NULL, stage INTEGER NOT NULL DEFAULT 0, "
+        "progress INTEGER NOT NULL DEFAULT 0, supplier TEXT, created_at TEXT NOT NULL, updated_at TEXT, "
+        "data TEXT NOT NULL)"
+    )
+    record = {**_document("po", "2025-01-01T00:00:00", "PO", "4500-0123"), "erp_status": "queued"}
+    conn.execute(
+        "INSERT INTO documents (id, status, created_at, data) VALUES (?, ?, ?, ?)",
+        ("po", "uploaded", record["created_at"], json.dumps(record)),
+    )
+    conn.commit()
+    conn.close()
+
+    store = api.SqliteDocumentStore(path)
+    assert [record["id"] for record in store.find_match_candidates("45000123", None)] == ["po"]
+    assert [record["id"] for record in store.find_by_erp_status("queued")] == ["po"]
@@ -0,0 +1,35 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+api = pytest.importorskip("api")
+
+
+def test_worker_survives_a_failed_error_status_write(monkeypatch):
+    async def failing_status(*args, **kwargs):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(api, "update_status", failing_status)
+    handled = []
+
+    async def intake(document):
+        if document.id == "DOC-1":
+            raise ValueError("bad document")
+        handled.append(document.id)
+
+    async def run():
+        pipeline = api.SupplyChainPipeline({"intake": intake}, workers={"intake": 1}, queue_size=4)
+        pipeline.start()
+        pipeline.submit(api.SupplyChainDocument("DOC-1", b"", "application/pdf"))
+        pipeline.submit(api.SupplyChainDocument("DOC-2", b"", "application/pdf"))
+        await asyncio.wait_for(pipeline._queues["intake"].join(), timeout=5)
+        stats = pipeline.stats()
+        await pipeline.shutdown()
+        return stats
+
+    stats = asyncio.run(run())
+    assert handled == ["DOC-2"]
+    assert stats["completed"] == 1
@@ -0,0 +1,92 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+api = pytest.importorskip("api")
+errors = pytest.importorskip("google.genai.errors")
+httpx = pytest.importorskip("httpx")
+
+
+def _throttled(retry_after=None):
+    headers = {"Retry-After": retry_after} if retry_after is not None else {}
+    response = httpx.Response(429, headers=headers)
+    return errors.APIError(429, {"error": {"message": "Resource exhausted", "status": "RESOURCE_EXHAUSTED"}}, response)
+
+
+def test_bucket_allows_a_burst_then_makes_callers_wait():
+    bucket = api.TokenBucket(rate=10, burst=2)
+    assert bucket._reserve() == 0.0
+    assert bucket._reserve() == 0.0
+    assert bucket._reserve() == pytest.approx(0.1, abs=0.01)
+
+
+def test_zero_rate_disables_the_bucket():
+    bucket = api.TokenBucket(rate=0, burst=1)
+    assert all(bucket._reserve() == 0.0 for _ in range(5))
+
+
+def test_limit_halves_on_throttle_once_per_burst_and_grows_back():
+    limiter = api.AdaptiveConcurrencyLimiter(max_limit=8, cooldown_seconds=60)
+    limiter.on_throttle()
+    limiter.on_throttle()
+    assert limiter.limit == 4
+    limiter.on_success()
+    assert limiter.limit == pytest.approx(4.25)
+
+
+def test_limit_never_drops_below_the_minimum():
+    limiter = api.AdaptiveConcurrencyLimiter(max_limit=4, min_limit=2, cooldown_seconds=0)
+    for _ in range(5):
+        limiter.on_throttle()
+    assert limiter.limit == 2
+
+
+def test_slots_respect_the_current_limit():
+    limiter = api.AdaptiveConcurrencyLimiter(max_limit=2)
+    peak = 0
+
+    async def call():
+        nonlocal peak
+        async with limiter.slot():
+            peak = max(peak, limiter.in_flight)
+            await asyncio.sleep(0.01)
+
+    async def run():
+        await asyncio.gather(*(call() for _ in range(6)))
+
+    asyncio.run(run())
+    assert peak == 2
+    assert limiter.in_flight == 0
+
+
+def test_429_lowers_the_concurrency_limit():
+    limiter = api.GeminiRateLimiter(rate=0, max_concurrency=8, max_retries=3)
+    assert limiter.on_failure(_throttled(), 0) is not None
+    assert limiter.concurrency.limit == 4
+    assert limiter.stats()["throttled"] == 1
+
+
+@pytest.mark.parametrize("header", ["7", "Thu, 01 Jan 2099 00:00:00 GMT"])
+def test_retry_after_sets_the_minimum_backoff(header):
+    limiter = api.GeminiRateLimiter(rate=0, base_delay=0.01, max_delay=10, max_retries=3)
+    assert limiter.backoff(0, _throttled(header)) >= 7
+    assert limiter.backoff(0, _throttled(header)) <= 40
+
+
+def test_exhausted_retries_surface_the_retry_after_hint():
+    limiter = api.GeminiRateLimiter(rate=0, max_retries=1, max_delay=30)
+    exc = _throttled("12")
+    assert limiter.on_failure(exc, 1) is None
+    error = limiter.exhausted_error(exc, 1)
+    assert isinstance(error, api.GeminiUnavailableError)
+    assert error.headers["Retry-After"] == "12"
+
+
+def test_client_errors_are_not_retried():
+    limiter = api.GeminiRateLimiter(rate=0, max_retries=3)
+    exc = errors.APIError(400, {"error": {"message": "bad request", "status": "INVALID_ARGUMENT"}})
+    assert limiter.on_failure(exc, 0) is None
+    assert limiter.exhausted_error(exc, 0) is exc
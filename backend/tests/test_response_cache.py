@@ -0,0 +1,85 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+api = pytest.importorskip("api")
+
+CONFIG = {"max_output_tokens": 16384, "temperature": 0}
+
+
+class ScriptedBackend(api.GeminiBackend):
+    name = "scripted"
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def generate(self, model, contents, config):
+        self.calls += 1
+        return self.responses.pop(0)
+
+    async def agenerate(self, model, contents, config):
+        return self.generate(model, contents, config)
+
+    async def astream(self, model, contents, config):
+        yield self.generate(model, contents, config)
+
+
+def _client(tmp_path, *responses):
+    cache = api.ResponseCache(tmp_path / "cache")
+    backend = ScriptedBackend(*responses)
+    return api.GeminiClient("project", "region", "gemini", cache=cache, backend=backend, max_continuations=0), backend
+
+
+def test_key_is_stable_and_ignores_config_order():
+    files = [(b"%PDF-1.4 drawing", "application/pdf")]
+    key = api.ResponseCache.make_key("gemini", CONFIG, "prompt", files)
+    assert key == api.ResponseCache.make_key("gemini", dict(reversed(list(CONFIG.items()))), "prompt", files)
+    assert key != api.ResponseCache.make_key("gemini", CONFIG, "other prompt", files)
+
+
+def test_key_changes_with_file_bytes_or_mime_type():
+    key = api.ResponseCache.make_key("gemini", CONFIG, "prompt", [(b"drawing", "application/pdf")])
+    assert key != api.ResponseCache.make_key("gemini", CONFIG, "prompt", [(b"drawing v2", "application/pdf")])
+    assert key != api.ResponseCache.make_key("gemini", CONFIG, "prompt", [(b"drawing", "image/png")])
+
+
+def test_file_handle_and_raw_bytes_share_a_key():
+    data = b"%PDF-1.4 drawing"
+    handle = api.FileHandleRegistry().get_or_create(data, "application/pdf")
+    assert api.ResponseCache.make_key("gemini", CONFIG, "prompt", [(handle, None)]) == api.ResponseCache.make_key(
+        "gemini", CONFIG, "prompt", [(data, "application/pdf")]
+    )
+
+
+def test_entries_expire_in_memory_and_on_disk(tmp_path):
+    cache = api.ResponseCache(tmp_path, ttl_seconds=-1)
+    cache.set("a" * 64, "answer")
+    assert cache.get("a" * 64) is None
+    assert api.ResponseCache(tmp_path).get("a" * 64) is None
+
+
+def test_disk_tier_survives_a_restart(tmp_path):
+    api.ResponseCache(tmp_path).set("b" * 64, "answer")
+    cache = api.ResponseCache(tmp_path)
+    assert cache.get("b" * 64) == "answer"
+    assert cache.stats()["disk_hits"] == 1
+
+
+def test_complete_responses_are_served_from_cache(tmp_path):
+    client, backend = _client(tmp_path, ("answer", "STOP"))
+    files = [(b"drawing", "application/pdf")]
+    assert client.chat_with_files("prompt", files) == "answer"
+    assert client.chat_with_files("prompt", files) == "answer"
+    assert backend.calls == 1
+
+
+@pytest.mark.parametrize("response", [("partial", "MAX_TOKENS"), ("", "STOP")])
+def test_truncated_and_empty_responses_are_not_cached(tmp_path, response):
+    client, backend = _client(tmp_path, response, ("answer", "STOP"))
+    files = [(b"drawing", "application/pdf")]
+    client.chat_with_files("prompt", files)
+    assert client.chat_with_files("prompt", files) == "answer"
+    assert backend.calls == 2
@@ -0,0 +1,37 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+api = pytest.importorskip("api")
+
+
+PURCHASE_ORDER = """PURCHASE ORDER
+PO Number: PO-4500123
+Order Date: 2025-03-12
+Supplier: Acme Steel Pvt Ltd
+Invoice To: Logistics Ltd, Accounts Payable
+MS Plate 10mm | 10 | 1,250.00 | 12,500.00
+Bolt M12 x 50 | 200 | 12.5 | 2,500.00
+Grand Total: INR 15,000.00
+"""
+
+
+def test_title_keyword_wins_over_later_mentions():
+    assert api.keyword_document_types(PURCHASE_ORDER) == ["PO", "Invoice"]
+
+
+def test_ambiguous_type_is_left_to_the_model():
+    fields, complete = api.parse_document_text(PURCHASE_ORDER)
+    assert fields["document_type"] == "PO"
+    assert not complete
+
+
+def test_unambiguous_document_skips_the_model():
+    text = PURCHASE_ORDER.replace("Invoice To: Logistics Ltd, Accounts Payable\n", "")
+    fields, complete = api.parse_document_text(text)
+    assert complete
+    assert fields["document_type"] == "PO"
+    assert fields["order_number"] == "PO-4500123"
+    assert len(fields["line_items"]) == 2
@@ -0,0 +1,89 @@
+import asyncio
+import hashlib
+import io
+import sys
+import zipfile
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+api = pytest.importorskip("api")
+fastapi = pytest.importorskip("fastapi")
+from starlette.datastructures import Headers, UploadFile  # noqa: E402
+
+PDF = b"%PDF-1.4\n" + b"0" * 100
+
+
+def _docx(entries):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name in entries:
+            archive.writestr(name, "<w:document/>")
+    return buffer.getvalue()
+
+
+def _read(data, allowed=api.DRAWING_UPLOAD_TYPES, content_type="application/pdf", size=None, **kwargs):
+    upload = UploadFile(
+        io.BytesIO(data),
+        size=size,
+        filename="upload.bin",
+        headers=Headers({"content-type": content_type}),
+    )
+    return asyncio.run(api.read_upload(upload, allowed, "File", "Unsupported file type", **kwargs))
+
+
+@pytest.mark.parametrize(
+    "head, mime",
+    [
+        (b"%PDF-1.7", "application/pdf"),
+        (b"\x89PNG\r\n\x1a\n", "image/png"),
+        (b"\xff\xd8\xff\xe0", "image/jpeg"),
+        (b"RIFF\x00\x00\x00\x00WEBPVP8 ", "image/webp"),
+        (b"PK\x03\x04", api.DOCX_MIME),
+        (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "application/msword"),
+        (b"GIF89a", None),
+        (b"", None),
+    ],
+)
+def test_mime_type_comes_from_magic_bytes(head, mime):
+    assert api.sniff_mime_type(head) == mime
+
+
+def test_upload_is_sniffed_and_hashed():
+    upload = _read(PDF, content_type="image/png")
+    assert upload.mime_type == "application/pdf"
+    assert upload.data == PDF
+    assert upload.size == len(PDF)
+    assert upload.sha256 == hashlib.sha256(PDF).hexdigest()
+
+
+def test_disallowed_type_is_rejected_despite_declared_content_type():
+    with pytest.raises(fastapi.HTTPException) as exc_info:
+        _read(b"GIF89a" + b"0" * 100, content_type="application/pdf")
+    assert exc_info.value.detail == "Unsupported file type"
+
+
+def test_oversized_upload_is_rejected_while_streaming(monkeypatch):
+    monkeypatch.setattr(api, "UPLOAD_CHUNK_BYTES", 16)
+    with pytest.raises(fastapi.HTTPException) as exc_info:
+        _read(PDF, max_bytes=64)
+    assert exc_info.value.status_code == 400
+    assert "exceeds" in exc_info.value.detail
+    assert _read(PDF, max_bytes=len(PDF)).size == len(PDF)
+
+
+def test_declared_size_over_the_cap_is_rejected_before_reading():
+    with pytest.raises(fastapi.HTTPException, match="exceeds"):
+        _read(PDF, size=10 * 1024 * 1024, max_bytes=1024)
+
+
+def test_empty_upload_is_rejected():
+    with pytest.raises(fastapi.HTTPException, match="empty"):
+        _read(b"")
+
+
+def test_zip_without_a_word_document_is_not_docx():
+    assert _read(_docx(["word/document.xml"]), api.DOCUMENT_UPLOAD_TYPES).mime_type == api.DOCX_MIME
+    with pytest.raises(fastapi.HTTPException):
+        _read(_docx(["payload.txt"]), api.DOCUMENT_UPLOAD_TYPES)
@@ -0,0 +1,104 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+api = pytest.importorskip("api")
+
+VENDORS = [
+    {"vendor_name": "Acme", "pricing": {"unit_price_inr": "₹1,200"}, "delivery": {"initial_days": 30}, "warranty": "12 months"},
+    {"vendor_name": "Bolt", "pricing": {"unit_price_inr": 1000}, "delivery": {"initial_days": 45}, "warranty": "2 years"},
+    {"vendor_name": "Crest", "pricing": {"unit_price_inr": 1100}, "delivery": {"initial_days": 10}, "warranty": None},
+]
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_store(request, tmp_path):
+    def make(**kwargs):
+        if request.param == "memory":
+            return api.MemoryVendorComparisonStore(**kwargs)
+        return api.SqliteVendorComparisonStore(tmp_path / "vendor_comparisons.db", **kwargs)
+
+    return make
+
+
+def test_stored_vendors_round_trip(make_store):
+    store = make_store()
+    comparison_id = store.put({"vendors": VENDORS, "ranking": []})
+    assert store.get(comparison_id) == {"vendors": VENDORS}
+    assert store.get("missing") is None
+
+
+def test_expired_comparisons_are_gone(make_store):
+    store = make_store(ttl_seconds=-1)
+    assert store.get(store.put({"vendors": VENDORS})) is None
+
+
+def test_least_recently_used_comparison_is_evicted(make_store):
+    store = make_store(max_entries=2)
+    first = store.put({"vendors": VENDORS})
+    second = store.put({"vendors": VENDORS})
+    assert store.get(first) is not None
+    third = store.put({"vendors": VENDORS})
+    assert store.get(second) is None
+    assert store.get(first) is not None and store.get(third) is not None
+
+
+def test_unusable_database_falls_back_to_memory(monkeypatch, tmp_path):
+    blocker = tmp_path / "not-a-dir"
+    blocker.write_text("")
+    monkeypatch.setattr(api, "VENDOR_COMPARISON_DB_PATH", blocker / "vendor_comparisons.db")
+    assert isinstance(api.create_vendor_comparison_store(), api.MemoryVendorComparisonStore)
+
+
+def test_vendors_are_ranked_by_weighted_score():
+    weights = api.normalize_score_weights({"price": 1.0})
+    ranking, comparison = api.rank_vendors(VENDORS, weights)
+    assert [row["vendor_name"] for row in ranking] == ["Bolt", "Crest", "Acme"]
+    assert [row["rank"] for row in ranking] == [1, 2, 3]
+    assert comparison["best_price_vendor"] == "Bolt"
+    assert comparison["best_delivery_vendor"] == "Crest"
+    assert comparison["best_warranty_vendor"] == "Bolt"
+
+
+def test_changing_priorities_reorders_the_ranking():
+    frame = api.score_vendors(VENDORS, api.normalize_score_weights({"delivery": 1.0}))
+    assert list(frame["vendor_name"]) == ["Crest", "Acme", "Bolt"]
+    frame = api.score_vendors(VENDORS, api.normalize_score_weights({"warranty": 1.0}))
+    # Acme's shortest warranty and Crest's missing one both score 0; the lower price wins the tie
+    assert list(frame["vendor_name"]) == ["Bolt", "Crest", "Acme"]
+
+
+def test_missing_values_score_zero_and_ties_score_one():
+    vendors = [
+        {"vendor_name": "A", "pricing": {"unit_price_inr": 500}},
+        {"vendor_name": "B", "pricing": {"unit_price_inr": 500}, "delivery": {"initial_days": 7}},
+    ]
+    frame = api.score_vendors(vendors, api.normalize_score_weights({"price": 1, "delivery": 1})).set_index("vendor_name")
+    assert frame.loc["A", "price_score"] == frame.loc["B", "price_score"] == 1.0
+    assert frame.loc["A", "delivery_score"] == 0.0
+    assert list(frame.index) == ["B", "A"]
+
+
+def test_weights_are_normalized_to_one():
+    assert api.normalize_score_weights({"price": 2, "delivery": 1, "warranty": 1}) == {
+        "price": 0.5,
+        "delivery": 0.25,
+        "warranty": 0.25,
+    }
+    assert api.parse_score_weights("Price=3, warranty=1") == {"price": 0.75, "delivery": 0.0, "warranty": 0.25}
+
+
+@pytest.mark.parametrize(
+    "weights, message",
+    [
+        ({"price": 1, "colour": 1}, "Unknown scoring criteria: colour"),
+        ({"price": -1, "delivery": 2}, "non-negative"),
+        ({"price": float("inf")}, "finite"),
+        ({"price": 0, "delivery": 0}, "At least one weight must be positive"),
+    ],
+)
+def test_invalid_weights_are_rejected(weights, message):
+    with pytest.raises(ValueError, match=message):
+        api.normalize_score_weights(weights)
@@ -0,0 +1,49 @@
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+api = pytest.importorskip("api")
+
+REPORT = json.dumps(
+    {
+        "drawing": "D-100",
+        "welds": [
+            {"Serial No": "W1", "Welding Type": "fillet {6mm}", "Welding Value": "6"},
+            {"Serial No": "W2", "Welding Type": 'butt "full pen"', "Welding Value": "10"},
+            {"Serial No": "W3", "Welding Type": "plug ]", "Welding Value": "3"},
+        ],
+        "explanations": "Three welds.",
+    }
+)
+
+
+def _chunks(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, 64, len(REPORT)])
+def test_welds_survive_any_chunking(size):
+    parser = api.IncrementalWeldParser()
+    emitted = []
+    for chunk in _chunks(REPORT, size):
+        emitted.extend(parser.feed(chunk))
+    assert [weld["Serial No"] for weld in emitted] == ["W1", "W2", "W3"]
+    assert emitted[1]["Welding Type"] == 'butt "full pen"'
+    assert parser.welds == emitted
+    assert parser.text == REPORT
+
+
+def test_each_weld_is_emitted_when_its_brace_closes():
+    parser = api.IncrementalWeldParser()
+    first_close = REPORT.index('"6"}') + 4
+    assert parser.feed(REPORT[:first_close - 1]) == []
+    assert [weld["Serial No"] for weld in parser.feed(REPORT[first_close - 1:first_close])] == ["W1"]
+
+
+def test_malformed_weld_is_skipped_and_parsing_continues():
+    parser = api.IncrementalWeldParser()
+    emitted = parser.feed('{"welds": [{"Serial No": "W1", oops}, {"Serial No": "W2"}]}')
+    assert [weld["Serial No"] for weld in emitted] == ["W2"]
@@ -12,6 +12,7 @@ import {
   getAllDocuments,
   getDocumentStatus,
   pollDocumentStatus,
+  watchBatchStatus,
   approveDocument,
   rejectDocument,
   type DocumentStatus as APIDocumentStatus,
@@ -64,7 +65,9 @@ const convertAPIDocumentToUI = (apiDoc: APIDocumentStatus): Document => {
     type: (extracted?.document_type as DocumentType) || "PO",
     supplier: extracted?.supplier || "Unknown",
     status: statusMap[apiDoc.status] || "In Review",
-    matchStatus: apiDoc.status === "completed" ? "Matched" : apiDoc.status === "error" ? "Failed" : "Partial",
+    matchStatus: apiDoc.match
+      ? apiDoc.match.status === "match" ? "Matched" : apiDoc.match.status === "exception" ? "Failed" : "Partial"
+      : apiDoc.status === "completed" ? "Matched" : apiDoc.status === "error" ? "Failed" : "Partial",
     confidence: extracted?.confidence === "high" ? 95 : extracted?.confidence === "medium" ? 75 : 50,
     lastUpdated: apiDoc.updated_at || apiDoc.created_at,
     orderValue: extracted?.total_amount ? extracted.total_amount * 100000 : undefined,
@@ -258,6 +261,7 @@ export default function SupplyChainDocumentAutomationPage() {
 
   // Store uploaded document IDs for step-by-step processing
   const [uploadedDocumentIds, setUploadedDocumentIds] = useState<string[]>([]);
+  const [uploadedBatchId, setUploadedBatchId] = useState<string | null>(null);
   const [isProcessingStage, setIsProcessingStage] = useState(false);
   const [processedStages, setProcessedStages] = useState<Set<number>>(new Set());
 
@@ -271,6 +275,7 @@ export default function SupplyChainDocumentAutomationPage() {
       
       // Store document IDs for step-by-step processing
       setUploadedDocumentIds(response.document_ids);
+      setUploadedBatchId(response.batch_id ?? null);
       
       // Stage 1 (Intake) is complete when files are uploaded
       // Move to wizard mode and stage 2, but don't process yet
@@ -294,38 +299,45 @@ export default function SupplyChainDocumentAutomationPage() {
     setIsProcessingStage(true);
     
     try {
-      // Poll all documents until current stage completes
-      const stagePromises = uploadedDocumentIds.map(docId => 
-        pollDocumentStatus(
-          docId,
-          (status) => {
-            // Update document in state
-            const uiDoc = convertAPIDocumentToUI(status);
-            setApiDocuments(prev => {
-              const index = prev.findIndex(d => d.id === docId);
-              if (index >= 0) {
-                const updated = [...prev];
-                updated[index] = status;
-                return updated;
-              }
-              return [...prev, status];
-            });
-            setDocuments(prev => {
-              const index = prev.findIndex(d => d.id === docId);
-              if (index >= 0) {
-                const updated = [...prev];
-                updated[index] = uiDoc;
-                return updated;
-              }
-              return [...prev, uiDoc];
-            });
-          },
-          2000, // Poll every 2 seconds
-          120 // Max 4 minutes
-        )
-      );
-      
-      await Promise.all(stagePromises);
+      const handleUpdate = (status: APIDocumentStatus) => {
+        // Update document in state
+        const docId = status.id;
+        const uiDoc = convertAPIDocumentToUI(status);
+        setApiDocuments(prev => {
+          const index = prev.findIndex(d => d.id === docId);
+          if (index >= 0) {
+            const updated = [...prev];
+            updated[index] = status;
+            return updated;
+          }
+          return [...prev, status];
+        });
+        setDocuments(prev => {
+          const index = prev.findIndex(d => d.id === docId);
+          if (index >= 0) {
+            const updated = [...prev];
+            updated[index] = uiDoc;
+            return updated;
+          }
+          return [...prev, uiDoc];
+        });
+      };
+
+      // One event stream for the whole batch; per-document polling if the upload had no batch id
+      if (uploadedBatchId) {
+        await watchBatchStatus(uploadedBatchId, uploadedDocumentIds, handleUpdate);
+      } else {
+        await Promise.all(
+          uploadedDocumentIds.map(docId =>
+            pollDocumentStatus(
+              docId,
+              handleUpdate,
+              2000, // Poll every 2 seconds
+              120 // Max 4 minutes
+            )
+          )
+        );
+      }
       
       // Mark current stage as processed
       setProcessedStages(prev => new Set(prev).add(activeStage));
@@ -346,6 +358,7 @@ export default function SupplyChainDocumentAutomationPage() {
     setActiveStage(1);
     setUploadedFiles([]);
     setUploadedDocumentIds([]);
+    setUploadedBatchId(null);
     setProcessedStages(new Set());
     setSearchQuery("");
     setSelectedDocTypes([]);
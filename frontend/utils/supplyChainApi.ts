@@ -30,12 +30,34 @@ export interface DocumentStatus {
     }>;
     confidence?: string;
   };
+  extraction_method?: "text-rules" | "text-model" | "multimodal";
+  erp_status?: "queued" | "synced" | "dead_letter";
+  erp_synced_at?: string;
+  classification?: {
+    type: string | null;
+    confidence: number;
+    routed: boolean;
+  };
+  match?: {
+    status: "match" | "partial" | "exception";
+    order_number?: string | null;
+    documents: Record<string, string>;
+    missing: string[];
+    matched_at: string;
+  };
   error?: string;
 }
 
 export interface UploadResponse {
   success: boolean;
   document_ids: string[];
+  duplicates?: Array<{
+    filename: string;
+    document_id: string;
+    duplicate_of: string;
+  }>;
+  batch_id?: string;
+  events_url?: string;
   message: string;
 }
 
@@ -45,6 +67,7 @@ export interface DocumentsResponse {
   total: number;
   limit: number;
   offset: number;
+  next_cursor?: string | null;
 }
 
 /**
@@ -109,16 +132,23 @@ export async function getDocumentStatus(documentId: string): Promise<DocumentSta
 
 /**
  * Get all documents with optional filtering
+ *
+ * Pass the previous response's `next_cursor` as `cursor` to fetch the next page;
+ * `fields` limits each returned record to those keys (plus `id`).
  */
 export async function getAllDocuments(
   status?: string,
   limit: number = 50,
-  offset: number = 0
+  offset: number = 0,
+  cursor?: string,
+  fields?: string[]
 ): Promise<DocumentsResponse> {
   const params = new URLSearchParams();
   if (status) params.append("status", status);
   params.append("limit", limit.toString());
   params.append("offset", offset.toString());
+  if (cursor) params.append("cursor", cursor);
+  if (fields && fields.length > 0) params.append("fields", fields.join(","));
 
   try {
     const response = await fetch(getApiUrl(`supply-chain/documents?${params.toString()}`));
@@ -190,6 +220,79 @@ export async function rejectDocument(documentId: string, reason?: string): Promi
   return result.document;
 }
 
+const TERMINAL_STATUSES = ["completed", "error", "approved", "rejected"];
+
+/**
+ * Follow a batch of documents over one server-sent event stream until every
+ * document has finished (or `timeout` ms pass). Falls back to polling each
+ * document when EventSource is unavailable or the stream fails.
+ */
+export async function watchBatchStatus(
+  batchId: string,
+  documentIds: string[],
+  onUpdate: (status: DocumentStatus) => void,
+  timeout: number = 240000
+): Promise<DocumentStatus[]> {
+  const pollAll = () =>
+    Promise.all(documentIds.map((docId) => pollDocumentStatus(docId, onUpdate, 2000, Math.ceil(timeout / 2000))));
+
+  if (typeof window === "undefined" || typeof EventSource === "undefined") {
+    return pollAll();
+  }
+
+  return new Promise((resolve, reject) => {
+    const latest = new Map<string, DocumentStatus>();
+    const source = new EventSource(getApiUrl(`supply-chain/events?batch_id=${encodeURIComponent(batchId)}`));
+    let settled = false;
+
+    const finish = (fn: () => void) => {
+      if (settled) return;
+      settled = true;
+      clearTimeout(timer);
+      source.close();
+      fn();
+    };
+
+    const timer = setTimeout(
+      () => finish(() => reject(new Error("Watch timeout: Document processing took too long"))),
+      timeout
+    );
+
+    const handleStatus = (status: DocumentStatus) => {
+      if (settled) return;
+      latest.set(status.id, status);
+      onUpdate(status);
+      const done = documentIds.every((docId) => {
+        const doc = latest.get(docId);
+        return doc !== undefined && TERMINAL_STATUSES.includes(doc.status);
+      });
+      if (done) {
+        finish(() => resolve(documentIds.map((docId) => latest.get(docId) as DocumentStatus)));
+      }
+    };
+
+    const handle = (event: MessageEvent) => handleStatus(JSON.parse(event.data) as DocumentStatus);
+    ["status", "extracted_data", "match", "erp", "error"].forEach((type) => source.addEventListener(type, handle as EventListener));
+
+    // Duplicate uploads can be linked to documents from an earlier batch, which this stream
+    // never reports; read each document once so already-finished ones count as done
+    documentIds.forEach((docId) => {
+      getDocumentStatus(docId)
+        .then((status) => {
+          // A streamed event may already be newer than this snapshot
+          if (!latest.has(status.id)) handleStatus(status);
+        })
+        .catch(() => undefined);
+    });
+    source.onerror = () => {
+      // EventSource reconnects on its own with Last-Event-ID; only give up if it has closed
+      if (source.readyState === EventSource.CLOSED) {
+        finish(() => pollAll().then(resolve, reject));
+      }
+    };
+  });
+}
+
 /**
  * Poll document status until completion or error
  */
@@ -205,7 +308,7 @@ export async function pollDocumentStatus(
     const status = await getDocumentStatus(documentId);
     onUpdate(status);
 
-    if (status.status === "completed" || status.status === "error" || status.status === "approved" || status.status === "rejected") {
+    if (TERMINAL_STATUSES.includes(status.status)) {
       return status;
     }
 